@@ -1,14 +1,22 @@
 import argparse
 import datetime
-import gzip
 import json
 import os
 import re
-import subprocess
+import sys
 import time
 
 from str_analysis.utils.file_utils import file_exists
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from annotation_source_cache import DEFAULT_ANNOTATION_CACHE_DIR
+from catalog_io import CatalogWriter, iterate_catalog_records
+from download_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_CONCURRENT_DOWNLOADS, DownloadCache
+from profiling import PROFILE_FORMATS
+from step_cache import StepCache
+from step_scheduler import Step, StepGraph, StepScheduler
+from step_telemetry import StepTelemetry, run_shell_command
+
 # install str-analysis python package
 os.system("""
 if ! python3 -m pip show str-analysis &> /dev/null
@@ -17,20 +25,85 @@ then
 fi
 """)
 
-
-def run(command, step_number=None):
+step_graph = StepGraph()
+
+def run(command, step_number=None, inputs=(), outputs=(), cpus=1, memory_gb=2, function=None):
+	"""Run a command. Commands that have a step number are added to the step graph and only run when
+	run_pending_steps() is called, so that steps which don't depend on each other can run in parallel.
+
+	Args:
+		command (str): shell command
+		step_number (int): pipeline step number
+		inputs (list): files read by the command. Used to determine which steps this step depends on.
+		outputs (list): files written, moved or deleted by the command.
+		cpus (int): number of CPUs used by the command
+		memory_gb (float): peak memory used by the command
+		function (callable): python function to call instead of running the command in a shell
+	"""
 	command = re.sub("[ \\t]{2,}", "  ", command)  # remove extra spaces
+	if step_number is not None:
+		if args.profile:
+			command = add_profiling_options(command, step_number, outputs)
+		step_graph.add_step(Step(command, step_number=step_number, inputs=inputs, outputs=outputs, cpus=cpus,
+								 memory_gb=memory_gb, function=function))
+		return
+
 	if not args.dry_run or command.startswith("mkdir"):
-		if step_number is None or (
-		   	not (args.only_step is not None and step_number != args.only_step) and
-			not (args.start_with_step is not None and step_number < args.start_with_step) and
-			not (args.end_with_step is not None and step_number > args.end_with_step)
-		):
-			if step_number is not None:
-				print(f"STEP #{step_number}: {command}")
-			else:
-				print(command)
-			subprocess.run(command, shell=True, check=True)
+		print(command)
+		start_time = time.time()
+		usage = run_shell_command(command)
+		telemetry.add_record(Step(command), "completed", usage=usage, start_time=start_time)
+
+def add_profiling_options(command, step_number, outputs=()):
+	"""Add the --profile-output option to each script from the scripts/ directory that the command runs, so that the
+	results are written to the profiles directory (see scripts/profiling.py). The profile names include the step's
+	first output, since steps that run on different shards have the same step number."""
+	script_counter = 0
+	def add_profile_output(match):
+		nonlocal script_counter
+		script_counter += 1
+		profile_name = f"step{step_number}.{os.path.basename(match.group(0)).replace('.py', '')}"
+		if outputs:
+			profile_name += f".{os.path.basename(outputs[0])}"
+		if script_counter > 1:
+			profile_name += f".{script_counter}"
+		return f"{match.group(0)} --profile-output {os.path.join(profiles_dir, profile_name)} " \
+			   f"--profile-format {args.profile_format}"
+
+	return re.sub(r"\S*scripts/[A-Za-z0-9_]+\.py", add_profile_output, command)
+
+def should_run_step(step):
+	return not (
+		(args.only_step is not None and step.step_number != args.only_step) or
+		(args.start_with_step is not None and step.step_number < args.start_with_step) or
+		(args.end_with_step is not None and step.step_number > args.end_with_step)
+	)
+
+def run_pending_steps():
+	"""Run all steps that have been added to the step graph so far, and then clear the graph"""
+	scheduler = StepScheduler(
+		max_parallel_steps=args.max_parallel_steps,
+		total_cpus=args.cpus,
+		total_memory_gb=args.memory_gb,
+		dry_run=args.dry_run,
+		step_cache=None if args.no_step_cache or args.dry_run else StepCache(args.step_cache_dir),
+		telemetry=telemetry)
+	try:
+		scheduler.run(step_graph, should_run_step=should_run_step)
+	finally:
+		if not args.dry_run:
+			telemetry.write_report(telemetry_report_prefix)
+	step_graph.clear()
+
+def find_previous_telemetry_report():
+	"""Returns the path of the most recent telemetry report from a previous run in the same base directory"""
+	previous_reports = []
+	for results_dir in os.listdir(base_dir):
+		path = os.path.join(base_dir, results_dir, "build_telemetry.json")
+		if results_dir.startswith("results__") and os.path.isfile(path) and path != f"{telemetry_report_prefix}.json":
+			previous_reports.append((os.path.getmtime(path), path))
+
+	return max(previous_reports)[1] if previous_reports else None
 
 def chdir(d):
 	print(f"cd {d}")
@@ -57,11 +130,73 @@ parser.add_argument("--variation-clusters-output-prefix", default="variation_clu
 parser.add_argument("--timestamp", default=datetime.datetime.now().strftime('%Y-%m-%d'),
 					help="Timestamp to use in the output directory name")
 parser.add_argument("--dry-run", action="store_true", help="Print commands without running them")
+parser.add_argument("--max-parallel-steps", type=int, default=os.cpu_count(),
+					help="Maximum number of steps to run at the same time. Steps only run in parallel when they don't "
+						 "depend on each other's outputs.")
+parser.add_argument("--cpus", type=int, default=os.cpu_count(),
+					help="Number of CPUs available for running steps in parallel")
+parser.add_argument("--step-cache-dir", help="Directory for storing manifests of completed steps. Steps whose "
+					"command, input files, and script versions match a previously completed step are skipped. "
+					"Defaults to a .step_cache subdirectory of the output directory.")
+parser.add_argument("--no-step-cache", action="store_true", help="Rerun all steps, even if they were already completed "
+					"with the same inputs")
+parser.add_argument("--count-output-records", action="store_true", help="Count the number of records in the output "
+					"files of each step and include these counts in the telemetry report")
+parser.add_argument("--previous-telemetry-report", help="Path of a build_telemetry.json report from a previous run to "
+					"compare against. Defaults to the most recent report in another results__ directory.")
+parser.add_argument("--memory-gb", type=float, help="Amount of memory (in GB) available for running steps in parallel. "
+					"Defaults to the total physical memory of this machine.")
+parser.add_argument("--intermediate-format", choices=["json", "arrow"], default="json", help="Format of the "
+					"annotated catalog that is read by the TSV export, validation and isolated TR steps. 'arrow' converts "
+					"it once to a memory-mapped columnar file instead of having each of these steps parse the JSON.")
+parser.add_argument("--shard-by-chromosome", action="store_true", help="Split the merged catalog into shards with "
+					"similar numbers of loci and run the annotation and format conversion steps on each shard in parallel")
+parser.add_argument("--num-shards", type=int, default=os.cpu_count(), help="Maximum number of shards to create when "
+					"--shard-by-chromosome is used")
+parser.add_argument("--min-gap-between-shards", type=int, default=10_000, help="When --shard-by-chromosome is used, "
+					"only split a chromosome between two loci if the gap between them is at least this many base pairs, "
+					"so that adjacent loci end up in the same shard")
+parser.add_argument("--download-cache-dir", default=DEFAULT_CACHE_DIR, help="Directory for caching downloaded source "
+					"and comparison catalogs. Files in this cache that are unchanged are not downloaded again.")
+parser.add_argument("--download-mirror-dir", help="Local directory that contains copies of the source and comparison "
+					"catalogs and of the allele frequency tables used in step 9. If specified, files are copied from here "
+					"instead of being downloaded, for offline runs.")
+parser.add_argument("--max-concurrent-downloads", type=int, default=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+					help="Maximum number of files to download at the same time")
+parser.add_argument("--annotation-threads", type=int, default=min(4, os.cpu_count()), help="Number of worker "
+					"processes used to add annotations in step 9")
+parser.add_argument("--annotation-cache-dir", default=DEFAULT_ANNOTATION_CACHE_DIR, help="Directory for caching the "
+					"parsed allele frequency and LPS tables used in step 9, so that they are only parsed again when "
+					"they change")
+parser.add_argument("--profile", action="store_true", help="Profile each step that runs a script from the scripts/ "
+					"directory, and write the results to the profiles/ subdirectory of the results directory. Since "
+					"this changes the step commands, these steps are rerun even if they were already completed.")
+parser.add_argument("--profile-format", choices=PROFILE_FORMATS, default="pstats", help="With --profile, record a "
+					"cProfile profile (pstats) or sample call stacks for a flame graph (collapsed) for each step")
 
 args = parser.parse_args()
 
 print("TIMESTAMP:", args.timestamp)
 
+telemetry = StepTelemetry(count_output_records=args.count_output_records)
+
+download_cache = DownloadCache(args.download_cache_dir, mirror_dir=args.download_mirror_dir,
+							   max_concurrent_downloads=args.max_concurrent_downloads)
+
+def fetch_files(urls, output_dir):
+	"""Download the given files through the download cache and link them into output_dir.
+
+	Return:
+		dict: maps each URL to its local path
+	"""
+	if args.dry_run:
+		print(f"Fetching {len(urls)} file(s) through the download cache in {download_cache.cache_dir}:")
+		for url in urls:
+			print(f"  {url}")
+		return {url: os.path.join(output_dir, os.path.basename(url)) for url in urls}
+
+	return download_cache.fetch_all(urls, output_dir=output_dir)
+
 
 for key in "hg38_reference_fasta", "gencode_gtf", "variation_clusters_bed", "lps_annotations":
 	if (
@@ -76,8 +211,7 @@ for key in "hg38_reference_fasta", "gencode_gtf", "variation_clusters_bed", "lps
 		parser.error(f"{key} file not found {path}")
 
 	if path.startswith("gs://"):
-		run(f"gsutil -m cp {path} .")
-		path = os.path.basename(path)
+		path = fetch_files([path], os.path.abspath("."))[path]
 
 	setattr(args, key, os.path.abspath(path))
 
@@ -87,6 +221,13 @@ working_dir = os.path.abspath(f"results__{args.timestamp}")
 run(f"mkdir -p {working_dir}")
 chdir(working_dir)
 
+if not args.step_cache_dir:
+	args.step_cache_dir = os.path.join(working_dir, ".step_cache")
+
+# the telemetry report is written next to the release draft folder
+telemetry_report_prefix = os.path.join(working_dir, "build_telemetry")
+profiles_dir = os.path.join(working_dir, "profiles")
+
 # create a release draft folder
 release_draft_folder = os.path.abspath(f"release_draft_{args.timestamp}")
 run(f"mkdir -p {release_draft_folder}")
@@ -113,28 +254,40 @@ source_catalogs_in_order = [
 ]
 
 
+# catalogs to compare the final catalog to
+comparison_catalogs_in_order = [
+	("GangSTR_v17", "https://s3.amazonaws.com/gangstr/hg38/genomewide/hg38_ver17.bed.gz"),
+	#("vamos_catalog_v2.1", "https://storage.googleapis.com/str-truth-set/hg38/ref/other/vamos_catalog.v2.1.bed.gz"),
+]
+
+# download source and comparison catalogs concurrently
+downloaded_paths = fetch_files([url for _, url in source_catalogs_in_order + comparison_catalogs_in_order], working_dir)
+
 source_catalog_paths = {}
 for catalog_name, url in source_catalogs_in_order:
-	if not os.path.isfile(os.path.basename(url)):
-		run(f"wget -O {os.path.basename(url)}.tmp -qnc {url} && mv {os.path.basename(url)}.tmp {os.path.basename(url)}")
-	source_catalog_paths[catalog_name] = os.path.abspath(os.path.basename(url))
+	source_catalog_paths[catalog_name] = downloaded_paths[url]
 
 # preprocess catalog of known disease-associated loci: split compound definitions
-run(f"python3 -u -m str_analysis.split_adjacent_loci_in_expansion_hunter_catalog {source_catalog_paths['KnownDiseaseAssociatedLoci']}", step_number=0)
-source_catalog_paths['KnownDiseaseAssociatedLoci'] = source_catalog_paths['KnownDiseaseAssociatedLoci'].replace(".json", ".split.json")
+known_disease_associated_loci_json_path = source_catalog_paths['KnownDiseaseAssociatedLoci']
+source_catalog_paths['KnownDiseaseAssociatedLoci'] = known_disease_associated_loci_json_path.replace(".json", ".split.json")
+run(f"python3 -u -m str_analysis.split_adjacent_loci_in_expansion_hunter_catalog {known_disease_associated_loci_json_path}",
+	step_number=0, inputs=[known_disease_associated_loci_json_path], outputs=[source_catalog_paths['KnownDiseaseAssociatedLoci']])
 # change motif definition for the RFC1 locus from AARRG => AAAAG since our catalog doesn't currently support IUPAC codes
-run(f"sed -i 's/AARRG/AAAAG/g' {source_catalog_paths['KnownDiseaseAssociatedLoci']}", step_number=0)
-run(f"gzip -f {source_catalog_paths['KnownDiseaseAssociatedLoci']}", step_number=0)
+run(f"sed 's/AARRG/AAAAG/g' {source_catalog_paths['KnownDiseaseAssociatedLoci']} | gzip > {source_catalog_paths['KnownDiseaseAssociatedLoci']}.gz",
+	step_number=0, inputs=[source_catalog_paths['KnownDiseaseAssociatedLoci']],
+	outputs=[source_catalog_paths['KnownDiseaseAssociatedLoci'] + ".gz"])
 
 source_catalog_paths['KnownDiseaseAssociatedLoci'] += ".gz"
 
 # compute stats for primary disease-associated loci
-if not args.dry_run:
-	with gzip.open(source_catalog_paths["KnownDiseaseAssociatedLoci"]) as f:
-		known_disease_associated_loci = json.load(f)
+primary_disease_associated_loci_path = source_catalog_paths["KnownDiseaseAssociatedLoci"].replace(
+	".json.gz", ".primary_disease_associated_loci.json.gz")
+unannotated_primary_disease_associated_loci_path = primary_disease_associated_loci_path.replace(
+	".json.gz", ".unannotated.json.gz")
 
+def write_primary_disease_associated_loci():
 	primary_disease_associated_loci = [
-		x for x in known_disease_associated_loci if x["Diseases"] and (
+		x for x in iterate_catalog_records(source_catalog_paths["KnownDiseaseAssociatedLoci"]) if x["Diseases"] and (
 			x["LocusId"].startswith("HOXA") or x["LocusId"].startswith("ARX") or "_" not in x["LocusId"]
 		)
 	]
@@ -142,25 +295,175 @@ if not args.dry_run:
 	# are not currently considered monogenic
 	assert len(primary_disease_associated_loci) == 63
 
-	primary_disease_associated_loci_path = source_catalog_paths["KnownDiseaseAssociatedLoci"].replace(
-		".json.gz", ".primary_disease_associated_loci.json.gz")
-
-	with gzip.open(primary_disease_associated_loci_path, "wt") as f:
-		json.dump(primary_disease_associated_loci, f, indent=4)
-
-	run(f"""python3 -u -m str_analysis.annotate_and_filter_str_catalog \
-		--verbose \
+	with CatalogWriter(unannotated_primary_disease_associated_loci_path) as writer:
+		writer.write_batch(primary_disease_associated_loci)
+
+run(f"write {unannotated_primary_disease_associated_loci_path}", step_number=0, function=write_primary_disease_associated_loci,
+	inputs=[source_catalog_paths["KnownDiseaseAssociatedLoci"]], outputs=[unannotated_primary_disease_associated_loci_path])
+
+run(f"""python3 -u -m str_analysis.annotate_and_filter_str_catalog \
+	--verbose \
+	--reference-fasta {args.hg38_reference_fasta} \
+	--min-interval-size-bp 1 \
+	--skip-gene-annotations \
+	--skip-mappability-annotations \
+	--skip-disease-loci-annotations \
+	--discard-loci-with-non-ACGT-bases-in-reference \
+	--discard-loci-with-non-ACGTN-bases-in-motif \
+	--output-path {primary_disease_associated_loci_path} \
+	{unannotated_primary_disease_associated_loci_path}""", step_number=1,
+	inputs=[unannotated_primary_disease_associated_loci_path, args.hg38_reference_fasta],
+	outputs=[primary_disease_associated_loci_path])
+
+run(f"python3 -m str_analysis.compute_catalog_stats --verbose {primary_disease_associated_loci_path}", step_number=2,
+	inputs=[primary_disease_associated_loci_path])
+
+
+def get_variation_cluster_release_paths():
+	"""Returns the paths of the variation cluster release files"""
+	variation_clusters_and_isolated_TRs_prefix = args.variation_clusters_output_prefix.replace(
+		"variation_clusters", "variation_clusters_and_isolated_TRs")
+	assert variation_clusters_and_isolated_TRs_prefix != args.variation_clusters_output_prefix
+
+	return {
+		"variation_clusters_TRGT": f"{args.variation_clusters_output_prefix}.TRGT.bed.gz",
+		"variation_clusters_LongTR": f"{args.variation_clusters_output_prefix}.LongTR.bed.gz",
+		"variation_clusters_and_isolated_TRs_TRGT": f"{variation_clusters_and_isolated_TRs_prefix}.TRGT.bed.gz",
+		"variation_clusters_and_isolated_TRs_LongTR": f"{variation_clusters_and_isolated_TRs_prefix}.LongTR.bed.gz",
+	}
+
+
+def add_annotation_and_format_conversion_steps(
+		merged_catalog_path, output_prefix, min_motif_size, max_motif_size, adjacent_repeats_source_bed=None,
+		variation_cluster_release_paths=None):
+	"""Add steps 6 through 14 to the step graph. These steps annotate the merged catalog and convert it to other formats.
+	When --shard-by-chromosome is used, they are added separately for each shard.
+
+	Args:
+		merged_catalog_path (str): path of the merged catalog (or shard of the merged catalog) from step 5
+		output_prefix (str): output path prefix for this catalog or shard
+		min_motif_size (int): minimum motif size
+		max_motif_size (int): maximum motif size
+		adjacent_repeats_source_bed (str): BED file to use as the source of adjacent loci for the TRsInRegion annotation.
+			If not specified, the BED file generated from this catalog in step 7 will be used.
+		variation_cluster_release_paths (dict): if specified, step 9 also writes the variation clusters and isolated TRs
+			catalog and the LongTR release files to these paths (see get_variation_cluster_release_paths). This requires
+			the complete catalog, so it can't be used for shards.
+
+	Return:
+		dict: paths of the output files generated by these steps
+	"""
+
+	# each annotation step writes a new version of the annotated catalog rather than overwriting the previous one, so that
+	# any step can be rerun on the same input. The final version is written to annotated_catalog_path in step 14.
+	annotated_catalog_path = f"{output_prefix}.EH.with_annotations.json.gz"
+	step6_annotated_catalog_path = f"{output_prefix}.EH.with_annotations.step6.json.gz"
+	run(f"""python3 -u -m str_analysis.annotate_and_filter_str_catalog --verbose \
 		--reference-fasta {args.hg38_reference_fasta} \
+		--gene-models-source gencode \
+		--gene-models-source refseq \
+		--gene-models-source mane \
+		--known-disease-associated-loci {primary_disease_associated_loci_path} \
+		--min-motif-size {min_motif_size} \
+		--max-motif-size {max_motif_size} \
 		--min-interval-size-bp 1 \
-		--skip-gene-annotations \
-		--skip-mappability-annotations \
-		--skip-disease-loci-annotations \
-		--discard-loci-with-non-ACGT-bases-in-reference \
-		--discard-loci-with-non-ACGTN-bases-in-motif \
-		--output-path {primary_disease_associated_loci_path} \
-		{primary_disease_associated_loci_path}""", step_number=1)
+		--discard-overlapping-intervals-with-similar-motifs \
+		--output-path {step6_annotated_catalog_path} \
+		{merged_catalog_path}""", step_number=6,
+		inputs=[merged_catalog_path, primary_disease_associated_loci_path, args.hg38_reference_fasta],
+		outputs=[step6_annotated_catalog_path], memory_gb=16)
+
+	# generate the ExpansionHunter catalog without extra annotations, and the BED, TRGT, LongTR, HipSTR and GangSTR
+	# catalogs in a single pass. These formats don't depend on the annotations added by later steps.
+	run(f"python3 -u {base_dir}/scripts/emit_catalog_formats.py "
+		f"--eh-json {output_prefix}.EH.with_loci_with_Ns_in_flanks.json.gz "
+		f"--bed {output_prefix}.bed.gz "
+		f"--trgt {output_prefix}.TRGT.bed "
+		f"--longtr {output_prefix}.LongTR.bed "
+		f"--hipstr {output_prefix}.HipSTR.bed "
+		f"--gangstr {output_prefix}.GangSTR.bed "
+		f"{step6_annotated_catalog_path}", step_number=7,
+		inputs=[step6_annotated_catalog_path],
+		outputs=[
+			f"{output_prefix}.EH.with_loci_with_Ns_in_flanks.json.gz",
+			f"{output_prefix}.bed.gz",
+			f"{output_prefix}.bed.gz.tbi",
+			f"{output_prefix}.TRGT.bed",
+			f"{output_prefix}.LongTR.bed",
+			f"{output_prefix}.HipSTR.bed",
+			f"{output_prefix}.GangSTR.bed",
+		])
+
+	run(f"python3 -m str_analysis.filter_out_loci_with_Ns_in_flanks "
+		f"-R {args.hg38_reference_fasta} "
+		f"-o {output_prefix}.EH.json.gz "
+		f"--output-list-of-filtered-loci {output_prefix}.loci_with_Ns_in_flanks.txt "
+		f"{output_prefix}.EH.with_loci_with_Ns_in_flanks.json.gz", step_number=8,
+		inputs=[f"{output_prefix}.EH.with_loci_with_Ns_in_flanks.json.gz", args.hg38_reference_fasta],
+		outputs=[f"{output_prefix}.EH.json.gz", f"{output_prefix}.loci_with_Ns_in_flanks.txt"])
+
+	latest_annotated_catalog_path = step6_annotated_catalog_path
+
+
+	# add variation cluster, allele frequency and LPS annotations in a single pass through the catalog
+	step9_annotated_catalog_path = f"{output_prefix}.EH.with_annotations.step9.json.gz"
+	step9_release_paths = []
+	if args.variation_clusters_bed and variation_cluster_release_paths:
+		step9_release_paths = [
+			variation_cluster_release_paths["variation_clusters_and_isolated_TRs_TRGT"],
+			variation_cluster_release_paths["variation_clusters_and_isolated_TRs_LongTR"],
+			variation_cluster_release_paths["variation_clusters_LongTR"],
+		]
+	run(f"python3 -u {base_dir}/scripts/annotate_catalog.py --verbose "
+		f"--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} " +
+		(f"--variation-clusters-bed {args.variation_clusters_bed} " if args.variation_clusters_bed else "") +
+		(f"--isolated-trs-output-bed {step9_release_paths[0]} "
+		 f"--isolated-trs-longtr-output-bed {step9_release_paths[1]} "
+		 f"--variation-clusters-longtr-output-bed {step9_release_paths[2]} " if step9_release_paths else "") +
+		(f"--lps-table {args.lps_annotations} " if args.lps_annotations else "") +
+		f"--add-t2t-assembly-frequencies-to-overlapping-loci "
+		f"--download-cache-dir {args.download_cache_dir} " +
+		(f"--download-mirror-dir {args.download_mirror_dir} " if args.download_mirror_dir else "") +
+		f"--annotation-cache-dir {args.annotation_cache_dir} "
+		f"--threads {args.annotation_threads} "
+		f"-o {step9_annotated_catalog_path} "
+		f"{latest_annotated_catalog_path}", step_number=9,
+		inputs=[latest_annotated_catalog_path, source_catalog_paths['KnownDiseaseAssociatedLoci'],
+				args.variation_clusters_bed, args.lps_annotations],
+		outputs=[step9_annotated_catalog_path] + step9_release_paths, cpus=args.annotation_threads, memory_gb=24)
+	latest_annotated_catalog_path = step9_annotated_catalog_path
+	catalog_with_variation_cluster_annotations_path = step9_annotated_catalog_path if args.variation_clusters_bed else None
+
+	# annotate with "TRsInRegion" based on adjacent loci
+	adjacent_repeats_source_bed = adjacent_repeats_source_bed or f"{output_prefix}.bed.gz"
+	step14_annotated_catalog_path = f"{output_prefix}.EH.with_annotations.step14.json.gz"
+	run(f"python3 -m str_analysis.add_adjacent_loci_to_expansion_hunter_catalog "
+		f"--ref-fasta {args.hg38_reference_fasta} "
+		f"--source-of-adjacent-loci {adjacent_repeats_source_bed} "
+		f"--add-extra-field TRsInRegion "
+		f"--only-add-extra-fields "
+		f"-o {step14_annotated_catalog_path} "
+		f"{latest_annotated_catalog_path}", step_number=14,
+		inputs=[latest_annotated_catalog_path, adjacent_repeats_source_bed, args.hg38_reference_fasta],
+		outputs=[step14_annotated_catalog_path], memory_gb=8)
+
+	# str_analysis writes plain gzip, but the release catalog is BGZF-compressed so that scripts/query_catalog.py can
+	# read individual records from it
+	run(f"gunzip -c {step14_annotated_catalog_path} | bgzip -c > {annotated_catalog_path}", step_number=14,
+		inputs=[step14_annotated_catalog_path], outputs=[annotated_catalog_path])
+
+	return {
+		"annotated_catalog": annotated_catalog_path,
+		"catalog_with_variation_cluster_annotations": catalog_with_variation_cluster_annotations_path,
+		"EH_catalog": f"{output_prefix}.EH.json.gz",
+		"loci_with_Ns_in_flanks": f"{output_prefix}.loci_with_Ns_in_flanks.txt",
+		"bed": f"{output_prefix}.bed.gz",
+		"TRGT": f"{output_prefix}.TRGT.bed",
+		"LongTR": f"{output_prefix}.LongTR.bed",
+		"HipSTR": f"{output_prefix}.HipSTR.bed",
+		"GangSTR": f"{output_prefix}.GangSTR.bed",
+	}
 
-	run(f"python3 -m str_analysis.compute_catalog_stats --verbose {primary_disease_associated_loci_path}", step_number=2)
 
 adjacent_repeats_source_bed = None
 for motif_size_label, min_motif_size, max_motif_size, release_tar_gz_path in [
@@ -209,10 +512,12 @@ for motif_size_label, min_motif_size, max_motif_size, release_tar_gz_path in [
 			--discard-loci-with-non-ACGT-bases-in-reference \
 			--discard-loci-with-non-ACGTN-bases-in-motif \
 			--output-path {filtered_catalog_path} \
-			{catalog_path}""", step_number=3)
+			{catalog_path}""", step_number=3,
+			inputs=[catalog_path, primary_disease_associated_loci_path, args.hg38_reference_fasta],
+			outputs=[filtered_catalog_path], memory_gb=8)
 
-		print(f"Stats for {catalog_path}")
-		run(f"python3 -m str_analysis.compute_catalog_stats --verbose {filtered_catalog_path}", step_number=3)
+		run(f"echo Stats for {catalog_path} && python3 -m str_analysis.compute_catalog_stats --verbose {filtered_catalog_path}",
+			step_number=3, inputs=[filtered_catalog_path])
 
 	# NOTE: we don't use the --merge-adjacent-loci-with-same-motif  option for str_analysis.merge_loci because
 	# it's important to presenve locus definitions as they appear in the individual source catalogs. If loci
@@ -234,55 +539,104 @@ for motif_size_label, min_motif_size, max_motif_size, release_tar_gz_path in [
 		--write-bed-files-with-unique-loci \
 		--outer-join-overlap-table-min-sources 1 \
 		--output-prefix {output_prefix}.merged \
-		{catalog_paths}""", step_number=5)
+		{catalog_paths}""", step_number=5,
+		inputs=list(filtered_source_catalog_paths.values()), outputs=[f"{output_prefix}.merged.json.gz"], memory_gb=16)
+
 
 	annotated_catalog_path = f"{output_prefix}.EH.with_annotations.json.gz"
-	run(f"""python3 -u -m str_analysis.annotate_and_filter_str_catalog --verbose \
-		--reference-fasta {args.hg38_reference_fasta} \
-		--gene-models-source gencode \
-		--gene-models-source refseq \
-		--gene-models-source mane \
-		--known-disease-associated-loci {primary_disease_associated_loci_path} \
-		--min-motif-size {min_motif_size} \
-		--max-motif-size {max_motif_size} \
-		--min-interval-size-bp 1 \
-		--discard-overlapping-intervals-with-similar-motifs \
-		--output-path {annotated_catalog_path} \
-		{output_prefix}.merged.json.gz""", step_number=6)
-
-	# create a version of the ExpansionHunter catalog without extra annotations
-	run(f"""python3 << EOF
-import gzip, ijson, json
-
-f = gzip.open("{annotated_catalog_path}", "rt")
-out = gzip.open("{output_prefix}.EH.json.gz", "wt")
-i = 0
-out.write("[")
-for record in ijson.items(f, "item", use_float=True):
-	# skip chrM loci because ExpansionHunter prints an error like: 'Unable to extract chrM:-793-207 from hg38.fa'
-	is_chrM = record["LocusId"].startswith("M-") or record["LocusId"].startswith("chrM-")
-	if is_chrM: print(f"Skipping chrM locus: {{record['LocusId']}}")
-	if is_chrM: continue
-	if i > 0: out.write(", ")
-	i += 1
-	out.write(json.dumps({{ 
-		k: v for k, v in record.items() if k in {{"LocusId", "ReferenceRegion", "VariantType", "LocusStructure"}} 
-	}}, indent=4))
-out.write("]")
-EOF
-""", step_number=7)
+	merged_catalog_path = f"{output_prefix}.merged.json.gz"
+	if args.shard_by_chromosome:
+		# split the merged catalog into shards with similar numbers of loci, run steps 6 through 14 on each shard in
+		# parallel, and then concatenate the per-shard outputs in order.
+		shards_manifest_path = f"{output_prefix}.merged.shards.json"
+		# the number of shards is only known after splitting, so list every shard that could be written. The step cache
+		# records the digests of the ones that exist, so that deleting or modifying a shard reruns this step.
+		possible_shard_prefixes = [f"{output_prefix}.merged.shard{i:03d}" for i in range(args.num_shards)]
+		run(f"python3 {base_dir}/scripts/shard_catalog.py split "
+			f"--num-shards {args.num_shards} "
+			f"--min-gap-between-shards {args.min_gap_between_shards} "
+			f"--output-manifest-path {shards_manifest_path} "
+			f"-o {output_prefix}.merged "
+			f"{merged_catalog_path}", step_number=5, inputs=[merged_catalog_path],
+			outputs=[shards_manifest_path] + [f"{shard_prefix}.json.gz" for shard_prefix in possible_shard_prefixes])
+		run_pending_steps()
+
+		if os.path.isfile(shards_manifest_path):
+			with open(shards_manifest_path, "rt") as f:
+				shard_prefixes = [shard["prefix"] for shard in json.load(f)["shards"]]
+		elif args.dry_run:
+			shard_prefixes = possible_shard_prefixes
+		else:
+			raise ValueError(f"{shards_manifest_path} not found. Rerun step 5 to generate it.")
+
+		shard_output_paths = [
+			add_annotation_and_format_conversion_steps(
+				f"{shard_prefix}.json.gz",
+				shard_prefix.replace(".merged.shard", ".shard"),
+				min_motif_size,
+				max_motif_size,
+				adjacent_repeats_source_bed=adjacent_repeats_source_bed)
+			for shard_prefix in shard_prefixes
+		]
+
+		output_paths = {
+			"annotated_catalog": annotated_catalog_path,
+			"EH_catalog": f"{output_prefix}.EH.json.gz",
+			"loci_with_Ns_in_flanks": f"{output_prefix}.loci_with_Ns_in_flanks.txt",
+			"bed": f"{output_prefix}.bed.gz",
+			"TRGT": f"{output_prefix}.TRGT.bed",
+			"LongTR": f"{output_prefix}.LongTR.bed",
+			"HipSTR": f"{output_prefix}.HipSTR.bed",
+			"GangSTR": f"{output_prefix}.GangSTR.bed",
+		}
+		for key, output_path in output_paths.items():
+			shard_paths = [paths[key] for paths in shard_output_paths]
+			if output_path.endswith(".json.gz"):
+				command = f"python3 {base_dir}/scripts/shard_catalog.py concat -o {output_path} " + " ".join(shard_paths)
+			elif output_path.endswith(".bed.gz"):
+				# bgzipped files can be concatenated directly
+				command = f"cat {' '.join(shard_paths)} > {output_path} && tabix -f -p bed {output_path}"
+			else:
+				command = f"cat {' '.join(shard_paths)} > {output_path}"
+			run(command, step_number=19, inputs=shard_paths,
+				outputs=[output_path] + ([f"{output_path}.tbi"] if output_path.endswith(".bed.gz") else []))
 
-	run(f"python3 -m str_analysis.filter_out_loci_with_Ns_in_flanks "
-		f"-R {args.hg38_reference_fasta} "
-		f"-o {output_prefix}.EH.without_loci_with_Ns_in_flanks.json.gz "
-		f"--output-list-of-filtered-loci {output_prefix}.loci_with_Ns_in_flanks.txt "
-		f"{output_prefix}.EH.json.gz", step_number=8)
-	run(f"mv {output_prefix}.EH.without_loci_with_Ns_in_flanks.json.gz {output_prefix}.EH.json.gz", step_number=8)
+		# the isolated TRs need to be computed from the complete catalog
+		output_paths["catalog_with_variation_cluster_annotations"] = annotated_catalog_path
+	else:
+		output_paths = add_annotation_and_format_conversion_steps(
+			merged_catalog_path,
+			output_prefix,
+			min_motif_size,
+			max_motif_size,
+			adjacent_repeats_source_bed=adjacent_repeats_source_bed,
+			variation_cluster_release_paths=get_variation_cluster_release_paths())
+
+	assert output_paths["annotated_catalog"] == annotated_catalog_path
+
+	# the release catalog is always JSON, but the steps below that only read it can use a columnar copy
+	if args.intermediate_format == "arrow":
+		catalog_path_for_downstream_steps = annotated_catalog_path.replace(".json.gz", ".arrow")
+		run(f"python3 {base_dir}/scripts/convert_catalog_format.py {annotated_catalog_path} {catalog_path_for_downstream_steps}",
+			step_number=14, inputs=[annotated_catalog_path], outputs=[catalog_path_for_downstream_steps], memory_gb=4)
+		output_paths["catalog_with_variation_cluster_annotations"] = catalog_path_for_downstream_steps
+	else:
+		catalog_path_for_downstream_steps = annotated_catalog_path
+
+	# index the annotated catalog so that scripts/query_catalog.py can look up its records by region using the BED file
+	offset_index_paths = [f"{annotated_catalog_path}.offsets.npy", f"{annotated_catalog_path}.offsets.json"]
+	run(f"python3 {base_dir}/scripts/query_catalog.py index {annotated_catalog_path}", step_number=14,
+		inputs=[annotated_catalog_path], outputs=offset_index_paths, memory_gb=4)
+
+	# annotate other catalogs with "TRsInRegion" based on adjacent loci in the full catalog
+	if motif_size_label == "1_to_1000bp_motifs":
+		adjacent_repeats_source_bed = f"{output_prefix}.bed.gz"
 
 	release_files = [
 		f"{output_prefix}.bed.gz",
 		f"{output_prefix}.bed.gz.tbi",
 		f"{annotated_catalog_path}",
+		*offset_index_paths,
 		f"{output_prefix}.EH.json.gz",
 		f"{output_prefix}.TRGT.bed",
 		f"{output_prefix}.LongTR.bed",
@@ -290,177 +644,96 @@ EOF
 		f"{output_prefix}.GangSTR.bed",
 	]
 
-
-	# add variation cluster annotations to the catalog
+	# create variation cluster release files
 	if args.variation_clusters_bed:
-		variation_clusters_release_filename = f"{args.variation_clusters_output_prefix}.TRGT.bed.gz"
-		variation_clusters_and_isolated_TRs_release_filename = args.variation_clusters_output_prefix.replace(
-			"variation_clusters", "variation_clusters_and_isolated_TRs") + ".TRGT.bed.gz"
-
-		assert variation_clusters_and_isolated_TRs_release_filename != variation_clusters_release_filename
-
-		run(f"""python3 {base_dir}/scripts/add_variation_cluster_annotations_to_catalog.py \
-			--verbose \
-			--output-catalog-json-path {output_prefix}.EH.with_annotations.with_variation_clusters.json.gz \
-			--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} \
-			{args.variation_clusters_bed} \
-			{annotated_catalog_path}""", step_number=9)
-
-		run(f"mv {output_prefix}.EH.with_annotations.with_variation_clusters.json.gz {annotated_catalog_path}", step_number=9)
-		run(f"cp {args.variation_clusters_bed} {variation_clusters_release_filename}", step_number=9)
-
-		run(f"""python3 {base_dir}/scripts/add_isolated_loci_to_variation_cluster_catalog.py \
-			--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} \
-			-o {variation_clusters_and_isolated_TRs_release_filename} \
-			{args.variation_clusters_bed} \
-			{annotated_catalog_path}""", step_number=9)
-
-		release_files.append(variation_clusters_release_filename)
-		release_files.append(variation_clusters_and_isolated_TRs_release_filename)
-
-		run(f"python3 {base_dir}/scripts/convert_trgt_catalog_to_longtr_format.py "
-			f"--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} "
-			f"{variation_clusters_release_filename}", step_number=10)
-		run(f"python3 {base_dir}/scripts/convert_trgt_catalog_to_longtr_format.py "
-			f"--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} "
-			f"{variation_clusters_and_isolated_TRs_release_filename}", step_number=10)
-
-		release_files.append(variation_clusters_release_filename.replace(".TRGT.bed.gz", ".LongTR.bed.gz"))
-		release_files.append(variation_clusters_and_isolated_TRs_release_filename.replace(".TRGT.bed.gz", ".LongTR.bed.gz"))
-
-	# add allele frequencies to the catalog
-	run(f"""python3 -u {base_dir}/scripts/add_allele_frequency_annotations.py \
-			--add-t2t-assembly-frequencies-to-overlapping-loci \
-			-o {annotated_catalog_path}.with_allele_frequencies.json.gz  {annotated_catalog_path}""", step_number=11)
-
-	run(f"mv {annotated_catalog_path}.with_allele_frequencies.json.gz {annotated_catalog_path}", step_number=11)
-
-	# add LPS annotations
-	if args.lps_annotations:
-		run(f"""python3 {base_dir}/scripts/add_LPS_stdev_annotations_to_catalog.py \
-			--output-catalog-json-path {output_prefix}.EH.with_annotations.with_LPS_annotations.json.gz \
-			--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} \
-			{args.lps_annotations} \
-			{annotated_catalog_path}""", step_number=12)
-
-		run(f"mv {output_prefix}.EH.with_annotations.with_LPS_annotations.json.gz {annotated_catalog_path}", step_number=12)
-
-	# annotate with "TRsInRegion" based on adjacent loci
-	if motif_size_label == "1_to_1000bp_motifs":
-		adjacent_repeats_source_bed = f"{output_prefix}.bed.gz"
-
-	# convert to BED
-	run(f"python3 -m str_analysis.convert_expansion_hunter_catalog_to_bed --split-adjacent-repeats "
-		f"{annotated_catalog_path}  --output-file {output_prefix}.bed.gz", step_number=13)
-
-	run(f"python3 -m str_analysis.add_adjacent_loci_to_expansion_hunter_catalog "
-		f"--ref-fasta {args.hg38_reference_fasta} "
-		f"--source-of-adjacent-loci {adjacent_repeats_source_bed} "
-		f"--add-extra-field TRsInRegion "
-		f"--only-add-extra-fields "
-		f"-o {annotated_catalog_path}.with_adjacent_loci_annotation.json.gz "
-		f"{annotated_catalog_path}", step_number=14)
-
-	run(f"mv {annotated_catalog_path}.with_adjacent_loci_annotation.json.gz {annotated_catalog_path}", step_number=14)
-
+		variation_cluster_release_paths = get_variation_cluster_release_paths()
+		run(f"cp {args.variation_clusters_bed} {variation_cluster_release_paths['variation_clusters_TRGT']}",
+			step_number=9, inputs=[args.variation_clusters_bed],
+			outputs=[variation_cluster_release_paths["variation_clusters_TRGT"]])
+
+		if args.shard_by_chromosome:
+			# step 9 wrote these files during annotation when the catalog wasn't sharded
+			run(f"""python3 {base_dir}/scripts/add_isolated_loci_to_variation_cluster_catalog.py \
+				--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} \
+				--longtr-output-bed-path {variation_cluster_release_paths["variation_clusters_and_isolated_TRs_LongTR"]} \
+				--variation-clusters-longtr-output-bed-path {variation_cluster_release_paths["variation_clusters_LongTR"]} \
+				-o {variation_cluster_release_paths["variation_clusters_and_isolated_TRs_TRGT"]} \
+				{args.variation_clusters_bed} \
+				{output_paths["catalog_with_variation_cluster_annotations"]}""", step_number=9,
+				inputs=[args.variation_clusters_bed, output_paths["catalog_with_variation_cluster_annotations"],
+						source_catalog_paths['KnownDiseaseAssociatedLoci']],
+				outputs=[variation_cluster_release_paths["variation_clusters_and_isolated_TRs_TRGT"],
+						 variation_cluster_release_paths["variation_clusters_and_isolated_TRs_LongTR"],
+						 variation_cluster_release_paths["variation_clusters_LongTR"]], memory_gb=8)
+
+		release_files += list(variation_cluster_release_paths.values())
 
 	# convert to TSV
-	run(f"""python3 << EOF
-import gzip
-import json
-import pandas as pd
-from pprint import pformat
-with gzip.open("{annotated_catalog_path}", "rt") as f:
-	data = json.load(f)
-print(f"Loaded {{len(data):,d}} records from {annotated_catalog_path}")
-print("Writing it to TSV file...")
-df = pd.DataFrame(data)
-core_columns = [
-	'LocusId', 'ReferenceRegion', 'LocusStructure', 'CanonicalMotif', 'TRsInRegion',
-	'Source', 'GencodeGeneRegion', 'GencodeGeneId', 'GencodeGeneName', 'GencodeTranscriptId',
-	'RefseqGeneRegion', 'RefseqGeneId', 'RefseqGeneName', 'RefseqTranscriptId', 
-	'ManeGeneRegion', 'ManeGeneId', 'ManeGeneName', 'ManeTranscriptId',
-	'KnownDiseaseAssociatedMotif',  'KnownDiseaseAssociatedLocus', 'NsInFlanks',
-	'LeftFlankMappability', 'FlanksAndLocusMappability', 'RightFlankMappability', 
-	'FoundInKnownDiseaseAssociatedLoci', 'FoundInIllumina174kPolymorphicTRs', 
-	'FoundInPerfectRepeatsInReference', 'FoundInPolymorphicTRsInT2TAssemblies', 
-	'NumRepeatsInReference', 'ReferenceRepeatPurity', 
-	'AlleleFrequenciesFromIllumina174k', 'StdevFromIllumina174k',
-	'AlleleFrequenciesFromT2TAssemblies', 'StdevFromT2TAssemblies',
-	'VariationCluster', 'VariationClusterSizeDiff',
-	'LPSLengthStdevFromHPRC100', 'LPSMotifFractionFromHPRC100',
-]
-
-drop_columns = ['VariantType', ]
-for c in set(core_columns)  - set(df.columns): df[c] = None
-df = df[core_columns + [c for c in df.columns if c not in (core_columns + drop_columns)]]
-
-output_tsv_path = "{annotated_catalog_path.replace('.json.gz', '') + '.tsv.gz'}"
-df.to_csv(output_tsv_path, sep="\\t", index=False)
-print(f"Wrote {{len(df):,d}} rows to {{output_tsv_path}} with columns: {{pformat(list(df.columns))}}")
-EOF
-""", step_number=15)
-
-	# convert the catalog from ExpansionHunter catalog format to TRGT, LongTR, HipSTR, and GangSTR formats
-	run(f"python3 -m str_analysis.convert_expansion_hunter_catalog_to_trgt_catalog --split-adjacent-repeats {annotated_catalog_path}  --output-file {output_prefix}.TRGT.bed", step_number=16)
-	run(f"python3 -m str_analysis.convert_expansion_hunter_catalog_to_longtr_format  {annotated_catalog_path}  --output-file {output_prefix}.LongTR.bed", step_number=17)
-	run(f"python3 -m str_analysis.convert_expansion_hunter_catalog_to_hipstr_format  {annotated_catalog_path}  --output-file {output_prefix}.HipSTR.bed", step_number=18)
-	run(f"python3 -m str_analysis.convert_expansion_hunter_catalog_to_gangstr_spec   {annotated_catalog_path}  --output-file {output_prefix}.GangSTR.bed", step_number=19)
+	output_tsv_path = annotated_catalog_path.replace('.json.gz', '') + '.tsv.gz'
+	run(f"python3 -u {base_dir}/scripts/export_catalog_to_tsv.py -o {output_tsv_path} {catalog_path_for_downstream_steps}",
+		step_number=15, inputs=[catalog_path_for_downstream_steps], outputs=[output_tsv_path])
 
 	# Confirm that the TRGT catalog passes 'trgt validate'
-	run(f"trgt validate --genome {args.hg38_reference_fasta}  --repeats {output_prefix}.TRGT.bed", step_number=20)
+	run(f"trgt validate --genome {args.hg38_reference_fasta}  --repeats {output_prefix}.TRGT.bed", step_number=20,
+		inputs=[f"{output_prefix}.TRGT.bed", args.hg38_reference_fasta])
 
 	# Perform basic internal consistency checks on the JSON catalog
 	run(f"python3 {base_dir}/scripts/validate_catalog.py " +
 		f"--known-pathogenic-loci-json-path {source_catalog_paths['KnownDiseaseAssociatedLoci']} " +
 		("--check-for-presence-of-annotations --check-for-presence-of-all-known-loci " if motif_size_label == "1_to_1000bp_motifs" else "") +
-		f"{annotated_catalog_path}", step_number=21)
+		f"{catalog_path_for_downstream_steps}", step_number=21,
+		inputs=[catalog_path_for_downstream_steps, source_catalog_paths['KnownDiseaseAssociatedLoci']])
 
 	# copy files to the release_draft folder and compute catalog stats
 	updated_release_files = []
 	for path in release_files:
 		if path.endswith(".bed"):
-			if not os.path.isfile(f"{path}.gz"):
-				if path.endswith(".TRGT.bed"):
-					run(f"gzip -f {path}", step_number=22)  # TRGT v1.1.1 and lower only works with gzip, not bgzip
-				else:
-					run(f"bgzip -f {path}", step_number=22)
+			if path.endswith(".TRGT.bed"):
+				compress_command = "gzip"  # TRGT v1.1.1 and lower only works with gzip, not bgzip
+			else:
+				compress_command = "bgzip"
+			run(f"{compress_command} -c {path} > {path}.gz", step_number=22, inputs=[path], outputs=[f"{path}.gz"])
 			updated_release_files.append(f"{path}.gz")
 		else:
 			if path.endswith(".json") or path.endswith(".json.gz") and ".EH." in path:
-				run(f"python3 {base_dir}/scripts/validate_json.py -k LocusId -k LocusStructure -k ReferenceRegion -k VariantType {path}", step_number=22)
+				run(f"python3 {base_dir}/scripts/validate_json.py -k LocusId -k LocusStructure -k ReferenceRegion -k VariantType {path}", step_number=22,
+					inputs=[path])
 			updated_release_files.append(path)
 
 	if release_tar_gz_path is None:
 		for path in updated_release_files:
-			run(f"cp {path} {release_draft_folder}", step_number=22)
+			run(f"cp {path} {release_draft_folder}", step_number=22,
+				inputs=[path], outputs=[os.path.join(release_draft_folder, os.path.basename(path))])
 	else:
-		run(f"tar czf {release_tar_gz_path} -C {os.path.dirname(output_prefix)} " + " ".join([os.path.basename(p) for p in updated_release_files]), step_number=22)
-		run(f"cp {release_tar_gz_path} {release_draft_folder}", step_number=22)
+		run(f"tar czf {release_tar_gz_path} -C {os.path.dirname(output_prefix)} " + " ".join([os.path.basename(p) for p in updated_release_files]), step_number=22,
+			inputs=updated_release_files, outputs=[release_tar_gz_path])
+		run(f"cp {release_tar_gz_path} {release_draft_folder}", step_number=22,
+			inputs=[release_tar_gz_path], outputs=[os.path.join(release_draft_folder, os.path.basename(release_tar_gz_path))])
+
+	run(f"python3 -m str_analysis.compute_catalog_stats --verbose {annotated_catalog_path}", step_number=23,
+		inputs=[annotated_catalog_path])
 
-	run(f"python3 -m str_analysis.compute_catalog_stats --verbose {annotated_catalog_path}", step_number=23)
+	run_pending_steps()
 
 	# report hours, minutes, seconds relative to start_time
 	diff = time.time() - start_time
 	print(f"Done generating {output_prefix} catalog. Took {diff//3600:.0f}h, {(diff%3600)//60:.0f}m, {diff%60:.0f}s")
 
+	previous_telemetry_report = args.previous_telemetry_report or find_previous_telemetry_report()
+	if previous_telemetry_report and not args.dry_run:
+		telemetry.print_comparison(previous_telemetry_report)
+
 	if motif_size_label != "1_to_1000bp_motifs":
 		continue
 
 	# compare to the GangSTR_v17 catalog to make sure it's included
-	comparison_catalogs_in_order = [
-		("GangSTR_v17", "https://s3.amazonaws.com/gangstr/hg38/genomewide/hg38_ver17.bed.gz"),
-		#("vamos_catalog_v2.1", "https://storage.googleapis.com/str-truth-set/hg38/ref/other/vamos_catalog.v2.1.bed.gz"),
-	]
-
 	comparison_catalog_paths = {}
 	for catalog_name, url in comparison_catalogs_in_order:
-		if not os.path.isfile(os.path.basename(url)):
-			run(f"wget -O {os.path.basename(url)}.tmp -qnc {url} && mv {os.path.basename(url)}.tmp {os.path.basename(url)}")
-		comparison_catalog_paths[catalog_name] = os.path.abspath(os.path.basename(url))
+		comparison_catalog_paths[catalog_name] = downloaded_paths[url]
 
 	path_after_conversion = comparison_catalog_paths["GangSTR_v17"].replace(".bed.gz", ".json.gz")
-	run(f"python3 -u -m str_analysis.convert_gangstr_spec_to_expansion_hunter_catalog --verbose {comparison_catalog_paths['GangSTR_v17']} -o {path_after_conversion}", step_number=30)
+	run(f"python3 -u -m str_analysis.convert_gangstr_spec_to_expansion_hunter_catalog --verbose {comparison_catalog_paths['GangSTR_v17']} -o {path_after_conversion}", step_number=30,
+		inputs=[comparison_catalog_paths['GangSTR_v17']], outputs=[path_after_conversion])
 	comparison_catalog_paths["GangSTR_v17"] = path_after_conversion
 
 	# compare catalog to other catalogs
@@ -478,9 +751,11 @@ EOF
 			--max-motif-size {max_motif_size} \
 			--output-path {filtered_comparison_catalog_path} \
 			--verbose \
-			{path}""", step_number=31)
+			{path}""", step_number=31,
+			inputs=[path, args.hg38_reference_fasta], outputs=[filtered_comparison_catalog_path], memory_gb=8)
 
-		run(f"python3 -m str_analysis.compute_catalog_stats --verbose {filtered_comparison_catalog_path}", step_number=32)
+		run(f"python3 -m str_analysis.compute_catalog_stats --verbose {filtered_comparison_catalog_path}", step_number=32,
+			inputs=[filtered_comparison_catalog_path])
 
 		run(f"""python3 -u -m str_analysis.merge_loci \
 			--output-prefix {catalog_name} \
@@ -489,8 +764,10 @@ EOF
 			--verbose \
 			--write-merge-stats-tsv \
 			{annotated_catalog_path} \
-			{filtered_comparison_catalog_path}""", step_number=33)
+			{filtered_comparison_catalog_path}""", step_number=33,
+			inputs=[annotated_catalog_path, filtered_comparison_catalog_path], memory_gb=16)
+
+	run_pending_steps()
 
 	diff = time.time() - start_time
 	print(f"Done with comparisons. Took {diff//3600:.0f}h, {(diff%3600)//60:.0f}m, {diff%60:.0f}s")
-
@@ -7,17 +7,24 @@ LPSMotifFractionFromHPRC100 is the fraction of alleles at a tandem repeat locus
 """
 
 import argparse
-import collections
+import functools
 import gzip
-import ijson
+import itertools
+import numpy as np
 import os
 import pandas as pd
 import simplejson as json
-import sys
-import tqdm
+import tempfile
 
-from str_analysis.utils.misc_utils import parse_interval
 from str_analysis.utils.eh_catalog_utils import parse_motifs_from_locus_structure
+
+from annotation_source_cache import DEFAULT_ANNOTATION_CACHE_DIR, ArrayBuilder, KeyIndex, StringArray, \
+	StringArrayBuilder, add_prefix, compile_key_index, load_compiled_source, remove_prefix
+from catalog_annotator import CatalogAnnotator, annotate_catalog
+from locus_key import LOCUS_KEY_DTYPE, encode_locus_ids
+from memory_budget import add_max_memory_argument, get_rows_per_chunk, sort_lines
+from profiling import add_profiling_arguments, profile_phase, run_main
+
 """
 Expected columns in lps table:
 'TRID', 'longestPureSegmentMotif', 'N_motif', '0thPercentile',
@@ -30,16 +37,196 @@ Expected columns in lps table:
        'Stdev'
 """
 
+
+# increment this when the output of compile_lps_table changes
+PARSER_VERSION = 3
+
+LPS_TABLE_COLUMNS = ["TRID", "longestPureSegmentMotif", "N_motif", "Stdev"]
+LPS_TABLE_COLUMN_TYPES = {"TRID": str, "longestPureSegmentMotif": str, "Stdev": np.float64}
+
+# approximate memory used per table row while a chunk of rows is being compiled with --max-memory
+LPS_TABLE_BYTES_PER_ROW = 1_000
+
+
+def compile_lps_table(lps_table, known_pathogenic_loci_json_path, max_memory=None):
+	"""Parse the LPS table into arrays for the annotation source cache. If max_memory is specified, the table is parsed
+	in chunks (see iterate_lps_table_chunks) and the compiled arrays are spilled to disk as they are built."""
+	print(f"Parsing {known_pathogenic_loci_json_path}")
+	fopen = gzip.open if known_pathogenic_loci_json_path.endswith("gz") else open
+	with fopen(known_pathogenic_loci_json_path, "rt") as f:
+		known_pathogenic_loci = json.load(f)
+		known_pathogenic_reference_regions_lookup = {}
+		for locus in known_pathogenic_loci:
+			motifs = parse_motifs_from_locus_structure(locus["LocusStructure"])
+			if isinstance(locus["ReferenceRegion"], list):
+				assert isinstance(locus["VariantId"], list)
+				assert len(locus["ReferenceRegion"]) == len(locus["VariantId"])
+				assert len(locus["ReferenceRegion"]) == len(motifs)
+				for variant_id, reference_region, motif in zip(locus["VariantId"], locus["ReferenceRegion"], motifs):
+					known_pathogenic_reference_regions_lookup[variant_id] = (reference_region, motif)
+			else:
+				known_pathogenic_reference_regions_lookup[locus["LocusId"]] = (locus["ReferenceRegion"], motifs[0])
+
+	print(f"Parsed {len(known_pathogenic_reference_regions_lookup)} known pathogenic loci")
+	print(f"Parsing {lps_table}")
+	known_pathogenic_locus_motifs = {
+		locus_id: motif for locus_id, (_, motif) in known_pathogenic_reference_regions_lookup.items()
+	}
+	with tempfile.TemporaryDirectory(prefix="lps_table.") as temp_dir:
+		spill_dir = temp_dir if max_memory is not None else None
+		locus_keys = ArrayBuilder(LOCUS_KEY_DTYPE, spill_dir)
+		lps_stdevs = ArrayBuilder(float, spill_dir)
+		motif_fractions = StringArrayBuilder(spill_dir)
+		for df, N_motif_sums in iterate_lps_table_chunks(lps_table, max_memory=max_memory):
+			# convert stdev in bp to stdev in repeat units
+			lps_stdevs_in_chunk = df["Stdev"] / df["longestPureSegmentMotif"].str.len()
+			motif_fraction_strings = df["longestPureSegmentMotif"] + ": " + df["N_motif"].astype(str) + "/" + N_motif_sums.astype(str)
+
+			# split TRIDs that contain several locus ids into one row per locus id, and only keep locus ids whose motif
+			# matches the LPS motif
+			df = pd.DataFrame({
+				"LocusId": df["TRID"].str.split(","),
+				"LPSMotif": df["longestPureSegmentMotif"],
+				"LPSStdev": lps_stdevs_in_chunk,
+				"MotifFraction": motif_fraction_strings,
+			}).explode("LocusId", ignore_index=True)
+
+			locus_motifs = df["LocusId"].map(known_pathogenic_locus_motifs)
+			other_locus_ids = df.loc[locus_motifs.isna(), "LocusId"]
+			invalid_locus_ids = other_locus_ids[other_locus_ids.str.count("-") != 3]
+			if len(invalid_locus_ids) > 0:
+				raise ValueError(f"Unexpected LocusId format in {lps_table}: {invalid_locus_ids.iloc[0]}")
+			locus_motifs = locus_motifs.fillna(other_locus_ids.str.split("-").str[3])
+			df = df[locus_motifs == df["LPSMotif"]]
+
+			locus_keys.append(encode_locus_ids(df["LocusId"].tolist()))
+			lps_stdevs.append([round(lps_stdev, 3) for lps_stdev in df["LPSStdev"].tolist()])
+			motif_fractions.append(df["MotifFraction"].tolist())
+
+		key_index = compile_key_index(locus_keys.build())
+		print(f"Found LPS annotations for {len(key_index['keys']):,d} locus ids")
+		return {
+			**add_prefix("key_index_", key_index),
+			"lps_stdevs": lps_stdevs.build(),
+			**add_prefix("motif_fractions_", motif_fractions.build()),
+		}
+
+
+def read_lps_table(lps_table, chunksize=None):
+	"""Read the LPS table columns that are used for annotations, or an iterator of chunks of them if chunksize is
+	specified. N_motif is left for pandas to infer so that the counts are formatted the same way as in the table."""
+	return pd.read_table(lps_table, usecols=LPS_TABLE_COLUMNS, dtype=LPS_TABLE_COLUMN_TYPES, chunksize=chunksize)
+
+
+def remove_rows_with_missing_values(df):
+	return df[~df["longestPureSegmentMotif"].isna() & ~df["Stdev"].isna() & ~df["N_motif"].isna()]
+
+
+def iterate_lps_table_chunks(lps_table, max_memory=None):
+	"""Yields (df, N_motif_sums) tuples for the rows of the LPS table that don't have missing values, where
+	N_motif_sums is the sum of the N_motif column across all rows with the same TRID.
+
+	Without max_memory, the whole table is yielded at once. Otherwise, the table is read in chunks twice: the first
+	pass sums N_motif by TRID by sorting (TRID, row number, N_motif) lines with memory_budget.sort_lines, and the second
+	pass yields each chunk along with the sums for its rows, which are sorted back into row order.
+	"""
+	if max_memory is None:
+		df = read_lps_table(lps_table)
+		before = len(df)
+		df = remove_rows_with_missing_values(df)
+		print(f"Filtered out {before - len(df):,d} out of {before:,d} ({(before - len(df)) / before:.1%}) records with missing values")
+		yield df, df.groupby("TRID")["N_motif"].transform("sum")
+		return
+
+	rows_per_chunk = get_rows_per_chunk(max_memory, LPS_TABLE_BYTES_PER_ROW)
+	# when the whole table is read at once, pandas parses N_motif as floats if any row has a missing or fractional
+	# count, so the chunks are converted to floats in that case too
+	N_motif_is_float = False
+
+	def iterate_N_motif_lines():
+		nonlocal N_motif_is_float
+		before = row_number = 0
+		for df in read_lps_table(lps_table, chunksize=rows_per_chunk):
+			N_motif_is_float |= df["N_motif"].dtype.kind == "f"
+			before += len(df)
+			df = remove_rows_with_missing_values(df)
+			for TRID, N_motif in zip(df["TRID"].tolist(), df["N_motif"].tolist()):
+				yield f"{TRID}\t{row_number}\t{N_motif}\n"
+				row_number += 1
+		print(f"Filtered out {before - row_number:,d} out of {before:,d} ({(before - row_number) / max(1, before):.1%}) records with missing values")
+
+	def iterate_N_motif_sum_lines():
+		get_TRID = lambda line: line.split("\t", 1)[0]
+		for _, lines in itertools.groupby(sort_lines(iterate_N_motif_lines(), get_TRID, max_memory=max_memory), get_TRID):
+			rows = [line.rstrip("\n").split("\t") for line in lines]
+			N_motif_sum = sum(float(N_motif) for _, _, N_motif in rows)
+			for _, row_number, _ in rows:
+				yield f"{row_number}\t{N_motif_sum}\n"
+
+	N_motif_sums = (float(line.split("\t")[1]) for line in sort_lines(
+		iterate_N_motif_sum_lines(), lambda line: int(line.split("\t", 1)[0]), max_memory=max_memory))
+	# the first pass runs when the first sum is requested, and has to finish before N_motif_is_float is used below
+	N_motif_sums = itertools.chain([next(N_motif_sums, None)], N_motif_sums)
+
+	for df in read_lps_table(lps_table, chunksize=rows_per_chunk):
+		df = remove_rows_with_missing_values(df)
+		chunk_N_motif_sums = pd.Series(list(itertools.islice(N_motif_sums, len(df))), index=df.index, dtype=float)
+		if N_motif_is_float:
+			df = df.astype({"N_motif": float})
+		else:
+			chunk_N_motif_sums = chunk_N_motif_sums.astype(np.int64)
+		yield df, chunk_N_motif_sums
+
+
+class LPSAnnotator(CatalogAnnotator):
+	"""Adds LPSLengthStdevFromHPRC100 and LPSMotifFractionFromHPRC100 fields to loci that are in the LPS table"""
+
+	name = "LPS annotations"
+
+	def __init__(self, lps_table, known_pathogenic_loci_json_path, annotation_cache_dir=None, max_memory=None):
+		super().__init__()
+		arrays = load_compiled_source(
+			"lps_annotations", [lps_table, known_pathogenic_loci_json_path], PARSER_VERSION,
+			functools.partial(compile_lps_table, max_memory=max_memory), cache_dir=annotation_cache_dir)
+		self.key_index = KeyIndex(remove_prefix("key_index_", arrays))
+		self.lps_stdevs = arrays["lps_stdevs"]
+		self.motif_fractions = StringArray(remove_prefix("motif_fractions_", arrays))
+		print(f"Loaded LPS annotations for {len(self.key_index):,d} loci")
+
+	def annotate_record(self, record):
+		return self.annotate_records([record])[0]
+
+	def annotate_records(self, records):
+		rows = self.key_index.get_batch(encode_locus_ids([record["LocusId"] for record in records])).tolist()
+		for record, row in zip(records, rows):
+			if row >= 0:
+				record["LPSLengthStdevFromHPRC100"] = float(self.lps_stdevs[row])
+				record["LPSMotifFractionFromHPRC100"] = self.motif_fractions[row]
+
+		return [row >= 0 for row in rows]
+
+	def may_annotate_locus_ids(self, locus_ids):
+		return (self.key_index.get_batch(encode_locus_ids([locus_id or "" for locus_id in locus_ids])) >= 0).tolist()
+
+
 def main():
 	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument("--known-pathogenic-loci-json-path", required=True, help="Path of ExpansionHunter catalog "
 						"containing known pathogenic loci. This is used to retrieve the original locus boundaries for "
 						"these loci since their IDs don't contain these coordinates the way that IDs of other loci do.")
+	parser.add_argument("--annotation-cache-dir", default=DEFAULT_ANNOTATION_CACHE_DIR, help="Directory for caching the "
+						"parsed LPS table")
+	add_max_memory_argument(parser)
 	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
+	parser.add_argument("--threads", type=int, default=1, help="Number of worker processes to use for annotating records")
+	parser.add_argument("--passthrough", action="store_true", help="Only parse and re-serialize the records that get "
+						"annotations, and copy all other records from the input catalog to the output unchanged. Requires "
+						"JSON input and output.")
 	parser.add_argument("--output-catalog-json-path",
 						help="Path of the output catalog JSON file that includes variation cluster annotations")
 	parser.add_argument("lps_table", help="Path of the LPS data table", default="HPRC_100_LongestPureSegmentQuantiles.txt.gz")
 	parser.add_argument("catalog_json_path", help="Path of the JSON catalog to annotate")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	for path in args.lps_table, args.catalog_json_path, args.known_pathogenic_loci_json_path:
@@ -49,86 +236,15 @@ def main():
 	if not args.output_catalog_json_path:
 		args.output_catalog_json_path = args.catalog_json_path.replace(".json", ".with_LPS_annotations.json")
 
-	print(f"Parsing {args.known_pathogenic_loci_json_path}")
-	fopen = gzip.open if args.known_pathogenic_loci_json_path.endswith("gz") else open
-	with fopen(args.known_pathogenic_loci_json_path, "rt") as f:
-		known_pathogenic_loci = json.load(f)
-		known_pathogenic_reference_regions_lookup = {}
-		for locus in known_pathogenic_loci:
-			motifs = parse_motifs_from_locus_structure(locus["LocusStructure"])
-			if isinstance(locus["ReferenceRegion"], list):
-				assert isinstance(locus["VariantId"], list)
-				assert len(locus["ReferenceRegion"]) == len(locus["VariantId"])
-				assert len(locus["ReferenceRegion"]) == len(motifs)
-				for variant_id, reference_region, motif in zip(locus["VariantId"], locus["ReferenceRegion"], motifs):
-					known_pathogenic_reference_regions_lookup[variant_id] = (reference_region, motif)
-			else:
-				known_pathogenic_reference_regions_lookup[locus["LocusId"]] = (locus["ReferenceRegion"], motifs[0])
+	with profile_phase("load annotation sources"):
+		annotator = LPSAnnotator(args.lps_table, args.known_pathogenic_loci_json_path,
+								 annotation_cache_dir=args.annotation_cache_dir, max_memory=args.max_memory)
 
-	print(f"Parsed {len(known_pathogenic_reference_regions_lookup)} known pathogenic loci")
-	print(f"Parsing {args.lps_table}")
-	df = pd.read_table(args.lps_table)
-	missing_columns = {"TRID", "longestPureSegmentMotif", "N_motif", "Stdev"} - set(df.columns)
-	if missing_columns:
-		parser.error(f"{args.lps_table} is missing expected columns: {missing_columns}")
-
-	before = len(df)
-	df = df[~df["longestPureSegmentMotif"].isna() & ~df["Stdev"].isna() & ~df["N_motif"].isna()]
-	print(f"Filtered out {before - len(df):,d} out of {before:,d} ({(before - len(df)) / before:.1%}) records with missing values")
-
-	# sum the N_motif column across all rows with the same TRID
-	TRID_to_N_motif_sum_lookup = dict(df.groupby("TRID")["N_motif"].sum())
-
-	annotation_lookup = {}
-	row_iterator = df.iterrows()
-	if args.show_progress_bar:
-		row_iterator = tqdm.tqdm(row_iterator, total=len(df), unit=" records", unit_scale=True)
-		
-	for _, row in row_iterator:
-		TRID = row["TRID"]
-		# convert stdev in bp to stdev in repeat units
-		lps_stdev = round(row["Stdev"] / len(row['longestPureSegmentMotif']), 3)
-		motif_fraction_string = f"{row['longestPureSegmentMotif']}: {row['N_motif']}/{TRID_to_N_motif_sum_lookup[TRID]}"
-		for locus_id in TRID.split(","):
-			if locus_id in known_pathogenic_reference_regions_lookup:
-				reference_region, motif = known_pathogenic_reference_regions_lookup[locus_id]
-			else:
-				assert locus_id.count("-") == 3
-				chrom, start_0based, end, motif = locus_id.split("-")
-				reference_region = f"{chrom}:{start_0based}-{end}"
-			
-			if motif != row["longestPureSegmentMotif"]:
-				continue
-				
-			annotation_lookup[locus_id] = {
-				"LPSLengthStdevFromHPRC100": lps_stdev,
-				"LPSMotifFractionFromHPRC100": motif_fraction_string,
-			}
-
-	input_locus_counter = annotated_locus_counter = 0
 	print(f"Adding LPS annotations to {args.catalog_json_path}")
-	fopen = gzip.open if args.catalog_json_path.endswith("gz") else open
-	with fopen(args.catalog_json_path, "rt") as f:
-		f2open = gzip.open if args.output_catalog_json_path.endswith("gz") else open
-		with f2open(args.output_catalog_json_path, "wt") as f2:
-			iterator = ijson.items(f, "item")
-			if args.show_progress_bar:
-				iterator = tqdm.tqdm(iterator, unit=" records", unit_scale=True)
-			f2.write("[")
-			for i, record in enumerate(iterator):
-				locus_id = record["LocusId"]
-				input_locus_counter += 1
-				if locus_id in annotation_lookup:
-					record.update(annotation_lookup[locus_id])
-					annotated_locus_counter += 1
-				if i > 0:
-					f2.write(", ")
-				f2.write(json.dumps(record, f2, use_decimal=True, indent=4))
-			f2.write("]")
-
-	print(f"Annotated {annotated_locus_counter:,d} out of {input_locus_counter:,d} loci")
+	annotate_catalog(args.catalog_json_path, args.output_catalog_json_path, [annotator],
+					 show_progress_bar=args.show_progress_bar, threads=args.threads, passthrough=args.passthrough)
+
 	print(f"Wrote annotated catalog to {args.output_catalog_json_path}")
 
 if __name__ == "__main__":
-	main()
-
+	run_main(main)
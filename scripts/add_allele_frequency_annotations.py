@@ -1,35 +1,34 @@
 import argparse
 import collections
-import gzip
-import ijson
-from intervaltree import Interval, IntervalTree
-import json
+import functools
+import numpy as np
 import os
 import pandas as pd
 import re
+import tempfile
 from str_analysis.utils.canonical_repeat_unit import compute_canonical_motif
-from str_analysis.utils.file_utils import download_local_copy
 from str_analysis.utils.misc_utils import parse_interval
-from str_analysis.utils.eh_catalog_utils import get_variant_catalog_iterator
-
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument("--skip-illumina174k-frequencies", action="store_true",
-                    help="Skip annotating with allele frequencies from Illumina 174k catalog")
-parser.add_argument("--skip-t2t-assembly-frequencies", action="store_true",
-                    help="Skip annotating with allele frequencies from T2T assemblies")
-parser.add_argument("--add-t2t-assembly-frequencies-to-overlapping-loci", action="store_true",
-                    help="By default, this script will only add the AlleleFrequenciesFromT2TAssemblies field to loci "
-                         "that exactly match the boundaries of loci in the T2T assemblies catalog. This option enables "
-                         "adding the AlleleFrequenciesFromT2TAssemblies field to overlapping loci with matching motifs "
-                         "after attempting to correct the repeat counts in the allele frequency histogram for any "
-                         "changes to the locus size.")
-parser.add_argument("-o", "--output-path", help="Output JSON path for annotated catalog")
-parser.add_argument("input_variant_catalog", help="Variant catalog in JSON or BED format")
-args, _ = parser.parse_known_args()
-
-if not args.output_path:
-    args.output_path = re.sub("(.bed|.json)(.gz)?$", "", os.path.expanduser(args.input_variant_catalog))
-    args.output_path += ".with_allele_frequences.json"
+
+from annotation_source_cache import DEFAULT_ANNOTATION_CACHE_DIR, ArrayBuilder, KeyIndex, StringArray, \
+    StringArrayBuilder, add_prefix, compile_key_index, load_compiled_source, remove_prefix
+from catalog_annotator import CatalogAnnotator, annotate_catalog
+from download_cache import DEFAULT_CACHE_DIR, DownloadCache
+from interval_index import IntervalIndex
+from locus_key import encode_positions
+from memory_budget import add_max_memory_argument, get_rows_per_chunk
+from profiling import add_profiling_arguments, profile_phase, run_main
+
+ILLUMINA_174K_URL = "https://github.com/Illumina/RepeatCatalogs/raw/master/hg38/genotype/1000genomes/1kg.gt.hist.tsv.gz"
+T2T_ASSEMBLIES_URL = "gs://str-truth-set-v2/filter_vcf/all_repeats_including_homopolymers_keeping_loci_that_have_overlapping_variants/combined/joined.78_samples.variants.tsv.gz"
+
+# increment this when the output of compile_illumina174k_table or compile_t2t_assemblies_table changes
+PARSER_VERSION = 2
+
+T2T_BATCH_SIZE = 100_000
+
+# approximate memory used per table row while a chunk of rows is being compiled with --max-memory
+ILLUMINA_174K_BYTES_PER_ROW = 2_000
+T2T_ASSEMBLIES_BYTES_PER_ROW = 5_000
 
 def convert_allele_histogram_dict_to_string(allele_histogram_dict):
     data = sorted(allele_histogram_dict.items())
@@ -48,146 +47,366 @@ def get_stdev_of_allele_histogram_dict(allele_histogram_dict):
     mean = sum(repeat_number * count for repeat_number, count in allele_histogram_dict.items()) / total
     return (sum((repeat_number - mean) ** 2 * count for repeat_number, count in allele_histogram_dict.items()) / total) ** 0.5
 
-#%%
-
-histograms_from_illumina_174k = {}
-stdev_from_illumina_174k = {}
-if not args.skip_illumina174k_frequencies:
-    # download illumina table
-    url = "https://github.com/Illumina/RepeatCatalogs/raw/master/hg38/genotype/1000genomes/1kg.gt.hist.tsv.gz"
-    print(f"Loading allele frequencies for the Illumina 174k catalog from {url}")
-    df1 = pd.read_table(download_local_copy(url))
-    print(f"Parsed {len(df1):,d} rows")
-    print("Computing histograms for Illumina 174k")
-    for _, record in df1.iterrows():
-        chrom, start_0based, end = record.VariantId.split("_")
-        chrom = chrom.replace("chr", "")
-        repeat_numbers = [int(x) for x in record.RepeatNumbers.split(",")]
-        allele_counts = [int(x) for x in record.AlleleCounts.split(",")]
-        if len(repeat_numbers) != len(allele_counts):
-            raise ValueError(f"RepeatNumbers and AlleleCounts have different lengths: {record.to_dict()}")
-
-        key = (chrom, int(start_0based), int(end))
-        histogram_dict = dict(zip(repeat_numbers, allele_counts))
-        histograms_from_illumina_174k[key] = convert_allele_histogram_dict_to_string(histogram_dict)
-        stdev_from_illumina_174k[key] = get_stdev_of_allele_histogram_dict(histogram_dict)
-
-    print(f"Processed allele frequency histograms for {len(df1):,d} rows and computed {len(histograms_from_illumina_174k):,d} records")
-df1 = None
-
-histograms_from_t2t_assemblies = {}
-stdev_from_t2t_assemblies = {}
-interval_trees_for_t2t_assemblies = collections.defaultdict(IntervalTree)
-if not args.skip_t2t_assembly_frequencies:
-    # download table of genotypes from T2T assemblies
-    url2 = "gs://str-truth-set-v2/filter_vcf/all_repeats_including_homopolymers_keeping_loci_that_have_overlapping_variants/combined/joined.78_samples.variants.tsv.gz"
-    print(f"Loading allele frequencies for the catalog of polymorphic loci in T2T assemblies from {url2}")
-    df2 = pd.read_table(download_local_copy(url2))
-    print(f"Parsed {len(df2):,d} rows")
-    print("Computing histograms for T2T assemblies")
-    allele_columns = [c for c in df2.columns if c.startswith("NumRepeats") and c != "NumRepeatsInReference"]
-    df2.rename(columns={c: c.replace(":", "_") for c in allele_columns}, inplace=True)
-    allele_columns = [c.replace(":", "_") for c in allele_columns]
-
-    for record in df2.itertuples():
-        chrom, start_1based, end = parse_interval(record.Locus)
-        start_0based = start_1based - 1
-        chrom = chrom.replace("chr", "")
-        key = (chrom, start_0based, end)
-        histogram_dict = collections.Counter()
-        for c in allele_columns:
-            allele_size = getattr(record, c) if not pd.isna(getattr(record, c)) else record.NumRepeatsInReference
-            histogram_dict[int(float(allele_size))] += 1
-
-        histograms_from_t2t_assemblies[key] = convert_allele_histogram_dict_to_string(histogram_dict)
-        stdev_from_t2t_assemblies[key] = get_stdev_of_allele_histogram_dict(histogram_dict)
-
-        if end > start_0based:
-            interval_trees_for_t2t_assemblies[chrom].add(Interval(start_0based, end, data = {
-                "HistogramDict": histogram_dict,
-                "CanonicalMotif": record.CanonicalMotif,
-            }))
-
-    print(f"Processed allele frequency histograms from {len(df2):,d} rows and computed {len(histograms_from_t2t_assemblies):,d} records")
-df2 = None
-
-#%%
-print(f"Parsing and annotating {args.input_variant_catalog}")
-counters = collections.Counter()
-fopen = gzip.open if args.output_path.endswith("gz") else open
-with fopen(os.path.expanduser(args.output_path), "wt") as out:
-    out.write("[")
-    for i, record in enumerate(get_variant_catalog_iterator(os.path.expanduser(args.input_variant_catalog))):
-        record = dict(record)
-        counters["total"] += 1
-        if isinstance(record["ReferenceRegion"], list):
-            raise ValueError(f"ReferenceRegion is a list in {record.to_dict()}")
-        chrom, start_0based, end = parse_interval(record["ReferenceRegion"])
-        chrom = chrom.replace("chr", "")
-        key = (chrom, start_0based, end)
-        if key in histograms_from_illumina_174k:
-            counters["found_illumina174_histogram"] += 1
-            record["AlleleFrequenciesFromIllumina174k"] = histograms_from_illumina_174k[key]
-            record["StdevFromIllumina174k"] = stdev_from_illumina_174k[key]
-
-        if key in histograms_from_t2t_assemblies:
-            counters["found_t2t_assemblies_histogram"] += 1
-            record["AlleleFrequenciesFromT2TAssemblies"] = histograms_from_t2t_assemblies[key]
-            record["StdevFromT2TAssemblies"] = stdev_from_t2t_assemblies[key]
-        else:
-            # check for overlap with nearby interval
-            if not record.get("CanonicalMotif"):
-                record["CanonicalMotif"] = compute_canonical_motif(record["LocusStructure"].strip("()*+").upper())
-            motif_size = len(record["CanonicalMotif"])
-
-            matching_interval = None
-            for interval in interval_trees_for_t2t_assemblies[chrom].overlap(start_0based, end):
-                if interval.data["CanonicalMotif"] != record["CanonicalMotif"]:
-                    continue
-                if interval.length() >= 2*motif_size and (end-start_0based) >= 2*motif_size and interval.overlap_size(start_0based, end) < 2 * motif_size:
-                    # if the two intervals overlap by less than 2x motif length, skip it
-                    continue
-
-                matching_interval = interval
-                break
-
-            if matching_interval:
-                counters["found_t2t_assemblies_histogram_via_overlap"] += 1
-                histogram_dict = matching_interval.data["HistogramDict"]
-                record["StdevFromT2TAssemblies"] = get_stdev_of_allele_histogram_dict(histogram_dict)
-
-                # allow equal-sized intervals thata are shifted relative to each other
-                intervals_are_the_same_size = matching_interval.length()//motif_size == (end - start_0based)//motif_size
-                # allow one interval to contain the other
-                one_interval_contains_the_other = not (
-                    (interval.begin > start_0based and interval.end > end) or (interval.begin < start_0based and interval.end < end)
-                )
-                if args.add_t2t_assembly_frequencies_to_overlapping_loci and (
-                    intervals_are_the_same_size or
-                    one_interval_contains_the_other
-                ):
-                    # Adjust the genotype repeat count by the difference in locus boundaries since changes in locus
-                    # boundaries affect the overall repeat count in each allele.
-                    locus_boundary_diff = ((matching_interval.end - matching_interval.begin) - (end - start_0based))//len(record["CanonicalMotif"])
-                    histogram_dict_adjusted = {
-                        repeat_number - locus_boundary_diff: count for repeat_number, count in histogram_dict.items()
-                    }
-                    if all(repeat_number >= 0 for repeat_number in histogram_dict_adjusted.keys()):
-                        # only use the histogram if all repeat numbers are non-negative. Othewise, something went wrong with the size adjustment
-                        record["AlleleFrequenciesFromT2TAssemblies"] = convert_allele_histogram_dict_to_string(histogram_dict_adjusted)
-
-        if i > 0:
-            out.write(", ")
-        json.dump(record, out, indent=1)
-    out.write("]\n")
-
-print(f"Annotated {counters['found_illumina174_histogram']:,d} out of {counters['total']:,d} loci in the Illumina 174k allele frequency catalog")
-print(f"Annotated {counters['found_t2t_assemblies_histogram']:,d} out of {counters['total']:,d} loci in the T2T assemblies allele frequency catalog")
-print(f"Annotated {counters['found_t2t_assemblies_histogram_via_overlap']:,d} out of {counters['total']:,d} loci in the T2T assemblies allele frequency catalog based on overlap")
-print(f"Wrote {counters['total']:,d} records to {args.output_path}")
-
-#%%
-
-
-
-# gs://str-truth-set-v2/filter_vcf/all_repeats_including_homopolymers/combined/joined_only_pure_repeats.78_samples.variants.tsv.gz
\ No newline at end of file
+def convert_allele_histogram_arrays_to_strings(repeat_numbers, allele_counts, histogram_sizes):
+    """Vectorized version of convert_allele_histogram_dict_to_string for many histograms at once.
+
+    Args:
+        repeat_numbers (np.array): the repeat numbers of all histograms, concatenated and sorted within each histogram
+        allele_counts (np.array): the allele count for each entry in repeat_numbers
+        histogram_sizes (np.array): the number of entries in each histogram
+
+    Return:
+        list: histogram strings like "10x:3,11x:5"
+    """
+    entries = [f"{repeat_number}x:{allele_count}" for repeat_number, allele_count in zip(
+        repeat_numbers.tolist(), allele_counts.tolist())]
+    offsets = np.concatenate([[0], np.cumsum(histogram_sizes)]).tolist()
+    return [",".join(entries[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+def get_stdevs_of_allele_histogram_arrays(repeat_numbers, allele_counts, histogram_sizes):
+    """Vectorized version of get_stdev_of_allele_histogram_dict. Takes the same arguments as
+    convert_allele_histogram_arrays_to_strings and returns a list of standard deviations."""
+    histogram_starts = np.concatenate([[0], np.cumsum(histogram_sizes)[:-1]])
+    histogram_indices = np.repeat(np.arange(len(histogram_sizes)), histogram_sizes)
+    repeat_numbers = repeat_numbers.astype(float)
+    totals = np.add.reduceat(allele_counts, histogram_starts)
+    means = np.add.reduceat(repeat_numbers * allele_counts, histogram_starts) / totals
+    variances = np.add.reduceat((repeat_numbers - means[histogram_indices]) ** 2 * allele_counts, histogram_starts) / totals
+    return np.sqrt(variances).tolist()
+
+def parse_allele_size_matrix(allele_sizes):
+    """Converts a matrix with one row per locus and one column per allele into histograms.
+
+    Args:
+        allele_sizes (np.array): 2D integer array of repeat numbers
+
+    Return:
+        3-tuple: (repeat_numbers, allele_counts, histogram_sizes) arrays as described in
+            convert_allele_histogram_arrays_to_strings
+    """
+    allele_sizes = np.sort(allele_sizes, axis=1)
+    is_first_in_run = np.ones(allele_sizes.shape, dtype=bool)
+    is_first_in_run[:, 1:] = allele_sizes[:, 1:] != allele_sizes[:, :-1]
+    run_starts = np.flatnonzero(is_first_in_run)
+    repeat_numbers = allele_sizes.ravel()[run_starts]
+    allele_counts = np.diff(np.append(run_starts, allele_sizes.size))
+    histogram_sizes = is_first_in_run.sum(axis=1)
+    return repeat_numbers, allele_counts, histogram_sizes
+
+
+def read_table_in_chunks(table_path, max_memory, bytes_per_row):
+    """Yields the whole table as one DataFrame, or if max_memory is specified, yields chunks of rows that each use
+    about max_memory bytes"""
+    if max_memory is None:
+        yield pd.read_table(table_path)
+    else:
+        yield from pd.read_table(table_path, chunksize=get_rows_per_chunk(max_memory, bytes_per_row))
+
+
+def compile_illumina174k_table(table_path, max_memory=None):
+    """Parse the Illumina 174k allele frequency table into arrays for the annotation source cache. If max_memory is
+    specified, the table is parsed in chunks and the compiled arrays are spilled to disk as they are built."""
+    with tempfile.TemporaryDirectory(prefix="illumina174k_table.") as temp_dir:
+        spill_dir = temp_dir if max_memory is not None else None
+        keys = ArrayBuilder(np.uint64, spill_dir)
+        histograms = StringArrayBuilder(spill_dir)
+        stdevs = ArrayBuilder(float, spill_dir)
+        num_rows = 0
+        for df1 in read_table_in_chunks(table_path, max_memory, ILLUMINA_174K_BYTES_PER_ROW):
+            num_rows += len(df1)
+            print(f"Parsed {num_rows:,d} rows")
+            print("Computing histograms for Illumina 174k")
+            variant_id_columns = df1.VariantId.str.split("_", expand=True)
+            chroms = variant_id_columns[0].tolist()
+            starts_0based = variant_id_columns[1].astype(int).tolist()
+            ends = variant_id_columns[2].astype(int).tolist()
+
+            df1["RepeatNumbers"] = df1.RepeatNumbers.astype(str)
+            df1["AlleleCounts"] = df1.AlleleCounts.astype(str)
+            histogram_sizes = df1.RepeatNumbers.str.count(",").to_numpy() + 1
+            mismatched_rows = histogram_sizes != df1.AlleleCounts.str.count(",").to_numpy() + 1
+            if mismatched_rows.any():
+                raise ValueError(f"RepeatNumbers and AlleleCounts have different lengths: {df1[mismatched_rows].iloc[0].to_dict()}")
+            repeat_numbers = np.array(",".join(df1.RepeatNumbers).split(","), dtype=np.int64)
+            allele_counts = np.array(",".join(df1.AlleleCounts).split(","), dtype=np.int64)
+
+            # sort the entries within each histogram by repeat number. If a repeat number is listed more than once, keep
+            # its last allele count.
+            histogram_indices = np.repeat(np.arange(len(df1)), histogram_sizes)
+            order = np.lexsort((repeat_numbers, histogram_indices))
+            repeat_numbers, allele_counts, histogram_indices = repeat_numbers[order], allele_counts[order], histogram_indices[order]
+            is_last_entry = np.ones(len(repeat_numbers), dtype=bool)
+            is_last_entry[:-1] = (repeat_numbers[1:] != repeat_numbers[:-1]) | (histogram_indices[1:] != histogram_indices[:-1])
+            repeat_numbers, allele_counts = repeat_numbers[is_last_entry], allele_counts[is_last_entry]
+            histogram_sizes = np.bincount(histogram_indices[is_last_entry], minlength=len(df1))
+
+            keys.append(encode_positions(chroms, starts_0based, ends))
+            histograms.append(convert_allele_histogram_arrays_to_strings(repeat_numbers, allele_counts, histogram_sizes))
+            stdevs.append(get_stdevs_of_allele_histogram_arrays(repeat_numbers, allele_counts, histogram_sizes))
+
+        print(f"Processed allele frequency histograms for {num_rows:,d} rows")
+        return {
+            **add_prefix("key_index_", compile_key_index(keys.build())),
+            **add_prefix("histograms_", histograms.build()),
+            "stdevs": stdevs.build(),
+        }
+
+def compile_t2t_assemblies_table(table_path, max_memory=None):
+    """Parse the table of genotypes from T2T assemblies into arrays for the annotation source cache. If max_memory is
+    specified, the table is parsed in chunks and the compiled arrays are spilled to disk as they are built."""
+    with tempfile.TemporaryDirectory(prefix="t2t_assemblies_table.") as temp_dir:
+        spill_dir = temp_dir if max_memory is not None else None
+        keys = ArrayBuilder(np.uint64, spill_dir)
+        histograms = StringArrayBuilder(spill_dir)
+        stdevs = ArrayBuilder(float, spill_dir)
+
+        # the non-empty T2T loci are indexed for overlap queries, and their histograms are kept in flat arrays
+        interval_chroms = []
+        interval_starts_0based = ArrayBuilder(np.int64, spill_dir)
+        interval_ends = ArrayBuilder(np.int64, spill_dir)
+        interval_motifs = []
+        interval_repeat_numbers = ArrayBuilder(np.int32, spill_dir)
+        interval_allele_counts = ArrayBuilder(np.int32, spill_dir)
+        interval_histogram_sizes = ArrayBuilder(np.int64, spill_dir)
+        # chromosome and motif strings are shared between rows so that each row only needs a reference to them
+        shared_strings = {}
+
+        num_rows = 0
+        for df2 in read_table_in_chunks(table_path, max_memory, T2T_ASSEMBLIES_BYTES_PER_ROW):
+            num_rows += len(df2)
+            print(f"Parsed {num_rows:,d} rows")
+            print("Computing histograms for T2T assemblies")
+            allele_columns = [c for c in df2.columns if c.startswith("NumRepeats") and c != "NumRepeatsInReference"]
+
+            locus_columns = df2.Locus.str.rsplit(":", n=1, expand=True)
+            interval_columns = locus_columns[1].str.split("-", expand=True)
+            chroms = locus_columns[0].str.replace("chr", "", regex=False).to_numpy(dtype=object)
+            starts_0based = interval_columns[0].astype(int).to_numpy() - 1
+            ends = interval_columns[1].astype(int).to_numpy()
+            keys.append(encode_positions(chroms, starts_0based, ends))
+
+            # process the allele matrix in batches to limit memory use
+            reference_allele_sizes = df2.NumRepeatsInReference.to_numpy(dtype=float)
+            is_non_empty = ends > starts_0based
+            for batch_start in range(0, len(df2), T2T_BATCH_SIZE):
+                batch_end = min(batch_start + T2T_BATCH_SIZE, len(df2))
+                allele_sizes = df2[allele_columns].iloc[batch_start:batch_end].to_numpy(dtype=float)
+                # alleles with no genotype are assumed to match the reference
+                allele_sizes = np.where(np.isnan(allele_sizes), reference_allele_sizes[batch_start:batch_end, None], allele_sizes)
+                repeat_numbers, allele_counts, histogram_sizes = parse_allele_size_matrix(allele_sizes.astype(np.int64))
+
+                histograms.append(convert_allele_histogram_arrays_to_strings(repeat_numbers, allele_counts, histogram_sizes))
+                stdevs.append(get_stdevs_of_allele_histogram_arrays(repeat_numbers, allele_counts, histogram_sizes))
+
+                batch_is_non_empty = is_non_empty[batch_start:batch_end]
+                entry_is_non_empty = np.repeat(batch_is_non_empty, histogram_sizes)
+                interval_repeat_numbers.append(repeat_numbers[entry_is_non_empty])
+                interval_allele_counts.append(allele_counts[entry_is_non_empty])
+                interval_histogram_sizes.append(histogram_sizes[batch_is_non_empty])
+
+            interval_chroms += [shared_strings.setdefault(chrom, chrom) for chrom in chroms[is_non_empty].tolist()]
+            interval_starts_0based.append(starts_0based[is_non_empty])
+            interval_ends.append(ends[is_non_empty])
+            interval_motifs += [
+                shared_strings.setdefault(motif, motif) for motif in df2.CanonicalMotif.to_numpy(dtype=object)[is_non_empty].tolist()
+            ]
+
+        interval_index = IntervalIndex(interval_chroms, interval_starts_0based.build(), interval_ends.build(), interval_motifs)
+
+        print(f"Processed allele frequency histograms from {num_rows:,d} rows")
+        return {
+            **add_prefix("key_index_", compile_key_index(keys.build())),
+            **add_prefix("histograms_", histograms.build()),
+            "stdevs": stdevs.build(),
+            **add_prefix("interval_index_", interval_index.get_arrays()),
+            "interval_histogram_repeat_numbers": interval_repeat_numbers.build(),
+            "interval_histogram_allele_counts": interval_allele_counts.build(),
+            "interval_histogram_offsets": np.concatenate([[0], np.cumsum(interval_histogram_sizes.build())]),
+        }
+
+
+class AlleleFrequencyAnnotator(CatalogAnnotator):
+    """Adds allele frequency histograms and standard deviations from the Illumina 174k catalog and from T2T assemblies"""
+
+    name = "allele frequencies"
+
+    def __init__(self, skip_illumina174k_frequencies=False, skip_t2t_assembly_frequencies=False,
+                 add_t2t_assembly_frequencies_to_overlapping_loci=False, download_cache_dir=None,
+                 download_mirror_dir=None, annotation_cache_dir=None, max_memory=None):
+        super().__init__()
+        download_cache = DownloadCache(download_cache_dir, mirror_dir=download_mirror_dir)
+        self.add_t2t_assembly_frequencies_to_overlapping_loci = add_t2t_assembly_frequencies_to_overlapping_loci
+
+        self.illumina174k_key_index = None
+        if not skip_illumina174k_frequencies:
+            print(f"Loading allele frequencies for the Illumina 174k catalog from {ILLUMINA_174K_URL}")
+            arrays = load_compiled_source(
+                "illumina174k_allele_frequencies", [download_cache.fetch(ILLUMINA_174K_URL)], PARSER_VERSION,
+                functools.partial(compile_illumina174k_table, max_memory=max_memory), cache_dir=annotation_cache_dir)
+            self.illumina174k_key_index = KeyIndex(remove_prefix("key_index_", arrays))
+            self.illumina174k_histograms = StringArray(remove_prefix("histograms_", arrays))
+            self.illumina174k_stdevs = arrays["stdevs"]
+            print(f"Loaded allele frequency histograms for {len(self.illumina174k_key_index):,d} loci")
+
+        self.t2t_key_index = None
+        self.t2t_interval_index = None
+        if not skip_t2t_assembly_frequencies:
+            print(f"Loading allele frequencies for the catalog of polymorphic loci in T2T assemblies from {T2T_ASSEMBLIES_URL}")
+            arrays = load_compiled_source(
+                "t2t_assemblies_allele_frequencies", [download_cache.fetch(T2T_ASSEMBLIES_URL)], PARSER_VERSION,
+                functools.partial(compile_t2t_assemblies_table, max_memory=max_memory), cache_dir=annotation_cache_dir)
+            self.t2t_key_index = KeyIndex(remove_prefix("key_index_", arrays))
+            self.t2t_histograms = StringArray(remove_prefix("histograms_", arrays))
+            self.t2t_stdevs = arrays["stdevs"]
+            self.t2t_interval_index = IntervalIndex.from_arrays(remove_prefix("interval_index_", arrays))
+            self.t2t_histogram_repeat_numbers = arrays["interval_histogram_repeat_numbers"]
+            self.t2t_histogram_allele_counts = arrays["interval_histogram_allele_counts"]
+            self.t2t_histogram_offsets = arrays["interval_histogram_offsets"]
+            print(f"Loaded allele frequency histograms for {len(self.t2t_key_index):,d} loci")
+
+    def annotate_record(self, record):
+        return self.annotate_records([record])[0]
+
+    def annotate_records(self, records):
+        # records that don't exactly match a T2T locus are grouped by chromosome and then checked for overlap with
+        # T2T loci all at once
+        overlap_queries = collections.defaultdict(list)
+        intervals = []
+        for record in records:
+            if isinstance(record["ReferenceRegion"], list):
+                raise ValueError(f"ReferenceRegion is a list in {record.to_dict()}")
+            chrom, start_0based, end = parse_interval(record["ReferenceRegion"])
+            intervals.append((chrom.replace("chr", ""), start_0based, end))
+        keys = encode_positions(*zip(*intervals)) if intervals else []
+
+        illumina174k_rows = self.illumina174k_key_index.get_batch(keys).tolist() if self.illumina174k_key_index else [-1] * len(keys)
+        t2t_rows = self.t2t_key_index.get_batch(keys).tolist() if self.t2t_key_index else [-1] * len(keys)
+        for record, (chrom, start_0based, end), illumina174k_row, t2t_row in zip(records, intervals, illumina174k_rows, t2t_rows):
+            if illumina174k_row >= 0:
+                self.counters["found_illumina174_histogram"] += 1
+                record["AlleleFrequenciesFromIllumina174k"] = self.illumina174k_histograms[illumina174k_row]
+                record["StdevFromIllumina174k"] = float(self.illumina174k_stdevs[illumina174k_row])
+
+            if t2t_row >= 0:
+                self.counters["found_t2t_assemblies_histogram"] += 1
+                record["AlleleFrequenciesFromT2TAssemblies"] = self.t2t_histograms[t2t_row]
+                record["StdevFromT2TAssemblies"] = float(self.t2t_stdevs[t2t_row])
+            elif self.t2t_interval_index is not None:
+                # check for overlap with nearby interval
+                if not record.get("CanonicalMotif"):
+                    record["CanonicalMotif"] = compute_canonical_motif(record["LocusStructure"].strip("()*+").upper())
+                motif_id = self.t2t_interval_index.get_motif_id(record["CanonicalMotif"])
+                if motif_id >= 0:
+                    overlap_queries[chrom].append((start_0based, end, motif_id, len(record["CanonicalMotif"]), record))
+
+        for chrom, queries in overlap_queries.items():
+            query_starts, query_ends, query_motif_ids, query_motif_sizes, query_records = zip(*queries)
+            query_starts = np.array(query_starts)
+            query_ends = np.array(query_ends)
+            query_indices, interval_indices = self.t2t_interval_index.overlap_batch(chrom, query_starts, query_ends)
+
+            interval_starts = self.t2t_interval_index.starts[interval_indices]
+            interval_ends = self.t2t_interval_index.ends[interval_indices]
+            motif_sizes = np.array(query_motif_sizes)[query_indices]
+            overlap_sizes = np.minimum(interval_ends, query_ends[query_indices]) - np.maximum(interval_starts, query_starts[query_indices])
+            is_match = self.t2t_interval_index.motif_ids[interval_indices] == np.array(query_motif_ids)[query_indices]
+            # if the two intervals overlap by less than 2x motif length, skip it
+            is_match &= ~(
+                (interval_ends - interval_starts >= 2*motif_sizes) &
+                (query_ends[query_indices] - query_starts[query_indices] >= 2*motif_sizes) &
+                (overlap_sizes < 2*motif_sizes)
+            )
+
+            # use the first matching interval for each query
+            matching_query_indices, first_match = np.unique(query_indices[is_match], return_index=True)
+            matching_interval_indices = interval_indices[is_match][first_match]
+            for query_index, interval_index in zip(matching_query_indices.tolist(), matching_interval_indices.tolist()):
+                self.add_histogram_from_overlapping_t2t_locus(
+                    query_records[query_index], int(query_starts[query_index]), int(query_ends[query_index]), interval_index)
+
+        return ["StdevFromIllumina174k" in record or "StdevFromT2TAssemblies" in record for record in records]
+
+    def add_histogram_from_overlapping_t2t_locus(self, record, start_0based, end, interval_index):
+        self.counters["found_t2t_assemblies_histogram_via_overlap"] += 1
+        interval_begin = int(self.t2t_interval_index.starts[interval_index])
+        interval_end = int(self.t2t_interval_index.ends[interval_index])
+        histogram_start, histogram_end = self.t2t_histogram_offsets[interval_index:interval_index+2].tolist()
+        histogram_dict = dict(zip(
+            self.t2t_histogram_repeat_numbers[histogram_start:histogram_end].tolist(),
+            self.t2t_histogram_allele_counts[histogram_start:histogram_end].tolist()))
+        record["StdevFromT2TAssemblies"] = get_stdev_of_allele_histogram_dict(histogram_dict)
+
+        motif_size = len(record["CanonicalMotif"])
+        # allow equal-sized intervals thata are shifted relative to each other
+        intervals_are_the_same_size = (interval_end - interval_begin)//motif_size == (end - start_0based)//motif_size
+        # allow one interval to contain the other
+        one_interval_contains_the_other = not (
+            (interval_begin > start_0based and interval_end > end) or (interval_begin < start_0based and interval_end < end)
+        )
+        if self.add_t2t_assembly_frequencies_to_overlapping_loci and (
+            intervals_are_the_same_size or
+            one_interval_contains_the_other
+        ):
+            # Adjust the genotype repeat count by the difference in locus boundaries since changes in locus
+            # boundaries affect the overall repeat count in each allele.
+            locus_boundary_diff = ((interval_end - interval_begin) - (end - start_0based))//motif_size
+            histogram_dict_adjusted = {
+                repeat_number - locus_boundary_diff: count for repeat_number, count in histogram_dict.items()
+            }
+            if all(repeat_number >= 0 for repeat_number in histogram_dict_adjusted.keys()):
+                # only use the histogram if all repeat numbers are non-negative. Othewise, something went wrong with the size adjustment
+                record["AlleleFrequenciesFromT2TAssemblies"] = convert_allele_histogram_dict_to_string(histogram_dict_adjusted)
+
+    def print_stats(self):
+        print(f"Annotated {self.counters['found_illumina174_histogram']:,d} out of {self.counters['total']:,d} loci in the Illumina 174k allele frequency catalog")
+        print(f"Annotated {self.counters['found_t2t_assemblies_histogram']:,d} out of {self.counters['total']:,d} loci in the T2T assemblies allele frequency catalog")
+        print(f"Annotated {self.counters['found_t2t_assemblies_histogram_via_overlap']:,d} out of {self.counters['total']:,d} loci in the T2T assemblies allele frequency catalog based on overlap")
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--skip-illumina174k-frequencies", action="store_true",
+                        help="Skip annotating with allele frequencies from Illumina 174k catalog")
+    parser.add_argument("--skip-t2t-assembly-frequencies", action="store_true",
+                        help="Skip annotating with allele frequencies from T2T assemblies")
+    parser.add_argument("--add-t2t-assembly-frequencies-to-overlapping-loci", action="store_true",
+                        help="By default, this script will only add the AlleleFrequenciesFromT2TAssemblies field to loci "
+                             "that exactly match the boundaries of loci in the T2T assemblies catalog. This option enables "
+                             "adding the AlleleFrequenciesFromT2TAssemblies field to overlapping loci with matching motifs "
+                             "after attempting to correct the repeat counts in the allele frequency histogram for any "
+                             "changes to the locus size.")
+    parser.add_argument("--download-cache-dir", default=DEFAULT_CACHE_DIR, help="Directory for caching the downloaded "
+                        "allele frequency tables")
+    parser.add_argument("--download-mirror-dir", help="Local directory that contains copies of the allele frequency "
+                        "tables. If specified, they are copied from here instead of being downloaded, for offline runs.")
+    parser.add_argument("--annotation-cache-dir", default=DEFAULT_ANNOTATION_CACHE_DIR, help="Directory for caching "
+                        "the parsed allele frequency tables")
+    add_max_memory_argument(parser)
+    parser.add_argument("--threads", type=int, default=1, help="Number of worker processes to use for annotating records")
+    parser.add_argument("-o", "--output-path", help="Output JSON path for annotated catalog")
+    parser.add_argument("input_variant_catalog", help="Variant catalog in JSON or BED format")
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.output_path:
+        args.output_path = re.sub("(.bed|.json)(.gz)?$", "", os.path.expanduser(args.input_variant_catalog))
+        args.output_path += ".with_allele_frequences.json"
+
+    with profile_phase("load annotation sources"):
+        annotator = AlleleFrequencyAnnotator(
+            skip_illumina174k_frequencies=args.skip_illumina174k_frequencies,
+            skip_t2t_assembly_frequencies=args.skip_t2t_assembly_frequencies,
+            add_t2t_assembly_frequencies_to_overlapping_loci=args.add_t2t_assembly_frequencies_to_overlapping_loci,
+            download_cache_dir=args.download_cache_dir,
+            download_mirror_dir=args.download_mirror_dir,
+            annotation_cache_dir=args.annotation_cache_dir,
+            max_memory=args.max_memory)
+
+    print(f"Parsing and annotating {args.input_variant_catalog}")
+    total = annotate_catalog(os.path.expanduser(args.input_variant_catalog), os.path.expanduser(args.output_path), [annotator],
+                             threads=args.threads)
+    print(f"Wrote {total:,d} records to {args.output_path}")
+
+
+if __name__ == "__main__":
+    run_main(main)
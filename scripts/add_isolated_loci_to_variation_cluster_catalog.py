@@ -1,23 +1,223 @@
 """This script takes a BED file of variation clusters and a JSON file of all tandem repeats and writes out a new BED file
 with all input variation clusters as well as any tandem repeats from teh input catalog that aren't embedded in variation clusters
 (ie. are isolated repeats).
+
+The output is sorted by chromosome name and start coordinate, the same way as 'bedtools sort', without running an
+external sort (see memory_budget.SortedBedWriter). It can optionally also write LongTR versions of the output and of
+the variation clusters BED file. annotate_catalog.py can produce the same outputs with IsolatedTRWriter while it annotates the
+catalog, so that the catalog and the variation clusters BED file don't have to be read again.
 """
 
 import argparse
 import collections
-import gzip
-import ijson
-import os
-import simplejson as json
+import numpy as np
 import re
-import sys
-import tqdm
 
-from str_analysis.utils.misc_utils import parse_interval
 from str_analysis.utils.eh_catalog_utils import get_variant_catalog_iterator
 from str_analysis.convert_expansion_hunter_catalog_to_trgt_catalog import convert_expansion_hunter_record_to_trgt_row
 
-MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD = 6
+from annotation_source_cache import KeyIndex, compile_key_index
+from bgzf_io import DEFAULT_THREADS, open_file
+from catalog_annotator import BATCH_SIZE, CatalogAnnotator
+from catalog_io import is_arrow_path, iterate_batches, iterate_catalog_records
+from convert_trgt_catalog_to_longtr_format import convert_trgt_row_to_longtr_row
+from diagnostics import Diagnostics
+from locus_key import encode_locus_ids
+from memory_budget import SortedBedWriter, add_max_memory_argument
+from merge_join import CHROM_ORDERS, MergeJoinSource, get_reference_region_interval, merge_join
+from profiling import add_profiling_arguments, iterate_in_phase, profile_phase, run_main
+from variation_clusters import VariationClusterStats, VariationClusterTable, iterate_variation_clusters, \
+	parse_known_pathogenic_reference_regions
+
+
+class LongTRWriter:
+	"""Converts TRGT BED rows to LongTR format (see convert_trgt_catalog_to_longtr_format.py) and writes them to a
+	BED file"""
+
+	def __init__(self, output_path, known_pathogenic_reference_regions_lookup, threads=DEFAULT_THREADS,
+				 print_all_warnings=False):
+		self.output_path = output_path
+		self.known_pathogenic_reference_regions_lookup = known_pathogenic_reference_regions_lookup
+		self.input_row_counter = 0
+		self.output_row_counter = 0
+		self.diagnostics = Diagnostics(verbose=print_all_warnings)
+		self._output_file = open_file(output_path, "wt", threads=threads)
+
+	def write(self, line):
+		self.input_row_counter += 1
+		output_row = convert_trgt_row_to_longtr_row(
+			line.strip("\n").split("\t"), self.known_pathogenic_reference_regions_lookup, self.diagnostics)
+		if output_row is not None:
+			self._output_file.write("\t".join(map(str, output_row)) + "\n")
+			self.output_row_counter += 1
+
+	def close(self):
+		self._output_file.close()
+		self.diagnostics.print_summary(self.output_path)
+		print(f"Wrote {self.output_row_counter:,d} out of {self.input_row_counter:,d} rows to {self.output_path}")
+
+
+def get_trgt_row(record):
+	"""Returns the (chrom, start_0based, end_1based, line) tuple of the TRGT BED row for the given catalog record"""
+	output_row = convert_expansion_hunter_record_to_trgt_row(record)
+	return output_row[0], int(output_row[1]), int(output_row[2]), "\t".join(map(str, output_row)) + "\n"
+
+
+class IsolatedTRWriter(CatalogAnnotator):
+	"""Writes the variation clusters and isolated TRs catalog as the records of the catalog are annotated. This doesn't
+	add any annotations to the records.
+
+	All variation clusters, and all catalog records whose LocusId isn't in a variation cluster, are written to a TRGT BED
+	file sorted by chromosome name and start coordinate. Optionally, LongTR versions of this BED file and of the
+	variation clusters BED file are also written.
+	"""
+
+	name = "isolated TRs"
+
+	# isolated TRs are collected from all records, so they can't be collected in separate worker processes
+	runs_in_main_process = True
+
+	def __init__(self, variation_cluster_table, output_bed_path, longtr_output_bed_path=None,
+				 variation_clusters_longtr_output_bed_path=None, threads=DEFAULT_THREADS, print_all_warnings=False,
+				 max_memory=None):
+		"""Args:
+			variation_cluster_table (VariationClusterTable): the parsed variation clusters BED file
+			output_bed_path (str): path of the output TRGT BED file
+			longtr_output_bed_path (str): optional path of the LongTR version of the output BED file
+			variation_clusters_longtr_output_bed_path (str): optional path of the LongTR version of the variation
+				clusters BED file
+			threads (int): number of compression threads
+			print_all_warnings (bool): print every warning from the LongTR conversion, instead of a summary
+			max_memory (int): optional number of bytes of isolated TRs to sort in memory before spilling them to disk
+		"""
+		super().__init__()
+		self.variation_cluster_table = variation_cluster_table
+		self.longtr_output_bed_path = longtr_output_bed_path
+		self.variation_clusters_longtr_output_bed_path = variation_clusters_longtr_output_bed_path
+		self.threads = threads
+		self.print_all_warnings = print_all_warnings
+
+		locus_keys, counts = np.unique(variation_cluster_table.locus_keys, return_counts=True)
+		if (counts > 1).any():
+			is_duplicate = np.isin(variation_cluster_table.locus_keys, locus_keys[counts > 1])
+			locus_ids = list(variation_cluster_table.iterate_locus_ids())
+			raise ValueError(f"locus_id '{locus_ids[int(np.flatnonzero(is_duplicate)[0])]}' occurs more than once")
+
+		# for each TR in a variation cluster, whether it was found in the input catalog
+		self.key_index = KeyIndex(compile_key_index(variation_cluster_table.locus_keys))
+		self.is_in_catalog = np.zeros(len(variation_cluster_table.locus_keys), dtype=bool)
+		self.sorted_bed_writer = SortedBedWriter(output_bed_path, threads=threads, max_memory=max_memory)
+
+	def annotate_record(self, record):
+		return self.annotate_records([record])[0]
+
+	def annotate_records(self, records):
+		rows = self.key_index.get_batch(encode_locus_ids([record["LocusId"] for record in records]))
+		self.is_in_catalog[rows[rows >= 0]] = True
+		self.counters["TRs_in_variation_clusters"] += int((rows >= 0).sum())
+		for record, row in zip(records, rows.tolist()):
+			if row < 0:
+				self.sorted_bed_writer.add(*get_trgt_row(record))
+				self.counters["isolated_TRs"] += 1
+
+		return [False] * len(records)
+
+	def close(self):
+		table = self.variation_cluster_table
+		if not self.is_in_catalog.all():
+			raise_error_for_locus_ids_not_in_catalog({
+				locus_id for locus_id, is_in_catalog in zip(table.iterate_locus_ids(), self.is_in_catalog.tolist())
+				if not is_in_catalog
+			})
+
+		# the variation clusters are merged with the isolated TRs in sorted order
+		variation_clusters_by_chrom = {}
+		for i in np.lexsort((table.ends, table.starts, table.chrom_ids)).tolist():
+			chrom = table.chroms[table.chrom_ids[i]]
+			variation_clusters_by_chrom.setdefault(chrom, []).append((int(table.starts[i]), int(table.ends[i]), table.lines[i]))
+
+		longtr_writer = None
+		if self.longtr_output_bed_path:
+			longtr_writer = LongTRWriter(
+				self.longtr_output_bed_path, table.known_pathogenic_reference_regions_lookup, threads=self.threads,
+				print_all_warnings=self.print_all_warnings)
+
+		self.sorted_bed_writer.close(
+			variation_clusters_by_chrom, on_write_row=longtr_writer.write if longtr_writer is not None else None)
+		if longtr_writer is not None:
+			longtr_writer.close()
+
+		if self.variation_clusters_longtr_output_bed_path:
+			longtr_writer = LongTRWriter(
+				self.variation_clusters_longtr_output_bed_path, table.known_pathogenic_reference_regions_lookup,
+				threads=self.threads, print_all_warnings=self.print_all_warnings)
+			for line in table.lines:
+				longtr_writer.write(line)
+			longtr_writer.close()
+
+	def print_stats(self):
+		total = self.counters["total"]
+		in_variation_clusters = self.counters["TRs_in_variation_clusters"]
+		print(f"{in_variation_clusters:,d} out of {total:,d} ({in_variation_clusters/max(1, total):.2%}) TRs were in "
+			  f"variation clusters")
+		print(f"Added {self.counters['isolated_TRs']:,d} isolated TRs to {self.sorted_bed_writer.output_path}")
+		print(f"Wrote {self.sorted_bed_writer.row_counter:,d} rows to {self.sorted_bed_writer.output_path}")
+
+
+def write_isolated_loci_using_merge_join(catalog_iterator, variation_clusters, sorted_bed_writer, counter,
+										 chrom_sort_key, variation_clusters_longtr_writer=None):
+	"""Add the variation clusters and the TRs from the catalog that aren't in any variation cluster to the
+	sorted_bed_writer. Unlike IsolatedTRWriter, this reads the variation clusters in lockstep with the catalog, so only
+	the variation clusters that overlap the current TR are kept in memory. The catalog and the variation clusters must
+	both be sorted by chromosome (in the order given by chrom_sort_key) and start coordinate, and each TR must overlap
+	the variation clusters that contain it."""
+	locus_ids_not_in_catalog = set()
+	def check_that_all_locus_ids_were_found(variation_cluster):
+		_, _, _, locus_ids, found_locus_ids = variation_cluster
+		locus_ids_not_in_catalog.update(locus_ids - found_locus_ids)
+
+	def get_variation_cluster_row(variation_cluster):
+		chrom, start_0based, end_1based, line, locus_ids, _ = variation_cluster
+		if len(set(locus_ids)) != len(locus_ids):
+			duplicate_locus_id = next(locus_id for locus_id in locus_ids if locus_ids.count(locus_id) > 1)
+			raise ValueError(f"locus_id '{duplicate_locus_id}' occurs more than once")
+
+		counter["variation_clusters"] += 1
+		line = line if line.endswith("\n") else f"{line}\n"
+		sorted_bed_writer.add(chrom, start_0based, end_1based, line)
+		if variation_clusters_longtr_writer is not None:
+			variation_clusters_longtr_writer.write(line)
+		return chrom, start_0based, end_1based, set(locus_ids), set()
+
+	variation_clusters_source = MergeJoinSource(
+		map(get_variation_cluster_row, variation_clusters), lambda variation_cluster: variation_cluster[:3],
+		"variation clusters BED file", on_discard=check_that_all_locus_ids_were_found)
+
+	# matches have to be recorded as each record is joined, since variation clusters are checked as soon as they are
+	# discarded from the merge join window
+	for record, [overlapping_variation_clusters] in merge_join(
+			catalog_iterator, get_reference_region_interval, [variation_clusters_source], chrom_sort_key=chrom_sort_key):
+		counter["TRs_from_catalog"] += 1
+		matching_variation_clusters = [
+			variation_cluster for variation_cluster in overlapping_variation_clusters if record["LocusId"] in variation_cluster[3]
+		]
+		if len(matching_variation_clusters) > 1:
+			raise ValueError(f"locus_id '{record['LocusId']}' occurs more than once")
+		elif matching_variation_clusters:
+			matching_variation_clusters[0][4].add(record["LocusId"])
+			counter["TRs_in_variation_clusters"] += 1
+		else:
+			sorted_bed_writer.add(*get_trgt_row(record))
+			counter["isolated_TRs"] += 1
+
+	if locus_ids_not_in_catalog:
+		raise_error_for_locus_ids_not_in_catalog(locus_ids_not_in_catalog)
+
+
+def raise_error_for_locus_ids_not_in_catalog(locus_ids):
+	raise ValueError(f"{len(locus_ids)} locus IDs in the variation cluster catalog were not found in the input repeat "
+					 f"catalog: {locus_ids}")
+
 
 def main():
 	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
@@ -25,10 +225,22 @@ def main():
 						"containing known pathogenic loci. This is used to retrieve the original locus boundaries for "
 						"these loci since their IDs don't contain these coordinates the way that IDs of other loci do.")
 	parser.add_argument("-o", "--output-bed-path", help="Path of output BED file.")
+	parser.add_argument("--longtr-output-bed-path", help="If specified, also write a LongTR version of the output BED "
+						"file to this path")
+	parser.add_argument("--variation-clusters-longtr-output-bed-path", help="If specified, also write a LongTR version "
+						"of the input variation clusters BED file to this path")
+	parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="Number of compression threads")
+	parser.add_argument("--merge-join", choices=list(CHROM_ORDERS), help="If the catalog and the variation clusters "
+						"BED file are both sorted by chromosome (in this order) and start coordinate, read the variation "
+						"clusters in lockstep with the catalog instead of loading them all into memory")
+	add_max_memory_argument(parser)
 	parser.add_argument("--verbose", action="store_true")
+	parser.add_argument("--print-all-warnings", action="store_true", help="Print every warning as it occurs, instead of "
+						"a summary with a few examples of each kind of warning")
 	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
 	parser.add_argument("input_variation_clusters_bed_path", help="Path of the input variation clusters BED file")
-	parser.add_argument("input_repeat_catalog", help="Catalog of all tandem repeats in JSON or BED format")
+	parser.add_argument("input_repeat_catalog", help="Catalog of all tandem repeats in JSON, Arrow, or BED format")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	if ".bed" not in args.input_variation_clusters_bed_path:
@@ -42,90 +254,79 @@ def main():
 	elif not args.output_bed_path.endswith(".bed"):
 		parser.error("--output-bed-path must have a '.bed' suffix")
 
-	fopen = gzip.open if args.known_pathogenic_loci_json_path.endswith("gz") else open
-	with fopen(args.known_pathogenic_loci_json_path, "rt") as f:
-		known_pathogenic_loci = json.load(f)
-		known_pathogenic_reference_regions_lookup = {}
-		for locus in known_pathogenic_loci:
-			if isinstance(locus["ReferenceRegion"], list):
-				assert isinstance(locus["VariantId"], list)
-				assert len(locus["ReferenceRegion"]) == len(locus["VariantId"])
-				for variant_id, reference_region in zip(locus["VariantId"], locus["ReferenceRegion"]):
-					known_pathogenic_reference_regions_lookup[variant_id] = reference_region
-			else:
-				known_pathogenic_reference_regions_lookup[locus["LocusId"]] = locus["ReferenceRegion"]
-
-	# get locus ids of TRs in variation clusters
-	locus_ids_in_variation_clusters = set()
-	counter = collections.Counter()
-	output_bed_file = open(args.output_bed_path, "wt")
-	fopen = gzip.open if args.input_variation_clusters_bed_path.endswith("gz") else open
-	with fopen(args.input_variation_clusters_bed_path, "rt") as f:
-		if args.show_progress_bar:
-			f = tqdm.tqdm(f, unit=" records", unit_scale=True)
-
-		for line in f:
-			counter['output_total'] += 1
-			output_bed_file.write(line)
-
-			counter["variation_clusters"] += 1
-			fields = line.strip("\n").split("\t")
-			chrom = fields[0]
-			start_0based = int(fields[1])
-			end_1based = int(fields[2])
-			info_fields = fields[3]
-
-			info_fields_dict = {}
-			for key_value in info_fields.split(";"):
-				key_value = key_value.split("=")
-				if len(key_value) != 2:
-					print(f"WARNING: skipping invalid key-value pair '{key_value}' in line {fields}")
-					continue
-				key, value = key_value
-				info_fields_dict[key] = value
-
-			region = f"{chrom.replace('chr', '')}:{start_0based}-{end_1based}"
-			for locus_id in info_fields_dict["ID"].split(","):
-				if locus_id in known_pathogenic_reference_regions_lookup or locus_id.count("-") == 3:
-					if locus_id in locus_ids_in_variation_clusters:
-						raise ValueError(f"locus_id '{locus_id}' occurs more than once")
-					locus_ids_in_variation_clusters.add(locus_id)
-				else:
-					raise ValueError(f"Unexpected locus_id '{locus_id}'")
+	known_pathogenic_reference_regions_lookup = parse_known_pathogenic_reference_regions(
+		args.known_pathogenic_loci_json_path)
 
-	print(f"Parsed {counter['variation_clusters']:,d} variation clusters from {args.input_variation_clusters_bed_path}")
+	if is_arrow_path(args.input_repeat_catalog):
+		catalog_iterator = iterate_catalog_records(args.input_repeat_catalog, use_float=True)
+	else:
+		catalog_iterator = get_variant_catalog_iterator(args.input_repeat_catalog, show_progress_bar=args.show_progress_bar)
 
-	all_catalog_ids = set()
-	for record in get_variant_catalog_iterator(args.input_repeat_catalog, show_progress_bar=args.show_progress_bar):
-		counter["TRs_from_catalog"] += 1
-		all_catalog_ids.add(record["LocusId"])
+	if not args.merge_join:
+		with profile_phase("load variation clusters"):
+			variation_cluster_table = VariationClusterTable(
+				args.input_variation_clusters_bed_path, known_pathogenic_reference_regions_lookup, threads=args.threads,
+				show_progress_bar=args.show_progress_bar, diagnostics=Diagnostics(verbose=args.print_all_warnings))
+		variation_cluster_table.stats.diagnostics.print_summary()
+		isolated_tr_writer = IsolatedTRWriter(
+			variation_cluster_table,
+			f"{args.output_bed_path}.gz",
+			longtr_output_bed_path=args.longtr_output_bed_path,
+			variation_clusters_longtr_output_bed_path=args.variation_clusters_longtr_output_bed_path,
+			threads=args.threads,
+			print_all_warnings=args.print_all_warnings,
+			max_memory=args.max_memory)
 
-		if record["LocusId"] in locus_ids_in_variation_clusters:
-			counter["TRs_in_variation_clusters"] += 1
-			continue
-		output_row = convert_expansion_hunter_record_to_trgt_row(record)
-		output_bed_file.write("\t".join(map(str, output_row)) + "\n")
-		counter['output_total'] += 1
-		counter['isolated_TRs'] += 1
+		for records in iterate_in_phase(iterate_batches(catalog_iterator, BATCH_SIZE), "read catalog"):
+			isolated_tr_writer.counters["total"] += len(records)
+			with profile_phase("find isolated TRs"):
+				isolated_tr_writer.annotate_records(records)
 
-	print(f"Parsed {counter['TRs_from_catalog']:,d} TRs from {args.input_repeat_catalog}")
-	output_bed_file.close()
+		print(f"Parsed {len(variation_cluster_table):,d} variation clusters from {args.input_variation_clusters_bed_path}")
+		print(f"Parsed {isolated_tr_writer.counters['total']:,d} TRs from {args.input_repeat_catalog}")
+		with profile_phase("write output"):
+			isolated_tr_writer.close()
+		isolated_tr_writer.print_stats()
+		return
+
+	counter = collections.Counter()
+	variation_cluster_stats = VariationClusterStats(Diagnostics(verbose=args.print_all_warnings))
+	variation_clusters = iterate_variation_clusters(
+		args.input_variation_clusters_bed_path, known_pathogenic_reference_regions_lookup, variation_cluster_stats,
+		threads=args.threads, show_progress_bar=args.show_progress_bar)
+	sorted_bed_writer = SortedBedWriter(f"{args.output_bed_path}.gz", threads=args.threads, max_memory=args.max_memory)
+	variation_clusters_longtr_writer = None
+	if args.variation_clusters_longtr_output_bed_path:
+		variation_clusters_longtr_writer = LongTRWriter(
+			args.variation_clusters_longtr_output_bed_path, known_pathogenic_reference_regions_lookup,
+			threads=args.threads, print_all_warnings=args.print_all_warnings)
 
-	unexpected_locus_ids_in_variation_cluster_catalog = locus_ids_in_variation_clusters - all_catalog_ids
-	if unexpected_locus_ids_in_variation_cluster_catalog:
-		raise ValueError(f"{len(unexpected_locus_ids_in_variation_cluster_catalog)} locus IDs in the variation cluster catalog "
-						 f"were not found in the input repeat catalog: {unexpected_locus_ids_in_variation_cluster_catalog}")
+	with profile_phase("merge join catalog and variation clusters"):
+		write_isolated_loci_using_merge_join(
+			catalog_iterator, variation_clusters, sorted_bed_writer, counter, CHROM_ORDERS[args.merge_join],
+			variation_clusters_longtr_writer=variation_clusters_longtr_writer)
+		if variation_clusters_longtr_writer is not None:
+			variation_clusters_longtr_writer.close()
 
+	variation_cluster_stats.diagnostics.print_summary()
+	print(f"Parsed {counter['variation_clusters']:,d} variation clusters from {args.input_variation_clusters_bed_path}")
+	print(f"Parsed {counter['TRs_from_catalog']:,d} TRs from {args.input_repeat_catalog}")
 	print(f"{counter['TRs_in_variation_clusters']:,d} out of {counter['TRs_from_catalog']:,d} "
 		  f"({counter['TRs_in_variation_clusters']/counter['TRs_from_catalog']*100:.2f}%) TRs were in variation clusters")
-	os.system(f"bedtools sort -i {args.output_bed_path} | bgzip > {args.output_bed_path}.sorted")
-	os.system(f"mv {args.output_bed_path}.sorted {args.output_bed_path}.gz")
-	os.remove(args.output_bed_path)
 
-	print(f"Added {counter['isolated_TRs']:,d} isolated TRs to {args.output_bed_path}.gz")
-	print(f"Wrote {counter['output_total']:,d} rows to {args.output_bed_path}.gz")
+	longtr_writer = None
+	if args.longtr_output_bed_path:
+		longtr_writer = LongTRWriter(
+			args.longtr_output_bed_path, known_pathogenic_reference_regions_lookup, threads=args.threads,
+			print_all_warnings=args.print_all_warnings)
+	with profile_phase("write output"):
+		sorted_bed_writer.close(on_write_row=longtr_writer.write if longtr_writer is not None else None)
+		if longtr_writer is not None:
+			longtr_writer.close()
+
+	print(f"Added {counter['isolated_TRs']:,d} isolated TRs to {sorted_bed_writer.output_path}")
+	print(f"Wrote {sorted_bed_writer.row_counter:,d} rows to {sorted_bed_writer.output_path}")
 
-	
-if __name__ == "__main__":
-	main()
 
+if __name__ == "__main__":
+	run_main(main)
@@ -1,17 +1,142 @@
 """Add variation cluster annotations to catalog"""
 
 import argparse
-import collections
-import gzip
-import ijson
+import numpy as np
 import os
-import simplejson as json
-import sys
-import tqdm
 
-from str_analysis.utils.misc_utils import parse_interval
+from annotation_source_cache import KeyIndex, compile_key_index
+from catalog_annotator import CatalogAnnotator, annotate_catalog
+from diagnostics import Diagnostics
+from locus_key import encode_locus_ids
+from merge_join import CHROM_ORDERS, MergeJoin, MergeJoinSource, get_reference_region_interval
+from profiling import add_profiling_arguments, profile_phase, run_main
+from variation_clusters import VariationClusterStats, VariationClusterTable, iterate_variation_clusters, \
+	parse_known_pathogenic_reference_regions
+
+
+class VariationClusterAnnotator(CatalogAnnotator):
+	"""Adds VariationCluster and VariationClusterSizeDiff fields to loci that are part of a variation cluster whose
+	boundaries differ from the locus boundaries by at least MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD bases"""
+
+	name = "variation cluster annotations"
+
+	def __init__(self, variation_clusters_bed_path, known_pathogenic_loci_json_path, verbose=False,
+				 show_progress_bar=False, merge_join_chrom_order=None, variation_cluster_table=None,
+				 print_all_warnings=False):
+		"""Args:
+			variation_clusters_bed_path (str): path of the variation clusters BED file
+			known_pathogenic_loci_json_path (str): path of the catalog of known pathogenic loci
+			verbose (bool): print stats about the variation clusters
+			show_progress_bar (bool): show a progress bar while parsing the variation clusters
+			merge_join_chrom_order (str): if specified, the catalog and the BED file must both be sorted by chromosome
+				(in this order, see merge_join.CHROM_ORDERS) and start coordinate. The variation clusters are then read in
+				lockstep with the catalog records instead of being loaded up front, so only the variation clusters that
+				overlap the current record are kept in memory.
+			variation_cluster_table (VariationClusterTable): the already-parsed variation clusters BED file, so that it
+				can be shared with other steps instead of being parsed again
+			print_all_warnings (bool): print every locus whose variation cluster boundaries differ from its own by less
+				than MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD bases, instead of a summary with a few examples. This doesn't
+				apply to variation_cluster_table, which has its own Diagnostics.
+		"""
+		super().__init__()
+		self.verbose = verbose
+
+		self.merge_join = None
+		if merge_join_chrom_order:
+			if verbose:
+				print(f"Parsing {variation_clusters_bed_path}")
+			self.variation_cluster_stats = VariationClusterStats(Diagnostics(verbose=print_all_warnings))
+			variation_clusters = iterate_variation_clusters(
+				variation_clusters_bed_path,
+				parse_known_pathogenic_reference_regions(known_pathogenic_loci_json_path),
+				self.variation_cluster_stats,
+				show_progress_bar=show_progress_bar)
+
+			# records have to be matched to variation clusters in catalog order, so this can't run in worker processes
+			self.runs_in_main_process = True
+			self.merge_join = MergeJoin(
+				[MergeJoinSource(variation_clusters, lambda variation_cluster: variation_cluster[:3], variation_clusters_bed_path)],
+				chrom_sort_key=CHROM_ORDERS[merge_join_chrom_order])
+		else:
+			if variation_cluster_table is None:
+				variation_cluster_table = VariationClusterTable(
+					variation_clusters_bed_path,
+					parse_known_pathogenic_reference_regions(known_pathogenic_loci_json_path),
+					show_progress_bar=show_progress_bar,
+					diagnostics=Diagnostics(verbose=print_all_warnings))
+			self.variation_cluster_stats = variation_cluster_table.stats
+			self.load_variation_clusters(variation_cluster_table)
+			self.print_variation_cluster_stats()
+
+	@property
+	def size_diff_histogram(self):
+		return self.variation_cluster_stats.size_diff_histogram
+
+	def load_variation_clusters(self, variation_cluster_table):
+		"""Index the loci whose boundaries differ from their variation cluster's boundaries by their locus keys"""
+		# the variation cluster and size difference of each locus that's above the threshold
+		is_above_threshold = variation_cluster_table.locus_size_diffs >= 0
+		self.key_index = KeyIndex(compile_key_index(variation_cluster_table.locus_keys[is_above_threshold]))
+		self.variation_cluster_table = variation_cluster_table
+		self.variation_clusters = variation_cluster_table.locus_variation_clusters[is_above_threshold]
+		self.size_diffs = variation_cluster_table.locus_size_diffs[is_above_threshold]
+		# each variation cluster interval is only added to the first record with a given locus id
+		self.is_row_used = np.zeros(len(self.size_diffs), dtype=bool)
+
+	def annotate_record(self, record):
+		return self.annotate_records([record])[0]
+
+	def annotate_records(self, records):
+		if self.merge_join is not None:
+			return [self.annotate_record_using_merge_join(record) for record in records]
+
+		rows = self.key_index.get_batch(encode_locus_ids([record["LocusId"] for record in records])).tolist()
+		results = []
+		for record, row in zip(records, rows):
+			if row < 0 or self.is_row_used[row]:
+				results.append(False)
+				continue
+
+			self.is_row_used[row] = True
+			record["VariationCluster"] = self.variation_cluster_table.get_region(self.variation_clusters[row])
+			record["VariationClusterSizeDiff"] = int(self.size_diffs[row])
+			results.append(True)
+
+		return results
+
+	def may_annotate_locus_ids(self, locus_ids):
+		if self.merge_join is not None:
+			return None
+
+		rows = self.key_index.get_batch(encode_locus_ids([locus_id or "" for locus_id in locus_ids]))
+		may_annotate = rows >= 0
+		may_annotate[may_annotate] = ~self.is_row_used[rows[may_annotate]]
+		return may_annotate.tolist()
+
+	def annotate_record_using_merge_join(self, record):
+		[variation_clusters] = self.merge_join.match(*get_reference_region_interval(record))
+		# if a locus is in more than one variation cluster, use the last one like load_variation_clusters does
+		for chrom, start_0based, end_1based, _, _, locus_id_to_size_diff in reversed(variation_clusters):
+			if record["LocusId"] in locus_id_to_size_diff:
+				# each variation cluster interval is only added to the first record with a given locus id
+				record["VariationCluster"] = f"{chrom.replace('chr', '')}:{start_0based}-{end_1based}"
+				record["VariationClusterSizeDiff"] = locus_id_to_size_diff.pop(record["LocusId"])
+				return True
+
+		return False
+
+	def close(self):
+		if self.merge_join is not None:
+			# read the rest of the BED file so that the variation cluster stats include all variation clusters
+			self.merge_join.close()
+			self.print_variation_cluster_stats()
+
+	def print_variation_cluster_stats(self):
+		if self.verbose:
+			self.variation_cluster_stats.print_stats()
+		else:
+			self.variation_cluster_stats.diagnostics.print_summary()
 
-MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD = 6
 
 def main():
 	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -19,13 +144,23 @@ def main():
 						"containing known pathogenic loci. This is used to retrieve the original locus boundaries for "
 						"these loci since their IDs don't contain these coordinates the way that IDs of other loci do.")
 	parser.add_argument("--verbose", action="store_true")
+	parser.add_argument("--print-all-warnings", action="store_true", help="Print every locus whose variation "
+						"cluster boundaries differ from its own by less than 6bp, instead of a summary with a few examples")
 	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
+	parser.add_argument("--threads", type=int, default=1, help="Number of worker processes to use for annotating records")
+	parser.add_argument("--passthrough", action="store_true", help="Only parse and re-serialize the records that get "
+						"annotations, and copy all other records from the input catalog to the output unchanged. Requires "
+						"JSON input and output.")
+	parser.add_argument("--merge-join", choices=list(CHROM_ORDERS), help="If the catalog and the BED file are both "
+						"sorted by chromosome (in this order) and start coordinate, read the variation clusters in "
+						"lockstep with the catalog instead of loading them all into memory")
 	parser.add_argument("--output-catalog-json-path",
 						help="Path of the output catalog JSON file that includes variation cluster annotations")
 	parser.add_argument("--generate-plot", action="store_true", help="Generate a plot of the size differences between "
 																	 "variation clusters and simple repeats")
 	parser.add_argument("variation_clusters_bed_path", help="Path of the variation clusters BED file")
 	parser.add_argument("catalog_json_path", help="Path of the JSON catalog to annotate")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	for path in args.variation_clusters_bed_path, args.catalog_json_path, args.known_pathogenic_loci_json_path:
@@ -35,130 +170,23 @@ def main():
 	if not args.output_catalog_json_path:
 		args.output_catalog_json_path = args.catalog_json_path.replace(".json", ".with_variation_clusters.json")
 
-	print(f"Parsing {args.known_pathogenic_loci_json_path}")
-	fopen = gzip.open if args.known_pathogenic_loci_json_path.endswith("gz") else open
-	with fopen(args.known_pathogenic_loci_json_path, "rt") as f:
-		known_pathogenic_loci = json.load(f)
-		known_pathogenic_reference_regions_lookup = {}
-		for locus in known_pathogenic_loci:
-			if isinstance(locus["ReferenceRegion"], list):
-				assert isinstance(locus["VariantId"], list)
-				assert len(locus["ReferenceRegion"]) == len(locus["VariantId"])
-				for variant_id, reference_region in zip(locus["VariantId"], locus["ReferenceRegion"]):
-					known_pathogenic_reference_regions_lookup[variant_id] = reference_region
-			else:
-				known_pathogenic_reference_regions_lookup[locus["LocusId"]] = locus["ReferenceRegion"]
-
-	locus_id_to_variation_cluster_interval = {}
-	locus_id_to_variation_cluster_size_difference_from_simple_repeat_boundaries = {}
-	size_diff_histogram = collections.Counter()
-	input_variation_clusters_counter = 0
-	input_locus_ids_counter = 0
-	almost_no_change_to_boundaries = 0
-	output_variation_clusters_counter = 0
-	examples = set()
-	if args.verbose:
-		print(f"Parsing {args.variation_clusters_bed_path}")
-
-	fopen = gzip.open if args.variation_clusters_bed_path.endswith("gz") else open
-	with fopen(args.variation_clusters_bed_path, "rt") as f:
-		if args.show_progress_bar:
-			f = tqdm.tqdm(f, unit=" records", unit_scale=True)
-
-		for line in f:
-			input_variation_clusters_counter += 1
-			fields = line.strip("\n").split("\t")
-			chrom = fields[0]
-			start_0based = int(fields[1])
-			end_1based = int(fields[2])
-			info_fields = fields[3]
-
-			info_fields_dict = {}
-			for key_value in info_fields.split(";"):
-				key_value = key_value.split("=")
-				if len(key_value) != 2:
-					print(f"WARNING: skipping invalid key-value pair '{key_value}' in line {fields}")
-					continue
-				key, value = key_value
-				info_fields_dict[key] = value
-
-			variation_cluster_differs_from_simple_repeat = False
-			region = f"{chrom.replace('chr', '')}:{start_0based}-{end_1based}"
-			for locus_id in info_fields_dict["ID"].split(","):
-				input_locus_ids_counter += 1
-				if locus_id in known_pathogenic_reference_regions_lookup:
-					region2 = known_pathogenic_reference_regions_lookup[locus_id]
-					original_chrom, original_start_0based, original_end_1based = parse_interval(region2)
-				elif locus_id.count("-") == 3:
-					original_chrom, original_start_0based, original_end_1based, _ = locus_id.split("-")
-					region2 = f"{original_chrom}:{original_start_0based}-{original_end_1based}"
-				else:
-					raise ValueError(f"Unexpected locus_id '{locus_id}'")
-
-				original_start_0based = int(original_start_0based)
-				original_end_1based = int(original_end_1based)
-
-				if abs(end_1based - original_end_1based) < MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD and abs(original_start_0based - start_0based) < MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD:
-					almost_no_change_to_boundaries += 1
-					if len(examples) < 5:
-						examples.add(f"VC:{region} and locus:{locus_id}")
-					print(f"{region} doesn't change {locus_id} by {MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD}bp or more")
-				else:
-					size_diff = abs(end_1based - original_end_1based) + abs(original_start_0based - start_0based)
-					variation_cluster_differs_from_simple_repeat = True
-					locus_id_to_variation_cluster_interval[locus_id] = region
-					locus_id_to_variation_cluster_size_difference_from_simple_repeat_boundaries[locus_id] = size_diff
-					size_diff_histogram[size_diff] += 1
-
-			if variation_cluster_differs_from_simple_repeat:
-				output_variation_clusters_counter += 1
-
-	locus_ids_in_variation_cluster_above_threshold = len(locus_id_to_variation_cluster_interval)
-	if args.verbose:
-		print(f"Parsed {input_variation_clusters_counter:,d} variation clusters that contained {input_locus_ids_counter:,d} simple TR ids")
-		if almost_no_change_to_boundaries:
-			print(f"Found {almost_no_change_to_boundaries:,d} out of {input_variation_clusters_counter:,d} "
-				  f"({almost_no_change_to_boundaries/input_variation_clusters_counter:.1%}) "
-				  f"variation clusters that did not change the original locus boundaries "
-				  f"by {MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD} bases or more")
-			print(f"These contained {input_locus_ids_counter - locus_ids_in_variation_cluster_above_threshold:,d} out of {input_locus_ids_counter:,d} "
-				  f"({(input_locus_ids_counter - locus_ids_in_variation_cluster_above_threshold)/input_locus_ids_counter:.1%}) locus IDs. "
-				  f"Examples: ", ", ".join(examples))
-		print(f"Found {output_variation_clusters_counter:,d} out of {input_variation_clusters_counter:,d} "
-			  f"({output_variation_clusters_counter/input_variation_clusters_counter:.1%}) variation clusters "
-			  f"differed from simple TRs by at least {MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD}bp")
+	with profile_phase("load annotation sources"):
+		annotator = VariationClusterAnnotator(
+			args.variation_clusters_bed_path,
+			args.known_pathogenic_loci_json_path,
+			verbose=args.verbose,
+			show_progress_bar=args.show_progress_bar,
+			merge_join_chrom_order=args.merge_join,
+			print_all_warnings=args.print_all_warnings)
 
 	print(f"Annotating {args.catalog_json_path} with variation cluster annotations")
-	fopen = gzip.open if args.catalog_json_path.endswith("gz") else open
-	with fopen(args.catalog_json_path, "rt") as f:
-		f2open = gzip.open if args.output_catalog_json_path.endswith("gz") else open
-		with f2open(args.output_catalog_json_path, "wt") as f2:
-			input_locus_counter = locus_without_variation_cluster_counter = output_locus_counter = 0
-			iterator = ijson.items(f, "item")
-			if args.show_progress_bar:
-				iterator = tqdm.tqdm(iterator, unit=" records", unit_scale=True)
-			f2.write("[")
-			for i, record in enumerate(iterator):
-				locus_id = record["LocusId"]
-				input_locus_counter += 1
-				if locus_id in locus_id_to_variation_cluster_interval:
-					#record["VariationClusterId"] = locus_id_to_variation_cluster_id[locus_id]
-					record["VariationCluster"] = locus_id_to_variation_cluster_interval[locus_id]
-					record["VariationClusterSizeDiff"] = locus_id_to_variation_cluster_size_difference_from_simple_repeat_boundaries[locus_id]
-					#del locus_id_to_variation_cluster_id[locus_id]
-					del locus_id_to_variation_cluster_interval[locus_id]
-				else:
-					locus_without_variation_cluster_counter += 1
-					#if args.verbose:
-					#	print(f"WARNING: locus_id {locus_id} not found in variation cluster catalog")
-
-				output_locus_counter += 1
-				if i > 0:
-					f2.write(", ")
-				f2.write(json.dumps(record, f2, use_decimal=True, indent=4))
-			f2.write("]")
+	output_locus_counter = annotate_catalog(
+		args.catalog_json_path, args.output_catalog_json_path, [annotator], show_progress_bar=args.show_progress_bar,
+		threads=args.threads, passthrough=args.passthrough)
 
 	if args.generate_plot:
+		input_locus_counter = annotator.counters["total"]
+		locus_without_variation_cluster_counter = input_locus_counter - annotator.counters["annotated"]
 		print(f"{locus_without_variation_cluster_counter:,d} out of {input_locus_counter:,d} "
 			  f"({locus_without_variation_cluster_counter/input_locus_counter:.1%}) loci from {args.catalog_json_path} are not in variation clusters")
 		print(f"Wrote {output_locus_counter:,d} out of {input_locus_counter:,d} ({output_locus_counter/input_locus_counter:.1%}) records "
@@ -169,7 +197,7 @@ def main():
 		import seaborn as sns
 		import matplotlib.pyplot as plt
 		plt.figure(figsize=(12, 6))
-		sns.barplot(x=list(size_diff_histogram.keys()), y=list(size_diff_histogram.values()))
+		sns.barplot(x=list(annotator.size_diff_histogram.keys()), y=list(annotator.size_diff_histogram.values()))
 		plt.xlabel("Size difference")
 		plt.ylabel("Count")
 		plt.title("Size difference between variation clusters and original loci")
@@ -181,5 +209,5 @@ def main():
 		print(f"Wrote VC size diff histograms to {output_prefix}.png and {output_prefix}.log.png")
 
 if __name__ == "__main__":
-	main()
+	run_main(main)
 
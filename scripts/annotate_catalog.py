@@ -0,0 +1,146 @@
+"""Add variation cluster, allele frequency, and LPS annotations to a catalog in a single pass.
+
+This applies the same annotators as add_variation_cluster_annotations_to_catalog.py, add_allele_frequency_annotations.py
+and add_LPS_stdev_annotations_to_catalog.py, but reads and writes the catalog only once instead of once per script.
+It can also write the variation clusters and isolated TRs catalog (see add_isolated_loci_to_variation_cluster_catalog.py)
+and LongTR versions of it and of the variation clusters BED file during the same pass, parsing the variation clusters
+BED file only once for all of these outputs.
+"""
+
+import argparse
+import os
+
+from add_allele_frequency_annotations import AlleleFrequencyAnnotator
+from add_isolated_loci_to_variation_cluster_catalog import IsolatedTRWriter
+from add_LPS_stdev_annotations_to_catalog import LPSAnnotator
+from add_variation_cluster_annotations_to_catalog import VariationClusterAnnotator
+from annotation_source_cache import DEFAULT_ANNOTATION_CACHE_DIR
+from bgzf_io import DEFAULT_THREADS
+from catalog_annotator import annotate_catalog
+from diagnostics import Diagnostics
+from download_cache import DEFAULT_CACHE_DIR
+from memory_budget import add_max_memory_argument
+from merge_join import CHROM_ORDERS
+from profiling import add_profiling_arguments, profile_phase, run_main
+from variation_clusters import VariationClusterTable, parse_known_pathogenic_reference_regions
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+	parser.add_argument("--known-pathogenic-loci-json-path", help="Path of ExpansionHunter catalog containing known "
+						"pathogenic loci. Required for variation cluster and LPS annotations.")
+	parser.add_argument("--variation-clusters-bed", help="If specified, add variation cluster annotations from this "
+						"BED file")
+	parser.add_argument("--merge-join", choices=list(CHROM_ORDERS), help="If the catalog and the variation clusters "
+						"BED file are both sorted by chromosome (in this order) and start coordinate, read the variation "
+						"clusters in lockstep with the catalog instead of loading them all into memory")
+	parser.add_argument("--isolated-trs-output-bed", help="If specified, write the variation clusters along with all "
+						"TRs from the catalog that aren't in a variation cluster to this TRGT BED file, sorted by "
+						"chromosome and start coordinate. Requires --variation-clusters-bed.")
+	parser.add_argument("--isolated-trs-longtr-output-bed", help="If specified, also write a LongTR version of "
+						"--isolated-trs-output-bed to this path")
+	parser.add_argument("--variation-clusters-longtr-output-bed", help="If specified, also write a LongTR version of "
+						"--variation-clusters-bed to this path")
+	parser.add_argument("--lps-table", help="If specified, add LPS annotations from this table")
+	parser.add_argument("--skip-allele-frequencies", action="store_true", help="Don't add allele frequency annotations")
+	parser.add_argument("--add-t2t-assembly-frequencies-to-overlapping-loci", action="store_true",
+						help="See add_allele_frequency_annotations.py")
+	parser.add_argument("--download-cache-dir", default=DEFAULT_CACHE_DIR, help="Directory for caching the downloaded "
+						"allele frequency tables")
+	parser.add_argument("--download-mirror-dir", help="Local directory that contains copies of the allele frequency "
+						"tables. If specified, they are copied from here instead of being downloaded, for offline runs.")
+	parser.add_argument("--annotation-cache-dir", default=DEFAULT_ANNOTATION_CACHE_DIR, help="Directory for caching the "
+						"parsed allele frequency and LPS tables")
+	add_max_memory_argument(parser)
+	parser.add_argument("--verbose", action="store_true")
+	parser.add_argument("--print-all-warnings", action="store_true", help="Print every warning as it occurs, instead of "
+						"a summary with a few examples of each kind of warning")
+	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
+	parser.add_argument("--threads", type=int, default=1, help="Number of worker processes to use for annotating records")
+	parser.add_argument("--passthrough", action="store_true", help="Only parse and re-serialize the records that get "
+						"annotations, and copy all other records from the input catalog to the output unchanged. Requires "
+						"JSON input and output, and --skip-allele-frequencies since allele frequency annotations are "
+						"matched by position rather than LocusId.")
+	parser.add_argument("-o", "--output-catalog-json-path", required=True, help="Path of the output JSON catalog")
+	parser.add_argument("catalog_json_path", help="Path of the JSON catalog to annotate")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	for path in args.catalog_json_path, args.variation_clusters_bed, args.lps_table, args.known_pathogenic_loci_json_path:
+		if path and not os.path.isfile(path):
+			parser.error(f"File not found: {path}")
+
+	if (args.variation_clusters_bed or args.lps_table) and not args.known_pathogenic_loci_json_path:
+		parser.error("--known-pathogenic-loci-json-path is required for variation cluster and LPS annotations")
+
+	if args.passthrough and (not args.skip_allele_frequencies or args.merge_join):
+		parser.error("--passthrough can't be used with allele frequency annotations or --merge-join")
+
+	isolated_trs_outputs = [args.isolated_trs_output_bed, args.isolated_trs_longtr_output_bed,
+							args.variation_clusters_longtr_output_bed]
+	if any(isolated_trs_outputs):
+		if not args.variation_clusters_bed:
+			parser.error("--variation-clusters-bed is required for the isolated TRs and LongTR outputs")
+		if not args.isolated_trs_output_bed:
+			parser.error("The LongTR outputs require --isolated-trs-output-bed")
+		if args.passthrough or args.merge_join:
+			parser.error("The isolated TRs and LongTR outputs can't be used with --passthrough or --merge-join")
+
+	with profile_phase("load annotation sources"):
+		# annotators are applied in the same order as the separate annotation steps
+		annotators = []
+		if args.variation_clusters_bed:
+			# parse the variation clusters BED file once for both the annotations and the isolated TRs outputs
+			variation_cluster_table = None
+			if not args.merge_join:
+				variation_cluster_table = VariationClusterTable(
+					args.variation_clusters_bed,
+					parse_known_pathogenic_reference_regions(args.known_pathogenic_loci_json_path),
+					show_progress_bar=args.show_progress_bar,
+					diagnostics=Diagnostics(verbose=args.print_all_warnings))
+
+			annotators.append(VariationClusterAnnotator(
+				args.variation_clusters_bed,
+				args.known_pathogenic_loci_json_path,
+				verbose=args.verbose,
+				show_progress_bar=args.show_progress_bar,
+				merge_join_chrom_order=args.merge_join,
+				variation_cluster_table=variation_cluster_table,
+				print_all_warnings=args.print_all_warnings))
+
+			if any(isolated_trs_outputs):
+				annotators.append(IsolatedTRWriter(
+					variation_cluster_table,
+					args.isolated_trs_output_bed,
+					longtr_output_bed_path=args.isolated_trs_longtr_output_bed,
+					variation_clusters_longtr_output_bed_path=args.variation_clusters_longtr_output_bed,
+					threads=DEFAULT_THREADS,
+					print_all_warnings=args.print_all_warnings,
+					max_memory=args.max_memory))
+
+		if not args.skip_allele_frequencies:
+			annotators.append(AlleleFrequencyAnnotator(
+				add_t2t_assembly_frequencies_to_overlapping_loci=args.add_t2t_assembly_frequencies_to_overlapping_loci,
+				download_cache_dir=args.download_cache_dir,
+				download_mirror_dir=args.download_mirror_dir,
+				annotation_cache_dir=args.annotation_cache_dir,
+				max_memory=args.max_memory))
+
+		if args.lps_table:
+			annotators.append(LPSAnnotator(
+				args.lps_table,
+				args.known_pathogenic_loci_json_path,
+				annotation_cache_dir=args.annotation_cache_dir,
+				max_memory=args.max_memory))
+
+	if not annotators:
+		parser.error("No annotations enabled")
+
+	print(f"Adding {', '.join(a.name for a in annotators)} to {args.catalog_json_path}")
+	total = annotate_catalog(args.catalog_json_path, args.output_catalog_json_path, annotators,
+							 show_progress_bar=args.show_progress_bar, threads=args.threads, passthrough=args.passthrough)
+	print(f"Wrote {total:,d} records to {args.output_catalog_json_path}")
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,245 @@
+"""Cache of annotation source tables that have already been parsed into lookup arrays.
+
+Parsing the large annotation tables (the Illumina 174k and T2T allele frequency tables, the HPRC LPS table) takes
+much longer than using them. Each table is therefore compiled once into a directory of NumPy .npy files, named after
+the sha256 of the source file(s) and the version of the code that parsed them. Later runs load these arrays with
+mmap_mode="r", which takes milliseconds, and parallel processes that load the same arrays share their pages.
+
+Since the arrays have to be memory-mappable, they can't contain Python objects. String columns are stored as a byte
+buffer plus offsets (see encode_strings and StringArray), and loci are looked up by their integer keys from locus_key.py
+through a sorted key array (see compile_key_index and KeyIndex). Tables that don't fit in memory can be compiled a
+chunk of rows at a time with ArrayBuilder and StringArrayBuilder.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_ANNOTATION_CACHE_DIR = os.path.expanduser(
+	os.path.join("~", ".cache", "tandem-repeat-catalog", "annotation_sources"))
+
+CHECKSUM_CHUNK_SIZE = 2**20
+
+
+def load_compiled_source(name, source_paths, parser_version, compile_function, cache_dir=None):
+	"""Return the arrays compiled from the given source files, compiling them first if they aren't in the cache yet.
+
+	Args:
+		name (str): short name for this annotation source, used in the cache directory name
+		source_paths (list): paths of the source files. The cache entry is invalidated if any of them change.
+		parser_version (int): version of compile_function. Increment it whenever compile_function's output changes.
+		compile_function (function): takes the source paths as arguments and returns a dict that maps array names to
+			NumPy arrays. The arrays can't have dtype=object.
+		cache_dir (str): cache directory
+
+	Return:
+		dict: maps array names to read-only memory-mapped arrays
+	"""
+	cache_dir = os.path.abspath(cache_dir or DEFAULT_ANNOTATION_CACHE_DIR)
+	os.makedirs(cache_dir, exist_ok=True)
+
+	cache_key = hashlib.sha256(f"{name}\t{parser_version}".encode())
+	for source_path in source_paths:
+		cache_key.update(get_source_checksum(source_path, cache_dir).encode())
+	artifact_dir = os.path.join(cache_dir, f"{name}.{cache_key.hexdigest()[:16]}")
+
+	if not os.path.isdir(artifact_dir):
+		print(f"Compiling {name} lookup tables from {', '.join(source_paths)}")
+		start_time = time.time()
+		arrays = compile_function(*source_paths)
+
+		# write to a temporary directory and then rename it so that other processes never see a partial artifact
+		temp_dir = f"{artifact_dir}.{os.getpid()}.tmp"
+		os.makedirs(temp_dir, exist_ok=True)
+		for array_name, array in arrays.items():
+			array = np.asarray(array)
+			if array.dtype == object:
+				raise ValueError(f"{name} array '{array_name}' has dtype=object, which can't be memory-mapped")
+			np.save(os.path.join(temp_dir, f"{array_name}.npy"), array, allow_pickle=False)
+		try:
+			os.rename(temp_dir, artifact_dir)
+		except OSError:
+			if not os.path.isdir(artifact_dir):
+				raise
+			shutil.rmtree(temp_dir)  # another process compiled the same source first
+		print(f"Compiled {name} lookup tables in {time.time() - start_time:.1f}s and saved them to {artifact_dir}")
+
+	arrays = {}
+	for file_name in os.listdir(artifact_dir):
+		if file_name.endswith(".npy"):
+			arrays[file_name[:-len(".npy")]] = np.load(os.path.join(artifact_dir, file_name), mmap_mode="r")
+
+	return arrays
+
+
+def get_source_checksum(path, cache_dir):
+	"""Returns the sha256 of the given file. Checksums are saved in the cache directory along with the file's size and
+	modification time so that unchanged files don't have to be read again."""
+	stat = os.stat(path)
+	real_path = os.path.realpath(path)
+	checksums_path = os.path.join(cache_dir, "source_checksums.json")
+	checksums = {}
+	if os.path.isfile(checksums_path):
+		with open(checksums_path, "rt") as f:
+			checksums = json.load(f)
+
+	entry = checksums.get(real_path)
+	if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+		return entry["sha256"]
+
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+			sha256.update(chunk)
+
+	checksums[real_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+	temp_path = f"{checksums_path}.{os.getpid()}.tmp"
+	with open(temp_path, "wt") as f:
+		json.dump(checksums, f, indent=4)
+	os.replace(temp_path, checksums_path)
+
+	return checksums[real_path]["sha256"]
+
+
+def add_prefix(prefix, arrays):
+	"""Returns a copy of the arrays dict with the prefix added to each name, so that several groups of arrays can be
+	stored in the same cache entry"""
+	return {f"{prefix}{name}": array for name, array in arrays.items()}
+
+
+def remove_prefix(prefix, arrays):
+	"""Returns the arrays whose names start with the prefix, with the prefix removed from their names"""
+	return {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+
+
+def encode_strings(strings):
+	"""Convert a list of strings to a dict with a "data" array that contains their utf-8 bytes and an "offsets" array
+	where the i-th string is data[offsets[i]:offsets[i+1]]"""
+	encoded_strings = [s.encode() for s in strings]
+	offsets = np.zeros(len(encoded_strings) + 1, dtype=np.int64)
+	np.cumsum([len(s) for s in encoded_strings], out=offsets[1:])
+	return {
+		"data": np.frombuffer(b"".join(encoded_strings), dtype=np.uint8),
+		"offsets": offsets,
+	}
+
+
+class StringArray:
+	"""Read-only list of strings backed by the arrays returned by encode_strings"""
+
+	def __init__(self, arrays):
+		self._data = arrays["data"]
+		self._offsets = arrays["offsets"]
+
+	def __len__(self):
+		return len(self._offsets) - 1
+
+	def __getitem__(self, i):
+		return self._data[self._offsets[i]:self._offsets[i+1]].tobytes().decode()
+
+	def __iter__(self):
+		data = self._data.tobytes()
+		offsets = self._offsets.tolist()
+		for start, end in zip(offsets[:-1], offsets[1:]):
+			yield data[start:end].decode()
+
+
+class ArrayBuilder:
+	"""Builds a 1D array from chunks of values, so that a table can be compiled a chunk of rows at a time.
+
+	If temp_dir is specified, each chunk is appended to a file in temp_dir instead of being kept in memory, and build
+	returns the array memory-mapped from that file. Memory-mapped arrays stay readable after temp_dir is deleted.
+	"""
+
+	def __init__(self, dtype, temp_dir=None):
+		self.dtype = np.dtype(dtype)
+		self._chunks = []
+		self._file = None
+		if temp_dir is not None:
+			self._file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".bin", delete=False)
+
+	def append(self, values):
+		values = np.asarray(values, dtype=self.dtype)
+		if self._file is None:
+			self._chunks.append(values)
+		else:
+			values.tofile(self._file)
+
+	def build(self):
+		if self._file is None:
+			return np.concatenate(self._chunks) if self._chunks else np.empty(0, dtype=self.dtype)
+
+		self._file.close()
+		if os.path.getsize(self._file.name) == 0:
+			return np.empty(0, dtype=self.dtype)
+		return np.memmap(self._file.name, dtype=self.dtype, mode="r")
+
+
+class StringArrayBuilder:
+	"""Builds the arrays returned by encode_strings from chunks of strings (see ArrayBuilder)"""
+
+	def __init__(self, temp_dir=None):
+		self._data = ArrayBuilder(np.uint8, temp_dir)
+		self._offsets = ArrayBuilder(np.int64, temp_dir)
+		self._offsets.append([0])
+		self._num_bytes = 0
+
+	def append(self, strings):
+		arrays = encode_strings(strings)
+		self._data.append(arrays["data"])
+		self._offsets.append(arrays["offsets"][1:] + self._num_bytes)
+		self._num_bytes += len(arrays["data"])
+
+	def build(self):
+		return {
+			"data": self._data.build(),
+			"offsets": self._offsets.build(),
+		}
+
+
+def compile_key_index(keys):
+	"""Compile an array of keys into arrays for KeyIndex. If a key occurs more than once, it's mapped to the row of its
+	last occurrence.
+
+	Args:
+		keys (np.array): the key for each row of a table, for example the position keys or locus keys from locus_key.py
+
+	Return:
+		dict: arrays to pass to KeyIndex
+	"""
+	keys = np.asarray(keys)
+	# np.unique returns the first occurrence of each key, so search the keys in reverse to get the last occurrence
+	unique_keys, reversed_rows = np.unique(keys[::-1], return_index=True)
+	return {
+		"keys": unique_keys,
+		"rows": (len(keys) - 1 - reversed_rows).astype(np.int64),
+	}
+
+
+class KeyIndex:
+	"""Maps keys to table rows using the arrays returned by compile_key_index"""
+
+	def __init__(self, arrays):
+		self._keys = arrays["keys"]
+		self._rows = arrays["rows"]
+
+	def __len__(self):
+		return len(self._rows)
+
+	def get(self, key):
+		"""Returns the row for the given key, or -1 if the key isn't in the index"""
+		return int(self.get_batch(np.array([key], dtype=self._keys.dtype))[0])
+
+	def get_batch(self, keys):
+		"""Returns an array with the row of each of the given keys, or -1 for keys that aren't in the index"""
+		keys = np.asarray(keys, dtype=self._keys.dtype)
+		if len(keys) == 0 or len(self._keys) == 0:
+			return np.full(len(keys), -1, dtype=np.int64)
+
+		positions = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+		return np.where(self._keys[positions] == keys, self._rows[positions], -1)
@@ -0,0 +1,75 @@
+"""Measure how many records per second catalog_io can read and write with each JSON backend and output mode.
+
+This reads the given catalog once per reader backend (with numbers parsed as Decimals and as floats) and then writes
+the records to temporary files as pretty-printed JSON, compact JSON, and Arrow (if pyarrow is installed).
+"""
+
+import argparse
+import ijson
+import importlib.util
+import os
+import tempfile
+import time
+
+from catalog_io import CatalogWriter, get_available_json_reader_backends, iterate_catalog_record_batches
+from profiling import add_profiling_arguments, run_main
+
+
+def benchmark_reader(catalog_path, backend, use_float):
+	start_time = time.perf_counter()
+	record_counter = 0
+	for batch in iterate_catalog_record_batches(catalog_path, backend=backend, use_float=use_float):
+		record_counter += len(batch)
+	return record_counter, time.perf_counter() - start_time
+
+
+def benchmark_writer(records, output_path, compact):
+	start_time = time.perf_counter()
+	with CatalogWriter(output_path, compact=compact) as writer:
+		writer.write_batch(records)
+	return len(records), time.perf_counter() - start_time
+
+
+def print_result(label, record_counter, elapsed_seconds, output_path=None):
+	size = f"  {os.path.getsize(output_path)/2**20:10,.1f} MB" if output_path else ""
+	print(f"{label:35s} {record_counter/elapsed_seconds:12,.0f} records/sec  {elapsed_seconds:8.2f} sec{size}")
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+	parser.add_argument("--skip-writers", action="store_true", help="Only benchmark the reader backends")
+	parser.add_argument("--output-dir", help="Directory for the output files. Defaults to a temporary directory that's "
+						"deleted afterwards.")
+	parser.add_argument("catalog_path", help="Path of a JSON catalog to read")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if not os.path.isfile(args.catalog_path):
+		parser.error(f"File not found: {args.catalog_path}")
+
+	print(f"ijson backend: {ijson.backend}")
+	for backend in get_available_json_reader_backends():
+		for use_float in False, True:
+			if backend == "orjson" and not use_float:
+				continue
+			record_counter, elapsed_seconds = benchmark_reader(args.catalog_path, backend, use_float)
+			print_result(f"read with {backend} ({'float' if use_float else 'Decimal'})", record_counter, elapsed_seconds)
+
+	if args.skip_writers:
+		return
+
+	records = [record for batch in iterate_catalog_record_batches(args.catalog_path) for record in batch]
+	with tempfile.TemporaryDirectory() as temp_dir:
+		output_dir = args.output_dir or temp_dir
+		outputs = [("write pretty JSON", "pretty.json.gz", False), ("write compact JSON", "compact.json.gz", True)]
+		if importlib.util.find_spec("pyarrow") is not None:
+			outputs.append(("write Arrow", "catalog.arrow", False))
+
+		for label, filename, compact in outputs:
+			output_path = os.path.join(output_dir, filename)
+			record_counter, elapsed_seconds = benchmark_writer(records, output_path, compact)
+			print_result(label, record_counter, elapsed_seconds, output_path=output_path)
+
+
+if __name__ == "__main__":
+	run_main(main)
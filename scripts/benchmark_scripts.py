@@ -0,0 +1,249 @@
+"""Measure the throughput of each catalog script on a synthetic catalog, and compare it to a baseline.
+
+The inputs are the files written by generate_synthetic_catalog.py. Each script runs as a separate process and
+its records per second, peak memory (RSS) and output size are measured. Annotation source caches start out empty,
+so the times include parsing the annotation tables. The results are written to a JSON report. If --baseline is
+specified, they're also compared to a previous report, and the exit code is 1 if any script got slower or used more
+memory by more than REGRESSION_THRESHOLD.
+
+Example:
+
+	python3 generate_synthetic_catalog.py -n 1000000 -o synthetic
+	python3 benchmark_scripts.py synthetic --output-report benchmark_report.json
+	# ... make changes ...
+	python3 benchmark_scripts.py synthetic --baseline benchmark_report.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from profiling import add_profiling_arguments, run_main
+from step_telemetry import REGRESSION_THRESHOLD, count_records, run_shell_command
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# throughput drops are only reported as regressions if the run also took at least this many seconds longer, so that
+# timing noise in short benchmarks isn't reported
+MIN_REGRESSION_SECONDS = 1
+
+
+def get_benchmarks(input_prefix, output_dir, download_cache_dir):
+	"""Returns a list of benchmarks. Each is a dict with the benchmark name, the shell command, the input file whose
+	records are counted to compute throughput, and the output paths whose sizes are reported."""
+	catalog = f"{input_prefix}.json.gz"
+	known_loci = f"{input_prefix}.known_pathogenic_loci.json"
+	variation_clusters_bed = f"{input_prefix}.variation_clusters.bed.gz"
+	lps_table = f"{input_prefix}.LPS.txt.gz"
+	trgt_bed = f"{input_prefix}.TRGT.bed.gz"
+
+	def output(filename):
+		return os.path.join(output_dir, filename)
+
+	def script(name):
+		return f"{sys.executable} {os.path.join(SCRIPTS_DIR, name)}"
+
+	annotation_cache = f"--annotation-cache-dir {output('annotation_cache')}"
+	return [
+		dict(name="validate_json", input=catalog, outputs=[],
+			 command=f"{script('validate_json.py')} {catalog}"),
+		dict(name="convert_catalog_format", input=catalog, outputs=[output("compact.json.gz")],
+			 command=f"{script('convert_catalog_format.py')} --compact {catalog} {output('compact.json.gz')}"),
+		dict(name="emit_catalog_formats", input=catalog, outputs=[
+				output(f"emitted.{suffix}") for suffix in ("json.gz", "TRGT.bed.gz", "LongTR.bed.gz", "HipSTR.bed.gz",
+														   "GangSTR.bed.gz")],
+			 command=f"{script('emit_catalog_formats.py')} --eh-json {output('emitted.json.gz')} "
+					 f"--trgt {output('emitted.TRGT.bed.gz')} --longtr {output('emitted.LongTR.bed.gz')} "
+					 f"--hipstr {output('emitted.HipSTR.bed.gz')} --gangstr {output('emitted.GangSTR.bed.gz')} {catalog}"),
+		dict(name="export_catalog_to_tsv", input=catalog, outputs=[output("catalog.tsv.gz")],
+			 command=f"{script('export_catalog_to_tsv.py')} -o {output('catalog.tsv.gz')} {catalog}"),
+		dict(name="shard_catalog", input=catalog, outputs=[output("shards.shards.json")],
+			 command=f"{script('shard_catalog.py')} split --num-shards 4 -o {output('shards')} {catalog}"),
+		dict(name="add_variation_cluster_annotations", input=catalog, outputs=[output("with_vcs.json.gz")],
+			 command=f"{script('add_variation_cluster_annotations_to_catalog.py')} --known-pathogenic-loci-json-path "
+					 f"{known_loci} --output-catalog-json-path {output('with_vcs.json.gz')} {variation_clusters_bed} "
+					 f"{catalog}"),
+		dict(name="add_variation_cluster_annotations:merge_join", input=catalog,
+			 outputs=[output("with_vcs.merge_join.json.gz")],
+			 command=f"{script('add_variation_cluster_annotations_to_catalog.py')} --known-pathogenic-loci-json-path "
+					 f"{known_loci} --merge-join natural --output-catalog-json-path "
+					 f"{output('with_vcs.merge_join.json.gz')} {variation_clusters_bed} {catalog}"),
+		dict(name="add_LPS_stdev_annotations", input=catalog, outputs=[output("with_lps.json.gz")],
+			 command=f"{script('add_LPS_stdev_annotations_to_catalog.py')} --known-pathogenic-loci-json-path "
+					 f"{known_loci} {annotation_cache} --output-catalog-json-path {output('with_lps.json.gz')} "
+					 f"{lps_table} {catalog}"),
+		dict(name="add_allele_frequency_annotations", input=catalog, outputs=[output("with_afs.json.gz")],
+			 command=f"{script('add_allele_frequency_annotations.py')} --download-cache-dir {download_cache_dir} "
+					 f"{annotation_cache} --add-t2t-assembly-frequencies-to-overlapping-loci "
+					 f"-o {output('with_afs.json.gz')} {catalog}"),
+		dict(name="annotate_catalog", input=catalog, outputs=[
+				output(filename) for filename in ("annotated.json.gz", "isolated_TRs.bed.gz", "isolated_TRs.LongTR.bed.gz",
+												  "variation_clusters.LongTR.bed.gz")],
+			 command=f"{script('annotate_catalog.py')} --known-pathogenic-loci-json-path {known_loci} "
+					 f"--variation-clusters-bed {variation_clusters_bed} --merge-join natural "
+					 f"--isolated-trs-output-bed {output('isolated_TRs.bed.gz')} "
+					 f"--isolated-trs-longtr-output-bed {output('isolated_TRs.LongTR.bed.gz')} "
+					 f"--variation-clusters-longtr-output-bed {output('variation_clusters.LongTR.bed.gz')} "
+					 f"--lps-table {lps_table} --add-t2t-assembly-frequencies-to-overlapping-loci "
+					 f"--download-cache-dir {download_cache_dir} {annotation_cache} "
+					 f"-o {output('annotated.json.gz')} {catalog}"),
+		dict(name="add_isolated_loci_to_variation_cluster_catalog", input=catalog,
+			 outputs=[output("isolated.bed.gz"), output("isolated.LongTR.bed.gz")],
+			 command=f"{script('add_isolated_loci_to_variation_cluster_catalog.py')} --known-pathogenic-loci-json-path "
+					 f"{known_loci} -o {output('isolated.bed')} --longtr-output-bed-path {output('isolated.LongTR.bed')} "
+					 f"{variation_clusters_bed} {catalog}"),
+		dict(name="convert_trgt_catalog_to_longtr_format", input=trgt_bed, outputs=[output("converted.LongTR.bed.gz")],
+			 command=f"{script('convert_trgt_catalog_to_longtr_format.py')} --known-pathogenic-loci-json-path "
+					 f"{known_loci} -o {output('converted.LongTR.bed')} {trgt_bed}"),
+	]
+
+
+def prefetch_allele_frequency_tables(download_cache_dir, mirror_dir):
+	"""Copy the synthetic allele frequency tables into a download cache so that the annotation scripts use them instead
+	of downloading the real tables"""
+	# these modules are imported here rather than at the top since this runs in a separate process. The peak RSS that
+	# os.wait4 reports for a subprocess includes the memory of the process it was forked from, so the benchmark process
+	# itself shouldn't import pandas or other large modules.
+	from add_allele_frequency_annotations import ILLUMINA_174K_URL, T2T_ASSEMBLIES_URL
+	from download_cache import DownloadCache
+
+	DownloadCache(download_cache_dir, mirror_dir=mirror_dir).fetch_all([ILLUMINA_174K_URL, T2T_ASSEMBLIES_URL])
+
+
+def run_benchmark(benchmark, num_input_records, num_runs=1):
+	"""Run the benchmark's command num_runs times and return the results of the fastest run"""
+	results = None
+	for _ in range(num_runs):
+		try:
+			usage = run_shell_command(benchmark["command"] + " > /dev/null")
+		except subprocess.CalledProcessError as e:
+			print(f"ERROR: {benchmark['name']} failed with exit code {e.returncode}: {benchmark['command']}")
+			return {"name": benchmark["name"], "status": "failed", "command": benchmark["command"]}
+
+		if results is None or usage["wall_seconds"] < results["wall_seconds"]:
+			results = {
+				"name": benchmark["name"],
+				"status": "completed",
+				"input_records": num_input_records,
+				"wall_seconds": usage["wall_seconds"],
+				"cpu_seconds": round(usage["user_cpu_seconds"] + usage["system_cpu_seconds"], 3),
+				"records_per_second": round(num_input_records / max(usage["wall_seconds"], 0.001), 1),
+				"peak_rss_mb": usage["peak_rss_mb"],
+				"output_bytes": sum(os.path.getsize(path) for path in benchmark["outputs"] if os.path.isfile(path)),
+				"command": benchmark["command"],
+			}
+
+	return results
+
+
+def print_results(results):
+	print(f"{'benchmark':50s} {'records/sec':>12s} {'wall time':>10s} {'peak RSS':>10s} {'output size':>12s}")
+	for result in results:
+		if result["status"] != "completed":
+			print(f"{result['name']:50s} {result['status']:>12s}")
+			continue
+		print(f"{result['name']:50s} {result['records_per_second']:12,.0f} {result['wall_seconds']:9.1f}s "
+			  f"{result['peak_rss_mb']:7,.0f} MB {result['output_bytes']/2**20:9,.1f} MB")
+
+
+def compare_to_baseline(results, baseline_report_path):
+	"""Print the change in throughput and peak memory relative to a previous report.
+
+	Return:
+		int: the number of benchmarks where records per second dropped, or peak RSS increased, by more than
+			REGRESSION_THRESHOLD
+	"""
+	with open(baseline_report_path, "rt") as f:
+		baseline_results = {r["name"]: r for r in json.load(f) if r.get("status") == "completed"}
+
+	print(f"Comparing to {baseline_report_path}:")
+	print(f"{'benchmark':50s} {'records/sec':>28s} {'peak RSS (MB)':>22s}")
+	regressions = 0
+	for result in results:
+		baseline = baseline_results.get(result["name"])
+		if result["status"] != "completed" or baseline is None:
+			continue
+
+		is_regression = (
+			(result["records_per_second"] < (1 - REGRESSION_THRESHOLD) * baseline["records_per_second"]
+			 and result["wall_seconds"] - baseline["wall_seconds"] > MIN_REGRESSION_SECONDS)
+			or result["peak_rss_mb"] > (1 + REGRESSION_THRESHOLD) * baseline["peak_rss_mb"]
+		)
+		regressions += is_regression
+		print(f"{result['name']:50s} {baseline['records_per_second']:12,.0f} => {result['records_per_second']:12,.0f} "
+			  f"{baseline['peak_rss_mb']:8,.0f} => {result['peak_rss_mb']:8,.0f}" + ("  <== REGRESSION" if is_regression else ""))
+
+	if regressions:
+		print(f"WARNING: {regressions} benchmark(s) were more than {REGRESSION_THRESHOLD:.0%} slower or used more than "
+			  f"{REGRESSION_THRESHOLD:.0%} more memory than in {baseline_report_path}")
+	return regressions
+
+
+def main():
+	benchmark_names = [benchmark["name"] for benchmark in get_benchmarks("", "", "")]
+
+	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+	parser.add_argument("--only", action="append", choices=benchmark_names, help="Only run this benchmark. Can be "
+						"specified more than once.")
+	parser.add_argument("--skip", action="append", choices=benchmark_names, default=[], help="Don't run this "
+						"benchmark. Can be specified more than once.")
+	parser.add_argument("--num-runs", type=int, default=1, help="Run each benchmark this many times and report the "
+						"fastest run")
+	parser.add_argument("--output-dir", help="Directory for the output files. Defaults to a temporary directory that's "
+						"deleted afterwards.")
+	parser.add_argument("--output-report", default="benchmark_report.json", help="Path of the JSON report")
+	parser.add_argument("--baseline", help="Path of a JSON report from a previous run to compare to")
+	parser.add_argument("input_prefix", help="Output prefix that was passed to generate_synthetic_catalog.py")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	for path in f"{args.input_prefix}.json.gz", f"{args.input_prefix}.allele_frequencies":
+		if not os.path.exists(path):
+			parser.error(f"{path} not found. Run generate_synthetic_catalog.py first.")
+
+	if args.baseline and not os.path.isfile(args.baseline):
+		parser.error(f"File not found: {args.baseline}")
+
+	input_prefix = os.path.abspath(args.input_prefix)
+	results = []
+	with tempfile.TemporaryDirectory() as temp_dir:
+		output_dir = os.path.abspath(args.output_dir or temp_dir)
+		os.makedirs(output_dir, exist_ok=True)
+
+		download_cache_dir = os.path.join(output_dir, "download_cache")
+		process = multiprocessing.get_context("spawn").Process(
+			target=prefetch_allele_frequency_tables,
+			args=(download_cache_dir, f"{input_prefix}.allele_frequencies"))
+		process.start()
+		process.join()
+		if process.exitcode != 0:
+			sys.exit(f"Failed to copy the allele frequency tables from {input_prefix}.allele_frequencies")
+
+		input_record_counts = {}
+		for benchmark in get_benchmarks(input_prefix, output_dir, download_cache_dir):
+			if (args.only and benchmark["name"] not in args.only) or benchmark["name"] in args.skip:
+				continue
+
+			if benchmark["input"] not in input_record_counts:
+				input_record_counts[benchmark["input"]] = count_records(benchmark["input"])
+
+			print(f"Running {benchmark['name']}")
+			shutil.rmtree(os.path.join(output_dir, "annotation_cache"), ignore_errors=True)
+			results.append(run_benchmark(benchmark, input_record_counts[benchmark["input"]], num_runs=args.num_runs))
+
+	print_results(results)
+	with open(args.output_report, "wt") as f:
+		json.dump(results, f, indent=1)
+	print(f"Wrote {len(results)} benchmark results to {args.output_report}")
+
+	if args.baseline and compare_to_baseline(results, args.baseline):
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,652 @@
+"""Multi-threaded BGZF reading and writing, with in-process tabix (.tbi) and CSI (.csi) indexing.
+
+BGZF files are series of independently-compressed gzip blocks, so they can be compressed and decompressed in parallel
+by a pool of threads (zlib releases the GIL while it works). They are also valid gzip files, so everything written here
+can still be read by gzip.open, tabix, bcftools, etc.
+
+Use open_file(path, mode) as a drop-in replacement for:
+
+	fopen = gzip.open if path.endswith("gz") else open
+	with fopen(path, mode) as f:
+
+Writing a .gz file with index_format="tbi" or "csi" also writes an index for the file while it's being compressed,
+which replaces running 'bgzip' and 'tabix' on the output afterwards. Indexed files must be sorted by chromosome and
+start coordinate. BgzfRandomAccessReader and TabixIndex read the lines of an indexed file that overlap a region, like
+'tabix file.bed.gz chr1:1000-2000'.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import io
+import os
+import struct
+import zlib
+
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+
+# maximum amount of uncompressed data per block. This is the same value that htslib uses.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+BGZF_EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+CSI_MIN_SHIFT = 14
+CSI_DEPTH = 6
+
+TABIX_FORMAT_GENERIC = 0
+TABIX_FORMAT_ZERO_BASED = 0x10000
+
+# maximum number of decompressed blocks (each up to 64kb) that BgzfRandomAccessReader keeps in its LRU cache
+DEFAULT_MAX_CACHED_BLOCKS = 1_000
+
+
+def open_file(path, mode="rt", threads=DEFAULT_THREADS, index_format=None):
+	"""Open a plain, gzip, or BGZF file for reading or writing.
+
+	Args:
+		path (str): file path. Files ending in "gz" are read and written as BGZF.
+		mode (str): "r", "rt", "rb", "w", "wt", or "wb"
+		threads (int): number of compression or decompression threads
+		index_format (str): when writing a BED file, "tbi" or "csi" to also write an index
+
+	Return:
+		file object
+	"""
+	is_binary = "b" in mode
+	if not path.endswith("gz"):
+		if index_format:
+			raise ValueError(f"Can't index {path} because it isn't compressed")
+		return open(path, mode.replace("t", ""))
+
+	if "r" in mode:
+		if not is_bgzf_file(path):
+			return gzip.open(path, mode)
+		raw = BgzfReader(path, threads=threads)
+		buffered = io.BufferedReader(raw, buffer_size=BGZF_BLOCK_SIZE)
+		return buffered if is_binary else io.TextIOWrapper(buffered, encoding="utf-8")
+
+	raw = BgzfWriter(path, threads=threads, index_format=index_format)
+	buffered = io.BufferedWriter(raw, buffer_size=BGZF_BLOCK_SIZE)
+	return buffered if is_binary else io.TextIOWrapper(buffered, encoding="utf-8")
+
+
+def bgzip_file(path, threads=DEFAULT_THREADS, index_format=None):
+	"""Compress a file to {path}.gz and delete the original, like 'bgzip -f'. Optionally also write an index for it,
+	like 'tabix -p bed'.
+
+	Return:
+		str: the path of the compressed file
+	"""
+	with open(path, "rb") as f, open_file(f"{path}.gz", "wb", threads=threads, index_format=index_format) as out:
+		for chunk in iter(lambda: f.read(2**22), b""):
+			out.write(chunk)
+	os.remove(path)
+	return f"{path}.gz"
+
+
+def is_bgzf_file(path):
+	with open(path, "rb") as f:
+		header = f.read(len(BGZF_HEADER))
+	return header[:4] == BGZF_HEADER[:4] and header[10:] == BGZF_HEADER[10:]
+
+
+def compress_block(data, compresslevel):
+	compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+	compressed_data = compressor.compress(data) + compressor.flush()
+	block_size = len(BGZF_HEADER) + 2 + len(compressed_data) + 8
+	return b"".join([
+		BGZF_HEADER,
+		struct.pack("<H", block_size - 1),
+		compressed_data,
+		struct.pack("<II", zlib.crc32(data), len(data)),
+	])
+
+
+class BgzfWriter(io.RawIOBase):
+	"""Writes a BGZF file, compressing blocks in a thread pool, and optionally builds a tabix or CSI index for it"""
+
+	def __init__(self, path, threads=DEFAULT_THREADS, compresslevel=6, index_format=None, zero_based=True,
+				 chrom_column=0, start_column=1, end_column=2, meta_char="#"):
+		"""Args:
+			path (str): output path
+			threads (int): number of compression threads
+			compresslevel (int): zlib compression level
+			index_format (str): None, "tbi" or "csi"
+			zero_based (bool): whether start coordinates are 0-based (as in BED files)
+			chrom_column (int): 0-based column index of the chromosome, for indexing
+			start_column (int): 0-based column index of the start coordinate, for indexing
+			end_column (int): 0-based column index of the end coordinate, for indexing
+			meta_char (str): lines that start with this character are skipped when indexing
+		"""
+		super().__init__()
+		if index_format not in (None, "tbi", "csi"):
+			raise ValueError(f"Unexpected index format: {index_format}")
+
+		self.path = path
+		self.compresslevel = compresslevel
+		self._output_file = open(path, "wb")
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads))
+		self._max_pending_blocks = 4 * max(1, threads)
+		self._pending_blocks = collections.deque()
+		self._buffer = bytearray()
+		self._block_offsets = [0]
+
+		self._index_builder = None
+		if index_format:
+			self._index_builder = TabixIndexBuilder(
+				index_format, zero_based=zero_based, chrom_column=chrom_column, start_column=start_column,
+				end_column=end_column, meta_char=meta_char)
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		data = bytes(data)
+		if self._index_builder is not None:
+			self._index_builder.add_data(data)
+
+		self._buffer += data
+		while len(self._buffer) >= BGZF_BLOCK_SIZE:
+			self._submit_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+			del self._buffer[:BGZF_BLOCK_SIZE]
+
+		return len(data)
+
+	def close(self):
+		if self.closed:
+			return
+
+		if self._buffer:
+			self._submit_block(bytes(self._buffer))
+			self._buffer.clear()
+		while self._pending_blocks:
+			self._write_next_block()
+		self._output_file.write(BGZF_EOF_BLOCK)
+		self._output_file.close()
+		self._executor.shutdown()
+
+		if self._index_builder is not None:
+			self._index_builder.write_index(f"{self.path}.{self._index_builder.index_format}", self._block_offsets)
+
+		super().close()
+
+	def _submit_block(self, data):
+		self._pending_blocks.append(self._executor.submit(compress_block, data, self.compresslevel))
+		while len(self._pending_blocks) > self._max_pending_blocks:
+			self._write_next_block()
+
+	def _write_next_block(self):
+		block = self._pending_blocks.popleft().result()
+		self._output_file.write(block)
+		self._block_offsets.append(self._block_offsets[-1] + len(block))
+
+
+class BgzfReader(io.RawIOBase):
+	"""Reads a BGZF file, decompressing blocks ahead of time in a thread pool"""
+
+	def __init__(self, path, threads=DEFAULT_THREADS):
+		super().__init__()
+		self.path = path
+		self._input_file = open(path, "rb")
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads))
+		self._max_pending_blocks = 4 * max(1, threads)
+		self._pending_blocks = collections.deque()
+		self._current_block = b""
+		self._current_block_offset = 0
+		self._reached_end_of_file = False
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		while self._current_block_offset >= len(self._current_block):
+			self._read_ahead()
+			if not self._pending_blocks:
+				return 0
+			self._current_block = self._pending_blocks.popleft().result()
+			self._current_block_offset = 0
+
+		n = min(len(buffer), len(self._current_block) - self._current_block_offset)
+		buffer[:n] = self._current_block[self._current_block_offset:self._current_block_offset + n]
+		self._current_block_offset += n
+		return n
+
+	def close(self):
+		if self.closed:
+			return
+		self._input_file.close()
+		for future in self._pending_blocks:
+			future.cancel()
+		self._executor.shutdown()
+		super().close()
+
+	def _read_ahead(self):
+		while not self._reached_end_of_file and len(self._pending_blocks) < self._max_pending_blocks:
+			compressed_data = self._read_compressed_block()
+			if compressed_data is None:
+				self._reached_end_of_file = True
+				break
+			self._pending_blocks.append(self._executor.submit(zlib.decompress, compressed_data, -15))
+
+	def _read_compressed_block(self):
+		"""Returns the deflate-compressed data of the next block, or None at the end of the file"""
+		return read_compressed_block(self._input_file, self.path)
+
+
+def read_compressed_block(input_file, path):
+	"""Reads the BGZF block that starts at the current position of input_file, and returns its deflate-compressed data,
+	or None at the end of the file"""
+	header = input_file.read(12)
+	if not header:
+		return None
+	if len(header) < 12 or header[:4] != BGZF_HEADER[:4]:
+		raise ValueError(f"{path} is not a valid BGZF file")
+
+	extra_length, = struct.unpack("<H", header[10:12])
+	extra = input_file.read(extra_length)
+	block_size = None
+	i = 0
+	while i + 4 <= len(extra):
+		subfield_id, subfield_length = extra[i:i+2], struct.unpack("<H", extra[i+2:i+4])[0]
+		if subfield_id == b"BC":
+			block_size = struct.unpack("<H", extra[i+4:i+6])[0] + 1
+		i += 4 + subfield_length
+
+	if block_size is None:
+		raise ValueError(f"{path} is not a valid BGZF file")
+
+	compressed_data = input_file.read(block_size - 12 - extra_length - 8)
+	input_file.read(8)  # CRC32 and ISIZE
+	return compressed_data
+
+
+class BgzfRandomAccessReader:
+	"""Reads data from a BGZF file at virtual offsets (compressed block offset << 16 | offset within the decompressed
+	block), as found in tabix indexes. The most recently used decompressed blocks are kept in an LRU cache, so reads
+	near each other only decompress each block once.
+	"""
+
+	def __init__(self, path, max_cached_blocks=DEFAULT_MAX_CACHED_BLOCKS):
+		self.path = path
+		self.max_cached_blocks = max_cached_blocks
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self._input_file = open(path, "rb")
+		self._blocks = collections.OrderedDict()  # maps block offsets to (data, next block offset) tuples
+
+	def read_block(self, block_offset):
+		"""Returns a (data, next_block_offset) tuple for the block that starts at the given compressed offset. data is
+		empty at the end of the file."""
+		block = self._blocks.get(block_offset)
+		if block is not None:
+			self.cache_hits += 1
+			self._blocks.move_to_end(block_offset)
+			return block
+
+		self.cache_misses += 1
+		self._input_file.seek(block_offset)
+		compressed_data = read_compressed_block(self._input_file, self.path)
+		block = (zlib.decompress(compressed_data, -15) if compressed_data is not None else b"", self._input_file.tell())
+		self._blocks[block_offset] = block
+		if len(self._blocks) > self.max_cached_blocks:
+			self._blocks.popitem(last=False)
+		return block
+
+	def read(self, virtual_offset, length):
+		"""Returns length bytes of decompressed data starting at the given virtual offset"""
+		block_offset, offset_within_block = virtual_offset >> 16, virtual_offset & 0xffff
+		chunks = []
+		while length > 0:
+			data, next_block_offset = self.read_block(block_offset)
+			if not data:
+				break
+			chunk = data[offset_within_block:offset_within_block + length]
+			chunks.append(chunk)
+			length -= len(chunk)
+			block_offset, offset_within_block = next_block_offset, 0
+		return b"".join(chunks)
+
+	def iterate_lines(self, start_virtual_offset, end_virtual_offset):
+		"""Yields the lines (as bytes, without newlines) that start at or after start_virtual_offset and before
+		end_virtual_offset"""
+		block_offset, offset_within_block = start_virtual_offset >> 16, start_virtual_offset & 0xffff
+		partial_line = b""
+		while True:
+			data, next_block_offset = self.read_block(block_offset)
+			if not data:
+				break
+			while offset_within_block < len(data):
+				if not partial_line and (block_offset << 16 | offset_within_block) >= end_virtual_offset:
+					return
+				newline_offset = data.find(b"\n", offset_within_block)
+				if newline_offset == -1:
+					partial_line += data[offset_within_block:]
+					break
+				yield partial_line + data[offset_within_block:newline_offset]
+				partial_line = b""
+				offset_within_block = newline_offset + 1
+			block_offset, offset_within_block = next_block_offset, 0
+		if partial_line:
+			yield partial_line
+
+	def close(self):
+		self._input_file.close()
+		self._blocks.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+class TabixIndexBuilder:
+	"""Builds a tabix (.tbi) or CSI (.csi) index from the lines of a sorted, tab-delimited file as it's being written.
+
+	Records are first indexed by their offsets in the uncompressed data. These are converted to BGZF virtual offsets
+	(compressed block offset << 16 | offset within the block) once the compressed size of each block is known.
+	"""
+
+	def __init__(self, index_format, zero_based=True, chrom_column=0, start_column=1, end_column=2, meta_char="#"):
+		self.index_format = index_format
+		self.zero_based = zero_based
+		self.chrom_column = chrom_column
+		self.start_column = start_column
+		self.end_column = end_column
+		self.meta_char = meta_char
+		self.min_shift = TBI_MIN_SHIFT if index_format == "tbi" else CSI_MIN_SHIFT
+		self.depth = TBI_DEPTH if index_format == "tbi" else CSI_DEPTH
+
+		self.chrom_names = []
+		self._bins = []          # for each chromosome, a dict that maps bin number to a list of [start, end] chunks
+		self._linear_index = []  # for each chromosome, the offset of the first record that overlaps each window
+		self._partial_line = b""
+		self._line_offset = 0
+		self._previous_start = 0
+
+	def add_data(self, data):
+		lines = (self._partial_line + data).split(b"\n")
+		self._partial_line = lines.pop()
+		for line in lines:
+			line_end_offset = self._line_offset + len(line) + 1
+			self._add_line(line, self._line_offset, line_end_offset)
+			self._line_offset = line_end_offset
+
+	def _add_line(self, line, line_start_offset, line_end_offset):
+		if not line or line.startswith(self.meta_char.encode()):
+			return
+
+		fields = line.split(b"\t")
+		chrom = fields[self.chrom_column].decode()
+		start = int(fields[self.start_column]) - (0 if self.zero_based else 1)
+		end = int(fields[self.end_column]) if self.end_column is not None else start + 1
+		end = max(end, start + 1)
+
+		if not self.chrom_names or self.chrom_names[-1] != chrom:
+			if chrom in self.chrom_names:
+				raise ValueError(f"Can't index file because it isn't sorted: {chrom} appears in more than one block")
+			self.chrom_names.append(chrom)
+			self._bins.append({})
+			self._linear_index.append([])
+			self._previous_start = 0
+		elif start < self._previous_start:
+			raise ValueError(f"Can't index file because it isn't sorted: {chrom}:{start} is after "
+							 f"{chrom}:{self._previous_start}")
+		self._previous_start = start
+
+		chunks = self._bins[-1].setdefault(reg2bin(start, end, self.min_shift, self.depth), [])
+		if chunks and chunks[-1][1] == line_start_offset:
+			chunks[-1][1] = line_end_offset
+		else:
+			chunks.append([line_start_offset, line_end_offset])
+
+		linear_index = self._linear_index[-1]
+		last_window = (end - 1) >> self.min_shift
+		if len(linear_index) <= last_window:
+			linear_index.extend([None] * (last_window + 1 - len(linear_index)))
+		for window in range(start >> self.min_shift, last_window + 1):
+			if linear_index[window] is None:
+				linear_index[window] = line_start_offset
+
+	def write_index(self, index_path, block_offsets):
+		"""Write the index.
+
+		Args:
+			index_path (str): output path
+			block_offsets (list): compressed file offset of each BGZF block, in order
+		"""
+		def to_virtual_offset(uncompressed_offset):
+			block_i, offset_within_block = divmod(uncompressed_offset, BGZF_BLOCK_SIZE)
+			return (block_offsets[block_i] << 16) | offset_within_block
+
+		if self._partial_line:
+			self._add_line(self._partial_line, self._line_offset, self._line_offset + len(self._partial_line))
+
+		names = b"".join(name.encode() + b"\x00" for name in self.chrom_names)
+		tabix_header = struct.pack(
+			"<6i",
+			TABIX_FORMAT_GENERIC | (TABIX_FORMAT_ZERO_BASED if self.zero_based else 0),
+			self.chrom_column + 1,
+			self.start_column + 1,
+			self.end_column + 1 if self.end_column is not None else 0,
+			ord(self.meta_char),
+			0,
+		) + struct.pack("<i", len(names)) + names
+
+		if self.index_format == "tbi":
+			output = [b"TBI\x01", struct.pack("<i", len(self.chrom_names)), tabix_header]
+		else:
+			output = [b"CSI\x01", struct.pack("<3i", self.min_shift, self.depth, len(tabix_header)), tabix_header,
+					  struct.pack("<i", len(self.chrom_names))]
+
+		for bins, linear_index in zip(self._bins, self._linear_index):
+			# fill windows that don't overlap any records with the offset from the previous window
+			previous_offset = 0
+			for window, offset in enumerate(linear_index):
+				linear_index[window] = previous_offset = offset if offset is not None else previous_offset
+
+			bins = {
+				bin_number: [(to_virtual_offset(start), to_virtual_offset(end)) for start, end in chunks]
+				for bin_number, chunks in bins.items()
+			}
+			loffsets = {}
+			if self.index_format == "csi":
+				for bin_number in bins:
+					first_window = get_first_window_of_bin(bin_number, self.depth)
+					loffsets[bin_number] = linear_index[first_window] if first_window < len(linear_index) else 0
+			compress_bins(bins, self.depth)
+
+			output.append(struct.pack("<i", len(bins)))
+			for bin_number, chunks in sorted(bins.items()):
+				if self.index_format == "tbi":
+					output.append(struct.pack("<Ii", bin_number, len(chunks)))
+				else:
+					output.append(struct.pack("<IQi", bin_number, to_virtual_offset(loffsets[bin_number]), len(chunks)))
+				for chunk_start, chunk_end in chunks:
+					output.append(struct.pack("<QQ", chunk_start, chunk_end))
+
+			if self.index_format == "tbi":
+				output.append(struct.pack("<i", len(linear_index)))
+				output.append(struct.pack(f"<{len(linear_index)}Q", *map(to_virtual_offset, linear_index)))
+
+		index_writer = BgzfWriter(index_path, threads=1)
+		index_writer.write(b"".join(output))
+		index_writer.close()
+
+
+class TabixIndex:
+	"""Reads a tabix (.tbi) index, such as one written by TabixIndexBuilder, and finds the lines of the indexed BGZF
+	file that overlap a region. The bins of each chromosome are only parsed the first time that chromosome is queried.
+	"""
+
+	def __init__(self, index_path):
+		self.index_path = index_path
+		# the index is BGZF-compressed, but its name doesn't end in "gz"
+		with gzip.open(index_path, "rb") as f:
+			self._data = f.read()
+		if self._data[:4] != b"TBI\x01":
+			raise ValueError(f"{index_path} is not a tabix index")
+
+		num_chroms, tabix_format, chrom_column, start_column, end_column, meta_char, _, names_length = \
+			struct.unpack_from("<8i", self._data, 4)
+		self.zero_based = bool(tabix_format & TABIX_FORMAT_ZERO_BASED)
+		self.chrom_column = chrom_column - 1
+		self.start_column = start_column - 1
+		self.end_column = end_column - 1 if end_column > 0 else None
+		self.meta_char = chr(meta_char).encode()
+		names_offset = 36
+		self.chrom_names = self._data[names_offset:names_offset + names_length].decode().split("\x00")[:num_chroms]
+
+		# find where the bins of each chromosome start, skipping over their contents
+		self._chrom_offsets = {}
+		offset = names_offset + names_length
+		for chrom in self.chrom_names:
+			self._chrom_offsets[chrom] = offset
+			num_bins, = struct.unpack_from("<i", self._data, offset)
+			offset += 4
+			for _ in range(num_bins):
+				num_chunks, = struct.unpack_from("<i", self._data, offset + 4)
+				offset += 8 + 16 * num_chunks
+			num_windows, = struct.unpack_from("<i", self._data, offset)
+			offset += 4 + 8 * num_windows
+		self._parsed_chroms = {}
+
+	def _get_chrom_bins(self, chrom):
+		"""Returns a (bins, linear_index) tuple for the given chromosome, where bins maps bin numbers to lists of
+		(start, end) virtual offset tuples, and linear_index has the virtual offset of the first record in each window"""
+		if chrom not in self._parsed_chroms:
+			offset = self._chrom_offsets[chrom]
+			num_bins, = struct.unpack_from("<i", self._data, offset)
+			offset += 4
+			bins = {}
+			for _ in range(num_bins):
+				bin_number, num_chunks = struct.unpack_from("<Ii", self._data, offset)
+				offset += 8
+				chunk_offsets = struct.unpack_from(f"<{2 * num_chunks}Q", self._data, offset)
+				bins[bin_number] = list(zip(chunk_offsets[::2], chunk_offsets[1::2]))
+				offset += 16 * num_chunks
+			num_windows, = struct.unpack_from("<i", self._data, offset)
+			linear_index = struct.unpack_from(f"<{num_windows}Q", self._data, offset + 4)
+			self._parsed_chroms[chrom] = (bins, linear_index)
+		return self._parsed_chroms[chrom]
+
+	def get_chunks(self, chrom, start, end):
+		"""Returns a sorted list of non-overlapping (start, end) virtual offset tuples for the parts of the file that may
+		contain lines overlapping the 0-based, half-open interval [start, end)"""
+		if chrom not in self._chrom_offsets or end <= start:
+			return []
+
+		bins, linear_index = self._get_chrom_bins(chrom)
+		window = start >> TBI_MIN_SHIFT
+		min_offset = linear_index[window] if window < len(linear_index) else (linear_index[-1] if linear_index else 0)
+		chunks = sorted(
+			chunk for bin_number in reg2bins(start, end, TBI_MIN_SHIFT, TBI_DEPTH) for chunk in bins.get(bin_number, [])
+			if chunk[1] > min_offset
+		)
+
+		merged_chunks = []
+		for chunk_start, chunk_end in chunks:
+			if merged_chunks and chunk_start <= merged_chunks[-1][1]:
+				merged_chunks[-1] = (merged_chunks[-1][0], max(merged_chunks[-1][1], chunk_end))
+			else:
+				merged_chunks.append((chunk_start, chunk_end))
+		return merged_chunks
+
+	def fetch(self, reader, chrom, start, end):
+		"""Yields the lines of the indexed file that overlap the 0-based, half-open interval [start, end), in file order.
+
+		Args:
+			reader (BgzfRandomAccessReader): reader for the indexed file
+			chrom (str): chromosome name, as it appears in the indexed file
+			start (int): 0-based start coordinate
+			end (int): end coordinate
+
+		Yields:
+			str: lines without the trailing newline
+		"""
+		for chunk_start, chunk_end in self.get_chunks(chrom, start, end):
+			for line in reader.iterate_lines(chunk_start, chunk_end):
+				if not line or line.startswith(self.meta_char):
+					continue
+				fields = line.split(b"\t")
+				if fields[self.chrom_column].decode() != chrom:
+					continue
+				line_start = int(fields[self.start_column]) - (0 if self.zero_based else 1)
+				line_end = int(fields[self.end_column]) if self.end_column is not None else line_start + 1
+				if line_start >= end:
+					# lines are sorted by start coordinate, so none of the remaining lines overlap the interval
+					return
+				if max(line_end, line_start + 1) > start:
+					yield line.decode()
+
+
+def compress_bins(bins, depth):
+	"""Reduce the size of the index the same way htslib does: move the chunks of bins that span less than one BGZF
+	block to their parent bin, and merge chunks that start in the same block as the previous chunk ends.
+
+	Args:
+		bins (dict): maps bin numbers to lists of (start, end) virtual offset tuples. Modified in place.
+		depth (int): number of levels in the binning scheme
+	"""
+	for level in range(depth, 0, -1):
+		first_bin_at_level = ((1 << (level * 3)) - 1) // 7
+		for bin_number in sorted(bins):
+			if bin_number < first_bin_at_level or bin_number not in bins:
+				continue
+			chunks = bins[bin_number]
+			if level < depth:
+				chunks.sort()
+			parent_bin = (bin_number - 1) >> 3
+			if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 and parent_bin in bins:
+				bins[parent_bin].extend(chunks)
+				del bins[bin_number]
+
+	for bin_number, chunks in bins.items():
+		chunks.sort()
+		merged_chunks = [chunks[0]]
+		for chunk_start, chunk_end in chunks[1:]:
+			if merged_chunks[-1][1] >> 16 >= chunk_start >> 16:
+				merged_chunks[-1] = (merged_chunks[-1][0], max(merged_chunks[-1][1], chunk_end))
+			else:
+				merged_chunks.append((chunk_start, chunk_end))
+		bins[bin_number] = merged_chunks
+
+
+def reg2bin(start, end, min_shift, depth):
+	"""Returns the smallest bin that contains the 0-based, half-open interval [start, end). Same as hts_reg2bin."""
+	end -= 1
+	shift = min_shift
+	first_bin_at_level = ((1 << (depth * 3)) - 1) // 7
+	for level in range(depth, 0, -1):
+		if start >> shift == end >> shift:
+			return first_bin_at_level + (start >> shift)
+		shift += 3
+		first_bin_at_level -= 1 << ((level - 1) * 3)
+	return 0
+
+
+def reg2bins(start, end, min_shift, depth):
+	"""Returns the numbers of all bins that may contain intervals overlapping the 0-based, half-open interval
+	[start, end). Same as hts_reg2bins."""
+	end -= 1
+	bins = []
+	first_bin_at_level = 0
+	shift = min_shift + depth * 3
+	for level in range(depth + 1):
+		bins.extend(range(first_bin_at_level + (start >> shift), first_bin_at_level + (end >> shift) + 1))
+		first_bin_at_level += 1 << (level * 3)
+		shift -= 3
+	return bins
+
+
+def get_first_window_of_bin(bin_number, depth):
+	"""Returns the index of the first linear index window covered by the given bin. Same as hts_bin_bot."""
+	level = 0
+	b = bin_number
+	while b:
+		level += 1
+		b = (b - 1) >> 3
+	first_bin_at_level = ((1 << (level * 3)) - 1) // 7
+	return (bin_number - first_bin_at_level) << ((depth - level) * 3)
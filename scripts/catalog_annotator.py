@@ -0,0 +1,244 @@
+"""Interface for scripts that add annotations to the records of a JSON catalog, and a function that applies several
+annotators to a catalog in a single streaming pass.
+
+Each annotator loads its lookup tables up front and then annotates records one batch at a time, so any number of
+annotators can share the same pass through the catalog instead of each one decompressing, parsing, re-serializing and
+recompressing the whole file.
+
+Annotators that can tell from a record's LocusId alone whether they might annotate it (see
+CatalogAnnotator.may_annotate_locus_ids) also support passthrough mode, where JSON records are only parsed and
+re-serialized if some annotator might change them. All other records are copied from the input to the output as is.
+"""
+
+import collections
+import multiprocessing
+import tqdm
+
+from catalog_io import CATALOG_BATCH_SIZE, CatalogWriter, get_raw_json_record_locus_id, is_arrow_path, \
+	iterate_batches, iterate_catalog_records, iterate_raw_json_records, parse_raw_json_record, serialize_record
+from profiling import iterate_in_phase, profile_phase
+
+BATCH_SIZE = CATALOG_BATCH_SIZE
+
+
+class CatalogAnnotator:
+	"""Base class for annotators. Subclasses load any data they need in __init__ and implement annotate_record."""
+
+	name = "annotations"
+
+	# annotators that have to see the records in catalog order (for example, because they read a sorted annotation
+	# source in lockstep with the catalog) set this to True. When records are annotated in worker processes, these
+	# annotators are applied in the main process before each batch is sent to the workers.
+	runs_in_main_process = False
+
+	def __init__(self):
+		self.counters = collections.Counter()
+
+	def annotate_record(self, record):
+		"""Add annotations to the given catalog record in place.
+
+		Args:
+			record (dict): catalog record
+
+		Return:
+			bool: True if any annotations were added to this record
+		"""
+		raise NotImplementedError
+
+	def annotate_records(self, records):
+		"""Add annotations to a batch of consecutive catalog records in place. Annotators that can process many records
+		more efficiently than one at a time can override this.
+
+		Args:
+			records (list): catalog records
+
+		Return:
+			list: a bool for each record that is True if any annotations were added to it
+		"""
+		return [self.annotate_record(record) for record in records]
+
+	def may_annotate_locus_ids(self, locus_ids):
+		"""Annotators that only annotate records whose LocusId is in their lookup table can override this to support
+		passthrough mode.
+
+		Args:
+			locus_ids (list): the LocusId of each record in a batch, or None for records that don't have one
+
+		Return:
+			list: a bool for each locus id that is False if annotate_records definitely won't change a record with this
+				LocusId, or None if this annotator has to see every record
+		"""
+		return None
+
+	def close(self):
+		"""Called after all records have been annotated. Annotators that read their annotation source in lockstep with
+		the catalog, or that write outputs of their own, can override this to finish up."""
+		pass
+
+	def print_stats(self):
+		print(f"Added {self.name} to {self.counters['annotated']:,d} out of {self.counters['total']:,d} loci")
+
+
+def annotate_catalog(catalog_json_path, output_catalog_json_path, annotators, show_progress_bar=False, threads=1,
+					 passthrough=False, compact=False):
+	"""Read the catalog once, apply all annotators to each record, and write the annotated records.
+
+	Args:
+		catalog_json_path (str): path of the input catalog in JSON, Arrow, or BED format
+		output_catalog_json_path (str): path of the output catalog in JSON or Arrow format
+		annotators (list): CatalogAnnotator objects to apply to each record, in order
+		show_progress_bar (bool): show a progress bar
+		threads (int): if more than 1, batches of records are annotated (and serialized, for JSON output) by this many
+			worker processes. The output is the same as with threads=1.
+		passthrough (bool): only parse and re-serialize the records that might be annotated, and copy the text of all
+			other records to the output unchanged. This requires JSON input and output, and annotators that implement
+			may_annotate_locus_ids. The output has the same records as without passthrough, but unannotated records
+			keep the formatting they had in the input.
+		compact (bool): write compact JSON instead of pretty-printing each record
+
+	Return:
+		int: the number of records written
+	"""
+	if passthrough:
+		if is_arrow_path(catalog_json_path) or ".json" not in catalog_json_path or is_arrow_path(output_catalog_json_path):
+			raise ValueError("Passthrough mode requires a JSON input catalog and a JSON output catalog")
+		unsupported_annotators = [annotator.name for annotator in annotators if annotator.runs_in_main_process or
+								  annotator.may_annotate_locus_ids([]) is None]
+		if unsupported_annotators:
+			raise ValueError(f"Passthrough mode isn't supported for {', '.join(unsupported_annotators)}")
+		iterator = iterate_raw_json_records(catalog_json_path)
+	else:
+		iterator = iterate_catalog_records(catalog_json_path)
+
+	if show_progress_bar:
+		iterator = tqdm.tqdm(iterator, unit=" records", unit_scale=True)
+
+	batches = iterate_in_phase(iterate_batches(iterator, BATCH_SIZE), "read catalog")
+	with CatalogWriter(output_catalog_json_path, compact=compact) as writer:
+		if passthrough and threads > 1:
+			annotate_batches_in_worker_processes(batches, writer, annotators, threads, passthrough=True)
+		elif passthrough:
+			for batch in batches:
+				with profile_phase("annotate records"):
+					raw_records = annotate_raw_batch(batch, annotators, compact=compact)
+				with profile_phase("write output"):
+					for raw_record in raw_records:
+						writer.write_json_string(raw_record)
+		elif threads > 1:
+			annotate_batches_in_worker_processes(batches, writer, annotators, threads)
+		else:
+			for batch in batches:
+				with profile_phase("annotate records"):
+					annotate_batch(batch, annotators)
+				with profile_phase("write output"):
+					for record in batch:
+						writer.write(record)
+
+	with profile_phase("close annotators"):
+		for annotator in annotators:
+			annotator.close()
+	for annotator in annotators:
+		annotator.print_stats()
+
+	return writer.record_counter
+
+
+def annotate_batch(batch, annotators):
+	for annotator in annotators:
+		annotator.counters["total"] += len(batch)
+		annotator.counters["annotated"] += sum(annotator.annotate_records(batch))
+
+
+def annotate_raw_batch(raw_records, annotators, compact=False):
+	"""Annotate a batch of records returned by iterate_raw_json_records.
+
+	Only the records that at least one annotator might annotate are parsed, annotated and re-serialized.
+
+	Return:
+		list: the JSON text of each record
+	"""
+	locus_ids = [get_raw_json_record_locus_id(raw_record) for raw_record in raw_records]
+	may_annotate = [False] * len(raw_records)
+	for annotator in annotators:
+		may_annotate = [a or b for a, b in zip(may_annotate, annotator.may_annotate_locus_ids(locus_ids))]
+
+	indices = [i for i, value in enumerate(may_annotate) if value]
+	records = [parse_raw_json_record(raw_records[i]) for i in indices]
+	for annotator in annotators:
+		annotator.counters["total"] += len(raw_records)
+		annotator.counters["annotated"] += sum(annotator.annotate_records(records))
+
+	raw_records = list(raw_records)
+	for i, record in zip(indices, records):
+		raw_records[i] = serialize_record(record, compact=compact)
+
+	return raw_records
+
+
+def annotate_batches_in_worker_processes(batches, writer, annotators, threads, passthrough=False):
+	"""Annotate batches of records in a pool of worker processes and write them in their original order.
+
+	The worker processes are forked after the annotators have loaded their lookup tables, so the workers share the
+	tables instead of each loading their own copy. Tables loaded from the annotation source cache are memory-mapped, so
+	their pages stay shared between the processes.
+
+	If passthrough is True, the batches contain raw JSON records (see annotate_raw_batch).
+	"""
+	context = multiprocessing.get_context("fork")
+	initargs = (annotators, not writer.is_arrow, writer.compact, passthrough)
+	with context.Pool(threads, initializer=_init_worker, initargs=initargs) as pool:
+		# limit the number of batches in flight so that memory use doesn't depend on the size of the catalog
+		pending_results = collections.deque()
+		main_process_annotators = [annotator for annotator in annotators if annotator.runs_in_main_process]
+		for batch in batches:
+			with profile_phase("annotate records"):
+				annotate_batch(batch, main_process_annotators)
+			pending_results.append(pool.apply_async(_annotate_batch_in_worker, (batch,)))
+			if len(pending_results) >= 2 * threads:
+				_write_worker_result(pending_results.popleft(), writer, annotators)
+
+		while pending_results:
+			_write_worker_result(pending_results.popleft(), writer, annotators)
+
+
+_worker_annotators = None
+_worker_serializes_records = False
+_worker_compact = False
+_worker_passthrough = False
+
+
+def _init_worker(annotators, serialize_records, compact, passthrough):
+	global _worker_annotators, _worker_serializes_records, _worker_compact, _worker_passthrough
+	_worker_annotators = annotators
+	_worker_serializes_records = serialize_records
+	_worker_compact = compact
+	_worker_passthrough = passthrough
+
+
+def _annotate_batch_in_worker(batch):
+	"""Returns the annotated records (or their JSON strings) along with each annotator's counters for this batch"""
+	for annotator in _worker_annotators:
+		annotator.counters = collections.Counter()
+	if _worker_passthrough:
+		# passthrough mode doesn't support annotators that run in the main process
+		return annotate_raw_batch(batch, _worker_annotators, compact=_worker_compact), [annotator.counters for annotator in _worker_annotators]
+
+	annotate_batch(batch, [annotator for annotator in _worker_annotators if not annotator.runs_in_main_process])
+	if _worker_serializes_records:
+		batch = [serialize_record(record, compact=_worker_compact) for record in batch]
+	return batch, [annotator.counters for annotator in _worker_annotators]
+
+
+def _write_worker_result(pending_result, writer, annotators):
+	with profile_phase("wait for worker processes"):
+		batch, counters = pending_result.get()
+
+	for annotator, annotator_counters in zip(annotators, counters):
+		annotator.counters.update(annotator_counters)
+	with profile_phase("write output"):
+		for record in batch:
+			if writer.is_arrow:
+				writer.write(record)
+			else:
+				writer.write_json_string(record)
+
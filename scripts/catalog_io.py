@@ -0,0 +1,485 @@
+"""Read and write catalogs in either JSON or Arrow IPC format.
+
+JSON (.json or .json.gz) is the release format. Arrow IPC (.arrow) is an optional columnar format for intermediate
+files that are passed between the scripts in this directory. Arrow files are memory-mapped when read, so loading them
+is much faster than parsing JSON token by token, and they're also smaller than indented JSON.
+
+In Arrow files, each field listed in ARROW_COLUMNS is stored in its own typed column. Any other fields, along with
+any values that don't match their column's type (for example, ReferenceRegion lists for loci with adjacent repeats,
+or explicit nulls), are stored in the ExtraFields column as a JSON object. This way, any record can be converted to
+Arrow and back without losing information, although the order of fields within each record may change.
+
+JSON catalogs can be read with several parser backends (see JSON_READER_BACKENDS). By default, the fastest one that's
+installed is used. JSON output is either pretty-printed with indent=4, as in the released catalogs, or compact. In both
+cases, Decimals are written exactly as they were read and floats are written with repr(), so numbers always round-trip.
+benchmark_catalog_io.py reports the throughput of each backend and output mode.
+"""
+
+import decimal
+import ijson
+import importlib.util
+import os
+import re
+import simplejson as json
+
+from bgzf_io import open_file
+
+ARROW_BATCH_SIZE = 50_000
+
+CATALOG_BATCH_SIZE = 10_000
+
+# ijson uses the yajl C library if it's installed, and otherwise falls back to a much slower pure-python parser. orjson
+# and json parse one record at a time after iterate_raw_json_records finds the record boundaries. orjson only supports
+# use_float=True since it can't parse numbers as Decimals.
+JSON_READER_BACKENDS = ("ijson", "orjson", "json")
+
+RAW_JSON_CHUNK_SIZE = 2**20
+
+RAW_JSON_SEPARATOR_REGEX = re.compile(r"[\s,\[]*")
+# matches everything up to the next brace that isn't inside a string, for objects that contain escaped characters
+RAW_JSON_OBJECT_CONTENT_REGEX = re.compile(r'[^"{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}]*)*')
+RAW_JSON_LOCUS_ID_REGEX = re.compile(r'"LocusId"\s*:\s*"((?:[^"\\]|\\.)*)"')
+RAW_JSON_REFERENCE_REGION_REGEX = re.compile(r'"ReferenceRegion"\s*:\s*(\[[^\]]*\]|"[^"]*")')
+
+# compress each column buffer so that Arrow files stay smaller than the gzipped JSON they replace
+ARROW_COMPRESSION = "zstd"
+
+EXTRA_FIELDS_COLUMN = "ExtraFields"
+
+# known catalog fields and their types. Fields are stored in this column order.
+ARROW_COLUMNS = [
+	("LocusId", str),
+	("ReferenceRegion", str),
+	("LocusStructure", str),
+	("VariantType", str),
+	("CanonicalMotif", str),
+	("Source", str),
+	("TRsInRegion", int),
+	("GencodeGeneRegion", str),
+	("GencodeGeneId", str),
+	("GencodeGeneName", str),
+	("GencodeTranscriptId", str),
+	("RefseqGeneRegion", str),
+	("RefseqGeneId", str),
+	("RefseqGeneName", str),
+	("RefseqTranscriptId", str),
+	("ManeGeneRegion", str),
+	("ManeGeneId", str),
+	("ManeGeneName", str),
+	("ManeTranscriptId", str),
+	("KnownDiseaseAssociatedMotif", str),
+	("KnownDiseaseAssociatedLocus", str),
+	("NsInFlanks", int),
+	("LeftFlankMappability", float),
+	("FlanksAndLocusMappability", float),
+	("RightFlankMappability", float),
+	("FoundInKnownDiseaseAssociatedLoci", str),
+	("FoundInIllumina174kPolymorphicTRs", str),
+	("FoundInPerfectRepeatsInReference", str),
+	("FoundInPolymorphicTRsInT2TAssemblies", str),
+	("NumRepeatsInReference", int),
+	("ReferenceRepeatPurity", float),
+	("AlleleFrequenciesFromIllumina174k", str),
+	("StdevFromIllumina174k", float),
+	("AlleleFrequenciesFromT2TAssemblies", str),
+	("StdevFromT2TAssemblies", float),
+	("VariationCluster", str),
+	("VariationClusterSizeDiff", int),
+	("LPSLengthStdevFromHPRC100", float),
+	("LPSMotifFractionFromHPRC100", str),
+]
+
+
+def is_arrow_path(path):
+	return path.endswith(".arrow")
+
+
+def get_arrow_schema():
+	import pyarrow as pa
+
+	arrow_types = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+	return pa.schema(
+		[pa.field(name, arrow_types[value_type]) for name, value_type in ARROW_COLUMNS] +
+		[pa.field(EXTRA_FIELDS_COLUMN, pa.string())]
+	)
+
+
+def convert_value_for_arrow_column(value, value_type):
+	"""Returns the value converted to the given column type, or None if it must be stored in the ExtraFields column"""
+	if value_type is str:
+		return value if isinstance(value, str) else None
+	if value_type is int:
+		return value if isinstance(value, int) and not isinstance(value, bool) else None
+	if value_type is float:
+		return float(value) if isinstance(value, (float, decimal.Decimal)) else None
+	return None
+
+
+def get_available_json_reader_backends():
+	"""Returns the JSON_READER_BACKENDS that are installed"""
+	backends = []
+	for backend in JSON_READER_BACKENDS:
+		if backend == "orjson" and importlib.util.find_spec("orjson") is None:
+			continue
+		backends.append(backend)
+	return backends
+
+
+def get_default_json_reader_backend(use_float=False):
+	"""Returns the fastest installed backend for reading JSON catalogs"""
+	if ijson.backend in ("yajl2_c", "yajl2_cffi"):
+		return "ijson"
+	if use_float and "orjson" in get_available_json_reader_backends():
+		return "orjson"
+	# the stdlib json parser is faster than ijson's pure-python backend
+	return "json"
+
+
+def iterate_catalog_records(catalog_path, use_float=False, backend=None):
+	"""Yields the records of a catalog without loading the whole file into memory.
+
+	Args:
+		catalog_path (str): path of a catalog in JSON, Arrow, or BED format
+		use_float (bool): if False, numbers in JSON catalogs are parsed as Decimals so that they can be written back out
+			unchanged. If True, they're parsed as floats. BED catalogs are converted to records by str_analysis.
+		backend (str): one of JSON_READER_BACKENDS to use for parsing JSON catalogs. Defaults to the fastest one that's
+			installed.
+	"""
+	if is_arrow_path(catalog_path):
+		yield from iterate_arrow_catalog_records(catalog_path, use_float=use_float)
+		return
+
+	if ".json" not in catalog_path:
+		from str_analysis.utils.eh_catalog_utils import get_variant_catalog_iterator
+		for record in get_variant_catalog_iterator(catalog_path):
+			yield dict(record)
+		return
+
+	backend = backend or get_default_json_reader_backend(use_float=use_float)
+	if backend == "ijson":
+		with open_file(catalog_path, "rb") as f:
+			yield from ijson.items(f, "item", use_float=use_float)
+	elif backend == "orjson":
+		if not use_float:
+			raise ValueError("The orjson backend can only be used with use_float=True")
+		import orjson
+		for raw_record in iterate_raw_json_records(catalog_path):
+			yield orjson.loads(raw_record)
+	elif backend == "json":
+		for raw_record in iterate_raw_json_records(catalog_path):
+			yield json.loads(raw_record) if use_float else parse_raw_json_record(raw_record)
+	else:
+		raise ValueError(f"Invalid JSON reader backend: {backend}")
+
+
+def iterate_catalog_record_batches(catalog_path, batch_size=CATALOG_BATCH_SIZE, **kwargs):
+	"""Yields lists of up to batch_size consecutive records. Takes the same keyword arguments as
+	iterate_catalog_records."""
+	yield from iterate_batches(iterate_catalog_records(catalog_path, **kwargs), batch_size)
+
+
+def iterate_batches(iterator, batch_size):
+	"""Yield lists of up to batch_size consecutive items from the iterator"""
+	batch = []
+	for item in iterator:
+		batch.append(item)
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def iterate_raw_json_records(catalog_path):
+	"""Yields the JSON text of each record in a JSON catalog, exactly as it appears in the file, without parsing it.
+
+	This only finds where each record begins and ends, so it's much faster than parsing the records. Records can be
+	parsed later with parse_raw_json_record, and the text of records that don't change can be written to the output
+	with CatalogWriter.write_json_string.
+	"""
+	with open_file(catalog_path, "rt") as f:
+		buffer = ""
+		position = 0
+		while True:
+			# skip the opening bracket and the separators between records
+			position = RAW_JSON_SEPARATOR_REGEX.match(buffer, position).end()
+			if position == len(buffer):
+				buffer = f.read(RAW_JSON_CHUNK_SIZE)
+				position = 0
+				if not buffer:
+					raise ValueError(f"{catalog_path} ended before the closing ']' of the list of records")
+				continue
+
+			if buffer[position] == "]":
+				return
+			if buffer[position] != "{":
+				raise ValueError(f"Unexpected character in {catalog_path}: {buffer[position:position+50]!r}")
+
+			end = find_raw_json_object_end(buffer, position)
+			while end is None:
+				chunk = f.read(RAW_JSON_CHUNK_SIZE)
+				if not chunk:
+					raise ValueError(f"{catalog_path} ended in the middle of a record: {buffer[position:position+200]!r}")
+				buffer = buffer[position:] + chunk
+				position = 0
+				end = find_raw_json_object_end(buffer, position)
+
+			yield buffer[position:end]
+			position = end
+
+
+def find_raw_json_object_end(text, start):
+	"""Returns the position just after the JSON object that starts at text[start], or None if text ends before the
+	object does"""
+	depth = 0
+	quote_counter = 0
+	position = start
+	while True:
+		# str.find is much faster than searching for either brace with a regex
+		brace_position = text.find("}", position)
+		if brace_position == -1:
+			return None
+		open_brace_position = text.find("{", position, brace_position)
+		if open_brace_position != -1:
+			brace_position = open_brace_position
+		if text.find("\\", position, brace_position) != -1:
+			# escaped quotes would throw off the quote count, so fall back to matching whole strings
+			return _find_raw_json_object_end_with_escapes(text, start)
+
+		# braces are inside a string if they follow an odd number of quotes
+		quote_counter += text.count('"', position, brace_position)
+		if quote_counter % 2 == 0:
+			depth += 1 if text[brace_position] == "{" else -1
+			if depth == 0:
+				return brace_position + 1
+		position = brace_position + 1
+
+
+def _find_raw_json_object_end_with_escapes(text, start):
+	depth = 0
+	position = start
+	while True:
+		position = RAW_JSON_OBJECT_CONTENT_REGEX.match(text, position).end()
+		if position == len(text) or text[position] == '"':
+			# an unterminated string means that the rest of the object hasn't been read yet
+			return None
+		depth += 1 if text[position] == "{" else -1
+		position += 1
+		if depth == 0:
+			return position
+
+
+def get_raw_json_record_locus_id(raw_record):
+	"""Returns the LocusId of a record returned by iterate_raw_json_records, or None if it doesn't have one"""
+	match = RAW_JSON_LOCUS_ID_REGEX.search(raw_record)
+	if match is None:
+		return None
+	locus_id = match.group(1)
+	return json.loads(f'"{locus_id}"') if "\\" in locus_id else locus_id
+
+
+def get_raw_json_record_reference_regions(raw_record):
+	"""Returns the list of ReferenceRegions of a record returned by iterate_raw_json_records. Records with a single
+	ReferenceRegion string return a list with one element."""
+	match = RAW_JSON_REFERENCE_REGION_REGEX.search(raw_record)
+	if match is None:
+		raise ValueError(f"Record doesn't have a ReferenceRegion: {raw_record[:200]}")
+	reference_regions = json.loads(match.group(1))
+	return reference_regions if isinstance(reference_regions, list) else [reference_regions]
+
+
+def parse_raw_json_record(raw_record):
+	"""Parses a record returned by iterate_raw_json_records the same way iterate_catalog_records does"""
+	return json.loads(raw_record, use_decimal=True)
+
+
+def iterate_arrow_catalog_records(arrow_path, use_float=False):
+	import pyarrow as pa
+
+	with pa.memory_map(arrow_path, "r") as source:
+		reader = pa.ipc.open_file(source)
+		names = reader.schema.names
+		for batch_i in range(reader.num_record_batches):
+			# converting whole columns to python lists is much faster than converting one row at a time
+			batch = reader.get_batch(batch_i)
+			for row in zip(*[column.to_pylist() for column in batch.columns]):
+				record = {name: value for name, value in zip(names, row) if value is not None}
+				extra_fields = record.pop(EXTRA_FIELDS_COLUMN, None)
+				if extra_fields:
+					record.update(json.loads(extra_fields, use_decimal=not use_float))
+				yield record
+
+
+def get_catalog_field_names(catalog_path):
+	"""Returns the names of all fields that appear in at least one record of the catalog, in order of first appearance.
+
+	This is much cheaper than reading the records: JSON catalogs are scanned for object keys without building records,
+	and for Arrow catalogs only the ExtraFields column is read.
+	"""
+	field_names = {}
+	if is_arrow_path(catalog_path):
+		import pyarrow as pa
+		with pa.memory_map(catalog_path, "r") as source:
+			reader = pa.ipc.open_file(source)
+			names = reader.schema.names
+			batches = [reader.get_batch(i) for i in range(reader.num_record_batches)]
+			for name in names:
+				if name != EXTRA_FIELDS_COLUMN and any(batch.column(name).null_count < batch.num_rows for batch in batches):
+					field_names[name] = True
+			for batch in batches:
+				for extra_fields in batch.column(EXTRA_FIELDS_COLUMN).drop_null().to_pylist():
+					field_names.update(dict.fromkeys(json.loads(extra_fields)))
+		return list(field_names)
+
+	if ".json" not in catalog_path:
+		for record in iterate_catalog_records(catalog_path):
+			field_names.update(dict.fromkeys(record))
+		return list(field_names)
+
+	with open_file(catalog_path, "rb") as f:
+		for prefix, event, value in ijson.parse(f):
+			if event == "map_key" and prefix == "item":
+				field_names[value] = True
+	return list(field_names)
+
+
+def read_catalog_dataframe(catalog_path):
+	"""Returns a pandas DataFrame with one row per catalog record and one column per field"""
+	import pandas as pd
+
+	if not is_arrow_path(catalog_path):
+		return pd.DataFrame(list(iterate_catalog_records(catalog_path, use_float=True)))
+
+	import pyarrow as pa
+	with pa.memory_map(catalog_path, "r") as source:
+		table = pa.ipc.open_file(source).read_all()
+
+	extra_fields = table.column(EXTRA_FIELDS_COLUMN)
+	df = table.drop_columns([EXTRA_FIELDS_COLUMN]).to_pandas()
+	df = df[[c for c in df.columns if df[c].notna().any()]]
+
+	# only parse the ExtraFields of rows that have them, and fill them into the corresponding rows of the DataFrame
+	row_indices = extra_fields.is_valid().to_numpy(zero_copy_only=False).nonzero()[0]
+	if len(row_indices):
+		extra_fields_df = pd.DataFrame(
+			[json.loads(value) for value in extra_fields.drop_null().to_pylist()], index=df.index[row_indices])
+		for column in extra_fields_df.columns:
+			values = df[column].astype(object) if column in df.columns else pd.Series(None, index=df.index, dtype=object)
+			values.update(extra_fields_df[column])
+			df[column] = values
+
+	return df
+
+
+def serialize_record(record, compact=False):
+	"""Returns the JSON representation of a record, as written to JSON catalogs by CatalogWriter"""
+	if compact:
+		return json.dumps(record, use_decimal=True, separators=(",", ":"))
+	return json.dumps(record, use_decimal=True, indent=4)
+
+
+class CatalogWriter:
+	"""Writes records one at a time to a JSON or Arrow catalog, depending on the output file extension. Use as a
+	context manager:
+
+		with CatalogWriter(output_path) as writer:
+			for record in records:
+				writer.write(record)
+
+	JSON records are pretty-printed with indent=4 unless compact is True. Records are written to a temporary file that
+	is renamed to output_path by close(), so a run that fails part way through never leaves a truncated catalog that
+	looks complete at output_path.
+	"""
+
+	def __init__(self, output_path, compact=False):
+		self.output_path = output_path
+		self.compact = compact
+		self.record_counter = 0
+		self._is_arrow = is_arrow_path(output_path)
+		# keep the file name at the end of the temporary path since the output format depends on its extension
+		output_dir, output_filename = os.path.split(output_path)
+		self._temp_path = os.path.join(output_dir, f".{os.getpid()}.tmp.{output_filename}")
+		if self._is_arrow:
+			import pyarrow as pa
+			self._schema = get_arrow_schema()
+			self._sink = pa.OSFile(self._temp_path, "wb")
+			self._arrow_writer = pa.ipc.new_file(
+				self._sink, self._schema, options=pa.ipc.IpcWriteOptions(compression=ARROW_COMPRESSION))
+			self._start_new_batch()
+		else:
+			self._output_file = open_file(self._temp_path, "wt")
+			self._output_file.write("[")
+
+	def write(self, record):
+		if not self._is_arrow:
+			self.write_json_string(serialize_record(record, compact=self.compact))
+			return
+
+		extra_fields = dict(record)
+		for name, value_type in ARROW_COLUMNS:
+			value = convert_value_for_arrow_column(extra_fields.get(name), value_type)
+			self._batch_columns[name].append(value)
+			if value is not None:
+				del extra_fields[name]
+		self._batch_columns[EXTRA_FIELDS_COLUMN].append(
+			json.dumps(extra_fields, use_decimal=True) if extra_fields else None)
+		if len(self._batch_columns[EXTRA_FIELDS_COLUMN]) >= ARROW_BATCH_SIZE:
+			self._write_batch()
+		self.record_counter += 1
+
+	def write_json_string(self, json_string):
+		"""Write a record that was already converted to JSON by serialize_record. Only supported for JSON output."""
+		if self._is_arrow:
+			raise ValueError(f"Can't write JSON strings to Arrow file {self.output_path}")
+		if self.record_counter > 0:
+			self._output_file.write("," if self.compact else ", ")
+		self._output_file.write(json_string)
+		self.record_counter += 1
+
+	def write_batch(self, records):
+		for record in records:
+			self.write(record)
+
+	@property
+	def is_arrow(self):
+		return self._is_arrow
+
+	def close(self):
+		if self._is_arrow:
+			self._write_batch()
+			self._arrow_writer.close()
+			self._sink.close()
+		else:
+			self._output_file.write("]")
+			self._output_file.close()
+		os.replace(self._temp_path, self.output_path)
+
+	def discard(self):
+		"""Close the temporary file and delete it without writing anything to output_path"""
+		if self._is_arrow:
+			self._sink.close()
+		else:
+			self._output_file.close()
+		os.remove(self._temp_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.discard()
+
+	def _start_new_batch(self):
+		self._batch_columns = {field.name: [] for field in self._schema}
+
+	def _write_batch(self):
+		if not self._batch_columns[EXTRA_FIELDS_COLUMN]:
+			return
+
+		import pyarrow as pa
+		batch = pa.RecordBatch.from_arrays(
+			[pa.array(self._batch_columns[field.name], type=field.type) for field in self._schema], schema=self._schema)
+		self._arrow_writer.write_batch(batch)
+		self._start_new_batch()
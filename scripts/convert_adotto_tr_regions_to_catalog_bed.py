@@ -18,23 +18,32 @@
 16	biotype	comma separated gene biotypes intersecting region (Ensembl v105)
 17	annos	JSON of TRF annotations in the region (list of dicts with keys: motif, entropy, ovl_flag, etc)
 """
+import argparse
 import json
-import gzip
 import os
 import tqdm
 
+from bgzf_io import open_file
+from memory_budget import add_max_memory_argument, sort_lines
+
+parser = argparse.ArgumentParser()
+add_max_memory_argument(parser)
+args = parser.parse_args()
+
 if not os.path.abspath(os.getcwd()).endswith("other"):
     os.chdir("./ref/other/")
 
-def convert_catalog_version(catalog_version):
-    input_filename = f"adotto_TRregions_v{catalog_version}.bed.gz"
-    output_filename = f"adotto_tr_catalog_v{catalog_version}.bed"
+def get_sort_key(line):
+    """Sort rows by chrom, start, end and motif"""
+    chrom, start, end, motif, _ = line.split("\t")
+    return chrom, int(start), int(end), motif
+
+def iterate_output_lines(input_filename, counters):
+    """Parse the adotto TR regions file and yield an output BED line for each TRF annotation"""
     print(f"Parsing {input_filename}")
-    f = gzip.open(input_filename, "rt")
-    
-    all_lines = f.readlines()
-    output_rows = []
-    for i, line in enumerate(tqdm.tqdm(all_lines, unit=" rows", unit_scale=True)):
+    f = open_file(input_filename, "rt")
+
+    for i, line in enumerate(tqdm.tqdm(f, unit=" rows", unit_scale=True)):
         fields = line.strip().split("\t")
         start = int(fields[1])
         end = int(fields[2])
@@ -46,31 +55,35 @@ def convert_catalog_version(catalog_version):
             if d["start"] < start or d["end"] > end:
                 print("ERROR:", i, d, start, end)
                 continue
-            output_rows.append((
+            counters["rows"] += 1
+            yield "\t".join(map(str, (
                 fields[0],
                 d["start"],
                 d["end"] + 1,
                 #"MOTIF="+d["motif"]+";PURITY="+str(d["purity"]),
                 d["motif"],
                 ".",
-            ))
+            ))) + "\n"
 
     f.close()
 
     #%%
-    print(f"Parsed {len(output_rows):,d} rows from {input_filename}")
-    
+    print(f"Parsed {counters['rows']:,d} rows from {input_filename}")
+
+def convert_catalog_version(catalog_version):
+    input_filename = f"adotto_TRregions_v{catalog_version}.bed.gz"
+    output_filename = f"adotto_tr_catalog_v{catalog_version}.bed"
+    counters = {"rows": 0}
+
     #%%
-    
-    with open(output_filename, "wt") as output_bed:
-        for row in sorted(output_rows):
-            output_bed.write("\t".join(map(str, row)) + "\n")
-            
-    print(f"Wrote {len(output_rows):,d} rows to {output_filename}.gz")
-            
-    os.system(f"bgzip -f {output_filename}")
-    os.system(f"tabix -f {output_filename}.gz")
-            
+
+    # with --max-memory, rows that don't fit in memory are sorted in temporary files
+    with open_file(f"{output_filename}.gz", "wt", index_format="tbi") as output_bed:
+        for line in sort_lines(iterate_output_lines(input_filename, counters), get_sort_key, max_memory=args.max_memory):
+            output_bed.write(line)
+
+    print(f"Wrote {counters['rows']:,d} rows to {output_filename}.gz")
+
     print(f"Done with catalog version {catalog_version}")
 #%%
 
@@ -0,0 +1,35 @@
+"""Convert a catalog between JSON and Arrow formats. The output format is based on the output file extension
+(.json, .json.gz, or .arrow). See catalog_io.py for details."""
+
+import argparse
+import os
+
+from catalog_io import JSON_READER_BACKENDS, CatalogWriter, iterate_catalog_record_batches
+from profiling import add_profiling_arguments, iterate_in_phase, profile_phase, run_main
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+	parser.add_argument("--json-backend", choices=JSON_READER_BACKENDS, help="Parser to use for JSON input. Defaults "
+						"to the fastest one that's installed.")
+	parser.add_argument("--compact", action="store_true", help="Write compact JSON instead of pretty-printing each "
+						"record")
+	parser.add_argument("input_catalog_path", help="Path of the input catalog in JSON, Arrow, or BED format")
+	parser.add_argument("output_catalog_path", help="Path of the output catalog (.json, .json.gz, or .arrow)")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if not os.path.isfile(args.input_catalog_path):
+		parser.error(f"File not found: {args.input_catalog_path}")
+
+	with CatalogWriter(args.output_catalog_path, compact=args.compact) as writer:
+		batches = iterate_catalog_record_batches(args.input_catalog_path, backend=args.json_backend)
+		for batch in iterate_in_phase(batches, "read catalog"):
+			with profile_phase("write output"):
+				writer.write_batch(batch)
+
+	print(f"Wrote {writer.record_counter:,d} records to {args.output_catalog_path}")
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -1,7 +1,7 @@
 import argparse
-import gzip
 import re
-import os
+
+from bgzf_io import open_file
 
 p = argparse.ArgumentParser()
 p.add_argument("-o", "--output-path", help="File path of the uncrompressed output bed file")
@@ -16,8 +16,7 @@ if not output_path:
 elif output_path.endswith(".gz"):
     output_path = output_path.replace(".gz", "")
 
-fopen = gzip.open if args.hipstr_catalog_bed.endswith("gz") else open
-with fopen(args.hipstr_catalog_bed, "rt") as f, open(output_path, "wt") as fo:
+with open_file(args.hipstr_catalog_bed, "rt") as f, open_file(f"{output_path}.gz", "wt") as fo:
     total_counter = 0
     for i, line in enumerate(f):
         total_counter += 1
@@ -41,6 +40,4 @@ with fopen(args.hipstr_catalog_bed, "rt") as f, open(output_path, "wt") as fo:
 
 print(f"Parsed {total_counter:,d} loci from {args.hipstr_catalog_bed}")
 
-os.system(f"bgzip -f {output_path}")
-#os.system(f"tabix {output_path}.gz")
 print(f"Wrote {total_counter:,d} rows to {output_path}.gz")
@@ -21,11 +21,13 @@ $16         fractionGinMotif : 0.4
 $17         fractionTinMotif : 0.2
 """
 import argparse
-import gzip
-import os
+
+from bgzf_io import open_file
+from memory_budget import add_max_memory_argument, sort_lines
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--output-bed", default="popstr_catalog_v2.bed", help="Output bed file path")
+add_max_memory_argument(parser)
 parser.add_argument("popstr_marker_info_files_gz", nargs="+",
                     help="One or more of the chrXXXmarkerInfo.gz files downloaded/cloned from "
                          "https://github.com/DecodeGenetics/popSTR ")
@@ -34,34 +36,38 @@ args = parser.parse_args()
 if not args.output_bed.endswith(".bed"):
     parser.error(f"Output file path must have a .bed suffix: {args.output_bed}")
 
-# parse input files
-output_rows = []
-for path in args.popstr_marker_info_files_gz:
-    print(f"Parsing {path}")
-    with gzip.open(path, "rt") as input_file:
-        for line in input_file:
-            fields = line.strip().split()
-            chrom = fields[0]
-            start_1based = int(fields[1])
-            end = int(fields[2])
-            motif = fields[3]
-            output_rows.append((chrom, start_1based - 1, end, motif, "."))
 
-print(f"Parsed {len(output_rows):,d} rows from {len(args.popstr_marker_info_files_gz)} input file(s)")
+def iterate_output_lines():
+    """Parse the input files and yield an output BED line for each row"""
+    global row_counter
+    for path in args.popstr_marker_info_files_gz:
+        print(f"Parsing {path}")
+        with open_file(path, "rt") as input_file:
+            for line in input_file:
+                fields = line.strip().split()
+                chrom = fields[0]
+                start_1based = int(fields[1])
+                end = int(fields[2])
+                motif = fields[3]
+                row_counter += 1
+                yield f"{chrom}\t{start_1based - 1}\t{end}\t{motif}\t.\n"
+
+    print(f"Parsed {row_counter:,d} rows from {len(args.popstr_marker_info_files_gz)} input file(s)")
+
 
-# write all rows to output bed
-with open(args.output_bed, "w") as f:
-    for row in sorted(output_rows):
-        f.write("\t".join(map(str, row)) + "\n")
+def get_sort_key(line):
+    """Sort rows by chrom, start, end and motif"""
+    chrom, start_0based, end, motif, _ = line.split("\t")
+    return chrom, int(start_0based), int(end), motif
 
-print(f"Wrote {len(output_rows):,d} rows to {args.output_bed}")
 
-# compress and index output bed
-def run(command):
-    print(command)
-    os.system(command)
+# write all rows to a compressed and indexed output bed. With --max-memory, rows that don't fit in memory are sorted in
+# temporary files.
+row_counter = 0
+with open_file(f"{args.output_bed}.gz", "wt", index_format="tbi") as f:
+    for line in sort_lines(iterate_output_lines(), get_sort_key, max_memory=args.max_memory):
+        f.write(line)
 
-run(f"bgzip -f {args.output_bed}")
-run(f"tabix -f -p bed {args.output_bed}.gz")
+print(f"Wrote {row_counter:,d} rows to {args.output_bed}.gz")
 
 print("Done")
\ No newline at end of file
@@ -5,13 +5,14 @@ It expects the TRGT locus ID to have the format "chr1-123456-123467-CAG" for iso
 
 import argparse
 import collections
-import gzip
-import os
-import simplejson as json
 import re
-import sys
 import tqdm
 
+from bgzf_io import DEFAULT_THREADS, open_file
+from diagnostics import Diagnostics
+from profiling import add_profiling_arguments, profile_phase, run_main
+from variation_clusters import parse_info_fields, parse_known_pathogenic_reference_regions
+
 
 def compute_dominant_motif(info_fields_dict, known_pathogenic_reference_regions_lookup):
     """Compute the dominant motif for a TR locus. For compound definitions (those that span multiple
@@ -42,15 +43,54 @@ def compute_dominant_motif(info_fields_dict, known_pathogenic_reference_regions_
     return dominant_motif
 
 
+def convert_trgt_row_to_longtr_row(fields, known_pathogenic_reference_regions_lookup, diagnostics=None):
+    """Convert a row of a TRGT catalog BED file to LongTR format.
+
+    Args:
+        fields (list): the columns of the TRGT BED row
+        known_pathogenic_reference_regions_lookup (dict): A dictionary mapping locus IDs to reference regions for all
+            known disease-associated loci
+        diagnostics (Diagnostics): if specified, skipped rows and invalid key-value pairs are reported here
+
+    Return:
+        list: the columns of the LongTR BED row, or None if the interval is too small for LongTR
+    """
+    chrom = fields[0]
+    start_0based = int(fields[1])
+    end_1based = int(fields[2])
+    if start_0based + 1 >= end_1based:
+        # avoid "Region has a STOP <= START" error
+        if diagnostics is not None:
+            diagnostics.report("skipped rows with intervals that are too small for LongTR",
+                               f"Skipping {fields[3]} because the interval has width {end_1based - start_0based}bp")
+        return None
+
+    info_fields_dict = parse_info_fields(fields, diagnostics)
+    dominant_motif = compute_dominant_motif(info_fields_dict, known_pathogenic_reference_regions_lookup)
+
+    return [
+        chrom,
+        start_0based + 1,  # LongTR BED files use 1-based coords.
+        end_1based,
+        len(dominant_motif),
+        round((end_1based - start_0based)/len(dominant_motif), 3),
+        info_fields_dict["ID"],
+        dominant_motif,
+    ]
+
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
     parser.add_argument("--known-pathogenic-loci-json-path", required=True, help="Path of ExpansionHunter catalog "
                         "containing known pathogenic loci. This is used to retrieve the original locus boundaries for "
                         "these loci since their IDs don't contain these coordinates the way that IDs of other loci do.")
     parser.add_argument("-o", "--output-bed-path", help="Path of output BED file.")
-    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="Number of compression threads")
+    parser.add_argument("--verbose", action="store_true", help="Print every warning as it occurs, instead of a "
+                        "summary with a few examples of each kind of warning")
     parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
     parser.add_argument("input_trgt_catalog_bed_path", help="Path of the input TRGT catalog BED file")
+    add_profiling_arguments(parser)
     args = parser.parse_args()
 
     if ".bed" not in args.input_trgt_catalog_bed_path:
@@ -63,69 +103,34 @@ def main():
     elif not args.output_bed_path.endswith(".bed"):
         parser.error("--output-bed-path must have a '.bed' suffix")
 
-    fopen = gzip.open if args.known_pathogenic_loci_json_path.endswith("gz") else open
-    with fopen(args.known_pathogenic_loci_json_path, "rt") as f:
-        known_pathogenic_loci = json.load(f)
-        known_pathogenic_reference_regions_lookup = {}
-        for locus in known_pathogenic_loci:
-            if isinstance(locus["ReferenceRegion"], list):
-                assert isinstance(locus["VariantId"], list)
-                assert len(locus["ReferenceRegion"]) == len(locus["VariantId"])
-                for variant_id, reference_region in zip(locus["VariantId"], locus["ReferenceRegion"]):
-                    known_pathogenic_reference_regions_lookup[variant_id] = reference_region
-            else:
-                known_pathogenic_reference_regions_lookup[locus["LocusId"]] = locus["ReferenceRegion"]
+    with profile_phase("load known pathogenic loci"):
+        known_pathogenic_reference_regions_lookup = parse_known_pathogenic_reference_regions(
+            args.known_pathogenic_loci_json_path)
 
     counter = collections.Counter()
-    output_bed_file = open(args.output_bed_path, "wt")
-    fopen = gzip.open if args.input_trgt_catalog_bed_path.endswith("gz") else open
-    with fopen(args.input_trgt_catalog_bed_path, "rt") as f:
+    diagnostics = Diagnostics(verbose=args.verbose)
+    output_bed_file = open_file(f"{args.output_bed_path}.gz", "wt", threads=args.threads)
+    with open_file(args.input_trgt_catalog_bed_path, "rt", threads=args.threads) as f:
         if args.show_progress_bar:
             f = tqdm.tqdm(f, unit=" records", unit_scale=True)
 
         for line in f:
             counter["total"] += 1
             fields = line.strip("\n").split("\t")
-            chrom = fields[0]
-            start_0based = int(fields[1])
-            end_1based = int(fields[2])
-            info_fields = fields[3]
-
-            if start_0based + 1 >= end_1based:
-                # avoid "Region has a STOP <= START" error
+            output_row = convert_trgt_row_to_longtr_row(fields, known_pathogenic_reference_regions_lookup, diagnostics)
+            if output_row is None:
                 counter["skipped"] += 1
-                if args.verbose:
-                    print(f"WARNING: Skipping record #{counter['skipped']} because the interval has width {end_1based - start_0based}bp")
                 continue
 
-            info_fields_dict = {}
-            for key_value in info_fields.split(";"):
-                key_value = key_value.split("=")
-                if len(key_value) != 2:
-                    print(f"WARNING: skipping invalid key-value pair '{key_value}' in line {fields}")
-                    continue
-                key, value = key_value
-                info_fields_dict[key] = value
-
-            dominant_motif = compute_dominant_motif(
-                info_fields_dict, known_pathogenic_reference_regions_lookup)
-
             counter["output"] += 1
-            output_bed_file.write("\t".join(map(str, [
-                chrom,
-                start_0based + 1,  # LongTR BED files use 1-based coords.
-                end_1based,
-                len(dominant_motif),
-                round((end_1based - start_0based)/len(dominant_motif), 3),
-                info_fields_dict["ID"],
-                dominant_motif,
-            ])) + "\n")
-
-    os.system(f"bgzip -f {args.output_bed_path}")
+            output_bed_file.write("\t".join(map(str, output_row)) + "\n")
+
+    output_bed_file.close()
 
+    diagnostics.print_summary()
     print(f"Wrote {counter['output']:,d} out of {counter['total']:,d} rows to {args.output_bed_path}.gz")
 
 
 if __name__ == "__main__":
-    main()
+    run_main(main)
 
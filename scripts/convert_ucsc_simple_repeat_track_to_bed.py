@@ -5,17 +5,21 @@ https://genome.ucsc.edu/cgi-bin/hgTables?db=hg38&hgta_group=rep&hgta_track=simpl
 """
 
 import argparse
-import gzip
 import json
 import os
 import tqdm
 
+from bgzf_io import DEFAULT_THREADS, open_file
+from profiling import add_profiling_arguments, run_main
+
 def main():
 	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument("--verbose", action="store_true")
 	parser.add_argument("-o", "--output-bed", help="Output BED file path")
+	parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="Number of compression threads")
 	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
 	parser.add_argument("simple_repeat_track_txt")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	if not os.path.isfile(args.simple_repeat_track_txt):
@@ -30,12 +34,11 @@ def main():
 	counter = 0
 	supercontig_loci_counter = 0
 
-	fopen = gzip.open if args.simple_repeat_track_txt.endswith("gz") else open
-	with fopen(args.simple_repeat_track_txt, "rt") as f:
+	with open_file(args.simple_repeat_track_txt, "rt", threads=args.threads) as f:
 		if args.show_progress_bar:
 			f = tqdm.tqdm(f, unit=" records", unit_scale=True)
 
-		with open(args.output_bed, "wt") as out:
+		with open_file(f"{args.output_bed}.gz", "wt", threads=args.threads) as out:
 			for line in f:
 				counter += 1
 				fields = line.strip("\n").split("\t")
@@ -48,11 +51,10 @@ def main():
 				motif = fields[-1]
 				out.write(f"{chrom}\t{start_0based}\t{end}\t{motif}\n")
 
-	os.system(f"bgzip -f {args.output_bed}")
 	if supercontig_loci_counter:
 		print(f"Skipped {supercontig_loci_counter:,d} out of {counter:,d} loci "
 			  f"({supercontig_loci_counter/counter:.2%}) because they are on supercontigs")
 	print(f"Wrote {counter:,d} rows to {args.output_bed}.gz")
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	run_main(main)
\ No newline at end of file
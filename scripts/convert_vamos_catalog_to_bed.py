@@ -2,6 +2,8 @@ import os
 import pandas as pd
 from pprint import pprint
 
+from bgzf_io import open_file
+
 if os.getcwd().endswith("str-truth-set-v2"):
 	os.chdir("str-truth-set/ref/other")
 elif os.getcwd().endswith("str-truth-set"):
@@ -25,9 +27,8 @@ output_path_prefix = f"vamos_catalog.{version}"
 df.to_csv(f"{output_path_prefix}.tsv.gz", sep="\t", index=False, header=True)
 
 df = df[["chrom", "start_0based", "end_1based", "motif1", "motif_size"]]
-df.to_csv(f"{output_path_prefix}.bed", sep="\t", index=False, header=False)
-os.system(f"bgzip -f {output_path_prefix}.bed")
-os.system(f"tabix -f {output_path_prefix}.bed.gz")
+with open_file(f"{output_path_prefix}.bed.gz", "wt", index_format="tbi") as f:
+	df.to_csv(f, sep="\t", index=False, header=False)
 print(f"Wrote {len(df):,d} loci to {output_path_prefix}.bed.gz")
 
 notes = """Notes: 
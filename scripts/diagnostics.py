@@ -0,0 +1,60 @@
+"""Count warnings by category and print a summary with a few examples, instead of printing one line per warning.
+
+Printing a line for every affected locus slows down loops over millions of records, and floods the pipeline log.
+Diagnostics counts the warnings in each category and keeps a bounded, random sample of example messages (using
+reservoir sampling, so that the examples come from the whole input rather than just its beginning). The summary is
+printed once at the end. With verbose=True, every message is also printed as it's reported.
+"""
+
+import collections
+import random
+
+DEFAULT_MAX_EXAMPLES = 5
+
+
+class Diagnostics:
+	"""Counters and example messages for each category of warning"""
+
+	def __init__(self, verbose=False, max_examples=DEFAULT_MAX_EXAMPLES, seed=0):
+		"""Args:
+			verbose (bool): also print every message as it's reported
+			max_examples (int): number of example messages to keep for each category
+			seed (int): random seed for choosing the examples, so that the summary is the same across runs
+		"""
+		self.verbose = verbose
+		self.max_examples = max_examples
+		self.counters = collections.Counter()
+		self.examples = collections.defaultdict(list)
+		self._random = random.Random(seed)
+
+	def report(self, category, message):
+		"""Record a warning.
+
+		Args:
+			category (str): short description of the warning, used as the heading in the summary
+			message (str): details about this occurrence of the warning
+		"""
+		self.counters[category] += 1
+		if self.verbose:
+			print(message)
+
+		examples = self.examples[category]
+		if len(examples) < self.max_examples:
+			examples.append(message)
+		else:
+			i = self._random.randrange(self.counters[category])
+			if i < self.max_examples:
+				examples[i] = message
+
+	def print_summary(self, label=None):
+		"""Print the number of warnings in each category along with the example messages
+
+		Args:
+			label (str): optional prefix for each heading, such as the name of the output file
+		"""
+		for category, count in self.counters.items():
+			print(f"WARNING: {label + ': ' if label else ''}{category}: {count:,d}" + (
+				"" if self.verbose else f". Example{'s' if len(self.examples[category]) > 1 else ''}:"))
+			if not self.verbose:
+				for message in self.examples[category]:
+					print(f"    {message}")
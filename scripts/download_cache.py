@@ -0,0 +1,255 @@
+"""Cache of downloaded source files.
+
+Files are downloaded concurrently into the cache directory, and a manifest records the sha256 of each completed
+download. Files that are already in the cache and still match their recorded sha256 are never downloaded again.
+Interrupted http(s) downloads are resumed from where they stopped. gs:// paths are copied with gsutil, and file://
+URLs or files in a local mirror directory (see --mirror-dir) are copied without network access, which is useful for
+offline and test runs. Several processes can share a cache directory: each file is fetched by only one of them while
+the others wait for it to finish.
+
+This can also be run as a script to prefetch files into the cache:
+
+	python3 scripts/download_cache.py --cache-dir ~/.cache/tandem-repeat-catalog url1 url2 ...
+"""
+
+import argparse
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from profiling import add_profiling_arguments, run_main
+
+DEFAULT_CACHE_DIR = os.path.expanduser(os.path.join("~", ".cache", "tandem-repeat-catalog", "downloads"))
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 4
+DOWNLOAD_CHUNK_SIZE = 2**20
+
+
+class DownloadCache:
+
+	def __init__(self, cache_dir=None, mirror_dir=None, max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+				 verbose=False):
+		"""Args:
+			cache_dir (str): directory where downloaded files and the manifest are stored
+			mirror_dir (str): optional local directory that contains copies of the remote files, named by their
+				basename. If specified, files are copied from this directory instead of being downloaded.
+			max_concurrent_downloads (int): maximum number of files to download at the same time
+			verbose (bool): print a message for each file
+		"""
+		self.cache_dir = os.path.abspath(cache_dir or DEFAULT_CACHE_DIR)
+		self.mirror_dir = os.path.abspath(mirror_dir) if mirror_dir else None
+		self.max_concurrent_downloads = max(1, max_concurrent_downloads)
+		self.verbose = verbose
+		self.manifest_path = os.path.join(self.cache_dir, "manifest.json")
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+	def get_cache_path(self, url):
+		"""Returns the path where the given URL is stored in the cache. Files are placed in a subdirectory named after
+		a hash of the URL so that different URLs with the same basename don't collide."""
+		url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
+		return os.path.join(self.cache_dir, url_hash, os.path.basename(urllib.parse.urlparse(url).path))
+
+	def is_cached(self, url):
+		"""Returns True if the given URL was downloaded before and the cached file is unchanged"""
+		entry = self._load_manifest().get(url)
+		path = self.get_cache_path(url)
+		if not entry or not os.path.isfile(path) or os.path.getsize(path) != entry["size"]:
+			return False
+		return compute_sha256(path) == entry["sha256"]
+
+	def fetch(self, url, output_dir=None):
+		"""Download a single file. See fetch_all."""
+		return self.fetch_all([url], output_dir=output_dir)[url]
+
+	def fetch_all(self, urls, output_dir=None):
+		"""Download any of the given URLs that aren't already in the cache, several at a time.
+
+		Args:
+			urls (list): http(s)://, gs://, or file:// URLs, or local paths
+			output_dir (str): if specified, a symlink to each cached file is created in this directory
+
+		Return:
+			dict: maps each URL to the path of its local copy
+		"""
+		local_paths = asyncio.run(self._fetch_all(list(dict.fromkeys(urls))))
+		if output_dir:
+			link_paths = {}
+			for url, cache_path in local_paths.items():
+				link_path = os.path.join(os.path.abspath(output_dir), os.path.basename(cache_path))
+				if link_path in link_paths:
+					raise ValueError(f"{url} and {link_paths[link_path]} have the same file name: {link_path}")
+				link_paths[link_path] = url
+				if os.path.realpath(link_path) != os.path.realpath(cache_path):
+					if os.path.lexists(link_path):
+						os.remove(link_path)
+					os.symlink(cache_path, link_path)
+				local_paths[url] = link_path
+
+		return local_paths
+
+	async def _fetch_all(self, urls):
+		semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+
+		async def fetch_with_semaphore(url):
+			async with semaphore:
+				return url, await self._fetch(url)
+
+		return dict(await asyncio.gather(*[fetch_with_semaphore(url) for url in urls]))
+
+	async def _fetch(self, url):
+		cache_path = self.get_cache_path(url)
+		if await asyncio.to_thread(self.is_cached, url):
+			if self.verbose:
+				print(f"Using cached copy of {url}: {cache_path}")
+			return cache_path
+
+		os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+		lock_file = await asyncio.to_thread(acquire_lock, f"{cache_path}.lock")
+		try:
+			# another process may have downloaded the file while this one was waiting for the lock
+			if await asyncio.to_thread(self.is_cached, url):
+				if self.verbose:
+					print(f"Using copy of {url} that was fetched by another process: {cache_path}")
+				return cache_path
+
+			return await self._download(url, cache_path)
+		finally:
+			lock_file.close()
+
+	async def _download(self, url, cache_path):
+		"""Download the URL to the cache path. Must be called while holding the lock for cache_path."""
+		# http(s) downloads always use the same partial file so that an interrupted download can be resumed by the
+		# next process that holds the lock. Copies can't be resumed, so they're written to a file named after this
+		# process.
+		partial_path = f"{cache_path}.partial"
+		start_time = time.time()
+
+		mirror_path = os.path.join(self.mirror_dir, os.path.basename(cache_path)) if self.mirror_dir else None
+		if mirror_path or url.startswith("file://") or "://" not in url:
+			if mirror_path:
+				source_path = mirror_path
+			elif url.startswith("file://"):
+				source_path = urllib.parse.urlparse(url).path
+			else:
+				source_path = url
+			if not os.path.isfile(source_path):
+				raise FileNotFoundError(f"{source_path} not found while fetching {url}")
+			print(f"Copying {source_path} to {cache_path}")
+			partial_path = f"{cache_path}.{os.getpid()}.partial"
+			await asyncio.to_thread(shutil.copyfile, source_path, partial_path)
+		elif url.startswith("gs://"):
+			print(f"Copying {url} to {cache_path}")
+			partial_path = f"{cache_path}.{os.getpid()}.partial"
+			process = await asyncio.create_subprocess_exec("gsutil", "-q", "cp", url, partial_path)
+			if await process.wait() != 0:
+				raise RuntimeError(f"gsutil cp {url} failed with exit code {process.returncode}")
+		elif url.startswith("http://") or url.startswith("https://"):
+			await asyncio.to_thread(download_with_resume, url, partial_path)
+		else:
+			raise ValueError(f"Unsupported URL: {url}")
+
+		digest = await asyncio.to_thread(compute_sha256, partial_path)
+		os.replace(partial_path, cache_path)
+
+		self._update_manifest(url, {
+			"path": cache_path,
+			"sha256": digest,
+			"size": os.path.getsize(cache_path),
+			"downloaded": time.strftime("%Y-%m-%d %H:%M:%S"),
+		})
+
+		if self.verbose:
+			print(f"Fetched {url} in {time.time() - start_time:.1f}s")
+
+		return cache_path
+
+	def _load_manifest(self):
+		if not os.path.isfile(self.manifest_path):
+			return {}
+		with open(self.manifest_path, "rt") as f:
+			return json.load(f)
+
+	def _update_manifest(self, url, entry):
+		# hold the lock while reloading and rewriting the manifest so that entries added by other processes aren't lost
+		with acquire_lock(f"{self.manifest_path}.lock"):
+			manifest = self._load_manifest()
+			previous_entry = manifest.get(url)
+			if previous_entry and previous_entry["sha256"] != entry["sha256"]:
+				print(f"WARNING: {url} has changed since it was last downloaded on {previous_entry['downloaded']}")
+			manifest[url] = entry
+			temp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+			with open(temp_path, "wt") as f:
+				json.dump(manifest, f, indent=4)
+			os.replace(temp_path, self.manifest_path)
+
+
+def acquire_lock(lock_path):
+	"""Wait for an exclusive lock on the given lock file. The lock is released when the returned file is closed."""
+	lock_file = open(lock_path, "a")
+	try:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+	except BaseException:
+		lock_file.close()
+		raise
+	return lock_file
+
+
+def download_with_resume(url, output_path):
+	"""Download an http(s) URL to the given path. If the path already contains part of the file from an earlier
+	download that was interrupted, only the rest of the file is requested."""
+	existing_size = os.path.getsize(output_path) if os.path.isfile(output_path) else 0
+	request = urllib.request.Request(url)
+	if existing_size:
+		request.add_header("Range", f"bytes={existing_size}-")
+
+	try:
+		response = urllib.request.urlopen(request)
+	except urllib.error.HTTPError as e:
+		if e.code != 416:  # requested range not satisfiable: the partial file is already complete
+			raise
+		return
+
+	with response:
+		is_resumed = existing_size and response.status == 206
+		if is_resumed:
+			print(f"Resuming download of {url} at {existing_size:,d} bytes")
+		else:
+			print(f"Downloading {url}")
+
+		with open(output_path, "ab" if is_resumed else "wb") as f:
+			for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""):
+				f.write(chunk)
+
+
+def compute_sha256(path):
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+	parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Download cache directory")
+	parser.add_argument("--mirror-dir", help="Copy files from this local directory instead of downloading them")
+	parser.add_argument("--max-concurrent-downloads", type=int, default=DEFAULT_MAX_CONCURRENT_DOWNLOADS)
+	parser.add_argument("-o", "--output-dir", help="If specified, create symlinks to the cached files in this directory")
+	parser.add_argument("urls", nargs="+", help="URLs to download")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	cache = DownloadCache(args.cache_dir, mirror_dir=args.mirror_dir,
+						  max_concurrent_downloads=args.max_concurrent_downloads, verbose=True)
+	for url, path in cache.fetch_all(args.urls, output_dir=args.output_dir).items():
+		print(f"{url} => {path}")
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,371 @@
+"""Convert an ExpansionHunter catalog to several output formats in a single pass.
+
+The catalog is parsed once and each record is passed to every requested format writer. Each writer runs in its own
+thread and receives records in batches through a bounded queue, so the writers don't hold up the parser or each other
+and memory use stays constant. Supported output formats are:
+
+	--eh-json    ExpansionHunter catalog with only the LocusId, ReferenceRegion, VariantType and LocusStructure fields,
+	             and without chrM loci (since ExpansionHunter can't extract flanking sequence for them)
+	--bed        sorted, bgzipped and tabix-indexed BED file with one row per repeat
+	--trgt       TRGT catalog with adjacent repeats split into separate rows
+	--longtr     LongTR catalog
+	--hipstr     HipSTR catalog (loci with motifs longer than 9bp are skipped, since HipSTR doesn't support them)
+	--gangstr    GangSTR catalog
+
+The output formats only depend on the LocusId, ReferenceRegion, LocusStructure and VariantType fields, so they can be
+generated from any version of the annotated catalog.
+"""
+
+import argparse
+import collections
+import os
+import queue
+import re
+import threading
+
+from str_analysis.utils.misc_utils import parse_interval
+
+from bgzf_io import open_file
+from catalog_io import CatalogWriter, iterate_catalog_records
+from diagnostics import Diagnostics
+from profiling import add_profiling_arguments, profile_phase, run_main
+
+BATCH_SIZE = 10_000
+MAX_QUEUED_BATCHES = 8
+
+EH_JSON_FIELDS = {"LocusId", "ReferenceRegion", "VariantType", "LocusStructure"}
+
+
+def get_repeats(record):
+	"""Returns a list of (chrom, start_0based, end_1based, motif, variant_type) tuples for the repeats in a catalog
+	record, and raises a ValueError if the record's LocusStructure doesn't match its ReferenceRegion"""
+	motifs = re.findall("[(]([A-Z]+)[)]", record["LocusStructure"])
+	if not motifs:
+		raise ValueError(f"Unable to parse LocusStructure '{record['LocusStructure']}' in catalog record: {record}")
+
+	reference_regions = record["ReferenceRegion"]
+	if not isinstance(reference_regions, list):
+		reference_regions = [reference_regions]
+
+	variant_types = record.get("VariantType", "Repeat")
+	if not isinstance(variant_types, list):
+		variant_types = [variant_types] * len(motifs)
+
+	if len(motifs) != len(reference_regions) or len(motifs) != len(variant_types):
+		raise ValueError(f"LocusStructure elements don't match the entries in ReferenceRegion or VariantType in "
+						 f"catalog record: {record}")
+
+	repeats = []
+	for motif, reference_region, variant_type in zip(motifs, reference_regions, variant_types):
+		chrom, start_0based, end_1based = parse_interval(reference_region)
+		repeats.append((chrom, start_0based, end_1based, motif, variant_type))
+
+	return repeats
+
+
+class FormatWriter:
+	"""Base class for output format writers. Subclasses implement convert_record, which returns the output rows for a
+	catalog record. Rows are written in catalog order, or if sort_rows is True, sorted by position within each
+	chromosome. Sorted output requires all records of a chromosome to be next to each other in the catalog."""
+
+	name = None
+	sort_rows = False
+
+	def __init__(self, output_path, print_all_warnings=False):
+		self.output_path = output_path
+		self.counters = collections.Counter()
+		self.diagnostics = Diagnostics(verbose=print_all_warnings)
+		self._output_file = open_file(output_path, "wt", index_format="tbi" if output_path.endswith(".bed.gz") else None)
+		self._current_chrom = None
+		self._rows_in_current_chrom = []
+		self._written_chroms = set()
+
+	def write_record(self, record):
+		self.counters["records"] += 1
+		rows = self.convert_record(record)
+		if not self.sort_rows:
+			self._write_rows(rows)
+			return
+
+		for row in rows:
+			if row[0] != self._current_chrom:
+				self._write_rows_in_current_chrom()
+				if row[0] in self._written_chroms:
+					raise ValueError(f"{row[0]} loci aren't all next to each other in the input catalog, so the "
+									 f"{self.name} output can't be sorted. Sort the catalog by chromosome and start "
+									 f"coordinate first.")
+				self._current_chrom = row[0]
+				self._written_chroms.add(row[0])
+			self._rows_in_current_chrom.append(row)
+
+	def convert_record(self, record):
+		raise NotImplementedError
+
+	def close(self):
+		self._write_rows_in_current_chrom()
+		self._output_file.close()
+		self.diagnostics.print_summary(self.output_path)
+		print(f"Wrote {self.counters['rows']:,d} rows to {self.output_path}")
+
+	def _write_rows_in_current_chrom(self):
+		self._rows_in_current_chrom.sort(key=lambda row: (row[1], row[2]))
+		self._write_rows(self._rows_in_current_chrom)
+		self._rows_in_current_chrom = []
+
+	def _write_rows(self, rows):
+		for row in rows:
+			self._output_file.write("\t".join(map(str, row)) + "\n")
+		self.counters["rows"] += len(rows)
+
+
+class ExpansionHunterJsonWriter:
+	name = "ExpansionHunter JSON"
+
+	def __init__(self, output_path, print_all_warnings=False):
+		self.output_path = output_path
+		self.counters = collections.Counter()
+		self.diagnostics = Diagnostics(verbose=print_all_warnings)
+		self._writer = CatalogWriter(output_path)
+
+	def write_record(self, record):
+		if record["LocusId"].startswith("M-") or record["LocusId"].startswith("chrM-"):
+			self.diagnostics.report("skipped chrM loci", f"Skipping chrM locus: {record['LocusId']}")
+			self.counters["skipped chrM loci"] += 1
+			return
+
+		self._writer.write({k: v for k, v in record.items() if k in EH_JSON_FIELDS})
+
+	def close(self):
+		self._writer.close()
+		self.diagnostics.print_summary(self.output_path)
+		print(f"Wrote {self._writer.record_counter:,d} records to {self.output_path}")
+
+
+class BedWriter(FormatWriter):
+	name = "BED"
+	sort_rows = True
+
+	def convert_record(self, record):
+		return [(chrom, start_0based, end_1based, motif, ".") for chrom, start_0based, end_1based, motif, _ in get_repeats(record)]
+
+
+class TRGTWriter(FormatWriter):
+	"""Writes the same rows as str_analysis.convert_expansion_hunter_catalog_to_trgt_catalog --split-adjacent-repeats,
+	except that chromosomes stay in catalog order instead of being sorted by name with bedtools"""
+
+	name = "TRGT"
+	sort_rows = True
+
+	def convert_record(self, record):
+		repeats = get_repeats(record)
+		chrom = repeats[-1][0]
+		locus_start_0based = min(start_0based for _, start_0based, _, _, _ in repeats)
+		locus_end_1based = max(end_1based for _, _, end_1based, _, _ in repeats)
+		# like the str_analysis converter, only skip loci whose whole span is too small, so adjacent repeats that are
+		# narrower than 2bp are still written when the locus as a whole is wide enough
+		if locus_start_0based + 1 >= locus_end_1based:
+			self.diagnostics.report(
+				"skipped loci with intervals that are too small for TRGT",
+				f"Skipping locus {record['LocusId']} because its ReferenceRegion "
+				f"{chrom}:{locus_start_0based+1}-{locus_end_1based} has a width = "
+				f"{locus_end_1based - locus_start_0based - 1}bp")
+			return []
+
+		if "|" in record["LocusStructure"]:
+			self.diagnostics.report(
+				"skipped loci with sequence swap operations",
+				f"Skipping locus {record['LocusId']} @ {chrom}:{locus_start_0based+1}-{locus_end_1based} because its "
+				f"LocusStructure {record['LocusStructure']} contains a sequence swap operation '|' which is not "
+				f"supported by TRGT.")
+			return []
+
+		rows = []
+		for chrom, start_0based, end_1based, motif, _ in repeats:
+			locus_id = f"{record['LocusId']}_{motif}" if len(repeats) > 1 else record["LocusId"]
+			rows.append((chrom, start_0based, end_1based, f"ID={locus_id};MOTIFS={motif};STRUC=({motif})n"))
+		return rows
+
+
+class LongTRWriter(FormatWriter):
+	"""Writes the same rows as str_analysis.convert_expansion_hunter_catalog_to_longtr_format"""
+
+	name = "LongTR"
+
+	def convert_record(self, record):
+		rows = []
+		for chrom, start_0based, end_1based, motif, _ in get_repeats(record):
+			if start_0based + 1 >= end_1based:
+				self.diagnostics.report(
+					"skipped repeats with intervals that are too small for LongTR",
+					f"Skipping locus {record['LocusId']} @ {chrom}:{start_0based+1}-{end_1based} because the interval "
+					f"has a width = {end_1based - start_0based - 1}bp")
+				continue
+			rows.append((
+				chrom,
+				start_0based + 1,  # LongTR BED files use 1-based coords.
+				end_1based,
+				len(motif),
+				int((end_1based - start_0based)/len(motif)),
+				record["LocusId"],
+			))
+		return rows
+
+
+class HipSTRWriter(FormatWriter):
+	"""Writes the same rows as str_analysis.convert_expansion_hunter_catalog_to_hipstr_format, which uses the same
+	columns as the GangSTR catalog"""
+
+	name = "HipSTR"
+
+	def convert_record(self, record):
+		offtarget_regions = record.get("OfftargetRegions", [])
+		rows = []
+		for chrom, start_0based, end_1based, motif, variant_type in get_repeats(record):
+			# HipSTR doesn't support motifs longer than 9bp or loci where start_1based == stop_1based
+			# (https://github.com/tfwillems/HipSTR/blob/master/src/region.cpp#L33-L35)
+			if start_0based + 1 >= end_1based or len(motif) > 9:
+				self.diagnostics.report(
+					"skipped repeats that HipSTR doesn't support",
+					f"Skipping locus {record['LocusId']} @ {chrom}:{start_0based+1}-{end_1based} with motif {motif}")
+				continue
+			rows.append((
+				chrom,
+				start_0based + 1,  # HipSTR BED files use 1-based coords.
+				end_1based,
+				len(motif),
+				motif,
+				",".join(offtarget_regions) if variant_type == "RareRepeat" else "",
+			))
+		return rows
+
+
+class GangSTRWriter(FormatWriter):
+	"""Writes the same rows as str_analysis.convert_expansion_hunter_catalog_to_gangstr_spec"""
+
+	name = "GangSTR"
+
+	def convert_record(self, record):
+		offtarget_regions = record.get("OfftargetRegions", [])
+		rows = []
+		for chrom, start_0based, end_1based, motif, variant_type in get_repeats(record):
+			if start_0based + 1 >= end_1based:
+				continue
+			rows.append((
+				chrom,
+				start_0based + 1,  # GangSTR BED files use 1-based coords.
+				end_1based,
+				len(motif),
+				motif,
+				",".join(offtarget_regions) if variant_type == "RareRepeat" else "",
+			))
+		return rows
+
+
+def run_writer(writer, batch_queue, errors):
+	"""Write batches of records from the queue until it returns None"""
+	batch = ()
+	try:
+		while True:
+			batch = batch_queue.get()
+			if batch is None:
+				break
+			for record in batch:
+				writer.write_record(record)
+		writer.close()
+	except Exception as e:
+		errors.append((writer.name, e))
+		# keep draining the queue so that the reader doesn't block
+		while batch is not None:
+			batch = batch_queue.get()
+
+
+def emit_catalog_formats(catalog_path, writers):
+	"""Parse the catalog once and pass each record to all writers.
+
+	Args:
+		catalog_path (str): path of the input catalog in JSON, Arrow or BED format
+		writers (list): writer objects, each of which is run in its own thread
+
+	Return:
+		int: the number of records in the catalog
+	"""
+	queues = [queue.Queue(maxsize=MAX_QUEUED_BATCHES) for _ in writers]
+	errors = []
+	threads = [
+		threading.Thread(target=run_writer, args=(writer, batch_queue, errors), daemon=True)
+		for writer, batch_queue in zip(writers, queues)
+	]
+	for thread in threads:
+		thread.start()
+
+	record_counter = 0
+	batch = []
+	with profile_phase("read catalog"):
+		for record in iterate_catalog_records(catalog_path):
+			record_counter += 1
+			batch.append(record)
+			if len(batch) >= BATCH_SIZE:
+				# the queues are bounded, so this waits if any writer falls behind
+				with profile_phase("wait for writers"):
+					for batch_queue in queues:
+						batch_queue.put(batch)
+				batch = []
+
+	with profile_phase("wait for writers"):
+		for batch_queue in queues:
+			if batch:
+				batch_queue.put(batch)
+			batch_queue.put(None)
+
+		for thread in threads:
+			thread.join()
+
+	if errors:
+		writer_name, error = errors[0]
+		raise RuntimeError(f"Error while writing {writer_name} output: {error}") from error
+
+	return record_counter
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+	parser.add_argument("--eh-json", help="Output path for the ExpansionHunter catalog")
+	parser.add_argument("--bed", help="Output path for the BED file. Must end in .bed.gz")
+	parser.add_argument("--trgt", help="Output path for the TRGT catalog")
+	parser.add_argument("--longtr", help="Output path for the LongTR catalog")
+	parser.add_argument("--hipstr", help="Output path for the HipSTR catalog")
+	parser.add_argument("--gangstr", help="Output path for the GangSTR catalog")
+	parser.add_argument("--print-all-warnings", action="store_true", help="Print every skipped locus, instead of a "
+						"summary with a few examples for each output format")
+	parser.add_argument("catalog_path", help="Path of the input catalog")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if not os.path.isfile(args.catalog_path):
+		parser.error(f"File not found: {args.catalog_path}")
+
+	if args.bed and not args.bed.endswith(".bed.gz"):
+		parser.error(f"--bed path must end in .bed.gz: {args.bed}")
+
+	writers = []
+	for output_path, writer_class in [
+		(args.eh_json, ExpansionHunterJsonWriter),
+		(args.bed, BedWriter),
+		(args.trgt, TRGTWriter),
+		(args.longtr, LongTRWriter),
+		(args.hipstr, HipSTRWriter),
+		(args.gangstr, GangSTRWriter),
+	]:
+		if output_path:
+			writers.append(writer_class(output_path, print_all_warnings=args.print_all_warnings))
+
+	if not writers:
+		parser.error("No output formats specified")
+
+	print(f"Converting {args.catalog_path} to {', '.join(writer.name for writer in writers)} format")
+	total = emit_catalog_formats(args.catalog_path, writers)
+	print(f"Processed {total:,d} records from {args.catalog_path}")
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,82 @@
+"""Export a catalog to a TSV file with one row per locus.
+
+The core columns are written first, in a fixed order, followed by any other fields found in the catalog. Records are
+streamed from the input catalog and written in chunks, so memory use doesn't grow with the size of the catalog.
+"""
+
+import argparse
+import csv
+import os
+from pprint import pformat
+import tqdm
+
+from bgzf_io import open_file
+from catalog_io import get_catalog_field_names, iterate_catalog_records
+from profiling import add_profiling_arguments, profile_phase, run_main
+
+CORE_COLUMNS = [
+	'LocusId', 'ReferenceRegion', 'LocusStructure', 'CanonicalMotif', 'TRsInRegion',
+	'Source', 'GencodeGeneRegion', 'GencodeGeneId', 'GencodeGeneName', 'GencodeTranscriptId',
+	'RefseqGeneRegion', 'RefseqGeneId', 'RefseqGeneName', 'RefseqTranscriptId',
+	'ManeGeneRegion', 'ManeGeneId', 'ManeGeneName', 'ManeTranscriptId',
+	'KnownDiseaseAssociatedMotif',  'KnownDiseaseAssociatedLocus', 'NsInFlanks',
+	'LeftFlankMappability', 'FlanksAndLocusMappability', 'RightFlankMappability',
+	'FoundInKnownDiseaseAssociatedLoci', 'FoundInIllumina174kPolymorphicTRs',
+	'FoundInPerfectRepeatsInReference', 'FoundInPolymorphicTRsInT2TAssemblies',
+	'NumRepeatsInReference', 'ReferenceRepeatPurity',
+	'AlleleFrequenciesFromIllumina174k', 'StdevFromIllumina174k',
+	'AlleleFrequenciesFromT2TAssemblies', 'StdevFromT2TAssemblies',
+	'VariationCluster', 'VariationClusterSizeDiff',
+	'LPSLengthStdevFromHPRC100', 'LPSMotifFractionFromHPRC100',
+]
+
+DROP_COLUMNS = ['VariantType', ]
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+	parser.add_argument("--chunk-size", type=int, default=100_000, help="Number of rows to write at a time")
+	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
+	parser.add_argument("-o", "--output-tsv-path", help="Output TSV path")
+	parser.add_argument("catalog_path", help="Path of the catalog in JSON, Arrow, or BED format")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if not os.path.isfile(args.catalog_path):
+		parser.error(f"File not found: {args.catalog_path}")
+
+	if not args.output_tsv_path:
+		args.output_tsv_path = args.catalog_path.replace(".json.gz", "").replace(".json", "").replace(".arrow", "")
+		args.output_tsv_path += ".tsv.gz"
+
+	# first pass: find all fields that appear in the catalog
+	with profile_phase("find field names"):
+		columns = CORE_COLUMNS + [
+			c for c in get_catalog_field_names(args.catalog_path) if c not in CORE_COLUMNS and c not in DROP_COLUMNS
+		]
+
+	# second pass: write the records
+	iterator = iterate_catalog_records(args.catalog_path, use_float=True)
+	if args.show_progress_bar:
+		iterator = tqdm.tqdm(iterator, unit=" records", unit_scale=True)
+
+	row_counter = 0
+	with open_file(args.output_tsv_path, "wt") as f:
+		writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+		writer.writerow(columns)
+		chunk = []
+		for record in iterator:
+			chunk.append([record.get(c) for c in columns])
+			if len(chunk) >= args.chunk_size:
+				with profile_phase("write output"):
+					writer.writerows(chunk)
+				row_counter += len(chunk)
+				chunk = []
+		writer.writerows(chunk)
+		row_counter += len(chunk)
+
+	print(f"Wrote {row_counter:,d} rows to {args.output_tsv_path} with columns: {pformat(columns)}")
+
+
+if __name__ == "__main__":
+	run_main(main)
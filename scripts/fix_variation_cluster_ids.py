@@ -12,6 +12,9 @@ from str_analysis.utils.eh_catalog_utils import parse_motifs_from_locus_structur
 from str_analysis.utils.find_repeat_unit import find_repeat_unit_without_allowing_interruptions
 from str_analysis.utils.misc_utils import parse_interval
 
+from diagnostics import Diagnostics
+from profiling import add_profiling_arguments, run_main
+
 
 stats = collections.Counter()
 
@@ -55,6 +58,7 @@ def main():
 	parser.add_argument("--verbose", action="store_true")
 	parser.add_argument("--show-progress-bar", action="store_true", help="Show a progress bar")
 	parser.add_argument("input_path", help="Path of the variation clusters BED file or the LPS data table")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	for path in args.input_path, args.known_pathogenic_loci_json_path:
@@ -86,6 +90,7 @@ def main():
 		fopen = gzip.open if args.input_path.endswith("gz") else open
 		with fopen(args.input_path, "rt") as f, fopen(output_path, "wt") as out_f:
 			counter = 0
+			diagnostics = Diagnostics(verbose=args.verbose)
 			for line in f:
 				fields = line.strip().split("\t")
 				assert len(fields) >= 4, f"Expected at least 4 fields in BED file, got {len(fields)}: {line}"
@@ -94,7 +99,8 @@ def main():
 				for key_value in info_fields.split(";"):
 					key_value = key_value.split("=")
 					if len(key_value) != 2:
-						print(f"WARNING: skipping invalid key-value pair '{key_value}' in line {fields}")
+						diagnostics.report("skipped invalid key-value pairs",
+										   f"skipping invalid key-value pair '{key_value}' in line {fields}")
 						continue
 					key, value = key_value
 					info_fields_dict[key] = value
@@ -107,6 +113,7 @@ def main():
 
 				counter += 1
 				out_f.write("\t".join(fields) + "\n")
+			diagnostics.print_summary()
 			print(f"Wrote {counter:,d} lines to {output_path}")
 	elif (
 		args.input_path.endswith(".txt") or args.input_path.endswith(".txt.gz")
@@ -135,4 +142,4 @@ def main():
 
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	run_main(main)
\ No newline at end of file
@@ -0,0 +1,396 @@
+"""Generate a synthetic catalog and annotation sources for benchmarking the scripts in this directory without the real
+multi-GB inputs or the hg38 reference.
+
+Loci are placed on the hg38 primary chromosomes in proportion to their lengths. Motif sizes and repeat counts are drawn
+from the distributions in a catalog stats TSV (see paper/combined_catalog_stats.*.tsv), so the synthetic catalog has
+the same mix of homopolymers, STRs, and VNTRs as the catalog it's modeled on. The following files are written:
+
+	{prefix}.json.gz                        ExpansionHunter catalog with the same fields as the step 6 annotated catalog
+	{prefix}.known_pathogenic_loci.json     catalog of known pathogenic loci. These are also in {prefix}.json.gz.
+	{prefix}.TRGT.bed.gz                    TRGT catalog
+	{prefix}.variation_clusters.bed.gz      variation clusters made up of adjacent loci
+	{prefix}.LPS.txt.gz                     LPS table for add_LPS_stdev_annotations_to_catalog.py
+	{prefix}.allele_frequencies/            Illumina 174k and T2T assembly genotype tables, named like the files at
+	                                        ILLUMINA_174K_URL and T2T_ASSEMBLIES_URL so that this directory can be
+	                                        used as a download cache mirror (see download_cache.py)
+
+Output is generated one chunk of loci at a time, so memory use doesn't depend on the number of loci.
+"""
+
+import argparse
+import collections
+import functools
+import numpy as np
+import os
+import pandas as pd
+import re
+import urllib.parse
+
+from str_analysis.utils.canonical_repeat_unit import compute_canonical_motif
+
+from add_allele_frequency_annotations import ILLUMINA_174K_URL, T2T_ASSEMBLIES_URL
+from bgzf_io import DEFAULT_THREADS, open_file
+from catalog_io import CatalogWriter
+from profiling import add_profiling_arguments, iterate_in_phase, profile_phase, run_main
+
+DEFAULT_STATS_TSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paper",
+								 "combined_catalog_stats.all_13_catalogs.tsv")
+DEFAULT_STATS_CATALOG = "platinumTRs_v1.0"
+
+HG38_CHROM_SIZES = {
+	"1": 248956422, "2": 242193529, "3": 198295559, "4": 190214555, "5": 181538259, "6": 170805979,
+	"7": 159345973, "8": 145138636, "9": 138394717, "10": 133797422, "11": 135086622, "12": 133275309,
+	"13": 114364328, "14": 107043718, "15": 101991189, "16": 90338345, "17": 83257441, "18": 80373285,
+	"19": 58617616, "20": 64444167, "21": 46709983, "22": 50818468, "X": 156040895, "Y": 57227415,
+}
+
+CHUNK_SIZE = 500_000
+
+GENE_REGIONS = ["intergenic", "intron", "promoter", "exon", "5' UTR", "3' UTR", "CDS"]
+GENE_REGION_WEIGHTS = [0.45, 0.4, 0.05, 0.03, 0.02, 0.03, 0.02]
+
+MAX_VARIATION_CLUSTER_PADDING = 40
+T2T_MISSING_GENOTYPE_FRACTION = 0.05
+
+
+class LocusSizeDistribution:
+	"""The motif size and repeat count distributions of a catalog in a catalog stats TSV"""
+
+	def __init__(self, stats_tsv_path, catalog_name):
+		df = pd.read_table(stats_tsv_path)
+		rows = df[df["catalog"] == catalog_name]
+		if len(rows) == 0:
+			raise ValueError(f"Catalog '{catalog_name}' not found in {stats_tsv_path}. Options: {', '.join(df['catalog'])}")
+		stats = rows.iloc[0]
+
+		self.max_motif_size = int(stats["max_motif_size"])
+		self.max_locus_size = int(stats["max_locus_size"])
+		self.max_num_repeats = int(re.match(r"\d+-(\d+)x", stats["num_repeats_range"]).group(1))
+
+		# motif sizes 1 through 6 are listed separately, and larger motifs are grouped into 7-24bp and 25+bp
+		self.motif_size_bins = [(size, size) for size in range(1, 7)] + [(7, 24), (25, max(25, self.max_motif_size))]
+		motif_size_counts = [stats[f"count_{size}bp_motifs"] for size in range(1, 7)] + [
+			stats["count_7-24bp_motifs"], stats["count_25+bp_motifs"]]
+		self.motif_size_bin_probabilities = np.array(motif_size_counts, dtype=float) / sum(motif_size_counts)
+
+		# repeat counts are listed separately from 0x to 24x, and then grouped into 25-50x and 51+x
+		self.num_repeats_bins = []
+		num_repeats_counts = []
+		for column in df.columns:
+			match = re.match(r"motif_sizes_per_locus_size:(\d+)(?:-(\d+))?(\+)?x$", column)
+			if not match:
+				continue
+			low = int(match.group(1))
+			high = int(match.group(2)) if match.group(2) else (max(low, self.max_num_repeats) if match.group(3) else low)
+			self.num_repeats_bins.append((low, high))
+			num_repeats_counts.append(stats[column])
+		self.num_repeats_bin_probabilities = np.array(num_repeats_counts, dtype=float) / sum(num_repeats_counts)
+
+	def sample_motif_sizes(self, rng, n):
+		return sample_from_bins(rng, self.motif_size_bins, self.motif_size_bin_probabilities, n)
+
+	def sample_num_repeats(self, rng, n):
+		return sample_from_bins(rng, self.num_repeats_bins, self.num_repeats_bin_probabilities, n)
+
+
+def sample_from_bins(rng, bins, probabilities, n):
+	"""Pick n bins with the given probabilities, and then a value within each bin. Values within wide bins are drawn
+	from a log-uniform distribution since the counts in these bins drop off quickly with size."""
+	bin_indices = rng.choice(len(bins), size=n, p=probabilities)
+	lows = np.array([low for low, _ in bins])[bin_indices]
+	highs = np.array([high for _, high in bins])[bin_indices]
+	values = np.exp(rng.uniform(np.log(np.maximum(lows, 1)), np.log(highs + 1)))
+	return np.clip(values.astype(np.int64), lows, highs)
+
+
+def generate_motifs(rng, motif_sizes):
+	"""Returns a list of random motifs with the given sizes"""
+	offsets = np.concatenate([[0], np.cumsum(motif_sizes)])
+	sequence = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, size=int(offsets[-1]))].tobytes().decode()
+	return [sequence[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+@functools.lru_cache(maxsize=100_000)
+def get_canonical_motif(motif):
+	return compute_canonical_motif(motif)
+
+
+def iterate_locus_chunks(rng, distribution, num_loci, chunk_size=CHUNK_SIZE):
+	"""Yields dictionaries of equal-length lists that describe the next chunk of loci. Loci are sorted by chromosome
+	(in the order of HG38_CHROM_SIZES) and position, and don't overlap."""
+	genome_size = sum(HG38_CHROM_SIZES.values())
+	chrom_num_loci = {
+		chrom: int(round(num_loci * chrom_size / genome_size)) for chrom, chrom_size in HG38_CHROM_SIZES.items()
+	}
+	chrom_num_loci["1"] += num_loci - sum(chrom_num_loci.values())
+
+	for chrom, chrom_size in HG38_CHROM_SIZES.items():
+		position = 10_000
+		mean_spacing = chrom_size / max(1, chrom_num_loci[chrom])
+		for chunk_start in range(0, chrom_num_loci[chrom], chunk_size):
+			n = min(chunk_size, chrom_num_loci[chrom] - chunk_start)
+			motif_sizes = distribution.sample_motif_sizes(rng, n)
+			num_repeats = distribution.sample_num_repeats(rng, n)
+			# loci with 0 repeats are shorter than their motif
+			locus_sizes = np.where(num_repeats > 0, motif_sizes * num_repeats, rng.integers(1, motif_sizes + 1))
+			locus_sizes = np.minimum(locus_sizes, distribution.max_locus_size)
+			num_repeats = locus_sizes // motif_sizes
+
+			mean_gap = max(1.0, mean_spacing - locus_sizes.mean())
+			gaps = rng.geometric(1 / mean_gap, size=n)
+			ends = position + np.cumsum(gaps + locus_sizes)
+			starts = ends - locus_sizes
+			position = int(ends[-1])
+
+			yield {
+				"chrom": chrom,
+				"starts": starts.tolist(),
+				"ends": ends.tolist(),
+				"gaps": gaps.tolist(),
+				"motifs": generate_motifs(rng, motif_sizes),
+				"num_repeats": num_repeats.tolist(),
+			}
+
+
+class SyntheticCatalogGenerator:
+	"""Writes the synthetic catalog and annotation sources one chunk of loci at a time"""
+
+	def __init__(self, output_prefix, num_loci, num_known_pathogenic_loci, variation_cluster_fraction,
+				 lps_fraction, illumina174k_fraction, t2t_fraction, t2t_num_samples, threads=DEFAULT_THREADS,
+				 seed=0):
+		self.output_prefix = output_prefix
+		self.rng = np.random.default_rng(seed)
+		self.variation_cluster_fraction = variation_cluster_fraction
+		self.lps_fraction = lps_fraction
+		self.illumina174k_fraction = illumina174k_fraction
+		self.t2t_fraction = t2t_fraction
+		self.t2t_allele_columns = [
+			f"NumRepeats{haplotype}:SAMPLE{i + 1:03d}" for i in range(t2t_num_samples) for haplotype in ("Hap1", "Hap2")
+		]
+		self.known_pathogenic_locus_stride = max(1, num_loci // max(1, num_known_pathogenic_loci))
+		self.num_known_pathogenic_loci = num_known_pathogenic_loci
+		self.known_pathogenic_loci = []
+		self.counters = collections.Counter()
+
+		allele_frequencies_dir = f"{output_prefix}.allele_frequencies"
+		os.makedirs(allele_frequencies_dir, exist_ok=True)
+		self.catalog_writer = CatalogWriter(f"{output_prefix}.json.gz")
+		self.trgt_file = open_file(f"{output_prefix}.TRGT.bed.gz", "wt", threads=threads)
+		self.variation_clusters_file = open_file(f"{output_prefix}.variation_clusters.bed.gz", "wt", threads=threads)
+		self.lps_file = open_file(f"{output_prefix}.LPS.txt.gz", "wt", threads=threads)
+		self.lps_file.write("TRID\tlongestPureSegmentMotif\tN_motif\tStdev\n")
+		self.illumina174k_file = open_file(
+			os.path.join(allele_frequencies_dir, get_url_basename(ILLUMINA_174K_URL)), "wt", threads=threads)
+		self.illumina174k_file.write("VariantId\tRepeatNumbers\tAlleleCounts\n")
+		self.t2t_file = open_file(
+			os.path.join(allele_frequencies_dir, get_url_basename(T2T_ASSEMBLIES_URL)), "wt", threads=threads)
+		self.t2t_file.write("\t".join(["Locus", "CanonicalMotif", "NumRepeatsInReference"] + self.t2t_allele_columns) + "\n")
+
+	def write_chunk(self, chunk):
+		chrom = chunk["chrom"]
+		n = len(chunk["starts"])
+		locus_ids = []
+		records = []
+		gene_regions = self.rng.choice(GENE_REGIONS, size=n, p=GENE_REGION_WEIGHTS).tolist()
+		purities = np.round(np.where(self.rng.random(n) < 0.6, 1.0, self.rng.uniform(0.5, 1.0, n)), 3).tolist()
+		mappabilities = np.round(self.rng.beta(5, 1, size=(n, 3)), 2).tolist()
+		for i, (start_0based, end_1based, motif, num_repeats) in enumerate(zip(
+				chunk["starts"], chunk["ends"], chunk["motifs"], chunk["num_repeats"])):
+			reference_region = f"chr{chrom}:{start_0based}-{end_1based}"
+			locus_id = f"{chrom}-{start_0based}-{end_1based}-{motif}"
+			if (self.counters["loci"] + i) % self.known_pathogenic_locus_stride == 0 and len(
+					self.known_pathogenic_loci) < self.num_known_pathogenic_loci:
+				locus_id = f"SYNTHETIC{len(self.known_pathogenic_loci) + 1}"
+				self.known_pathogenic_loci.append({
+					"LocusId": locus_id,
+					"LocusStructure": f"({motif})*",
+					"ReferenceRegion": reference_region,
+					"VariantType": "Repeat",
+				})
+			locus_ids.append(locus_id)
+
+			record = {
+				"LocusId": locus_id,
+				"ReferenceRegion": reference_region,
+				"LocusStructure": f"({motif})*",
+				"VariantType": "Repeat",
+				"Source": "synthetic",
+				"CanonicalMotif": get_canonical_motif(motif),
+				"NumRepeatsInReference": num_repeats,
+				"ReferenceRepeatPurity": purities[i],
+				"NsInFlanks": 0,
+				"LeftFlankMappability": mappabilities[i][0],
+				"FlanksAndLocusMappability": mappabilities[i][1],
+				"RightFlankMappability": mappabilities[i][2],
+			}
+			for prefix in "Gencode", "Refseq", "Mane":
+				record[f"{prefix}GeneRegion"] = gene_regions[i]
+				if gene_regions[i] != "intergenic":
+					gene_number = (self.counters["loci"] + i) // 100
+					record[f"{prefix}GeneName"] = f"GENE{gene_number}"
+					record[f"{prefix}GeneId"] = f"{prefix.upper()}G{gene_number:08d}"
+					record[f"{prefix}TranscriptId"] = f"{prefix.upper()}T{gene_number:08d}"
+			records.append(record)
+
+		self.catalog_writer.write_batch(records)
+		self.trgt_file.writelines(
+			f"chr{chrom}\t{start_0based}\t{end_1based}\tID={locus_id};MOTIFS={motif};STRUC=({motif})n\n"
+			for start_0based, end_1based, locus_id, motif in zip(chunk["starts"], chunk["ends"], locus_ids, chunk["motifs"])
+		)
+
+		self.write_variation_clusters(chunk, locus_ids)
+		self.write_lps_rows(chunk, locus_ids, self.rng.random(n) < self.lps_fraction)
+		self.write_illumina174k_rows(chunk, self.rng.random(n) < self.illumina174k_fraction)
+		self.write_t2t_rows(chunk, self.rng.random(n) < self.t2t_fraction)
+		self.counters["loci"] += n
+
+	def write_variation_clusters(self, chunk, locus_ids):
+		"""Groups of 1 to 4 adjacent loci are combined into variation clusters that extend past the loci by a random
+		number of bases, so that some variation clusters change the locus boundaries by less than 6bp"""
+		chrom, starts, ends, gaps, motifs = chunk["chrom"], chunk["starts"], chunk["ends"], chunk["gaps"], chunk["motifs"]
+		n = len(starts)
+		cluster_starts = np.flatnonzero(self.rng.random(n) < self.variation_cluster_fraction).tolist()
+		cluster_sizes = self.rng.choice([1, 2, 3, 4], size=len(cluster_starts), p=[0.4, 0.3, 0.2, 0.1]).tolist()
+		paddings = self.rng.integers(0, MAX_VARIATION_CLUSTER_PADDING, size=(len(cluster_starts), 2)).tolist()
+		next_available_locus = 0
+		rows = []
+		for first, size, (left_padding, right_padding) in zip(cluster_starts, cluster_sizes, paddings):
+			if first < next_available_locus or first == 0:
+				continue
+			last = min(first + size, n - 1) - 1
+			if last < first:
+				continue
+			next_available_locus = last + 2
+
+			# the padding stays within the gaps around the cluster, so that variation clusters don't overlap other loci
+			start_0based = starts[first] - min(left_padding, gaps[first] - 1)
+			end_1based = ends[last] + min(right_padding, gaps[last + 1] - 1)
+			cluster_motifs = motifs[first:last + 1]
+			rows.append(f"chr{chrom}\t{start_0based}\t{end_1based}\t"
+						f"ID={','.join(locus_ids[first:last + 1])};MOTIFS={','.join(cluster_motifs)};"
+						f"STRUC={''.join(f'({motif})n' for motif in cluster_motifs)}\n")
+		self.variation_clusters_file.writelines(rows)
+		self.counters["variation_clusters"] += len(rows)
+
+	def write_lps_rows(self, chunk, locus_ids, is_selected):
+		"""Each selected locus gets an LPS row for its own motif, and some also get a row for a different motif"""
+		rows = []
+		indices = np.flatnonzero(is_selected).tolist()
+		motif_counts = self.rng.integers(1, 100, size=(len(indices), 2)).tolist()
+		stdevs = np.round(self.rng.exponential(5, size=len(indices)), 3).tolist()
+		has_second_motif = (self.rng.random(len(indices)) < 0.3).tolist()
+		for i, (n_motif, n_other_motif), stdev, add_second_motif in zip(indices, motif_counts, stdevs, has_second_motif):
+			motif = chunk["motifs"][i]
+			rows.append(f"{locus_ids[i]}\t{motif}\t{n_motif}\t{stdev}\n")
+			if add_second_motif:
+				rows.append(f"{locus_ids[i]}\t{motif[1:] + motif[:1] + 'A'}\t{n_other_motif}\t{stdev}\n")
+		self.lps_file.writelines(rows)
+		self.counters["LPS_rows"] += len(rows)
+
+	def write_illumina174k_rows(self, chunk, is_selected):
+		rows = []
+		for i in np.flatnonzero(is_selected).tolist():
+			num_repeats = chunk["num_repeats"][i]
+			repeat_numbers = sorted(set(
+				max(0, num_repeats + delta) for delta in self.rng.integers(-3, 4, size=self.rng.integers(1, 6)).tolist()))
+			allele_counts = self.rng.integers(1, 2000, size=len(repeat_numbers)).tolist()
+			rows.append(f"{chunk['chrom']}_{chunk['starts'][i]}_{chunk['ends'][i]}\t"
+						f"{','.join(map(str, repeat_numbers))}\t{','.join(map(str, allele_counts))}\n")
+		self.illumina174k_file.writelines(rows)
+		self.counters["illumina174k_rows"] += len(rows)
+
+	def write_t2t_rows(self, chunk, is_selected):
+		"""Half of the selected loci match a T2T locus exactly, and the other half overlap a T2T locus that's one motif
+		longer, so that both exact matches and overlap matches are exercised"""
+		indices = np.flatnonzero(is_selected)
+		if len(indices) == 0:
+			return
+		motifs = [chunk["motifs"][i] for i in indices.tolist()]
+		motif_sizes = np.array([len(motif) for motif in motifs])
+		starts = np.array(chunk["starts"])[indices]
+		ends = np.array(chunk["ends"])[indices]
+		ends = np.where(self.rng.random(len(indices)) < 0.5, ends, ends + motif_sizes)
+		num_repeats = (ends - starts) // motif_sizes
+		allele_sizes = num_repeats[:, None] + self.rng.integers(-2, 3, size=(len(indices), len(self.t2t_allele_columns)))
+		allele_sizes = np.maximum(allele_sizes, 0).astype(float)
+		allele_sizes[self.rng.random(allele_sizes.shape) < T2T_MISSING_GENOTYPE_FRACTION] = np.nan
+
+		df = pd.DataFrame(allele_sizes, columns=self.t2t_allele_columns)
+		df.insert(0, "Locus", [f"chr{chunk['chrom']}:{start_0based + 1}-{end_1based}"
+							   for start_0based, end_1based in zip(starts.tolist(), ends.tolist())])
+		df.insert(1, "CanonicalMotif", [get_canonical_motif(motif) for motif in motifs])
+		df.insert(2, "NumRepeatsInReference", num_repeats)
+		df.to_csv(self.t2t_file, sep="\t", header=False, index=False, float_format="%.0f")
+		self.counters["t2t_rows"] += len(df)
+
+	def close(self):
+		self.catalog_writer.close()
+		for f in self.trgt_file, self.variation_clusters_file, self.lps_file, self.illumina174k_file, self.t2t_file:
+			f.close()
+
+		with CatalogWriter(f"{self.output_prefix}.known_pathogenic_loci.json") as writer:
+			writer.write_batch(self.known_pathogenic_loci)
+
+		print(f"Wrote {self.counters['loci']:,d} loci to {self.output_prefix}.json.gz and {self.output_prefix}.TRGT.bed.gz")
+		print(f"Wrote {len(self.known_pathogenic_loci):,d} known pathogenic loci to "
+			  f"{self.output_prefix}.known_pathogenic_loci.json")
+		print(f"Wrote {self.counters['variation_clusters']:,d} variation clusters to "
+			  f"{self.output_prefix}.variation_clusters.bed.gz")
+		print(f"Wrote {self.counters['LPS_rows']:,d} rows to {self.output_prefix}.LPS.txt.gz")
+		print(f"Wrote {self.counters['illumina174k_rows']:,d} Illumina 174k rows and {self.counters['t2t_rows']:,d} "
+			  f"T2T assembly rows to {self.output_prefix}.allele_frequencies/")
+
+
+def get_url_basename(url):
+	return os.path.basename(urllib.parse.urlparse(url).path)
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+	parser.add_argument("-n", "--num-loci", type=int, default=100_000, help="Number of loci to generate")
+	parser.add_argument("--stats-tsv", default=DEFAULT_STATS_TSV, help="Catalog stats TSV with the motif size and "
+						"repeat count distributions to use")
+	parser.add_argument("--stats-catalog", default=DEFAULT_STATS_CATALOG, help="Value in the 'catalog' column of "
+						"--stats-tsv for the catalog whose distributions to use")
+	parser.add_argument("--num-known-pathogenic-loci", type=int, default=60, help="Number of loci to include in the "
+						"known pathogenic loci catalog")
+	parser.add_argument("--variation-cluster-fraction", type=float, default=0.05, help="Fraction of loci that start a "
+						"variation cluster")
+	parser.add_argument("--lps-fraction", type=float, default=0.3, help="Fraction of loci with LPS annotations")
+	parser.add_argument("--illumina174k-fraction", type=float, default=0.04, help="Fraction of loci in the Illumina "
+						"174k allele frequency table")
+	parser.add_argument("--t2t-fraction", type=float, default=0.35, help="Fraction of loci in the T2T assemblies "
+						"allele frequency table")
+	parser.add_argument("--t2t-num-samples", type=int, default=78, help="Number of samples in the T2T assemblies table")
+	parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="Number of compression threads")
+	parser.add_argument("--seed", type=int, default=0, help="Random seed")
+	parser.add_argument("-o", "--output-prefix", default="synthetic_catalog", help="Prefix of the output files")
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if args.num_loci < 1:
+		parser.error("--num-loci must be at least 1")
+
+	distribution = LocusSizeDistribution(args.stats_tsv, args.stats_catalog)
+	print(f"Generating {args.num_loci:,d} loci with the motif size and repeat count distributions of "
+		  f"{args.stats_catalog}")
+
+	generator = SyntheticCatalogGenerator(
+		args.output_prefix,
+		args.num_loci,
+		num_known_pathogenic_loci=args.num_known_pathogenic_loci,
+		variation_cluster_fraction=args.variation_cluster_fraction,
+		lps_fraction=args.lps_fraction,
+		illumina174k_fraction=args.illumina174k_fraction,
+		t2t_fraction=args.t2t_fraction,
+		t2t_num_samples=args.t2t_num_samples,
+		threads=args.threads,
+		seed=args.seed)
+	for chunk in iterate_in_phase(iterate_locus_chunks(generator.rng, distribution, args.num_loci), "generate loci"):
+		with profile_phase("write output"):
+			generator.write_chunk(chunk)
+	generator.close()
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,134 @@
+"""Memory-efficient index for finding overlaps between genomic intervals.
+
+Intervals are stored in NumPy arrays rather than as Python objects. For each chromosome, the intervals are sorted by
+start coordinate, and a running maximum of their end coordinates is kept alongside the starts. The intervals that
+overlap a query are then the ones between two binary searches: the first interval whose running maximum end is past
+the query start, and the last interval that starts before the query end. This takes a few bytes per interval instead
+of the ~1kb per interval used by intervaltree.IntervalTree, and can be built in a single vectorized sort.
+
+Intervals are half-open, so [start, end) overlaps the query [query_start, query_end) if start < query_end and
+end > query_start.
+"""
+
+import numpy as np
+
+from annotation_source_cache import StringArray, add_prefix, encode_strings, remove_prefix
+
+
+class IntervalIndex:
+
+	def __init__(self, chroms, starts, ends, motifs=None):
+		"""Args:
+			chroms (list): chromosome of each interval
+			starts (list or np.array): 0-based start coordinate of each interval
+			ends (list or np.array): end coordinate of each interval
+			motifs (list): optional motif of each interval. Motifs are stored as integer ids (see get_motif_id).
+		"""
+		starts = np.asarray(starts, dtype=np.int32)
+		ends = np.asarray(ends, dtype=np.int32)
+		if len(chroms) != len(starts) or len(starts) != len(ends):
+			raise ValueError(f"chroms, starts and ends must have the same length: {len(chroms)}, {len(starts)}, "
+							 f"{len(ends)}")
+
+		arrays = {"starts": starts, "ends": ends}
+		if motifs is not None:
+			unique_motifs, motif_ids = np.unique(np.asarray(motifs, dtype=object).astype(str), return_inverse=True)
+			arrays["motif_ids"] = motif_ids.astype(np.int32)
+			arrays.update(add_prefix("motifs_", encode_strings(unique_motifs.tolist())))
+
+		# sort the intervals by (chrom, start, end), and compute the running maximum of the ends within each chromosome
+		unique_chroms, chrom_ids = np.unique(np.asarray(chroms, dtype=object).astype(str), return_inverse=True)
+		order = np.lexsort((ends, starts, chrom_ids))
+		chrom_boundaries = np.searchsorted(chrom_ids[order], np.arange(len(unique_chroms) + 1))
+		max_ends = np.empty(len(order), dtype=np.int32)
+		for lo, hi in zip(chrom_boundaries[:-1], chrom_boundaries[1:]):
+			max_ends[lo:hi] = np.maximum.accumulate(ends[order[lo:hi]])
+
+		arrays.update({
+			"sorted_indices": order.astype(np.int32),
+			"sorted_starts": starts[order],
+			"max_ends": max_ends,
+			"chrom_boundaries": chrom_boundaries.astype(np.int64),
+		})
+		arrays.update(add_prefix("chroms_", encode_strings(unique_chroms.tolist())))
+
+		self._init_from_arrays(arrays)
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		"""Create an IntervalIndex from the arrays returned by get_arrays, for example after loading them from the
+		annotation source cache"""
+		interval_index = cls.__new__(cls)
+		interval_index._init_from_arrays(arrays)
+		return interval_index
+
+	def get_arrays(self):
+		"""Returns a dict of all arrays needed to recreate this index with from_arrays"""
+		return dict(self._arrays)
+
+	def _init_from_arrays(self, arrays):
+		self._arrays = arrays
+		self.starts = arrays["starts"]
+		self.ends = arrays["ends"]
+		self.motif_ids = arrays.get("motif_ids")
+		self.motif_id_lookup = {}
+		if self.motif_ids is not None:
+			self.motif_id_lookup = {motif: i for i, motif in enumerate(StringArray(remove_prefix("motifs_", arrays)))}
+
+		self._sorted_indices = {}
+		self._sorted_starts = {}
+		self._max_ends = {}
+		chrom_boundaries = arrays["chrom_boundaries"].tolist()
+		for i, chrom in enumerate(StringArray(remove_prefix("chroms_", arrays))):
+			lo, hi = chrom_boundaries[i], chrom_boundaries[i+1]
+			self._sorted_indices[chrom] = arrays["sorted_indices"][lo:hi]
+			self._sorted_starts[chrom] = arrays["sorted_starts"][lo:hi]
+			self._max_ends[chrom] = arrays["max_ends"][lo:hi]
+
+	def __len__(self):
+		return len(self.starts)
+
+	def get_motif_id(self, motif):
+		"""Returns the integer id of the given motif, or -1 if no interval in the index has this motif"""
+		return self.motif_id_lookup.get(motif, -1)
+
+	def overlap(self, chrom, start, end):
+		"""Returns an array with the indices of the intervals that overlap [start, end), sorted by interval start and
+		end coordinates. Indices refer to the order in which intervals were passed to the constructor."""
+		if chrom not in self._sorted_indices:
+			return np.empty(0, dtype=np.int32)
+
+		lo = np.searchsorted(self._max_ends[chrom], start, side="right")
+		hi = np.searchsorted(self._sorted_starts[chrom], end, side="left")
+		candidates = self._sorted_indices[chrom][lo:hi]
+		return candidates[self.ends[candidates] > start]
+
+	def overlap_batch(self, chrom, query_starts, query_ends):
+		"""Finds overlaps for many queries on the same chromosome at once. This is most efficient when the queries are
+		sorted by position, since each query then only scans the intervals near the previous query.
+
+		Args:
+			chrom (str): chromosome of the queries
+			query_starts (np.array): 0-based start coordinate of each query
+			query_ends (np.array): end coordinate of each query
+
+		Return:
+			2-tuple: (query_indices, interval_indices) arrays with one entry per overlapping pair. Pairs are sorted by
+				query index, and then by interval start and end coordinates.
+		"""
+		query_starts = np.asarray(query_starts, dtype=np.int64)
+		query_ends = np.asarray(query_ends, dtype=np.int64)
+		if chrom not in self._sorted_indices or len(query_starts) == 0:
+			return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+		lo = np.searchsorted(self._max_ends[chrom], query_starts, side="right")
+		hi = np.searchsorted(self._sorted_starts[chrom], query_ends, side="left")
+		num_candidates = np.maximum(hi - lo, 0)
+
+		# expand the [lo, hi) ranges into one row per (query, candidate interval) pair
+		query_indices = np.repeat(np.arange(len(query_starts)), num_candidates)
+		range_offsets = np.arange(num_candidates.sum()) - np.repeat(np.cumsum(num_candidates) - num_candidates, num_candidates)
+		interval_indices = self._sorted_indices[chrom][np.repeat(lo, num_candidates) + range_offsets]
+
+		is_overlap = self.ends[interval_indices] > query_starts[query_indices]
+		return query_indices[is_overlap], interval_indices[is_overlap]
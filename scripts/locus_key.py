@@ -0,0 +1,142 @@
+"""Compact integer keys for tandem repeat loci.
+
+The annotation scripts join tables on locus ids like "1-12345-12360-CAG" and on intervals like "1:12345-12360". Keeping
+millions of these as Python strings (or tuples) in dicts and sets takes several GB, so this module encodes them as
+fixed-size integers that can be stored in NumPy arrays and compared, sorted, and searched in bulk:
+
+- a position key is a uint64 that packs the chromosome index (6 bits), 0-based start (29 bits) and end (29 bits).
+  Chromosomes 1-22, X, Y and M (with or without the "chr" prefix) are encoded exactly. Other contigs are rare
+  enough that their positions are stored as a 58-bit hash instead.
+- a motif key is a uint64 that packs motifs of up to 29 A/C/G/T bases as 2 bits per base, plus their length in the
+  next 5 bits. Longer motifs, or motifs with other characters, are stored as a 63-bit hash with the top bit set.
+- a locus key combines the two in a LOCUS_KEY_DTYPE record. Locus ids that aren't in the "chrom-start-end-motif"
+  format (for example, the ids of known pathogenic loci like "HTT") get position 0 and the hash of the whole id as
+  their motif key.
+
+Encoding is deterministic, so keys computed in different processes or saved in the annotation source cache can be
+compared directly.
+"""
+
+import hashlib
+
+import numpy as np
+
+LOCUS_KEY_DTYPE = np.dtype([("position", np.uint64), ("motif", np.uint64)])
+
+CHROMOSOMES = [str(i) for i in range(1, 23)] + ["X", "Y", "M"]
+CHROMOSOME_INDEX = {chrom: i + 1 for i, chrom in enumerate(CHROMOSOMES)}
+CHROMOSOME_INDEX["MT"] = CHROMOSOME_INDEX["M"]
+OTHER_CHROMOSOME_INDEX = 63
+
+COORDINATE_BITS = 29
+MAX_COORDINATE = 2**COORDINATE_BITS - 1
+CHROMOSOME_SHIFT = 2 * COORDINATE_BITS
+
+MAX_PACKED_MOTIF_LENGTH = 29
+MOTIF_LENGTH_SHIFT = 2 * MAX_PACKED_MOTIF_LENGTH
+MOTIF_HASH_FLAG = 1 << 63
+BASE_CODES = {"A": 0, "C": 1, "G": 2, "T": 3}
+
+
+def _hash(value, bits):
+	return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little") >> (64 - bits)
+
+
+def normalize_chrom(chrom):
+	"""Returns the chromosome name without the "chr" prefix"""
+	return chrom[3:] if chrom.startswith("chr") else chrom
+
+
+def encode_position(chrom, start_0based, end):
+	"""Returns the position key of the interval [start_0based, end) on the given chromosome"""
+	chrom = normalize_chrom(chrom)
+	chrom_index = CHROMOSOME_INDEX.get(chrom)
+	if chrom_index is None:
+		return (OTHER_CHROMOSOME_INDEX << CHROMOSOME_SHIFT) | _hash(f"{chrom}:{start_0based}-{end}", CHROMOSOME_SHIFT)
+
+	if not 0 <= start_0based <= MAX_COORDINATE or not 0 <= end <= MAX_COORDINATE:
+		raise ValueError(f"Interval {chrom}:{start_0based}-{end} is outside the range of position keys")
+	return (chrom_index << CHROMOSOME_SHIFT) | (start_0based << COORDINATE_BITS) | end
+
+
+def encode_positions(chroms, starts_0based, ends):
+	"""Vectorized version of encode_position.
+
+	Args:
+		chroms (list or np.array): chromosome of each interval
+		starts_0based (list or np.array): 0-based start coordinate of each interval
+		ends (list or np.array): end coordinate of each interval
+
+	Return:
+		np.array: uint64 position keys
+	"""
+	starts_0based = np.asarray(starts_0based, dtype=np.int64)
+	ends = np.asarray(ends, dtype=np.int64)
+	unique_chroms, chrom_ids = np.unique(np.asarray(chroms, dtype=object).astype(str), return_inverse=True)
+	chrom_indices = np.array(
+		[CHROMOSOME_INDEX.get(normalize_chrom(chrom), OTHER_CHROMOSOME_INDEX) for chrom in unique_chroms.tolist()],
+		dtype=np.uint64)[chrom_ids.ravel()]
+
+	is_other_chrom = chrom_indices == OTHER_CHROMOSOME_INDEX
+	out_of_range = ~is_other_chrom & ((starts_0based < 0) | (starts_0based > MAX_COORDINATE) | (ends < 0) | (ends > MAX_COORDINATE))
+	if out_of_range.any():
+		i = int(np.flatnonzero(out_of_range)[0])
+		raise ValueError(f"Interval {chroms[i]}:{starts_0based[i]}-{ends[i]} is outside the range of position keys")
+
+	keys = (chrom_indices << np.uint64(CHROMOSOME_SHIFT)) | \
+		(np.where(is_other_chrom, 0, starts_0based).astype(np.uint64) << np.uint64(COORDINATE_BITS)) | \
+		np.where(is_other_chrom, 0, ends).astype(np.uint64)
+	for i in np.flatnonzero(is_other_chrom).tolist():
+		keys[i] = encode_position(str(chroms[i]), int(starts_0based[i]), int(ends[i]))
+
+	return keys
+
+
+def decode_position(position_key):
+	"""Returns the (chrom, start_0based, end) tuple encoded in a position key. The chromosome is returned without the
+	"chr" prefix. Raises ValueError for positions on other contigs, since these are stored as hashes."""
+	position_key = int(position_key)
+	chrom_index = position_key >> CHROMOSOME_SHIFT
+	if not 1 <= chrom_index <= len(CHROMOSOMES):
+		raise ValueError(f"Position key {position_key} can't be decoded")
+
+	return CHROMOSOMES[chrom_index - 1], (position_key >> COORDINATE_BITS) & MAX_COORDINATE, position_key & MAX_COORDINATE
+
+
+def encode_motif(motif):
+	"""Returns the motif key of the given motif"""
+	if len(motif) > MAX_PACKED_MOTIF_LENGTH or any(base not in BASE_CODES for base in motif):
+		return MOTIF_HASH_FLAG | _hash(motif, 63)
+
+	packed_bases = 0
+	for base in motif:
+		packed_bases = (packed_bases << 2) | BASE_CODES[base]
+	return (len(motif) << MOTIF_LENGTH_SHIFT) | packed_bases
+
+
+def encode_locus_id(locus_id):
+	"""Returns the (position key, motif key) tuple for the given locus id"""
+	fields = locus_id.split("-")
+	if len(fields) == 4 and fields[1].isdigit() and fields[2].isdigit():
+		chrom, start_0based, end, motif = fields
+		return encode_position(chrom, int(start_0based), int(end)), encode_motif(motif)
+
+	return 0, MOTIF_HASH_FLAG | _hash(locus_id, 63)
+
+
+def encode_locus_ids(locus_ids):
+	"""Returns a LOCUS_KEY_DTYPE array with the locus keys of the given locus ids"""
+	motif_key_cache = {}
+	keys = np.empty(len(locus_ids), dtype=LOCUS_KEY_DTYPE)
+	for i, locus_id in enumerate(locus_ids):
+		fields = locus_id.split("-")
+		if len(fields) == 4 and fields[1].isdigit() and fields[2].isdigit():
+			chrom, start_0based, end, motif = fields
+			motif_key = motif_key_cache.get(motif)
+			if motif_key is None:
+				motif_key = motif_key_cache[motif] = encode_motif(motif)
+			keys[i] = (encode_position(chrom, int(start_0based), int(end)), motif_key)
+		else:
+			keys[i] = encode_locus_id(locus_id)
+
+	return keys
@@ -0,0 +1,183 @@
+"""Helpers for scripts that take a --max-memory budget.
+
+Once the data a script would keep in memory reaches the budget, it's spilled to temporary files instead: sort_lines
+writes sorted runs that are then merged, SortedBedWriter sorts BED rows one chromosome at a time using sort_lines, and
+annotation_source_cache.ArrayBuilder builds compiled arrays in files that are memory-mapped. Temporary files are
+written to the directory given by the TMPDIR environment variable (see tempfile.gettempdir).
+"""
+
+import heapq
+import os
+import re
+import sys
+import tempfile
+
+from bgzf_io import DEFAULT_THREADS, open_file
+
+MEMORY_SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+# estimated memory used by each buffered line in addition to the line itself: its sort key and its list entry
+BUFFERED_LINE_OVERHEAD_BYTES = 150
+
+# sorted runs are merged into one run before more than this many files would be open at once
+MAX_RUNS_PER_MERGE = 256
+
+MIN_ROWS_PER_CHUNK = 1_000
+
+
+def parse_memory_size(value):
+	"""Parse a memory size like "512M", "4G" or "4GB" into a number of bytes. Sizes without a unit are in bytes."""
+	match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)i?B?\s*", str(value), re.IGNORECASE)
+	if not match:
+		raise ValueError(f"Invalid memory size: '{value}'. Expected a number followed by an optional K, M, G or T unit.")
+	return int(float(match.group(1)) * MEMORY_SIZE_UNITS[match.group(2).upper()])
+
+
+def add_max_memory_argument(parser):
+	"""Add the --max-memory option to an argparse parser"""
+	parser.add_argument("--max-memory", type=parse_memory_size, help="Approximate amount of memory (for example, "
+						"'4G' or '500M') to use for the data that would otherwise be kept in memory in full. Once this "
+						"budget is reached, the data is spilled to temporary files. By default, there is no limit.")
+
+
+def get_rows_per_chunk(max_memory, bytes_per_row):
+	"""Returns the number of table rows to read at a time so that a chunk of rows uses at most max_memory bytes"""
+	return max(MIN_ROWS_PER_CHUNK, int(max_memory // bytes_per_row))
+
+
+def sort_lines(lines, key, max_memory=None):
+	"""Yields the lines in the order given by the key function. Lines with equal keys keep their input order.
+
+	If max_memory is specified, lines are buffered until their estimated size reaches max_memory, and each full buffer
+	is sorted and written to a temporary file as a sorted run. The runs are then merged, which only keeps one line from
+	each run in memory.
+
+	Args:
+		lines (iterator): lines that end with a newline
+		key (function): takes a line and returns its sort key
+		max_memory (int): optional number of bytes of lines to keep in memory
+	"""
+	buffer = []
+	buffer_size = 0
+	run_paths = []
+	with tempfile.TemporaryDirectory(prefix="sort_lines.") as temp_dir:
+		for line in lines:
+			buffer.append(line)
+			buffer_size += sys.getsizeof(line) + BUFFERED_LINE_OVERHEAD_BYTES
+			if max_memory is not None and buffer_size >= max_memory:
+				buffer.sort(key=key)
+				run_paths.append(write_sorted_run(buffer, temp_dir, len(run_paths)))
+				buffer = []
+				buffer_size = 0
+				if len(run_paths) >= MAX_RUNS_PER_MERGE:
+					run_paths = [merge_sorted_runs(run_paths, key, temp_dir)]
+
+		buffer.sort(key=key)
+		if not run_paths:
+			yield from buffer
+			return
+
+		run_files = [open(run_path, "rt") for run_path in run_paths]
+		try:
+			# heapq.merge is stable, so lines with equal keys come from earlier runs first
+			yield from heapq.merge(*run_files, buffer, key=key)
+		finally:
+			for run_file in run_files:
+				run_file.close()
+
+
+def write_sorted_run(lines, temp_dir, run_index):
+	"""Write already-sorted lines to a new file in temp_dir, and return its path"""
+	run_path = os.path.join(temp_dir, f"run{run_index}.txt")
+	with open(run_path, "wt") as f:
+		f.writelines(lines)
+	return run_path
+
+
+def merge_sorted_runs(run_paths, key, temp_dir):
+	"""Merge sorted runs into a single new run, delete them, and return the path of the new run"""
+	run_files = [open(run_path, "rt") for run_path in run_paths]
+	merged_run_path = write_sorted_run(heapq.merge(*run_files, key=key), temp_dir, f"{len(run_paths)}.merged")
+	for run_file in run_files:
+		run_file.close()
+		os.remove(run_file.name)
+	os.rename(merged_run_path, run_paths[0])
+	return run_paths[0]
+
+
+def get_bed_interval(line):
+	"""Returns the (start_0based, end_1based) tuple of a BED row"""
+	fields = line.split("\t", 3)
+	return int(fields[1]), int(fields[2])
+
+
+class SortedBedWriter:
+	"""Writes BED rows sorted by chromosome name and start coordinate, like 'bedtools sort', without an external sort.
+
+	Rows can be added in any order. They are spilled to a temporary file per chromosome, and written to the output one
+	chromosome at a time when the writer is closed. Chromosomes whose rows were added in sorted order (for example,
+	because they came from a sorted catalog) are streamed from their temporary file, and only the rows of other
+	chromosomes are sorted, using sort_lines with the max_memory budget.
+	"""
+
+	def __init__(self, output_path, threads=DEFAULT_THREADS, max_memory=None):
+		self.output_path = output_path
+		self.threads = threads
+		self.max_memory = max_memory
+		self.row_counter = 0
+		self._temp_dir = tempfile.TemporaryDirectory(prefix="sorted_bed_writer.")
+		self._chrom_files = {}
+		self._chrom_previous_sort_keys = {}
+		self._unsorted_chroms = set()
+
+	def add(self, chrom, start_0based, end_1based, line):
+		"""Add a BED row. The line must end with a newline."""
+		chrom_file = self._chrom_files.get(chrom)
+		if chrom_file is None:
+			chrom_file = open(os.path.join(self._temp_dir.name, f"{len(self._chrom_files)}.bed"), "wt")
+			self._chrom_files[chrom] = chrom_file
+
+		sort_key = (start_0based, end_1based)
+		previous_sort_key = self._chrom_previous_sort_keys.get(chrom)
+		if previous_sort_key is not None and sort_key < previous_sort_key:
+			self._unsorted_chroms.add(chrom)
+		self._chrom_previous_sort_keys[chrom] = sort_key
+		chrom_file.write(line)
+
+	def close(self, sorted_rows_by_chrom=None, on_write_row=None):
+		"""Write all rows to the output file.
+
+		Args:
+			sorted_rows_by_chrom (dict): optionally maps chromosomes to lists of (start_0based, end_1based, line) tuples
+				that are already sorted. These are merged with the rows that were added to the writer, and come first
+				when rows have the same interval.
+			on_write_row (function): optionally called with each line in output order
+		"""
+		sorted_rows_by_chrom = sorted_rows_by_chrom or {}
+		with open_file(self.output_path, "wt", threads=self.threads) as output_file:
+			for chrom in sorted(set(self._chrom_files) | set(sorted_rows_by_chrom)):
+				rows = self._iterate_rows(chrom)
+				if chrom in sorted_rows_by_chrom:
+					rows = heapq.merge(sorted_rows_by_chrom[chrom], rows, key=lambda row: row[:2])
+				for _, _, line in rows:
+					output_file.write(line)
+					self.row_counter += 1
+					if on_write_row is not None:
+						on_write_row(line)
+
+		self._temp_dir.cleanup()
+
+	def _iterate_rows(self, chrom):
+		"""Yields the (start_0based, end_1based, line) tuples of the rows that were added for the given chromosome, in
+		sorted order"""
+		chrom_file = self._chrom_files.get(chrom)
+		if chrom_file is None:
+			return
+		chrom_file.close()
+
+		with open(chrom_file.name, "rt") as f:
+			lines = f
+			if chrom in self._unsorted_chroms:
+				lines = sort_lines(f, key=get_bed_interval, max_memory=self.max_memory)
+			for line in lines:
+				yield (*get_bed_interval(line), line)
@@ -0,0 +1,207 @@
+"""Streaming merge join of a coordinate-sorted catalog with coordinate-sorted annotation sources.
+
+When the catalog and an annotation source (for example, the variation clusters BED file) are both sorted by chromosome
+and start coordinate, they can be joined by walking through both in lockstep instead of loading the whole source into
+a lookup table. Each source keeps only a window of the rows near the current catalog record in memory:
+
+- an "overlap" join matches each catalog record to the source rows whose intervals overlap it. The window holds the
+  rows that start before the end of the current record and end after its start.
+- an "exact" join matches each catalog record to the source rows with the same interval, and optionally the same key
+  (for example, the same motif). The window holds the rows that start at the current record's start coordinate.
+
+Both sides have to use the same chromosome order (see CHROM_ORDERS), and a ValueError is raised as soon as a record or
+row is found to be out of order. Intervals are half-open, so [start, end) overlaps [query_start, query_end) if
+start < query_end and end > query_start.
+"""
+
+from str_analysis.utils.misc_utils import parse_interval
+
+from locus_key import CHROMOSOME_INDEX, OTHER_CHROMOSOME_INDEX, normalize_chrom
+
+
+def natural_chrom_sort_key(chrom):
+	"""Sorts chromosomes as 1, 2, ..., 22, X, Y, M followed by any other contigs in alphabetical order, with or without
+	the "chr" prefix"""
+	chrom = normalize_chrom(chrom)
+	return CHROMOSOME_INDEX.get(chrom, OTHER_CHROMOSOME_INDEX), chrom
+
+
+def lexicographic_chrom_sort_key(chrom):
+	"""Sorts chromosomes by name, the way 'bedtools sort' and 'sort -k1,1' do"""
+	return chrom
+
+
+CHROM_ORDERS = {
+	"natural": natural_chrom_sort_key,
+	"lexicographic": lexicographic_chrom_sort_key,
+}
+
+
+def get_reference_region_interval(record):
+	"""Returns the (chrom, start_0based, end) tuple of a catalog record's ReferenceRegion. For loci with more than one
+	reference region, returns the interval that spans all of them."""
+	reference_regions = record["ReferenceRegion"]
+	if not isinstance(reference_regions, list):
+		return parse_interval(reference_regions)
+
+	intervals = [parse_interval(reference_region) for reference_region in reference_regions]
+	return intervals[0][0], min(start_0based for _, start_0based, _ in intervals), max(end for _, _, end in intervals)
+
+
+class MergeJoinSource:
+	"""An annotation source for MergeJoin"""
+
+	def __init__(self, rows, get_interval, name, join="overlap", get_key=None, on_discard=None):
+		"""Args:
+			rows (iterable): source rows, sorted by chromosome and start coordinate
+			get_interval (function): takes a row and returns its (chrom, start_0based, end) tuple
+			name (str): name of this source, used in error messages
+			join (str): "overlap" or "exact"
+			get_key (function): for exact joins, optionally takes a row and returns a key that must also equal the key
+				of the catalog record
+			on_discard (function): optionally called with each row once it can no longer match any catalog record,
+				including rows that never matched one
+		"""
+		if join not in ("overlap", "exact"):
+			raise ValueError(f"Invalid join type: {join}")
+
+		self.rows = iter(rows)
+		self.get_interval = get_interval
+		self.name = name
+		self.join = join
+		self.get_key = get_key
+		self.on_discard = on_discard
+
+		# the next row that hasn't been added to the window yet, along with its interval
+		self.next_row = None
+		self.next_interval = None
+		self.previous_sort_key = None
+		self.window = []
+		self.window_chrom_sort_key = None
+		self.min_window_end = None
+
+
+class MergeJoin:
+	"""Matches a stream of coordinate-sorted catalog records to rows from one or more coordinate-sorted sources"""
+
+	def __init__(self, sources, chrom_sort_key=natural_chrom_sort_key):
+		"""Args:
+			sources (list): MergeJoinSource objects
+			chrom_sort_key (function): the chromosome order of the catalog and the sources (see CHROM_ORDERS)
+		"""
+		self.sources = sources
+		self.chrom_sort_key = chrom_sort_key
+		self.previous_sort_key = None
+		for source in self.sources:
+			self._read_next_row(source)
+
+	def match(self, chrom, start_0based, end, key=None):
+		"""Returns the rows that match the given catalog record. Catalog records must be passed to this method in
+		sorted order.
+
+		Args:
+			chrom (str): chromosome of the catalog record
+			start_0based (int): start coordinate of the catalog record
+			end (int): end coordinate of the catalog record
+			key (object): key of the catalog record for exact joins that use get_key
+
+		Return:
+			list: for each source, a list of the rows that match this record, in the order they appear in the source
+		"""
+		sort_key = (self.chrom_sort_key(chrom), start_0based)
+		if self.previous_sort_key is not None and sort_key < self.previous_sort_key:
+			raise ValueError(f"Catalog isn't sorted: {chrom}:{start_0based}-{end} is after a record that starts later")
+		self.previous_sort_key = sort_key
+
+		return [self._match_source(source, chrom, start_0based, end, key) for source in self.sources]
+
+	def close(self):
+		"""Discard all rows that are still in the windows or haven't been read yet"""
+		for source in self.sources:
+			self._evict(source, lambda interval: True)
+			while source.next_row is not None:
+				self._discard(source, source.next_row)
+				self._read_next_row(source)
+
+	def _match_source(self, source, chrom, start_0based, end, key):
+		chrom_sort_key = self.chrom_sort_key(chrom)
+		if source.window_chrom_sort_key != chrom_sort_key:
+			self._evict(source, lambda interval: True)
+			source.window_chrom_sort_key = chrom_sort_key
+
+		if source.join == "overlap":
+			# rows that end at or before this record's start can't overlap this record or any later ones
+			if source.min_window_end is not None and source.min_window_end <= start_0based:
+				self._evict(source, lambda interval: interval[2] <= start_0based)
+			read_until = (chrom_sort_key, end)
+		else:
+			self._evict(source, lambda interval: interval[1] < start_0based)
+			read_until = (chrom_sort_key, start_0based + 1)
+
+		# add rows to the window until reaching a row that starts at or after read_until
+		while source.next_row is not None:
+			next_chrom, next_start_0based, next_end = source.next_interval
+			next_chrom_sort_key = self.chrom_sort_key(next_chrom)
+			if (next_chrom_sort_key, next_start_0based) >= read_until:
+				break
+			if next_chrom_sort_key != chrom_sort_key or (source.join == "overlap" and next_end <= start_0based) or (
+					source.join == "exact" and next_start_0based < start_0based):
+				# this row is on an earlier chromosome or ends before this record, so it can't match any record
+				self._discard(source, source.next_row)
+			else:
+				source.window.append((source.next_interval, source.next_row))
+				if source.min_window_end is None or next_end < source.min_window_end:
+					source.min_window_end = next_end
+			self._read_next_row(source)
+
+		if source.join == "overlap":
+			return [row for (_, row_start_0based, row_end), row in source.window if row_start_0based < end and row_end > start_0based]
+
+		return [row for (_, row_start_0based, row_end), row in source.window if row_start_0based == start_0based and row_end == end and (
+			source.get_key is None or source.get_key(row) == key)]
+
+	def _read_next_row(self, source):
+		source.next_row = next(source.rows, None)
+		if source.next_row is None:
+			source.next_interval = None
+			return
+
+		source.next_interval = source.get_interval(source.next_row)
+		chrom, start_0based, end = source.next_interval
+		sort_key = (self.chrom_sort_key(chrom), start_0based)
+		if source.previous_sort_key is not None and sort_key < source.previous_sort_key:
+			raise ValueError(f"{source.name} isn't sorted: {chrom}:{start_0based}-{end} is after a row that starts later")
+		source.previous_sort_key = sort_key
+
+	def _evict(self, source, should_evict):
+		"""Remove the rows for which should_evict(interval) is True from the window"""
+		window = []
+		for interval, row in source.window:
+			if should_evict(interval):
+				self._discard(source, row)
+			else:
+				window.append((interval, row))
+		source.window = window
+		source.min_window_end = min((interval[2] for interval, _ in window), default=None)
+
+	def _discard(self, source, row):
+		if source.on_discard is not None:
+			source.on_discard(row)
+
+
+def merge_join(records, get_record_interval, sources, chrom_sort_key=natural_chrom_sort_key, get_record_key=None):
+	"""Yields (record, matches) tuples for each record, where matches is the list returned by MergeJoin.match. All rows
+	are discarded at the end, so each source's on_discard callback is called for every row.
+
+	Args:
+		records (iterable): catalog records, sorted by chromosome and start coordinate
+		get_record_interval (function): takes a record and returns its (chrom, start_0based, end) tuple
+		sources (list): MergeJoinSource objects
+		chrom_sort_key (function): the chromosome order of the records and sources (see CHROM_ORDERS)
+		get_record_key (function): optionally takes a record and returns its key for exact joins that use get_key
+	"""
+	join = MergeJoin(sources, chrom_sort_key=chrom_sort_key)
+	for record in records:
+		chrom, start_0based, end = get_record_interval(record)
+		yield record, join.match(chrom, start_0based, end, key=get_record_key(record) if get_record_key else None)
+	join.close()
@@ -0,0 +1,298 @@
+"""Optional profiling for the scripts in this directory.
+
+Scripts that add the --profile options (see add_profiling_arguments) and call their main() through run_main(main)
+can be profiled without any other changes:
+
+	--profile                  print the wall time, CPU time and peak traced memory of each phase of the script,
+	                           along with the functions that took the most time
+	--profile-output PREFIX    also write the phase timings to {PREFIX}.phases.tsv, the largest memory allocations at
+	                           the end of each phase to {PREFIX}.memory.txt, and either cProfile stats to
+	                           {PREFIX}.pstats or sampled call stacks to {PREFIX}.collapsed.txt (see --profile-format)
+
+Phases are marked in the code with `with profile_phase("...")` or iterate_in_phase(...), and do nothing
+unless a profiler is running. A phase that's entered more than once (for example, once per batch of records)
+accumulates its times across all calls. Nested phases are reported as "outer/inner".
+
+The collapsed stacks file has one line per unique call stack followed by the number of samples, which is the input
+format of flamegraph.pl and speedscope. Memory is measured with tracemalloc, which slows down allocation-heavy code,
+so the phase times are most useful relative to each other. Only the main process is profiled: records that are
+annotated in worker processes (--threads > 1) show up as time spent waiting for the workers.
+
+Scripts that don't have a main() function can be profiled by running them through this module:
+
+	python3 profiling.py --profile-output profile convert_hipstr_catalog_to_regular_bed_file.py hipstr.bed
+"""
+
+import argparse
+import cProfile
+import collections
+import contextlib
+import io
+import os
+import pstats
+import runpy
+import signal
+import sys
+import time
+import tracemalloc
+
+PROFILE_FORMATS = ("pstats", "collapsed")
+STACK_SAMPLING_INTERVAL_SECONDS = 0.005
+NUM_TOP_FUNCTIONS_TO_PRINT = 25
+NUM_TOP_ALLOCATIONS_TO_WRITE = 10
+
+_active_profiler = None
+
+
+class Profiler:
+	"""Measures the phases of a script, and optionally records a cProfile profile or sampled call stacks"""
+
+	def __init__(self, output_prefix=None, profile_format="pstats", trace_memory=True):
+		"""Args:
+			output_prefix (str): if specified, write the profiling results to files with this prefix
+			profile_format (str): "pstats" to record a cProfile profile, or "collapsed" to sample call stacks
+			trace_memory (bool): measure the peak memory allocated during each phase using tracemalloc
+		"""
+		if profile_format not in PROFILE_FORMATS:
+			raise ValueError(f"Invalid profile format: {profile_format}. Options: {', '.join(PROFILE_FORMATS)}")
+
+		self.output_prefix = output_prefix
+		self.profile_format = profile_format
+		self.trace_memory = trace_memory
+		self.phase_stats = collections.OrderedDict()
+		self.memory_snapshots = collections.OrderedDict()
+		self.stack_counts = collections.Counter()
+		self._phase_stack = []
+		self._cprofile = None
+		self._start_time = None
+		self._start_cpu_time = None
+		self.total_wall_seconds = 0
+		self.total_cpu_seconds = 0
+		self.total_peak_traced_bytes = 0
+
+	def start(self):
+		global _active_profiler
+		_active_profiler = self
+		if self.trace_memory:
+			tracemalloc.start()
+		if self.profile_format == "pstats":
+			self._cprofile = cProfile.Profile()
+			self._cprofile.enable()
+		else:
+			signal.signal(signal.SIGPROF, self._sample_stack)
+			signal.setitimer(signal.ITIMER_PROF, STACK_SAMPLING_INTERVAL_SECONDS, STACK_SAMPLING_INTERVAL_SECONDS)
+		self._start_time = time.perf_counter()
+		self._start_cpu_time = time.process_time()
+
+	def stop(self):
+		global _active_profiler
+		self.total_wall_seconds = time.perf_counter() - self._start_time
+		self.total_cpu_seconds = time.process_time() - self._start_cpu_time
+		if self._cprofile is not None:
+			self._cprofile.disable()
+		else:
+			signal.setitimer(signal.ITIMER_PROF, 0)
+			signal.signal(signal.SIGPROF, signal.SIG_DFL)
+		if self.trace_memory:
+			self._update_peak_traced_memory()
+			tracemalloc.stop()
+		_active_profiler = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Context manager that adds the wall time, CPU time and peak traced memory of the code it wraps to the stats
+		for the given phase"""
+		if self._phase_stack:
+			name = f"{self._phase_stack[-1]['name']}/{name}"
+
+		self._update_peak_traced_memory()
+		entry = {"name": name, "peak_traced_bytes": 0}
+		if self.trace_memory:
+			entry["start_traced_bytes"] = tracemalloc.get_traced_memory()[0]
+			tracemalloc.reset_peak()
+		self._phase_stack.append(entry)
+		start_time = time.perf_counter()
+		start_cpu_time = time.process_time()
+		try:
+			yield
+		finally:
+			wall_seconds = time.perf_counter() - start_time
+			cpu_seconds = time.process_time() - start_cpu_time
+			self._update_peak_traced_memory()
+			self._phase_stack.pop()
+
+			stats = self.phase_stats.setdefault(name, collections.Counter())
+			stats["calls"] += 1
+			stats["wall_seconds"] += wall_seconds
+			stats["cpu_seconds"] += cpu_seconds
+			if self.trace_memory:
+				stats["peak_traced_bytes"] = max(stats["peak_traced_bytes"], entry["peak_traced_bytes"])
+				stats["allocated_bytes"] += tracemalloc.get_traced_memory()[0] - entry["start_traced_bytes"]
+				if self.output_prefix and name not in self.memory_snapshots:
+					self.memory_snapshots[name] = tracemalloc.take_snapshot()
+
+	def _update_peak_traced_memory(self):
+		"""tracemalloc only keeps one peak, so it's copied to all open phases (and the total) before it's reset by the
+		next phase"""
+		if not self.trace_memory:
+			return
+		peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+		self.total_peak_traced_bytes = max(self.total_peak_traced_bytes, peak_traced_bytes)
+		for entry in self._phase_stack:
+			entry["peak_traced_bytes"] = max(entry["peak_traced_bytes"], peak_traced_bytes)
+
+	def _sample_stack(self, signal_number, frame):
+		stack = []
+		while frame is not None:
+			code = frame.f_code
+			stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+			frame = frame.f_back
+		self.stack_counts[";".join(reversed(stack))] += 1
+
+	def print_summary(self):
+		rows = [(name, stats["calls"], stats["wall_seconds"], stats["cpu_seconds"], stats["peak_traced_bytes"])
+				for name, stats in self.phase_stats.items()]
+		rows.append(("total", 1, self.total_wall_seconds, self.total_cpu_seconds,
+					 self.total_peak_traced_bytes))
+
+		print(f"Profile: {'phase':40s} {'calls':>10s} {'wall time':>10s} {'CPU time':>10s} {'peak traced memory':>20s}")
+		for name, calls, wall_seconds, cpu_seconds, peak_traced_bytes in rows:
+			peak_traced_memory = f"{peak_traced_bytes/2**20:,.1f} MB" if self.trace_memory else ""
+			print(f"Profile: {name:40s} {calls:10,d} {wall_seconds:9.2f}s {cpu_seconds:9.2f}s {peak_traced_memory:>20s}")
+
+		if self._cprofile is not None:
+			output = io.StringIO()
+			pstats.Stats(self._cprofile, stream=output).sort_stats("cumulative").print_stats(NUM_TOP_FUNCTIONS_TO_PRINT)
+			print(output.getvalue())
+		elif self.stack_counts:
+			total_samples = sum(self.stack_counts.values())
+			function_counts = collections.Counter()
+			for stack, count in self.stack_counts.items():
+				function_counts[stack.rsplit(";", 1)[-1]] += count
+			print(f"Profile: functions that were running in the most samples (out of {total_samples:,d}):")
+			for function, count in function_counts.most_common(NUM_TOP_FUNCTIONS_TO_PRINT):
+				print(f"Profile: {count/total_samples:6.1%}  {function}")
+
+	def write_outputs(self):
+		"""Write the profiling results to files that start with output_prefix"""
+		output_dir = os.path.dirname(self.output_prefix)
+		if output_dir:
+			os.makedirs(output_dir, exist_ok=True)
+
+		output_paths = [f"{self.output_prefix}.phases.tsv"]
+		with open(output_paths[-1], "wt") as f:
+			f.write("\t".join(["phase", "calls", "wall_seconds", "cpu_seconds", "peak_traced_mb", "allocated_mb"]) + "\n")
+			for name, stats in list(self.phase_stats.items()) + [("total", {
+					"calls": 1, "wall_seconds": self.total_wall_seconds, "cpu_seconds": self.total_cpu_seconds,
+					"peak_traced_bytes": self.total_peak_traced_bytes, "allocated_bytes": 0})]:
+				f.write("\t".join([
+					name, str(stats["calls"]), f"{stats['wall_seconds']:.3f}", f"{stats['cpu_seconds']:.3f}",
+					f"{stats['peak_traced_bytes']/2**20:.1f}" if self.trace_memory else "",
+					f"{stats['allocated_bytes']/2**20:.1f}" if self.trace_memory and name != "total" else "",
+				]) + "\n")
+
+		if self.memory_snapshots:
+			output_paths.append(f"{self.output_prefix}.memory.txt")
+			with open(output_paths[-1], "wt") as f:
+				for name, snapshot in self.memory_snapshots.items():
+					f.write(f"Largest allocations that were still held at the end of phase '{name}':\n")
+					for statistic in snapshot.statistics("lineno")[:NUM_TOP_ALLOCATIONS_TO_WRITE]:
+						f.write(f"    {statistic}\n")
+					f.write("\n")
+
+		if self._cprofile is not None:
+			output_paths.append(f"{self.output_prefix}.pstats")
+			self._cprofile.dump_stats(output_paths[-1])
+		else:
+			output_paths.append(f"{self.output_prefix}.collapsed.txt")
+			with open(output_paths[-1], "wt") as f:
+				for stack, count in sorted(self.stack_counts.items()):
+					f.write(f"{stack} {count}\n")
+
+		print(f"Wrote profiling results to {', '.join(output_paths)}")
+
+
+def profile_phase(name):
+	"""Returns a context manager that measures the code it wraps as part of the given phase if a profiler is running,
+	and does nothing otherwise"""
+	if _active_profiler is None:
+		return contextlib.nullcontext()
+	return _active_profiler.phase(name)
+
+
+def iterate_in_phase(iterator, name):
+	"""Yields the items of the iterator, counting the time spent generating them as part of the given phase. Since this
+	adds overhead to every item, it should be used for iterators over batches rather than individual records."""
+	if _active_profiler is None:
+		yield from iterator
+		return
+
+	iterator = iter(iterator)
+	while True:
+		with _active_profiler.phase(name):
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+		yield item
+
+
+def add_profiling_arguments(parser):
+	parser.add_argument("--profile", action="store_true", help="Print the time and memory used by each phase of this "
+						"script, along with the functions that took the most time")
+	parser.add_argument("--profile-output", help="Output prefix for writing the profiling results to files. Implies "
+						"--profile")
+	parser.add_argument("--profile-format", choices=PROFILE_FORMATS, default="pstats", help="Record a cProfile profile "
+						"(pstats), or sample call stacks for a flame graph (collapsed)")
+
+
+def run_main(main):
+	"""Call main(), with profiling if the --profile or --profile-output options are on the command line"""
+	parser = argparse.ArgumentParser(add_help=False)
+	add_profiling_arguments(parser)
+	args, _ = parser.parse_known_args()
+	if not args.profile and not args.profile_output:
+		return main()
+
+	profiler = Profiler(output_prefix=args.profile_output, profile_format=args.profile_format)
+	try:
+		with profiler:
+			return main()
+	finally:
+		profiler.print_summary()
+		if args.profile_output:
+			profiler.write_outputs()
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+	add_profiling_arguments(parser)
+	parser.add_argument("script_path", help="Path of the python script to profile")
+	parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments to pass to the script")
+	args = parser.parse_args()
+
+	if not os.path.isfile(args.script_path):
+		parser.error(f"File not found: {args.script_path}")
+
+	# run the script as if it had been run directly, with its own directory on the module search path
+	sys.argv = [args.script_path] + args.script_args
+	sys.path.insert(0, os.path.dirname(os.path.abspath(args.script_path)))
+	profiler = Profiler(output_prefix=args.profile_output, profile_format=args.profile_format)
+	try:
+		with profiler:
+			runpy.run_path(args.script_path, run_name="__main__")
+	finally:
+		profiler.print_summary()
+		if args.profile_output:
+			profiler.write_outputs()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,479 @@
+"""This script looks up the annotated catalog records that overlap genomic regions, either from the command line or
+through a lightweight HTTP server, without scanning the whole catalog.
+
+Regions are looked up in the catalog's BED file using its existing tabix index ({bed}.gz.tbi). Each BED row is then
+mapped to the full annotated record through a sidecar offset index ({catalog}.offsets.npy) that stores, for the
+position key (see locus_key.py) of each ReferenceRegion, the BGZF virtual offset and length of the record's JSON text
+in the catalog. The size and sha256 of the indexed catalog are saved in {catalog}.offsets.json, so that an index is
+never used with a different version of the catalog. Both files are read through BgzfRandomAccessReader, which keeps recently decompressed blocks in an LRU
+cache, so a query only decompresses the few blocks that contain the matching records.
+
+Subcommands:
+	index    build the sidecar offset index for a BGZF-compressed JSON catalog
+	query    print the records that overlap one or more regions
+	serve    answer queries over HTTP, for example: GET /query?region=chr4:3074877-3074968&region=chrX:147912050
+			 or POST /query with a JSON body like {"regions": ["chr4:3074877-3074968", "chrX"]}
+
+Regions can be given as "chr1:1000-2000" (1-based, inclusive coordinates, like tabix and samtools), "chr1:1000", or
+just "chr1".
+"""
+
+import argparse
+import array
+import bisect
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+from str_analysis.utils.misc_utils import parse_interval
+
+from annotation_source_cache import DEFAULT_ANNOTATION_CACHE_DIR, get_source_checksum
+from bgzf_io import DEFAULT_MAX_CACHED_BLOCKS, BgzfRandomAccessReader, TabixIndex, is_bgzf_file, open_file
+from catalog_io import (
+	RAW_JSON_SEPARATOR_REGEX, find_raw_json_object_end, get_raw_json_record_reference_regions,
+)
+from locus_key import MAX_COORDINATE, encode_positions
+from profiling import add_profiling_arguments, profile_phase, run_main
+
+OFFSET_INDEX_SUFFIX = ".offsets.npy"
+OFFSET_INDEX_MANIFEST_SUFFIX = ".offsets.json"
+OFFSET_INDEX_DTYPE = np.dtype([("key", np.uint64), ("virtual_offset", np.uint64), ("length", np.uint32)])
+
+# number of ReferenceRegions to convert to position keys at a time while building the offset index
+KEY_BATCH_SIZE = 100_000
+
+REGION_REGEX = re.compile(r"([^:\s]+)(?::([0-9]+)(?:-([0-9]+))?)?")
+
+
+def get_offset_index_path(catalog_path):
+	return f"{catalog_path}{OFFSET_INDEX_SUFFIX}"
+
+
+def get_offset_index_manifest_path(catalog_path):
+	return f"{catalog_path}{OFFSET_INDEX_MANIFEST_SUFFIX}"
+
+
+def iterate_raw_json_records_with_offsets(catalog_path):
+	"""Yields a (virtual_offset, length, raw_record) tuple for each record in a BGZF-compressed JSON catalog, where
+	length is the number of bytes of the record's JSON text.
+
+	This works like catalog_io.iterate_raw_json_records, but reads the catalog one BGZF block at a time so that the
+	virtual offset of each record is known. Blocks are decoded as latin-1 so that positions in the text are byte offsets.
+	"""
+	if not is_bgzf_file(catalog_path):
+		raise ValueError(f"{catalog_path} is not BGZF-compressed. Recompress it with 'bgzip' to index it.")
+
+	with BgzfRandomAccessReader(catalog_path, max_cached_blocks=1) as reader:
+		block_offsets = []  # compressed offset of each block read so far
+		block_starts = []   # decompressed offset at which each of these blocks starts
+		next_block_offset = 0
+		buffer = ""
+		buffer_start = 0    # decompressed offset of buffer[0]
+		position = 0
+
+		def read_next_block():
+			nonlocal next_block_offset, buffer, buffer_start, position
+			while True:
+				block_offset = next_block_offset
+				data, next_block_offset = reader.read_block(block_offset)
+				if next_block_offset == block_offset:
+					return False
+				if data:
+					break  # skip empty blocks, such as the EOF marker block
+
+			block_offsets.append(block_offset)
+			block_starts.append(buffer_start + len(buffer))
+			buffer_start += position
+			buffer = buffer[position:] + data.decode("latin-1")
+			position = 0
+			return True
+
+		while True:
+			# skip the opening bracket and the separators between records
+			position = RAW_JSON_SEPARATOR_REGEX.match(buffer, position).end()
+			if position == len(buffer):
+				if not read_next_block():
+					raise ValueError(f"{catalog_path} ended before the closing ']' of the list of records")
+				continue
+
+			if buffer[position] == "]":
+				return
+			if buffer[position] != "{":
+				raise ValueError(f"Unexpected character in {catalog_path}: {buffer[position:position+50]!r}")
+
+			end = find_raw_json_object_end(buffer, position)
+			while end is None:
+				if not read_next_block():
+					raise ValueError(f"{catalog_path} ended in the middle of a record: {buffer[position:position+200]!r}")
+				end = find_raw_json_object_end(buffer, position)
+
+			record_start = buffer_start + position
+			i = bisect.bisect_right(block_starts, record_start) - 1
+			virtual_offset = (block_offsets[i] << 16) | (record_start - block_starts[i])
+			yield virtual_offset, end - position, buffer[position:end]
+			position = end
+
+
+def build_offset_index(catalog_path):
+	"""Returns an OFFSET_INDEX_DTYPE array, sorted by key, with a row for each ReferenceRegion of each record"""
+	keys = array.array("Q")
+	virtual_offsets = array.array("Q")
+	lengths = array.array("I")
+	intervals = []
+
+	def add_keys():
+		chroms, starts_0based, ends = zip(*intervals)
+		keys.frombytes(encode_positions(chroms, starts_0based, ends).tobytes())
+		intervals.clear()
+
+	for virtual_offset, length, raw_record in iterate_raw_json_records_with_offsets(catalog_path):
+		for reference_region in get_raw_json_record_reference_regions(raw_record):
+			intervals.append(parse_interval(reference_region))
+			virtual_offsets.append(virtual_offset)
+			lengths.append(length)
+		if len(intervals) >= KEY_BATCH_SIZE:
+			add_keys()
+	if intervals:
+		add_keys()
+
+	offset_index = np.empty(len(keys), dtype=OFFSET_INDEX_DTYPE)
+	offset_index["key"] = np.frombuffer(keys, dtype=np.uint64)
+	offset_index["virtual_offset"] = np.frombuffer(virtual_offsets, dtype=np.uint64)
+	offset_index["length"] = np.frombuffer(lengths, dtype=np.uint32)
+	return offset_index[np.argsort(offset_index["key"], kind="stable")]
+
+
+def get_catalog_checksum(catalog_path, checksum_cache_dir=None):
+	"""Returns the sha256 of the catalog, which is cached in checksum_cache_dir until the catalog changes"""
+	checksum_cache_dir = os.path.abspath(checksum_cache_dir or DEFAULT_ANNOTATION_CACHE_DIR)
+	os.makedirs(checksum_cache_dir, exist_ok=True)
+	return get_source_checksum(catalog_path, checksum_cache_dir)
+
+
+def load_offset_index(catalog_path, checksum_cache_dir=None):
+	"""Returns the memory-mapped offset index of the given catalog, after checking that it was built from a catalog with
+	the same size and sha256. File modification times aren't compared, since downloaded or copied release files can
+	have any modification time.
+
+	Args:
+		catalog_path (str): path of the catalog
+		checksum_cache_dir (str): directory where the catalog's sha256 is cached (see get_catalog_checksum)
+	"""
+	offset_index_path = get_offset_index_path(catalog_path)
+	manifest_path = get_offset_index_manifest_path(catalog_path)
+	rerun_message = f"Run '{os.path.basename(__file__)} index {catalog_path}' to update it."
+	for path in offset_index_path, manifest_path:
+		if not os.path.isfile(path):
+			raise ValueError(f"{path} not found. {rerun_message}")
+
+	with open(manifest_path, "rt") as f:
+		manifest = json.load(f)
+	if manifest["catalog_size"] != os.path.getsize(catalog_path) or \
+			manifest["catalog_sha256"] != get_catalog_checksum(catalog_path, checksum_cache_dir):
+		raise ValueError(f"{offset_index_path} was built for a different version of {catalog_path}. {rerun_message}")
+
+	return np.load(offset_index_path, mmap_mode="r")
+
+
+def parse_region(region):
+	"""Parse a region like "chr1:1000-2000" (1-based, inclusive coordinates), "chr1:1000" or "chr1" into a
+	(chrom, start_0based, end_1based) tuple"""
+	match = REGION_REGEX.fullmatch(region.strip().replace(",", ""))
+	if not match:
+		raise ValueError(f"Invalid region: '{region}'. Expected a region like chr1:1000-2000")
+
+	chrom, start_1based, end_1based = match.groups()
+	if start_1based is None:
+		return chrom, 0, MAX_COORDINATE
+	start_0based = int(start_1based) - 1
+	end_1based = int(end_1based) if end_1based is not None else start_0based + 1
+	if start_0based < 0 or end_1based <= start_0based:
+		raise ValueError(f"Invalid region: '{region}'. The end coordinate must be >= the start coordinate, which must be >= 1")
+	return chrom, start_0based, end_1based
+
+
+class CatalogRegionQuery:
+	"""Finds the records of an annotated catalog that overlap genomic regions, using the catalog's tabix-indexed BED
+	file and the offset index written by the index subcommand. Not thread-safe."""
+
+	def __init__(self, bed_path, catalog_path, max_cached_blocks=DEFAULT_MAX_CACHED_BLOCKS, checksum_cache_dir=None):
+		self.offset_index = load_offset_index(catalog_path, checksum_cache_dir=checksum_cache_dir)
+		self.tabix_index = TabixIndex(f"{bed_path}.tbi")
+		self.bed_reader = BgzfRandomAccessReader(bed_path, max_cached_blocks)
+		self.catalog_reader = BgzfRandomAccessReader(catalog_path, max_cached_blocks)
+		self._keys = self.offset_index["key"]
+		self._bed_chroms = set(self.tabix_index.chrom_names)
+
+	def get_bed_chrom(self, chrom):
+		"""Returns the name of the given chromosome in the BED file, with or without the "chr" prefix, or None if the
+		BED file doesn't have it"""
+		for name in (chrom, chrom[3:] if chrom.startswith("chr") else f"chr{chrom}"):
+			if name in self._bed_chroms:
+				return name
+		return None
+
+	def query(self, chrom, start_0based, end_1based):
+		"""Returns the JSON text of each record that overlaps the given interval, in catalog order"""
+		return self.query_batch([(chrom, start_0based, end_1based)])[0]
+
+	def query_batch(self, regions):
+		"""Looks up many regions at once.
+
+		Args:
+			regions (list): (chrom, start_0based, end_1based) tuples
+
+		Return:
+			list: for each region, a list with the JSON text of each record that overlaps it, in catalog order
+		"""
+		bed_intervals_by_region = []
+		for chrom, start_0based, end_1based in regions:
+			bed_chrom = self.get_bed_chrom(chrom)
+			bed_intervals = []
+			if bed_chrom is not None:
+				for line in self.tabix_index.fetch(self.bed_reader, bed_chrom, start_0based, end_1based):
+					fields = line.split("\t", 3)
+					bed_intervals.append((fields[0], int(fields[1]), int(fields[2])))
+			bed_intervals_by_region.append(bed_intervals)
+
+		all_bed_intervals = [interval for bed_intervals in bed_intervals_by_region for interval in bed_intervals]
+		if not all_bed_intervals:
+			return [[] for _ in regions]
+
+		# look up all intervals at once. Each key can match more than one row, for example if a record has several
+		# ReferenceRegions or if two intervals on non-main chromosomes have the same key.
+		keys = encode_positions(*zip(*all_bed_intervals))
+		first_rows = np.searchsorted(self._keys, keys, side="left").tolist()
+		last_rows = np.searchsorted(self._keys, keys, side="right").tolist()
+
+		records_by_offset = {}
+		results = []
+		i = 0
+		for bed_intervals in bed_intervals_by_region:
+			records = {}
+			for chrom, start_0based, end_1based in bed_intervals:
+				for row in self.offset_index[first_rows[i]:last_rows[i]].tolist():
+					_, virtual_offset, length = row
+					record = records_by_offset.get(virtual_offset)
+					if record is None:
+						record = self.catalog_reader.read(virtual_offset, length).decode()
+						records_by_offset[virtual_offset] = record
+					# make sure the record has this ReferenceRegion and didn't just match its key
+					if f'"{chrom}:{start_0based}-{end_1based}"' in record:
+						records[virtual_offset] = record
+				i += 1
+			results.append([records[virtual_offset] for virtual_offset in sorted(records)])
+
+		return results
+
+
+def index_catalog(args):
+	start_time = time.time()
+	with profile_phase("build offset index"):
+		offset_index = build_offset_index(args.catalog_json_path)
+
+	with profile_phase("compute catalog checksum"):
+		catalog_sha256 = get_catalog_checksum(args.catalog_json_path, args.checksum_cache_dir)
+
+	offset_index_path = get_offset_index_path(args.catalog_json_path)
+	manifest_path = get_offset_index_manifest_path(args.catalog_json_path)
+	with profile_phase("write offset index"):
+		temp_path = f"{offset_index_path}.{os.getpid()}.tmp.npy"
+		np.save(temp_path, offset_index, allow_pickle=False)
+		os.replace(temp_path, offset_index_path)
+
+		# the manifest is written last, so that a partially written index is never used
+		with open(f"{manifest_path}.tmp", "wt") as f:
+			json.dump({
+				"catalog": os.path.basename(args.catalog_json_path),
+				"catalog_size": os.path.getsize(args.catalog_json_path),
+				"catalog_sha256": catalog_sha256,
+				"num_rows": len(offset_index),
+			}, f, indent=4)
+		os.replace(f"{manifest_path}.tmp", manifest_path)
+
+	print(f"Wrote {len(offset_index):,d} ReferenceRegion offsets to {offset_index_path} in {time.time() - start_time:.1f}s")
+
+
+def read_regions(args):
+	"""Returns a list of (region_name, (chrom, start_0based, end_1based)) tuples for the regions given on the command
+	line"""
+	regions = [(region, parse_region(region)) for region in args.regions]
+	if args.regions_bed:
+		with open_file(args.regions_bed, "rt") as f:
+			for line in f:
+				if not line.strip() or line.startswith(("#", "track", "browser")):
+					continue
+				fields = line.rstrip("\n").split("\t")
+				chrom, start_0based, end_1based = fields[0], int(fields[1]), int(fields[2])
+				regions.append((f"{chrom}:{start_0based + 1}-{end_1based}", (chrom, start_0based, end_1based)))
+	return regions
+
+
+def query_catalog(args):
+	regions = read_regions(args)
+	catalog_query = CatalogRegionQuery(args.bed, args.catalog, max_cached_blocks=args.max_cached_blocks,
+		checksum_cache_dir=args.checksum_cache_dir)
+
+	start_time = time.time()
+	with profile_phase("query regions"):
+		results = catalog_query.query_batch([region for _, region in regions])
+
+	# records that overlap more than one region are only written once
+	records = {}
+	for region_records in results:
+		for record in region_records:
+			records[record] = None
+	elapsed_ms = (time.time() - start_time) * 1000
+
+	with profile_phase("write records"):
+		output_file = open_file(args.output_path, "wt") if args.output_path else sys.stdout
+		output_file.write("[" + ", ".join(records) + "]\n")
+		if args.output_path:
+			output_file.close()
+
+	print(f"Found {len(records):,d} records that overlap {len(regions):,d} region(s) in {elapsed_ms:.1f}ms"
+		  + (f" and wrote them to {args.output_path}" if args.output_path else ""), file=sys.stderr)
+
+
+class RegionQueryHandler(http.server.BaseHTTPRequestHandler):
+	"""Answers GET /query?region=... and POST /query requests with a JSON object that maps each region to the list of
+	records that overlap it"""
+
+	def do_GET(self):
+		url = urllib.parse.urlparse(self.path)
+		if url.path != "/query":
+			self.send_json(404, json.dumps({"error": f"Unknown path: {url.path}. Use /query"}))
+			return
+		self.answer_query(urllib.parse.parse_qs(url.query).get("region", []))
+
+	def do_POST(self):
+		url = urllib.parse.urlparse(self.path)
+		if url.path != "/query":
+			self.send_json(404, json.dumps({"error": f"Unknown path: {url.path}. Use /query"}))
+			return
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+			regions = body.get("regions") if isinstance(body, dict) else None
+			if not isinstance(regions, list) or not all(isinstance(region, str) for region in regions):
+				raise ValueError('Expected a JSON body like {"regions": ["chr1:1000-2000", ...]}')
+		except ValueError as e:
+			self.send_json(400, json.dumps({"error": str(e)}))
+			return
+		self.answer_query(regions)
+
+	def answer_query(self, regions):
+		if not regions:
+			self.send_json(400, json.dumps({"error": "No regions specified"}))
+			return
+		try:
+			parsed_regions = [parse_region(region) for region in regions]
+		except ValueError as e:
+			self.send_json(400, json.dumps({"error": str(e)}))
+			return
+
+		with self.server.query_lock:
+			results = self.server.catalog_query.query_batch(parsed_regions)
+
+		# the records are already JSON, so they're written as-is instead of being parsed and serialized again
+		self.send_json(200, "{" + ", ".join(
+			f"{json.dumps(region)}: [{', '.join(records)}]" for region, records in zip(regions, results)
+		) + "}")
+
+	def send_json(self, status, body):
+		body = body.encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def create_server(catalog_query, host, port):
+	"""Returns an HTTP server that answers region queries using the given CatalogRegionQuery"""
+	server = http.server.ThreadingHTTPServer((host, port), RegionQueryHandler)
+	server.catalog_query = catalog_query
+	server.query_lock = threading.Lock()
+	return server
+
+
+def serve(args):
+	catalog_query = CatalogRegionQuery(args.bed, args.catalog, max_cached_blocks=args.max_cached_blocks,
+		checksum_cache_dir=args.checksum_cache_dir)
+	server = create_server(catalog_query, args.host, args.port)
+	print(f"Serving region queries for {args.catalog} at http://{args.host}:{server.server_port}/query")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	index_parser = subparsers.add_parser("index", help="Build the offset index of a BGZF-compressed JSON catalog")
+	index_parser.add_argument("catalog_json_path", help="Path of the annotated JSON catalog. The offset index is "
+							  f"written to {{catalog_json_path}}{OFFSET_INDEX_SUFFIX} and "
+							  f"{{catalog_json_path}}{OFFSET_INDEX_MANIFEST_SUFFIX}")
+
+	query_parser = subparsers.add_parser("query", help="Print the records that overlap the given regions as a JSON list")
+	serve_parser = subparsers.add_parser("serve", help="Answer region queries over HTTP")
+	for subparser in query_parser, serve_parser:
+		subparser.add_argument("--bed", required=True, help="Path of the catalog's bgzipped BED file. Its tabix index "
+							   "must be next to it.")
+		subparser.add_argument("--catalog", required=True, help="Path of the annotated JSON catalog, indexed with the "
+							   "index subcommand")
+		subparser.add_argument("--max-cached-blocks", type=int, default=DEFAULT_MAX_CACHED_BLOCKS, help="Number of "
+							   "decompressed BGZF blocks of each file to keep in memory")
+	for subparser in index_parser, query_parser, serve_parser:
+		subparser.add_argument("--checksum-cache-dir", default=DEFAULT_ANNOTATION_CACHE_DIR, help="Directory for "
+							   "caching the sha256 of the catalog, so that it's only computed again if the catalog changes")
+
+	query_parser.add_argument("--regions-bed", help="BED file of additional regions to look up")
+	query_parser.add_argument("-o", "--output-path", help="Path of the output JSON file. Defaults to stdout.")
+	query_parser.add_argument("regions", nargs="*", help="Regions like chr1:1000-2000 (1-based, inclusive), chr1:1000 "
+							  "or chr1")
+
+	serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+	serve_parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if args.command == "index":
+		if not os.path.isfile(args.catalog_json_path):
+			parser.error(f"File not found: {args.catalog_json_path}")
+		try:
+			index_catalog(args)
+		except ValueError as e:
+			parser.error(str(e))
+		return
+
+	for path in args.bed, f"{args.bed}.tbi", args.catalog:
+		if not os.path.isfile(path):
+			parser.error(f"File not found: {path}")
+
+	if args.command == "query":
+		if not args.regions and not args.regions_bed:
+			parser.error("Specify at least one region or --regions-bed")
+		try:
+			query_catalog(args)
+		except ValueError as e:
+			parser.error(str(e))
+	elif args.command == "serve":
+		try:
+			serve(args)
+		except ValueError as e:
+			parser.error(str(e))
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,156 @@
+"""This script splits a JSON catalog into coordinate-range shards that contain similar numbers of loci, and concatenates
+shards back together after they've been processed.
+
+Shard boundaries are only placed between chromosomes or in gaps between loci that are at least --min-gap-between-shards
+wide, so that loci that overlap or are adjacent to each other always end up in the same shard. Shards are numbered in
+coordinate order (with chromosomes in the order in which they first appear in the input catalog), so concatenating the
+outputs of per-shard steps in shard order produces a catalog that is sorted the same way.
+"""
+
+import argparse
+import bisect
+import collections
+import json
+import os
+
+from str_analysis.utils.misc_utils import parse_interval
+
+from catalog_io import CatalogWriter, iterate_catalog_records, iterate_raw_json_records
+from profiling import add_profiling_arguments, profile_phase, run_main
+
+
+def parse_reference_region(reference_region):
+	"""Returns the chromosome, start, and end of a ReferenceRegion, which may be a list of adjacent regions"""
+	if isinstance(reference_region, list):
+		chrom, start_0based, _ = parse_interval(reference_region[0])
+		_, _, end_1based = parse_interval(reference_region[-1])
+	else:
+		chrom, start_0based, end_1based = parse_interval(reference_region)
+	return chrom, start_0based, end_1based
+
+
+def compute_shard_boundaries(intervals_by_chrom, num_shards, min_gap_between_shards):
+	"""Choose shard boundaries so that each shard contains approximately the same number of loci.
+
+	Args:
+		intervals_by_chrom (dict): maps each chromosome to a list of (start_0based, end_1based) tuples. Chromosomes are
+			processed in the order of this dictionary's keys.
+		num_shards (int): the desired number of shards
+		min_gap_between_shards (int): only place a shard boundary within a chromosome if the gap between the loci on
+			either side of it is at least this many base pairs.
+
+	Return:
+		list: (chrom_index, start_0based) tuples where each shard after the first begins
+	"""
+	total_loci = sum(len(intervals) for intervals in intervals_by_chrom.values())
+	target_loci_per_shard = max(1, total_loci / max(1, num_shards))
+
+	boundaries = []
+	loci_in_current_shard = 0
+	for chrom_index, intervals in enumerate(intervals_by_chrom.values()):
+		intervals.sort()
+		max_end = None
+		for start_0based, end_1based in intervals:
+			if loci_in_current_shard >= target_loci_per_shard and len(boundaries) < num_shards - 1 and (
+				max_end is None or start_0based - max_end >= min_gap_between_shards
+			):
+				boundaries.append((chrom_index, start_0based))
+				loci_in_current_shard = 0
+
+			loci_in_current_shard += 1
+			max_end = end_1based if max_end is None else max(max_end, end_1based)
+
+	return boundaries
+
+
+def split_catalog(args):
+	"""Split the input catalog into shards and write a manifest that lists them"""
+	# first pass: get the coordinates of all loci
+	with profile_phase("find shard boundaries"):
+		intervals_by_chrom = collections.OrderedDict()
+		for record in iterate_catalog_records(args.catalog_json_path):
+			chrom, start_0based, end_1based = parse_reference_region(record["ReferenceRegion"])
+			intervals_by_chrom.setdefault(chrom, []).append((start_0based, end_1based))
+
+		chrom_indices = {chrom: i for i, chrom in enumerate(intervals_by_chrom)}
+		boundaries = compute_shard_boundaries(intervals_by_chrom, args.num_shards, args.min_gap_between_shards)
+		intervals_by_chrom = None
+
+	# second pass: write each record to its shard
+	shards = []
+	for shard_index in range(len(boundaries) + 1):
+		shard_prefix = f"{args.output_prefix}.shard{shard_index:03d}"
+		shards.append({
+			"prefix": shard_prefix,
+			"path": f"{shard_prefix}.json.gz",
+			"num_loci": 0,
+			"first_region": None,
+			"last_region": None,
+		})
+
+	writers = [CatalogWriter(shard["path"]) for shard in shards]
+	for record in iterate_catalog_records(args.catalog_json_path):
+		chrom, start_0based, _ = parse_reference_region(record["ReferenceRegion"])
+		shard_index = bisect.bisect_right(boundaries, (chrom_indices[chrom], start_0based))
+		writers[shard_index].write(record)
+
+		shard = shards[shard_index]
+		region = record["ReferenceRegion"]
+		shard["num_loci"] += 1
+		shard["first_region"] = shard["first_region"] or (region[0] if isinstance(region, list) else region)
+		shard["last_region"] = region[-1] if isinstance(region, list) else region
+
+	for writer in writers:
+		writer.close()
+
+	with open(args.output_manifest_path or f"{args.output_prefix}.shards.json", "wt") as f:
+		json.dump({"input_catalog": os.path.abspath(args.catalog_json_path), "shards": shards}, f, indent=4)
+
+	for shard in shards:
+		print(f"Wrote {shard['num_loci']:10,d} loci in {shard['first_region']} .. {shard['last_region']} to {shard['path']}")
+
+
+def concatenate_json_catalogs(args):
+	"""Concatenate JSON catalogs (each of which is a list of records) into one list, preserving the order of records.
+	Records are streamed one at a time and copied without being parsed."""
+	with CatalogWriter(args.output_path) as writer:
+		for path in args.input_paths:
+			for raw_record in iterate_raw_json_records(path):
+				writer.write_json_string(raw_record)
+
+	print(f"Concatenated {len(args.input_paths)} catalogs with {writer.record_counter:,d} records into {args.output_path}")
+
+
+def main():
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	split_parser = subparsers.add_parser("split", help="Split a JSON catalog into shards")
+	split_parser.add_argument("--num-shards", type=int, default=os.cpu_count(), help="Maximum number of shards")
+	split_parser.add_argument("--min-gap-between-shards", type=int, default=10_000, help="Only split a chromosome between "
+							  "two loci if the gap between them is at least this many base pairs")
+	split_parser.add_argument("--output-manifest-path", help="Path of the output JSON file that lists the shards. "
+							  "Defaults to {output_prefix}.shards.json")
+	split_parser.add_argument("-o", "--output-prefix", required=True, help="Output prefix for shard files")
+	split_parser.add_argument("catalog_json_path", help="Path of the JSON catalog to split")
+
+	concat_parser = subparsers.add_parser("concat", help="Concatenate JSON catalogs in the given order")
+	concat_parser.add_argument("-o", "--output-path", required=True, help="Path of the output JSON catalog")
+	concat_parser.add_argument("input_paths", nargs="+", help="JSON catalogs to concatenate")
+
+	add_profiling_arguments(parser)
+	args = parser.parse_args()
+
+	if args.command == "split":
+		if not os.path.isfile(args.catalog_json_path):
+			parser.error(f"File not found: {args.catalog_json_path}")
+		split_catalog(args)
+	elif args.command == "concat":
+		for path in args.input_paths:
+			if not os.path.isfile(path):
+				parser.error(f"File not found: {path}")
+		concatenate_json_catalogs(args)
+
+
+if __name__ == "__main__":
+	run_main(main)
@@ -0,0 +1,158 @@
+"""Content-addressed cache of completed pipeline steps.
+
+Each step is identified by a hash of its command, the contents of its input files, and the versions of the code it runs
+(the in-repo scripts and the modules they import from the scripts/ directory, or the installed str-analysis package).
+After a step completes, a manifest is written that maps this hash to the digests of the step's outputs. On subsequent
+runs, a step is skipped if a manifest with the same hash exists and its outputs are unchanged. Since the hash of a step
+includes the digests of its inputs, changing a script causes only the steps that run it, and the steps downstream of
+those, to be rerun.
+"""
+
+import ast
+import hashlib
+import inspect
+import json
+import os
+import re
+import threading
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StepCache:
+
+	def __init__(self, cache_dir):
+		self.cache_dir = os.path.abspath(cache_dir)
+		self.manifests_dir = os.path.join(self.cache_dir, "manifests")
+		os.makedirs(self.manifests_dir, exist_ok=True)
+
+		self._file_digests_path = os.path.join(self.cache_dir, "file_digests.json")
+		self._file_digests = {}
+		if os.path.isfile(self._file_digests_path):
+			with open(self._file_digests_path, "rt") as f:
+				self._file_digests = json.load(f)
+
+		self._lock = threading.Lock()
+
+	def compute_file_digest(self, path):
+		"""Returns the sha256 of the given file. Digests are cached based on the file's size and modification time so
+		that large files like the reference FASTA are only read once."""
+		if not os.path.isfile(path):
+			return None
+
+		stat = os.stat(path)
+		fingerprint = f"{stat.st_size}:{stat.st_mtime_ns}"
+		with self._lock:
+			cached = self._file_digests.get(path)
+			if cached and cached["fingerprint"] == fingerprint:
+				return cached["sha256"]
+
+		sha256 = hashlib.sha256()
+		with open(path, "rb") as f:
+			for chunk in iter(lambda: f.read(2**20), b""):
+				sha256.update(chunk)
+		digest = sha256.hexdigest()
+
+		with self._lock:
+			self._file_digests[path] = {"fingerprint": fingerprint, "sha256": digest}
+			self._save_file_digests()
+
+		return digest
+
+	def compute_step_key(self, step):
+		"""Returns a hash of the step's command, its input file contents, and the versions of the code it runs"""
+		key_fields = {
+			"command": step.command,
+			"inputs": {path: self.compute_file_digest(path) for path in sorted(step.inputs)},
+			"code_versions": get_code_versions(step),
+		}
+		return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+	def get_cached_manifest(self, step):
+		"""Returns the manifest of a previous run of this step if its hash matches and its outputs are unchanged.
+		Otherwise, returns None."""
+		step.cache_key = self.compute_step_key(step)
+		manifest_path = os.path.join(self.manifests_dir, f"{step.cache_key}.json")
+		if not os.path.isfile(manifest_path):
+			return None
+
+		with open(manifest_path, "rt") as f:
+			manifest = json.load(f)
+
+		for path, digest in manifest["outputs"].items():
+			if self.compute_file_digest(path) != digest:
+				return None
+
+		return manifest
+
+	def record(self, step):
+		"""Write a manifest for a step that just completed successfully"""
+		manifest = {
+			"key": step.cache_key,
+			"step_number": step.step_number,
+			"command": step.command,
+			"inputs": {path: self.compute_file_digest(path) for path in step.inputs},
+			"outputs": {path: self.compute_file_digest(path) for path in step.outputs if os.path.isfile(path)},
+			"completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+		}
+		manifest_path = os.path.join(self.manifests_dir, f"{step.cache_key}.json")
+		with open(f"{manifest_path}.tmp", "wt") as f:
+			json.dump(manifest, f, indent=4)
+		os.replace(f"{manifest_path}.tmp", manifest_path)
+
+	def _save_file_digests(self):
+		with open(f"{self._file_digests_path}.tmp", "wt") as f:
+			json.dump(self._file_digests, f, indent=1)
+		os.replace(f"{self._file_digests_path}.tmp", self._file_digests_path)
+
+
+def get_code_versions(step):
+	"""Returns a dictionary that describes the versions of code that a step runs: the source code of the python function
+	for python steps, digests of any scripts from the scripts/ directory that appear in the command (along with the
+	local modules they import), and the installed version of str-analysis if the command uses it."""
+	code_versions = {}
+	if step.function is not None:
+		code_versions["function"] = inspect.getsource(step.function)
+
+	for script_name in re.findall(r"scripts/([A-Za-z0-9_]+\.py)", step.command):
+		for path in sorted(find_local_module_paths(os.path.join(SCRIPTS_DIR, script_name))):
+			with open(path, "rb") as f:
+				code_versions[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+
+	if "str_analysis" in step.command:
+		code_versions["str-analysis"] = get_installed_package_version("str-analysis")
+
+	return code_versions
+
+
+def find_local_module_paths(script_path, found_paths=None):
+	"""Returns the paths of the given script and all modules from the scripts/ directory that it imports directly or
+	indirectly"""
+	found_paths = set() if found_paths is None else found_paths
+	if script_path in found_paths or not os.path.isfile(script_path):
+		return found_paths
+
+	found_paths.add(script_path)
+	with open(script_path, "rt") as f:
+		tree = ast.parse(f.read())
+
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Import):
+			module_names = [alias.name for alias in node.names]
+		elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+			module_names = [node.module]
+		else:
+			continue
+		for module_name in module_names:
+			find_local_module_paths(os.path.join(SCRIPTS_DIR, f"{module_name}.py"), found_paths)
+
+	return found_paths
+
+
+def get_installed_package_version(package_name):
+	from importlib import metadata
+	try:
+		return metadata.version(package_name)
+	except metadata.PackageNotFoundError:
+		return None
@@ -0,0 +1,232 @@
+"""Dependency graph of pipeline steps and a scheduler that runs independent steps in parallel.
+
+Each step declares the files it reads (inputs) and the files it writes (outputs). Dependencies are inferred from these
+declarations in the order that steps are added to the graph: a step waits for the most recent step that wrote any of
+its inputs, and a step that writes a file waits for all earlier steps that read or wrote that file. This means that
+steps which update a file in place (ie. 'mv new_version.json.gz catalog.json.gz') are still ordered correctly relative to
+the steps before and after them.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from step_telemetry import run_function, run_shell_command
+
+
+DEFAULT_STEP_MEMORY_GB = 2
+
+
+class Step:
+	"""A single pipeline step: either a shell command or a python function, along with its inputs and outputs."""
+
+	def __init__(self, command, step_number=None, inputs=(), outputs=(), cpus=1, memory_gb=DEFAULT_STEP_MEMORY_GB,
+				 function=None):
+		"""Args:
+			command (str): shell command to run, or a description of the step if function is specified
+			step_number (int): step number used by --only-step, --start-with-step and --end-with-step
+			inputs (list): paths of files that this step reads
+			outputs (list): paths of files that this step writes, moves, or deletes
+			cpus (int): number of CPU slots this step occupies while it runs
+			memory_gb (float): amount of memory this step is expected to use at its peak
+			function (callable): optional python function to call instead of running the command in a shell
+		"""
+		self.command = command
+		self.step_number = step_number
+		self.cwd = os.getcwd()
+		self.inputs = [os.path.abspath(os.path.join(self.cwd, p)) for p in inputs if p]
+		self.outputs = [os.path.abspath(os.path.join(self.cwd, p)) for p in outputs if p]
+		self.cpus = max(1, cpus)
+		self.memory_gb = memory_gb
+		self.function = function
+		self.dependencies = []
+
+	def __str__(self):
+		return f"STEP #{self.step_number}: {self.command}" if self.step_number is not None else self.command
+
+
+class StepGraph:
+	"""Collects steps in the order they are declared and infers the dependencies between them"""
+
+	def __init__(self):
+		self.steps = []
+		self._last_writer = {}
+		self._readers_since_last_write = collections.defaultdict(list)
+
+	def add_step(self, step):
+		dependencies = []
+		for path in step.inputs:
+			if path in self._last_writer:
+				dependencies.append(self._last_writer[path])
+
+		for path in step.outputs:
+			if path in self._last_writer:
+				dependencies.append(self._last_writer[path])
+			dependencies.extend(self._readers_since_last_write[path])
+
+		step.dependencies = [d for d in dict.fromkeys(dependencies) if d is not step]
+
+		for path in step.inputs:
+			self._readers_since_last_write[path].append(step)
+		for path in step.outputs:
+			self._last_writer[path] = step
+			self._readers_since_last_write[path] = []
+
+		self.steps.append(step)
+		return step
+
+	def __len__(self):
+		return len(self.steps)
+
+	def clear(self):
+		self.__init__()
+
+	def compute_levels(self):
+		"""Returns a dictionary that maps each step to its depth in the graph. Steps at the same depth don't depend on
+		each other and can run at the same time."""
+		levels = {}
+		for step in self.steps:
+			levels[step] = 1 + max((levels[d] for d in step.dependencies), default=-1)
+		return levels
+
+
+class StepScheduler:
+	"""Runs the steps in a StepGraph, starting each step as soon as its dependencies have completed and enough CPU and
+	memory slots are free."""
+
+	def __init__(self, max_parallel_steps=1, total_cpus=None, total_memory_gb=None, dry_run=False, step_cache=None,
+				 telemetry=None):
+		"""Args:
+			max_parallel_steps (int): maximum number of steps to run at the same time
+			total_cpus (int): number of CPU slots shared by all running steps
+			total_memory_gb (float): amount of memory shared by all running steps
+			dry_run (bool): print steps without running them
+			step_cache (StepCache): if specified, skip steps whose results are already in this cache
+			telemetry (StepTelemetry): if specified, record the resource usage of each step
+		"""
+		self.max_parallel_steps = max(1, max_parallel_steps)
+		self.total_cpus = total_cpus or os.cpu_count() or 1
+		self.total_memory_gb = total_memory_gb or get_total_memory_gb()
+		self.dry_run = dry_run
+		self.step_cache = step_cache
+		self.telemetry = telemetry
+		self._print_lock = threading.Lock()
+
+	def run(self, step_graph, should_run_step=lambda step: True):
+		"""Run all steps in the graph.
+
+		Args:
+			step_graph (StepGraph): the steps to run
+			should_run_step (callable): called with each step to decide whether to run it. Steps that are not run are
+				treated as already completed, so their outputs are assumed to exist from a previous run.
+		"""
+		steps_to_run = [step for step in step_graph.steps if should_run_step(step)]
+		if self.dry_run:
+			levels = step_graph.compute_levels()
+			for step in sorted(steps_to_run, key=lambda s: levels[s]):
+				print(f"[parallel group {levels[step]}] {step}")
+			return
+
+		remaining = set(steps_to_run)
+		completed = set(step_graph.steps) - remaining
+		running = {}
+		failures = []
+		finished_condition = threading.Condition()
+		cpus_in_use = memory_gb_in_use = 0
+
+		def run_in_thread(step):
+			error = None
+			try:
+				self._run_step(step)
+			except BaseException as e:
+				error = e
+
+			with finished_condition:
+				running.pop(step)
+				if error is not None:
+					failures.append((step, error))
+				else:
+					completed.add(step)
+				finished_condition.notify()
+
+		with finished_condition:
+			while remaining or running:
+				if not failures:
+					for step in [s for s in steps_to_run if s in remaining]:
+						if len(running) >= self.max_parallel_steps:
+							break
+						if not all(d in completed for d in step.dependencies):
+							continue
+						if running and (
+							cpus_in_use + step.cpus > self.total_cpus or
+							memory_gb_in_use + step.memory_gb > self.total_memory_gb
+						):
+							continue
+
+						remaining.remove(step)
+						running[step] = threading.Thread(target=run_in_thread, args=(step,), daemon=True)
+						cpus_in_use += step.cpus
+						memory_gb_in_use += step.memory_gb
+						running[step].start()
+
+				if not running:
+					if remaining and not failures:
+						raise RuntimeError(f"Unable to schedule {len(remaining)} step(s) because of unmet dependencies")
+					break
+
+				running_before = set(running)
+				finished_condition.wait()
+				for step in running_before - set(running):
+					cpus_in_use -= step.cpus
+					memory_gb_in_use -= step.memory_gb
+
+		if failures:
+			step, error = failures[0]
+			print(f"ERROR: {step} failed: {error}")
+			raise error
+
+	def _run_step(self, step):
+		start_time = time.time()
+		if self.step_cache is not None and self.step_cache.get_cached_manifest(step) is not None:
+			with self._print_lock:
+				print(f"{step}  [SKIPPING - outputs are unchanged since the last run with the same inputs]", flush=True)
+			if self.telemetry is not None:
+				self.telemetry.add_record(step, "cached", start_time=start_time)
+			return
+
+		with self._print_lock:
+			print(step, flush=True)
+
+		try:
+			usage = self._execute(step)
+		except BaseException:
+			if self.telemetry is not None:
+				self.telemetry.add_record(
+					step, "failed", usage={"wall_seconds": round(time.time() - start_time, 3)}, start_time=start_time)
+			raise
+
+		if self.step_cache is not None:
+			self.step_cache.record(step)
+		if self.telemetry is not None:
+			self.telemetry.add_record(step, "completed", usage=usage, start_time=start_time)
+
+	def _execute(self, step):
+		"""Runs the step and returns its resource usage"""
+		if step.function is not None:
+			return run_function(step.function)
+
+		if self.max_parallel_steps == 1:
+			return run_shell_command(step.command, cwd=step.cwd)
+
+		# prefix each line of output with the step number so that output from parallel steps can be told apart
+		prefix = f"[STEP #{step.step_number}] " if step.step_number is not None else ""
+		return run_shell_command(step.command, cwd=step.cwd, output_prefix=prefix, print_lock=self._print_lock)
+
+
+def get_total_memory_gb():
+	"""Returns the total physical memory of this machine in GB, or infinity if it can't be determined"""
+	try:
+		return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+	except (ValueError, OSError, AttributeError):
+		return float("inf")
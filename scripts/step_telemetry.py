@@ -0,0 +1,224 @@
+"""Resource usage telemetry for pipeline steps.
+
+For each step, this records wall time, CPU time, peak memory (RSS), bytes read and written, and optionally the number
+of records in each output file. Subprocesses are measured using os.wait4 so that the numbers reflect the step's own
+process tree even when several steps run in parallel. The results are written to JSON and TSV reports that can be
+compared against the report from a previous run to find bottlenecks and catch performance regressions.
+"""
+
+import collections
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+REPORT_COLUMNS = [
+	"step_number", "label", "status", "start_time", "wall_seconds", "user_cpu_seconds", "system_cpu_seconds",
+	"peak_rss_mb", "input_bytes", "output_bytes", "block_io_read_bytes", "block_io_write_bytes", "output_records",
+	"command",
+]
+
+# wall time increases larger than this fraction (and larger than MIN_REGRESSION_SECONDS) are reported as regressions
+REGRESSION_THRESHOLD = 0.2
+MIN_REGRESSION_SECONDS = 60
+
+
+def run_shell_command(command, cwd=None, output_prefix=None, print_lock=None):
+	"""Run a shell command and return its resource usage.
+
+	Args:
+		command (str): shell command
+		cwd (str): working directory for the command
+		output_prefix (str): if specified, each line of the command's output will be printed with this prefix
+		print_lock (threading.Lock): lock to hold while printing prefixed output lines
+
+	Return:
+		dict: resource usage of the command and all its child processes
+	"""
+	start_time = time.time()
+	if output_prefix is None:
+		process = subprocess.Popen(command, shell=True, cwd=cwd)
+	else:
+		process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+								   text=True, bufsize=1)
+		for line in process.stdout:
+			with print_lock or threading.Lock():
+				sys.stdout.write(output_prefix + line)
+				sys.stdout.flush()
+
+	# use wait4 rather than process.wait() to get the resource usage of this specific process tree
+	_, wait_status, rusage = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(wait_status)
+	usage = convert_rusage_to_dict(rusage)
+	usage["wall_seconds"] = round(time.time() - start_time, 3)
+	if process.returncode != 0:
+		raise subprocess.CalledProcessError(process.returncode, command)
+
+	return usage
+
+
+def run_function(function):
+	"""Call a python function in the current thread and return its resource usage"""
+	start_time = time.time()
+	rusage_before = resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF))
+	function()
+	rusage_after = resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF))
+
+	usage = convert_rusage_to_dict(rusage_after)
+	before = convert_rusage_to_dict(rusage_before)
+	for key in "user_cpu_seconds", "system_cpu_seconds", "block_io_read_bytes", "block_io_write_bytes":
+		usage[key] = round(usage[key] - before[key], 3)
+	usage["wall_seconds"] = round(time.time() - start_time, 3)
+	return usage
+
+
+def convert_rusage_to_dict(rusage):
+	maxrss_bytes = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+	return {
+		"user_cpu_seconds": round(rusage.ru_utime, 3),
+		"system_cpu_seconds": round(rusage.ru_stime, 3),
+		"peak_rss_mb": round(maxrss_bytes / 2**20, 1),
+		"block_io_read_bytes": rusage.ru_inblock * 512,
+		"block_io_write_bytes": rusage.ru_oublock * 512,
+	}
+
+
+def count_records(path):
+	"""Returns the number of records in a catalog file: loci in a JSON catalog, or data rows in a BED or TSV file"""
+	fopen = gzip.open if path.endswith("gz") else open
+	if ".json" in path:
+		count = 0
+		with fopen(path, "rb") as f:
+			# count LocusId keys instead of parsing the JSON since this is much faster. The last few bytes of each chunk
+			# are carried over to the next chunk in case a key is split across chunks.
+			previous_tail = b""
+			for chunk in iter(lambda: f.read(2**24), b""):
+				data = previous_tail + chunk
+				count += data.count(b'"LocusId"')
+				previous_tail = data[-(len(b'"LocusId"') - 1):]
+		return count
+
+	if ".bed" in path or ".tsv" in path or ".txt" in path:
+		with fopen(path, "rb") as f:
+			count = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(2**24), b""))
+		return count - 1 if ".tsv" in path else count
+
+	return None
+
+
+def get_step_label(step):
+	"""Returns a label that identifies a step across runs (unlike the command, it doesn't include absolute paths)"""
+	if step.function is not None:
+		tool = step.function.__name__
+	else:
+		tokens = step.command.split()
+		tool = tokens[0] if tokens else ""
+		for i, token in enumerate(tokens):
+			if token == "-m" and i + 1 < len(tokens):
+				tool = tokens[i + 1]
+				break
+			if token.endswith(".py"):
+				tool = os.path.basename(token)
+				break
+
+	if step.outputs:
+		return f"{tool} => {os.path.basename(step.outputs[0])}"
+	if step.inputs:
+		return f"{tool} <= {os.path.basename(step.inputs[0])}"
+	return tool
+
+
+class StepTelemetry:
+	"""Collects resource usage records for all steps and subprocesses run during a pipeline run"""
+
+	def __init__(self, count_output_records=False):
+		self.count_output_records = count_output_records
+		self.records = []
+		self._label_counts = collections.Counter()
+		self._lock = threading.Lock()
+
+	def add_record(self, step, status, usage=None, start_time=None):
+		"""Record the resource usage of a step.
+
+		Args:
+			step (Step): the step
+			status (str): "completed", "cached", or "failed"
+			usage (dict): resource usage returned by run_shell_command or run_function
+			start_time (float): the time when the step started
+		"""
+		record = {
+			"step_number": step.step_number,
+			"status": status,
+			"start_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time or time.time())),
+			"input_bytes": sum(os.path.getsize(p) for p in step.inputs if os.path.isfile(p)),
+			"output_bytes": sum(os.path.getsize(p) for p in step.outputs if os.path.isfile(p)),
+			"command": step.command,
+		}
+		record.update(usage or {})
+		if self.count_output_records and status == "completed":
+			counts = [count_records(p) for p in step.outputs if os.path.isfile(p)]
+			counts = [c for c in counts if c is not None]
+			record["output_records"] = sum(counts) if counts else None
+
+		with self._lock:
+			label = get_step_label(step)
+			self._label_counts[label] += 1
+			if self._label_counts[label] > 1:
+				label += f" #{self._label_counts[label]}"
+			record["label"] = label
+			self.records.append(record)
+
+	def write_report(self, output_prefix):
+		"""Write the telemetry records to {output_prefix}.json and {output_prefix}.tsv"""
+		with self._lock:
+			records = list(self.records)
+
+		with open(f"{output_prefix}.json", "wt") as f:
+			json.dump(records, f, indent=1)
+
+		with open(f"{output_prefix}.tsv", "wt") as f:
+			f.write("\t".join(REPORT_COLUMNS) + "\n")
+			for record in records:
+				f.write("\t".join(
+					"" if record.get(c) is None else str(record[c]).replace("\t", " ").replace("\n", " ")
+					for c in REPORT_COLUMNS
+				) + "\n")
+
+		print(f"Wrote telemetry for {len(records):,d} steps to {output_prefix}.json and {output_prefix}.tsv")
+
+	def print_comparison(self, previous_report_path):
+		"""Print per-step wall time, CPU time and peak memory compared to the report from a previous run"""
+		with open(previous_report_path, "rt") as f:
+			previous_records = {r["label"]: r for r in json.load(f) if r.get("status") == "completed"}
+
+		print(f"Comparing step telemetry to {previous_report_path}:")
+		print(f"{'step':>5}  {'wall time':>21}  {'CPU time':>21}  {'peak RSS (MB)':>21}  step")
+		regressions = 0
+		for record in self.records:
+			previous = previous_records.get(record["label"])
+			if record["status"] != "completed" or previous is None:
+				continue
+
+			cpu_seconds = record["user_cpu_seconds"] + record["system_cpu_seconds"]
+			previous_cpu_seconds = previous["user_cpu_seconds"] + previous["system_cpu_seconds"]
+			is_regression = (
+				record["wall_seconds"] - previous["wall_seconds"] > max(MIN_REGRESSION_SECONDS,
+																		 REGRESSION_THRESHOLD * previous["wall_seconds"])
+			)
+			regressions += is_regression
+			print(f"{record['step_number'] if record['step_number'] is not None else '':>5}  "
+				  f"{format_seconds(previous['wall_seconds']):>9} => {format_seconds(record['wall_seconds']):>9}  "
+				  f"{format_seconds(previous_cpu_seconds):>9} => {format_seconds(cpu_seconds):>9}  "
+				  f"{previous['peak_rss_mb']:>9,.0f} => {record['peak_rss_mb']:>9,.0f}  "
+				  f"{record['label']}" + ("  <== REGRESSION" if is_regression else ""))
+
+		if regressions:
+			print(f"WARNING: {regressions} step(s) took more than {REGRESSION_THRESHOLD:.0%} longer than in the previous run")
+
+
+def format_seconds(seconds):
+	return f"{seconds//3600:.0f}h{(seconds%3600)//60:02.0f}m{seconds%60:02.0f}s"
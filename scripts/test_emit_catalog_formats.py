@@ -0,0 +1,88 @@
+"""Check that emit_catalog_formats.py writes the same TRGT, LongTR, HipSTR and GangSTR catalogs as the str_analysis
+converters that it replaced. Run with: python -m pytest scripts/test_emit_catalog_formats.py
+"""
+
+import importlib
+import os
+import shutil
+
+import pytest
+
+from catalog_io import CatalogWriter
+from emit_catalog_formats import BedWriter, GangSTRWriter, HipSTRWriter, LongTRWriter, TRGTWriter, emit_catalog_formats
+
+TEST_RECORDS = [
+	{"LocusId": "1-100-110-CAG", "ReferenceRegion": "chr1:100-110", "LocusStructure": "(CAG)*", "VariantType": "Repeat"},
+	{"LocusId": "1-200-201-A", "ReferenceRegion": "chr1:200-201", "LocusStructure": "(A)*", "VariantType": "Repeat"},
+	{"LocusId": "1-300-350-AAAAGAAAAGAA", "ReferenceRegion": "chr1:300-350", "LocusStructure": "(AAAAGAAAAGAA)*",
+	 "VariantType": "Repeat"},
+	{"LocusId": "ADJACENT", "ReferenceRegion": ["chr1:400-415", "chr1:415-427"], "LocusStructure": "(CAG)*(CCG)*",
+	 "VariantType": ["Repeat", "RareRepeat"], "OfftargetRegions": ["chr2:10-20", "chr3:30-40"]},
+	{"LocusId": "ADJ", "ReferenceRegion": ["chr1:500-501", "chr1:501-527"], "LocusStructure": "(A)*(CAG)*",
+	 "VariantType": ["Repeat", "Repeat"]},
+	{"LocusId": "RARE", "ReferenceRegion": "chr2:500-531", "LocusStructure": "(GGCCCC)*", "VariantType": "RareRepeat",
+	 "OfftargetRegions": ["chr5:10-20"]},
+	{"LocusId": "X-600-617-AT", "ReferenceRegion": "chrX:600-617", "LocusStructure": "(AT)*", "VariantType": "Repeat"},
+]
+
+
+def import_str_analysis_converter(format_name):
+	"""Returns the str_analysis module that converts ExpansionHunter catalogs to the given format. Older str_analysis
+	versions call these modules convert_expansion_hunter_variant_catalog_to_*."""
+	for prefix in "convert_expansion_hunter_catalog_to_", "convert_expansion_hunter_variant_catalog_to_":
+		try:
+			return importlib.import_module(f"str_analysis.{prefix}{format_name}")
+		except ImportError:
+			continue
+	pytest.skip(f"str_analysis {format_name} converter isn't installed")
+
+
+@pytest.fixture
+def catalog_path(tmp_path):
+	path = os.path.join(tmp_path, "catalog.json.gz")
+	with CatalogWriter(path) as writer:
+		for record in TEST_RECORDS:
+			writer.write(record)
+	return path
+
+
+@pytest.mark.parametrize("format_name, writer_class", [
+	("longtr_format", LongTRWriter),
+	("hipstr_format", HipSTRWriter),
+	("gangstr_spec", GangSTRWriter),
+])
+def test_output_matches_str_analysis_converter(tmp_path, catalog_path, format_name, writer_class):
+	converter = import_str_analysis_converter(format_name)
+	expected_path = os.path.join(tmp_path, "expected.bed")
+	converter.process_variant_catalog(catalog_path, expected_path)
+
+	output_path = os.path.join(tmp_path, "output.bed")
+	emit_catalog_formats(catalog_path, [writer_class(output_path)])
+
+	with open(expected_path, "rb") as expected, open(output_path, "rb") as output:
+		assert output.read() == expected.read()
+
+
+def test_trgt_output_matches_str_analysis_converter(tmp_path, catalog_path):
+	converter = import_str_analysis_converter("trgt_catalog")
+	# the converter sorts its output with bedtools. TEST_RECORDS are already in bedtools' chromosome order.
+	if shutil.which("bedtools") is None:
+		pytest.skip("bedtools isn't installed")
+	expected_path = os.path.join(tmp_path, "expected.bed")
+	converter.process_expansion_hunter_catalog(catalog_path, expected_path, split_adjacent_repeats=True)
+
+	output_path = os.path.join(tmp_path, "output.bed")
+	emit_catalog_formats(catalog_path, [TRGTWriter(output_path)])
+
+	with open(expected_path, "rb") as expected, open(output_path, "rb") as output:
+		assert output.read() == expected.read()
+
+
+def test_sorted_output_requires_contiguous_chromosomes(tmp_path):
+	catalog_path = os.path.join(tmp_path, "catalog.json.gz")
+	with CatalogWriter(catalog_path) as writer:
+		for record in TEST_RECORDS[0], TEST_RECORDS[5], TEST_RECORDS[1]:
+			writer.write(record)
+
+	with pytest.raises(RuntimeError, match="chr1 loci aren't all next to each other"):
+		emit_catalog_formats(catalog_path, [BedWriter(os.path.join(tmp_path, "output.bed.gz"))])
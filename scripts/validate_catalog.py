@@ -6,6 +6,9 @@ import json
 from str_analysis.utils.misc_utils import parse_interval
 from str_analysis.utils.eh_catalog_utils import get_variant_catalog_iterator
 
+from catalog_io import is_arrow_path, iterate_catalog_records
+from profiling import add_profiling_arguments, run_main
+
 EXPECTED_KEYS_IN_ANNOTATED_CATALOG = {
 	"ReferenceRegion": str,
 	"LocusStructure": str,
@@ -48,6 +51,7 @@ def main():
 						"containing known pathogenic loci. This is used to retrieve the original locus boundaries for "
 						"these loci since their IDs don't contain these coordinates the way that IDs of other loci do.")
 	parser.add_argument("simple_repeat_catalog_path")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	known_disease_loci_catalog = parse_known_pathogenic_loci(args.known_pathogenic_loci_json_path)
@@ -67,7 +71,10 @@ def main():
 	locus_ids = set()
 	reference_regions = set()
 
-	input_file_iterator = get_variant_catalog_iterator(args.simple_repeat_catalog_path)
+	if is_arrow_path(args.simple_repeat_catalog_path):
+		input_file_iterator = iterate_catalog_records(args.simple_repeat_catalog_path, use_float=True)
+	else:
+		input_file_iterator = get_variant_catalog_iterator(args.simple_repeat_catalog_path)
 	for i, record in enumerate(input_file_iterator):
 		if not record["ReferenceRegion"].startswith("chr"):
 			print(f"ERROR: ReferenceRegion {record['ReferenceRegion']} does not start with 'chr'")
@@ -123,4 +130,4 @@ def main():
 	print(f"Done. Catalog passed validation.")
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	run_main(main)
\ No newline at end of file
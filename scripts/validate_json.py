@@ -2,32 +2,31 @@
 of dictionaries that have the required keys."""
 
 import argparse
-import ijson
-import gzip
 import os
 
+from catalog_io import iterate_catalog_records
+from profiling import add_profiling_arguments, run_main
+
 def failed_validation(json_path, keys=None):
 	keys = set(keys) if keys is not None else set()
 	error_counter =	total = 0
-	fopen = gzip.open if json_path.endswith("gz") else open
-	with fopen(json_path, "rb") as f:
-		parser = ijson.items(f, "item", use_float=True)
-		for i, record in enumerate(parser):
-			total += 1
-			if not isinstance(record, dict):
-				print(f"ERROR: record #{i + 1} is not a dictionary: {record}")
+	# the ijson backend yields list items that aren't dictionaries instead of raising an error, so they can be reported
+	for i, record in enumerate(iterate_catalog_records(json_path, use_float=True, backend="ijson")):
+		total += 1
+		if not isinstance(record, dict):
+			print(f"ERROR: record #{i + 1} is not a dictionary: {record}")
+			error_counter += 1
+			if error_counter >= 50:
+				return error_counter, total
+
+		if keys:
+			missing_keys = keys - set(record.keys())
+			if missing_keys:
+				print(f"ERROR: {', '.join(keys)} key(s) are missing in record #{i + 1}: {record}")
 				error_counter += 1
 				if error_counter >= 50:
 					return error_counter, total
 
-			if keys:
-				missing_keys = keys - set(record.keys())
-				if missing_keys:
-					print(f"ERROR: {', '.join(keys)} key(s) are missing in record #{i + 1}: {record}")
-					error_counter += 1
-					if error_counter >= 50:
-						return error_counter, total
-
 	return error_counter, total
 
 
@@ -35,6 +34,7 @@ def main():
 	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
 	parser.add_argument("-k", "--key", action="append", help="Key to check for in each record")
 	parser.add_argument("json_path", help="Path of the JSON file to validate")
+	add_profiling_arguments(parser)
 	args = parser.parse_args()
 
 	if not os.path.isfile(args.json_path):
@@ -49,4 +49,4 @@ def main():
 
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	run_main(main)
\ No newline at end of file
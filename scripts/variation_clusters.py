@@ -0,0 +1,217 @@
+"""Parse the variation clusters BED file once and share it between the steps that use it.
+
+The variation clusters BED file is used to add VariationCluster annotations to the catalog (see
+add_variation_cluster_annotations_to_catalog.py), to generate the variation clusters and isolated TRs catalog (see
+add_isolated_loci_to_variation_cluster_catalog.py), and to generate LongTR versions of both (see
+convert_trgt_catalog_to_longtr_format.py). VariationClusterTable stores the parsed BED file in columns, so that all of
+these can be produced from a single parse of the BED file and a single pass through the catalog.
+"""
+
+import array
+import collections
+import numpy as np
+import tqdm
+
+from str_analysis.utils.misc_utils import parse_interval
+
+from bgzf_io import DEFAULT_THREADS, open_file
+from catalog_io import iterate_catalog_records
+from diagnostics import Diagnostics
+from locus_key import LOCUS_KEY_DTYPE, encode_locus_id
+
+MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD = 6
+
+
+def parse_known_pathogenic_reference_regions(known_pathogenic_loci_json_path):
+	"""Returns a dictionary that maps the LocusId or VariantId of each known pathogenic locus to its ReferenceRegion"""
+	print(f"Parsing {known_pathogenic_loci_json_path}")
+	known_pathogenic_reference_regions_lookup = {}
+	for locus in iterate_catalog_records(known_pathogenic_loci_json_path):
+		if isinstance(locus["ReferenceRegion"], list):
+			assert isinstance(locus["VariantId"], list)
+			assert len(locus["ReferenceRegion"]) == len(locus["VariantId"])
+			for variant_id, reference_region in zip(locus["VariantId"], locus["ReferenceRegion"]):
+				known_pathogenic_reference_regions_lookup[variant_id] = reference_region
+		else:
+			known_pathogenic_reference_regions_lookup[locus["LocusId"]] = locus["ReferenceRegion"]
+
+	return known_pathogenic_reference_regions_lookup
+
+
+def parse_info_fields(fields, diagnostics=None):
+	"""Returns a dictionary of the key=value pairs in the 4th column of a TRGT BED row
+
+	Args:
+		fields (list): the columns of the BED row
+		diagnostics (Diagnostics): if specified, invalid key-value pairs are reported here instead of being printed
+	"""
+	info_fields_dict = {}
+	for key_value in fields[3].split(";"):
+		key_value = key_value.split("=")
+		if len(key_value) != 2:
+			message = f"skipping invalid key-value pair '{key_value}' in line {fields}"
+			if diagnostics is None:
+				print(f"WARNING: {message}")
+			else:
+				diagnostics.report("skipped invalid key-value pairs", message)
+			continue
+		key, value = key_value
+		info_fields_dict[key] = value
+
+	return info_fields_dict
+
+
+class VariationClusterStats:
+	"""Counts how many of the loci in each variation cluster differ from the variation cluster boundaries by at least
+	MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD bases"""
+
+	def __init__(self, diagnostics=None):
+		"""Args:
+			diagnostics (Diagnostics): where to report loci that the variation clusters don't change, and invalid BED
+				rows. If not specified, a new Diagnostics object is created.
+		"""
+		self.counters = collections.Counter()
+		self.size_diff_histogram = collections.Counter()
+		self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+
+	def print_stats(self):
+		input_variation_clusters_counter = self.counters["input_variation_clusters"]
+		input_locus_ids_counter = self.counters["input_locus_ids"]
+		almost_no_change_to_boundaries = self.counters["almost_no_change_to_boundaries"]
+		output_variation_clusters_counter = self.counters["output_variation_clusters"]
+		locus_ids_in_variation_cluster_above_threshold = self.counters["locus_ids_above_threshold"]
+		print(f"Parsed {input_variation_clusters_counter:,d} variation clusters that contained {input_locus_ids_counter:,d} simple TR ids")
+		if almost_no_change_to_boundaries:
+			print(f"Found {almost_no_change_to_boundaries:,d} out of {input_variation_clusters_counter:,d} "
+				  f"({almost_no_change_to_boundaries/input_variation_clusters_counter:.1%}) "
+				  f"variation clusters that did not change the original locus boundaries "
+				  f"by {MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD} bases or more")
+			print(f"These contained {input_locus_ids_counter - locus_ids_in_variation_cluster_above_threshold:,d} out of {input_locus_ids_counter:,d} "
+				  f"({(input_locus_ids_counter - locus_ids_in_variation_cluster_above_threshold)/input_locus_ids_counter:.1%}) locus IDs")
+		print(f"Found {output_variation_clusters_counter:,d} out of {input_variation_clusters_counter:,d} "
+			  f"({output_variation_clusters_counter/input_variation_clusters_counter:.1%}) variation clusters "
+			  f"differed from simple TRs by at least {MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD}bp")
+		self.diagnostics.print_summary()
+
+
+def iterate_variation_clusters(variation_clusters_bed_path, known_pathogenic_reference_regions_lookup, stats,
+							   threads=DEFAULT_THREADS, show_progress_bar=False):
+	"""Yields a (chrom, start_0based, end_1based, line, locus_ids, locus_id_to_size_diff) tuple for each variation
+	cluster, where line is the BED row and locus_id_to_size_diff contains the loci whose boundaries differ from the
+	variation cluster boundaries by at least MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD bases
+
+	Args:
+		variation_clusters_bed_path (str): path of the variation clusters BED file
+		known_pathogenic_reference_regions_lookup (dict): see parse_known_pathogenic_reference_regions
+		stats (VariationClusterStats): updated with the variation clusters as they are parsed
+		threads (int): number of decompression threads
+		show_progress_bar (bool): show a progress bar
+	"""
+	with open_file(variation_clusters_bed_path, "rt", threads=threads) as f:
+		if show_progress_bar:
+			f = tqdm.tqdm(f, unit=" records", unit_scale=True)
+
+		for line in f:
+			stats.counters["input_variation_clusters"] += 1
+			fields = line.strip("\n").split("\t")
+			chrom = fields[0]
+			start_0based = int(fields[1])
+			end_1based = int(fields[2])
+			info_fields_dict = parse_info_fields(fields, stats.diagnostics)
+
+			locus_ids = info_fields_dict["ID"].split(",")
+			locus_id_to_size_diff = {}
+			region = f"{chrom.replace('chr', '')}:{start_0based}-{end_1based}"
+			for locus_id in locus_ids:
+				stats.counters["input_locus_ids"] += 1
+				if locus_id in known_pathogenic_reference_regions_lookup:
+					region2 = known_pathogenic_reference_regions_lookup[locus_id]
+					original_chrom, original_start_0based, original_end_1based = parse_interval(region2)
+				elif locus_id.count("-") == 3:
+					original_chrom, original_start_0based, original_end_1based, _ = locus_id.split("-")
+				else:
+					raise ValueError(f"Unexpected locus_id '{locus_id}'")
+
+				original_start_0based = int(original_start_0based)
+				original_end_1based = int(original_end_1based)
+
+				if abs(end_1based - original_end_1based) < MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD and abs(original_start_0based - start_0based) < MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD:
+					stats.counters["almost_no_change_to_boundaries"] += 1
+					stats.diagnostics.report(
+						f"loci whose variation cluster boundaries differ from theirs by less than {MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD}bp",
+						f"VC:{region} and locus:{locus_id}")
+				else:
+					size_diff = abs(end_1based - original_end_1based) + abs(original_start_0based - start_0based)
+					locus_id_to_size_diff[locus_id] = size_diff
+					stats.size_diff_histogram[size_diff] += 1
+
+			if locus_id_to_size_diff:
+				stats.counters["output_variation_clusters"] += 1
+				stats.counters["locus_ids_above_threshold"] += len(locus_id_to_size_diff)
+
+			yield chrom, start_0based, end_1based, line, locus_ids, locus_id_to_size_diff
+
+
+class VariationClusterTable:
+	"""The variation clusters BED file, stored in columns.
+
+	Each variation cluster has a row in the chrom_ids, starts, ends and lines columns. Each locus in a variation cluster
+	has a row in the locus_keys, locus_variation_clusters and locus_size_diffs columns, in the order they appear in the
+	BED file. locus_size_diffs is -1 for loci whose boundaries differ from the variation cluster boundaries by less than
+	MINIMUM_CHANGE_TO_BOUNDARIES_THRESHOLD bases.
+	"""
+
+	def __init__(self, variation_clusters_bed_path, known_pathogenic_reference_regions_lookup, threads=DEFAULT_THREADS,
+				 show_progress_bar=False, diagnostics=None):
+		self.variation_clusters_bed_path = variation_clusters_bed_path
+		self.known_pathogenic_reference_regions_lookup = known_pathogenic_reference_regions_lookup
+		self.stats = VariationClusterStats(diagnostics)
+
+		chrom_ids = {}
+		variation_cluster_chrom_ids = array.array("H")
+		variation_cluster_starts = array.array("q")
+		variation_cluster_ends = array.array("q")
+		self.lines = []
+		locus_key_positions = array.array("Q")
+		locus_key_motifs = array.array("Q")
+		locus_variation_clusters = array.array("q")
+		locus_size_diffs = array.array("q")
+		print(f"Parsing {variation_clusters_bed_path}")
+		for chrom, start_0based, end_1based, line, locus_ids, locus_id_to_size_diff in iterate_variation_clusters(
+				variation_clusters_bed_path, known_pathogenic_reference_regions_lookup, self.stats, threads=threads,
+				show_progress_bar=show_progress_bar):
+			variation_cluster_index = len(self.lines)
+			variation_cluster_chrom_ids.append(chrom_ids.setdefault(chrom, len(chrom_ids)))
+			variation_cluster_starts.append(start_0based)
+			variation_cluster_ends.append(end_1based)
+			self.lines.append(line if line.endswith("\n") else f"{line}\n")
+			for locus_id in locus_ids:
+				locus_key_position, locus_key_motif = encode_locus_id(locus_id)
+				locus_key_positions.append(locus_key_position)
+				locus_key_motifs.append(locus_key_motif)
+				locus_variation_clusters.append(variation_cluster_index)
+				locus_size_diffs.append(locus_id_to_size_diff.get(locus_id, -1))
+
+		self.chroms = list(chrom_ids)
+		self.chrom_ids = np.frombuffer(variation_cluster_chrom_ids, dtype=np.uint16)
+		self.starts = np.frombuffer(variation_cluster_starts, dtype=np.int64)
+		self.ends = np.frombuffer(variation_cluster_ends, dtype=np.int64)
+		self.locus_keys = np.empty(len(locus_key_positions), dtype=LOCUS_KEY_DTYPE)
+		self.locus_keys["position"] = np.frombuffer(locus_key_positions, dtype=np.uint64)
+		self.locus_keys["motif"] = np.frombuffer(locus_key_motifs, dtype=np.uint64)
+		self.locus_variation_clusters = np.frombuffer(locus_variation_clusters, dtype=np.int64)
+		self.locus_size_diffs = np.frombuffer(locus_size_diffs, dtype=np.int64)
+
+	def __len__(self):
+		return len(self.lines)
+
+	def iterate_locus_ids(self):
+		"""Yields the locus ids of all loci in the order of the locus_* columns. These are only kept as locus keys, so
+		this parses them from the BED rows again."""
+		for line in self.lines:
+			yield from parse_info_fields(line.strip("\n").split("\t"), Diagnostics())["ID"].split(",")
+
+	def get_region(self, variation_cluster_index):
+		"""Returns the variation cluster's interval in "chrom:start_0based-end" format, without the "chr" prefix"""
+		chrom = self.chroms[self.chrom_ids[variation_cluster_index]].replace("chr", "")
+		return f"{chrom}:{self.starts[variation_cluster_index]}-{self.ends[variation_cluster_index]}"